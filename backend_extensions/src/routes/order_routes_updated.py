@@ -7,13 +7,16 @@ from typing import Optional, List
 from datetime import datetime
 from routes.auth_routes import get_current_active_user
 from routes.websocket_routes import notify_order_update, notify_new_order
-import random
-import string
+import os
+import sys
 
-router = APIRouter(prefix="/api/orders", tags=["订单管理"])
+# 复用主工程 src/services/id_generator 生成订单号
+# （追加到 sys.path 末尾，避免覆盖本工程自己的 storage 包）
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
+
+from services.id_generator import next_order_number
 
-def generate_order_number():
-    return "ORD" + datetime.now().strftime("%Y%m%d%H%M%S") + ''.join(random.choices(string.digits, k=4))
+router = APIRouter(prefix="/api/orders", tags=["订单管理"])
 
 class OrderItemCreate(BaseModel):
     menu_item_id: int
@@ -124,7 +127,7 @@ def create_order(
     if not store:
         raise HTTPException(status_code=404, detail="店铺不存在")
     
-    order_number = generate_order_number()
+    order_number = next_order_number(order_data.store_id)
     total_amount = 0.0
     
     new_order = Order(
@@ -183,10 +183,22 @@ async def batch_print_receipts(
     
     results = []
     
+    # 订单和订单项各一条查询取回，不再逐单查询
+    orders = {
+        order.id: order
+        for order in db.query(Order).filter(Order.id.in_(order_ids)).all()
+    } if order_ids else {}
+    items_by_order = {}
+    if orders:
+        for item in db.query(OrderItem).filter(
+            OrderItem.order_id.in_(list(orders))
+        ).order_by(OrderItem.order_id, OrderItem.id).all():
+            items_by_order.setdefault(item.order_id, []).append(item)
+    
     for order_id in order_ids:
-        order = db.query(Order).filter(Order.id == order_id).first()
+        order = orders.get(order_id)
         if order:
-            order_items = db.query(OrderItem).filter(OrderItem.order_id == order_id).all()
+            order_items = items_by_order.get(order_id, [])
             
             order_data = {
                 "order_number": order.order_number,
@@ -1,54 +1,36 @@
-from typing import Dict, Set
-from fastapi import WebSocket, WebSocketDisconnect
-import json
+from fastapi import WebSocket
+from datetime import datetime
 import logging
+import os
+import sys
+
+# 复用主工程 src/services/ws_hub 的连接管理与跨 worker 消息代理
+# （追加到 sys.path 末尾，避免覆盖本工程自己的 storage 包）
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+from services.ws_hub import ConnectionManager as HubConnectionManager
 
 logger = logging.getLogger(__name__)
 
-class ConnectionManager:
-    def __init__(self):
-        # 存储所有活跃的 WebSocket 连接
-        self.active_connections: Dict[str, Set[WebSocket]] = {}
-    
+class ConnectionManager(HubConnectionManager):
+    """按房间名管理连接，房间内的广播经 broker 转发到所有 worker"""
+
     async def connect(self, websocket: WebSocket, room: str):
         """连接到指定房间"""
-        await websocket.accept()
-        if room not in self.active_connections:
-            self.active_connections[room] = set()
-        self.active_connections[room].add(websocket)
-        logger.info(f"WebSocket connected to room: {room}, total: {len(self.active_connections[room])}")
-    
+        await self.join(room, websocket, connection_id=str(id(websocket)))
+
     def disconnect(self, websocket: WebSocket, room: str):
         """断开连接"""
-        if room in self.active_connections:
-            self.active_connections[room].discard(websocket)
-            if not self.active_connections[room]:
-                del self.active_connections[room]
-        logger.info(f"WebSocket disconnected from room: {room}")
-    
+        self.leave(room, str(id(websocket)))
+
     async def send_personal_message(self, message: str, websocket: WebSocket):
         """发送个人消息"""
         await websocket.send_text(message)
-    
+
     async def broadcast(self, message: dict, room: str):
         """向房间内所有连接广播消息"""
-        if room not in self.active_connections:
-            return
-        
-        message_str = json.dumps(message, ensure_ascii=False)
-        disconnected = set()
-        
-        for connection in self.active_connections[room]:
-            try:
-                await connection.send_text(message_str)
-            except Exception as e:
-                logger.error(f"Failed to send message: {e}")
-                disconnected.add(connection)
-        
-        # 清理断开的连接
-        for connection in disconnected:
-            self.active_connections[room].discard(connection)
-    
+        await self.publish([room], message)
+
     async def broadcast_order_update(self, order_id: int, status: str, room: str = "orders"):
         """广播订单更新"""
         await self.broadcast({
@@ -57,7 +39,7 @@ class ConnectionManager:
             "status": status,
             "timestamp": str(datetime.now())
         }, room)
-    
+
     async def broadcast_new_order(self, order_data: dict, room: str = "orders"):
         """广播新订单"""
         await self.broadcast({
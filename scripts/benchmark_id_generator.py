@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+订单号生成器吞吐基准
+模拟多 worker（多进程，每个进程不同的 worker ID）、每个 worker 多线程并发生成订单号，
+统计吞吐量，并检查全部订单号无重复、每个 worker 内严格递增。不访问数据库。
+
+用法：
+  python scripts/benchmark_id_generator.py
+  python scripts/benchmark_id_generator.py --workers 8 --threads 4 --count 200000
+"""
+
+import sys
+import os
+import argparse
+import time
+import threading
+from multiprocessing import Pool
+
+# 添加 src 目录到 Python 路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from services.id_generator import SnowflakeGenerator, MAX_WORKER_ID
+
+
+def run_worker(args):
+    """一个 worker 进程：threads 个线程共用一个生成器，共生成 count 个 ID"""
+    worker_id, threads, count = args
+    generator = SnowflakeGenerator(worker_id)
+    per_thread = count // threads
+    results = [None] * threads
+
+    def produce(slot):
+        next_id = generator.next_id
+        results[slot] = [next_id() for _ in range(per_thread)]
+
+    started = time.perf_counter()
+    pool = [threading.Thread(target=produce, args=(i,)) for i in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    ids = [value for chunk in results for value in chunk]
+    # 单线程时按生成顺序检查递增；多线程时检查排序后无重复即可
+    ordered = threads > 1 or all(a < b for a, b in zip(ids, ids[1:]))
+    return worker_id, ids, elapsed, ordered, generator.borrowed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="订单号生成器吞吐基准")
+    parser.add_argument("--workers", type=int, default=4, help="worker 进程数")
+    parser.add_argument("--threads", type=int, default=2, help="每个 worker 的线程数")
+    parser.add_argument("--count", type=int, default=100000, help="每个 worker 生成的 ID 数")
+    args = parser.parse_args()
+
+    if args.workers > MAX_WORKER_ID + 1:
+        print(f"❌ worker 数不能超过 {MAX_WORKER_ID + 1}")
+        sys.exit(1)
+
+    # 单线程基准
+    generator = SnowflakeGenerator(0)
+    started = time.perf_counter()
+    previous = -1
+    for _ in range(args.count):
+        value = generator.next_id()
+        if value <= previous:
+            print("❌ 单线程生成的 ID 未严格递增")
+            sys.exit(1)
+        previous = value
+    elapsed = time.perf_counter() - started
+    print(f"✓ 单线程: {args.count} 个 ID，{elapsed:.3f}s，{args.count / elapsed:,.0f} 个/秒")
+
+    # 多 worker 基准
+    tasks = [(worker_id, args.threads, args.count) for worker_id in range(args.workers)]
+    started = time.perf_counter()
+    with Pool(args.workers) as pool:
+        results = pool.map(run_worker, tasks)
+    wall = time.perf_counter() - started
+
+    all_ids = set()
+    total = 0
+    for worker_id, ids, elapsed, ordered, borrowed in results:
+        total += len(ids)
+        all_ids.update(ids)
+        print(f"  worker {worker_id}: {len(ids)} 个，{len(ids) / elapsed:,.0f} 个/秒，借用未来毫秒 {borrowed} 次")
+        if not ordered:
+            print(f"❌ worker {worker_id} 生成的 ID 未严格递增")
+            sys.exit(1)
+
+    print(f"✓ {args.workers} 个 worker × {args.threads} 线程: {total} 个 ID，{wall:.3f}s，{total / wall:,.0f} 个/秒")
+    if len(all_ids) != total:
+        print(f"❌ 出现重复 ID: {total - len(all_ids)} 个")
+        sys.exit(1)
+    print("\n✅ 全部 ID 唯一")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+数据库迁移脚本：每日营收汇总增量维护
+daily_revenue 表新增 paid_orders / paid_amount / cancelled_orders 字段，
+并添加 (store_id, date) 唯一约束供增量 upsert 使用
+"""
+
+import sys
+import os
+
+# 添加 src 目录到 Python 路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from sqlalchemy import text
+from storage.database.db import get_session
+
+def migrate():
+    """执行数据库迁移"""
+    print("开始执行数据库迁移：每日营收汇总增量维护...")
+
+    try:
+        session = get_session()
+
+        # 新增字段
+        print("新增 daily_revenue 字段...")
+        session.execute(text("""
+            ALTER TABLE daily_revenue
+                ADD COLUMN IF NOT EXISTS paid_orders INTEGER NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS paid_amount DOUBLE PRECISION NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS cancelled_orders INTEGER NOT NULL DEFAULT 0;
+        """))
+        print("✓ 字段添加成功")
+
+        # 清理重复的 (store_id, date) 行，只保留最新一行
+        print("清理重复的汇总行...")
+        result = session.execute(text("""
+            DELETE FROM daily_revenue a
+            USING daily_revenue b
+            WHERE a.store_id = b.store_id
+              AND a.date = b.date
+              AND a.id < b.id;
+        """))
+        print(f"✓ 删除重复行 {result.rowcount} 条")
+
+        # 添加唯一约束
+        print("添加 (store_id, date) 唯一约束...")
+        session.execute(text("""
+            DO $$
+            BEGIN
+                IF NOT EXISTS (
+                    SELECT 1 FROM pg_constraint WHERE conname = 'daily_revenue_store_date_key'
+                ) THEN
+                    ALTER TABLE daily_revenue
+                        ADD CONSTRAINT daily_revenue_store_date_key UNIQUE (store_id, date);
+                END IF;
+            END $$;
+        """))
+        print("✓ 唯一约束添加成功")
+
+        # 提交事务
+        session.commit()
+        print("\n✅ 数据库迁移成功完成！")
+        print("\n接下来回填历史汇总数据：")
+        print("  python scripts/rebuild_daily_revenue.py --start 2024-01-01")
+
+    except Exception as e:
+        print(f"\n❌ 数据库迁移失败: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
+    finally:
+        if 'session' in locals():
+            session.close()
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+"""
+数据库迁移脚本：订单号生成器 worker ID 租约
+创建 id_worker_leases 表。未配置 ID_WORKER_ID 的进程首次生成订单号 / 交易号时
+从该表租用一个未被占用的 worker ID，并在运行期间定期续租
+"""
+
+import sys
+import os
+
+# 添加 src 目录到 Python 路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from storage.database.db import get_engine
+from storage.database.shared.model import IdWorkerLeases
+
+def migrate():
+    """执行数据库迁移"""
+    print("开始执行数据库迁移：worker ID 租约...")
+
+    try:
+        print("创建 id_worker_leases 表...")
+        IdWorkerLeases.__table__.create(bind=get_engine(), checkfirst=True)
+        print("✓ 表创建成功")
+        print("\n✅ 数据库迁移成功完成！")
+
+    except Exception as e:
+        print(f"\n❌ 数据库迁移失败: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+数据库迁移脚本：积分兑换每日用量
+创建 point_exchange_daily_usage 表（(agreement_id, usage_date) 唯一），
+并按兑换日志回填已成功兑换的积分，兑换时的每日限额校验改为读写该表
+"""
+
+import sys
+import os
+
+# 添加 src 目录到 Python 路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from sqlalchemy import text
+from storage.database.db import get_engine, get_session
+from storage.database.shared.model import PointExchangeDailyUsage
+
+def migrate():
+    """执行数据库迁移"""
+    print("开始执行数据库迁移：积分兑换每日用量...")
+
+    try:
+        # 创建表
+        print("创建 point_exchange_daily_usage 表...")
+        PointExchangeDailyUsage.__table__.create(bind=get_engine(), checkfirst=True)
+        print("✓ 表创建成功")
+
+        session = get_session()
+
+        # 按协议、日期回填成功兑换的积分
+        print("回填每日用量...")
+        result = session.execute(text("""
+            INSERT INTO point_exchange_daily_usage (agreement_id, usage_date, points_used, exchange_count, updated_at)
+            SELECT agreement_id,
+                   date_trunc('day', created_at),
+                   SUM(source_points),
+                   COUNT(*),
+                   now()
+            FROM point_exchange_logs
+            WHERE status = 'success'
+            GROUP BY agreement_id, date_trunc('day', created_at)
+            ON CONFLICT (agreement_id, usage_date) DO UPDATE
+                SET points_used = EXCLUDED.points_used,
+                    exchange_count = EXCLUDED.exchange_count,
+                    updated_at = now();
+        """))
+        print(f"✓ 回填 {result.rowcount} 行")
+
+        # 提交事务
+        session.commit()
+        print("\n✅ 数据库迁移成功完成！")
+
+    except Exception as e:
+        print(f"\n❌ 数据库迁移失败: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
+    finally:
+        if 'session' in locals():
+            session.close()
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+数据库迁移脚本：跨店铺结算轧差
+创建 store_settlement_transfers 表，保存每个结算周期按店铺对轧差后的净额划转
+"""
+
+import sys
+import os
+
+# 添加 src 目录到 Python 路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from sqlalchemy import text
+from storage.database.db import get_engine, get_session
+from storage.database.shared.model import StoreSettlementTransfers
+
+def migrate():
+    """执行数据库迁移"""
+    print("开始执行数据库迁移：跨店铺结算轧差...")
+
+    try:
+        # 创建表
+        print("创建 store_settlement_transfers 表...")
+        StoreSettlementTransfers.__table__.create(bind=get_engine(), checkfirst=True)
+        print("✓ 表创建成功")
+
+        # 结算任务按 status + settlement_date 领取待结算记录
+        session = get_session()
+        print("添加 store_point_settlements (status, settlement_date) 索引...")
+        session.execute(text("""
+            CREATE INDEX IF NOT EXISTS ix_store_point_settlements_status_date
+                ON store_point_settlements (status, settlement_date);
+        """))
+        print("✓ 索引添加成功")
+
+        # 提交事务
+        session.commit()
+        print("\n✅ 数据库迁移成功完成！")
+        print("\n接下来配置结算任务（cron）：")
+        print("  10 0 * * * python scripts/run_store_settlement.py --cycle daily")
+
+    except Exception as e:
+        print(f"\n❌ 数据库迁移失败: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
+    finally:
+        if 'session' in locals():
+            session.close()
+
+if __name__ == "__main__":
+    migrate()
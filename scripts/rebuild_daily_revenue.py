@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+每日营收汇总回填/重算脚本
+从订单表重算指定区间的 daily_revenue 汇总行，用于历史数据回填或修复遗漏的增量事件
+
+用法：
+  python scripts/rebuild_daily_revenue.py --start 2024-01-01 --end 2024-01-31
+  python scripts/rebuild_daily_revenue.py --start 2024-01-01 --store-id 1
+"""
+
+import sys
+import os
+import argparse
+from datetime import date, datetime, timedelta
+
+# 添加 src 目录到 Python 路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from storage.database.db import get_session
+from services.revenue_rollup import rebuild_daily_revenue
+
+
+def parse_date(value: str) -> date:
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="重算每日营收汇总")
+    parser.add_argument("--start", type=parse_date, required=True, help="开始日期 YYYY-MM-DD")
+    parser.add_argument("--end", type=parse_date, default=date.today(), help="结束日期 YYYY-MM-DD（默认今天）")
+    parser.add_argument("--store-id", type=int, default=None, help="只重算指定店铺")
+    parser.add_argument("--chunk-days", type=int, default=31, help="每个事务处理的天数")
+    args = parser.parse_args()
+
+    if args.start > args.end:
+        print("❌ 开始日期不能晚于结束日期")
+        sys.exit(1)
+
+    print(f"开始重算每日营收汇总: {args.start} ~ {args.end}, store_id={args.store_id}")
+
+    session = get_session()
+    try:
+        total_rows = 0
+        chunk_start = args.start
+        # 分段提交，避免长区间占用一个大事务
+        while chunk_start <= args.end:
+            chunk_end = min(chunk_start + timedelta(days=args.chunk_days - 1), args.end)
+            rows = rebuild_daily_revenue(session, chunk_start, chunk_end, args.store_id)
+            session.commit()
+            total_rows += rows
+            print(f"✓ {chunk_start} ~ {chunk_end}: {rows} 行")
+            chunk_start = chunk_end + timedelta(days=1)
+
+        print(f"\n✅ 重算完成，共写入 {total_rows} 行")
+
+    except Exception as e:
+        session.rollback()
+        print(f"\n❌ 重算失败: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    main()
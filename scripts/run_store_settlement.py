@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+跨店铺积分结算任务
+结算最近一个已结束周期（及之前遗漏）的 pending 结算记录，按店铺对轧差写入净额划转，
+建议由 cron 在每个周期开始后执行，例如每天 00:10：
+
+  10 0 * * * python scripts/run_store_settlement.py --cycle daily
+
+用法：
+  python scripts/run_store_settlement.py                  # 使用 STORE_SETTLEMENT_CYCLE（默认 daily）
+  python scripts/run_store_settlement.py --cycle weekly
+  python scripts/run_store_settlement.py --cycle monthly --dry-run
+"""
+
+import sys
+import os
+import argparse
+
+# 添加 src 目录到 Python 路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from storage.database.db import get_session
+from services.settlement_netting import SETTLEMENT_CYCLES, STORE_SETTLEMENT_CYCLE, run_settlement_cycle
+
+
+def main():
+    parser = argparse.ArgumentParser(description="跨店铺积分结算轧差")
+    parser.add_argument("--cycle", choices=SETTLEMENT_CYCLES, default=STORE_SETTLEMENT_CYCLE, help="结算周期")
+    parser.add_argument("--dry-run", action="store_true", help="只计算不提交")
+    args = parser.parse_args()
+
+    session = get_session()
+    try:
+        summary = run_settlement_cycle(session, args.cycle)
+        if args.dry_run:
+            session.rollback()
+        else:
+            session.commit()
+
+        print(f"结算周期: {summary['cycle']} {summary['period_start']:%Y-%m-%d} ~ {summary['period_end']:%Y-%m-%d}")
+        print(f"✓ 完成结算记录 {summary['settlements_completed']} 条，店铺对 {summary['store_pairs']} 个")
+        print(f"✓ 净额划转 {summary['transfers']} 条，净积分 {summary['net_points']}，净金额 {summary['net_amount']}")
+        print(f"✓ 更新第三方协议结算日期 {summary['agreements_closed']} 个")
+        print("\n⚠️ dry-run 模式，未提交" if args.dry_run else "\n✅ 结算完成")
+
+    except Exception as e:
+        session.rollback()
+        print(f"\n❌ 结算失败: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+测试营收汇总失败不影响业务请求
+- apply_event: 事件处理函数抛异常时只回滚 SAVEPOINT，会话中已提交的对象不过期（内存 SQLite，无需数据库）
+- 下单 / 收银支付接口: 汇总处理函数抛异常时接口仍返回 200（需要已初始化的测试数据库）
+"""
+import sys
+import os
+
+# 添加项目路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from sqlalchemy import create_engine, inspect, Column, Integer, String
+from sqlalchemy.orm import Session, declarative_base
+
+from services.revenue_rollup import apply_event
+
+
+def _failing_handler(db, *args):
+    """模拟汇总失败（如 daily_revenue 唯一约束缺失、锁超时）"""
+    raise RuntimeError("模拟汇总失败")
+
+
+def test_apply_event_keeps_instances():
+    """汇总失败后会话中的对象不过期、未提交的汇总写入被撤销"""
+    print("=" * 60)
+    print("测试 apply_event 只回滚 SAVEPOINT")
+    print("=" * 60)
+
+    Base = declarative_base()
+
+    class Row(Base):
+        __tablename__ = "rows"
+        id = Column(Integer, primary_key=True)
+        name = Column(String)
+
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    db = Session(engine, expire_on_commit=False)
+    try:
+        order = Row(name="order")
+        db.add(order)
+        db.commit()
+
+        def handler(session, obj):
+            session.add(Row(name="rollup"))
+            session.flush()
+            _failing_handler(session)
+
+        apply_event(db, handler, order)
+
+        assert not inspect(order).expired_attributes, "汇总失败后订单对象被过期"
+        assert order.name == "order"
+        assert db.query(Row).count() == 1, "失败的汇总写入没有被撤销"
+    finally:
+        db.close()
+
+    print("✓ 汇总失败后订单对象仍可访问")
+
+
+def test_endpoints_survive_rollup_failure():
+    """下单、收银支付时汇总失败，接口仍返回 200"""
+    print("=" * 60)
+    print("测试汇总失败时下单 / 支付接口返回 200")
+    print("=" * 60)
+
+    from fastapi.testclient import TestClient
+    from storage.database.db import get_session
+    from storage.database.shared.model import MenuItems, Tables, Stores
+    import api.restaurant_api as restaurant_api
+
+    db = get_session()
+    try:
+        store = db.query(Stores).first()
+        assert store is not None, "没有店铺，请先初始化测试数据"
+        table = db.query(Tables).filter(Tables.store_id == store.id).first()
+        item = db.query(MenuItems).filter(
+            MenuItems.store_id == store.id,
+            MenuItems.is_available == True,
+            MenuItems.stock > 0
+        ).first()
+        assert table is not None and item is not None, "没有可用的桌号或菜品，请先初始化测试数据"
+        table_id, item_id = table.id, item.id
+    finally:
+        db.close()
+
+    handlers = ("record_order_created", "record_order_paid", "record_order_status_change")
+    originals = {name: getattr(restaurant_api, name) for name in handlers}
+    for name in handlers:
+        setattr(restaurant_api, name, _failing_handler)
+    try:
+        with TestClient(restaurant_api.app) as client:
+            response = client.post("/orders/", json={
+                "table_id": table_id,
+                "items": [{"menu_item_id": item_id, "quantity": 1}]
+            })
+            assert response.status_code == 200, f"下单返回 {response.status_code}: {response.text}"
+            order_id = response.json()["id"]
+            print(f"✓ 下单成功: order_id={order_id}")
+
+            response = client.post(f"/api/orders/{order_id}/process-payment", json={})
+            assert response.status_code == 200, f"支付返回 {response.status_code}: {response.text}"
+            print("✓ 收银支付成功")
+    finally:
+        for name, handler in originals.items():
+            setattr(restaurant_api, name, handler)
+
+
+def main():
+    results = []
+    for test in (test_apply_event_keeps_instances, test_endpoints_survive_rollup_failure):
+        try:
+            test()
+            results.append((test.__name__, True))
+        except Exception as e:
+            print(f"❌ {test.__name__}: {e}")
+            results.append((test.__name__, False))
+
+    print("\n" + "=" * 60)
+    for name, passed in results:
+        print(f"{name}: {'✓ 通过' if passed else '✗ 失败'}")
+    print("=" * 60)
+    return 0 if all(passed for _, passed in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
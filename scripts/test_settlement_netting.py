@@ -0,0 +1,130 @@
+"""
+单元测试 - 店铺间积分结算轧差（net_obligations）与结算周期（cycle_period）
+纯函数测试，不访问数据库
+"""
+import sys
+import os
+import math
+from datetime import datetime
+
+# 添加项目路径
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from services.settlement_netting import Obligation, cycle_period, net_obligations
+
+
+def _as_tuples(transfers):
+    return [(t.from_store_id, t.to_store_id, t.net_points, t.net_amount, t.settlement_count) for t in transfers]
+
+
+def test_net_obligations():
+    """测试轧差方向、符号与抵消"""
+    print("=" * 60)
+    print("测试 net_obligations")
+    print("=" * 60)
+
+    # 单方向：原样输出
+    transfers = net_obligations({(1, 2): Obligation(100, 10.0, 3)})
+    assert _as_tuples(transfers) == [(1, 2, 100, 10.0, 3)], _as_tuples(transfers)
+    print("✓ 单方向应付原样输出")
+
+    # 双向：按净金额决定方向，每对店铺只有一条记录
+    transfers = net_obligations({
+        (1, 2): Obligation(30, 3.0, 1),
+        (2, 1): Obligation(100, 10.0, 2),
+    })
+    assert _as_tuples(transfers) == [(2, 1, 70, 7.0, 3)], _as_tuples(transfers)
+    print("✓ 双向轧差后只保留净额方向")
+
+    # 积分与金额方向相反（两个方向汇率不同）：按金额定方向，净积分不为负
+    transfers = net_obligations({
+        (7, 8): Obligation(10, 2.0, 1),
+        (8, 7): Obligation(5, 3.0, 1),
+    })
+    assert _as_tuples(transfers) == [(8, 7, 0, 1.0, 2)], _as_tuples(transfers)
+    print("✓ 积分与金额方向相反时 net_points 不为负")
+
+    # 金额相等：按净积分定方向，金额为 +0.0
+    transfers = net_obligations({
+        (3, 4): Obligation(5, 2.5, 1),
+        (4, 3): Obligation(20, 2.5, 1),
+    })
+    assert _as_tuples(transfers) == [(4, 3, 15, 0.0, 2)], _as_tuples(transfers)
+    assert math.copysign(1.0, transfers[0].net_amount) > 0, "净金额为 -0.0"
+    print("✓ 金额相等时按净积分定方向，净金额为 0.0")
+
+    # 完全抵消：不产生记录
+    transfers = net_obligations({
+        (5, 6): Obligation(10, 1.1, 1),
+        (6, 5): Obligation(10, 1.1, 1),
+    })
+    assert transfers == [], _as_tuples(transfers)
+    print("✓ 完全抵消的店铺对不产生记录")
+
+    # 全部记录非负，并按 (来源, 目标) 排序
+    transfers = net_obligations({
+        (9, 1): Obligation(1, 0.1, 1),
+        (2, 3): Obligation(2, 0.2, 1),
+        (3, 2): Obligation(8, 0.1, 1),
+    })
+    assert [(t.from_store_id, t.to_store_id) for t in transfers] == [(2, 3), (9, 1)], _as_tuples(transfers)
+    assert all(t.net_points >= 0 and t.net_amount >= 0 for t in transfers), _as_tuples(transfers)
+    print("✓ 记录按店铺排序且全部非负")
+    return True
+
+
+def test_cycle_period():
+    """测试结算周期边界"""
+    print("\n" + "=" * 60)
+    print("测试 cycle_period")
+    print("=" * 60)
+
+    # 2026-03-04 是周三
+    now = datetime(2026, 3, 4, 15, 30)
+
+    assert cycle_period("daily", now) == (datetime(2026, 3, 3), datetime(2026, 3, 4))
+    print("✓ daily: 昨天")
+
+    assert cycle_period("weekly", now) == (datetime(2026, 2, 23), datetime(2026, 3, 2))
+    assert cycle_period("weekly", datetime(2026, 3, 2)) == (datetime(2026, 2, 23), datetime(2026, 3, 2))
+    print("✓ weekly: 上周一至本周一")
+
+    assert cycle_period("monthly", now) == (datetime(2026, 2, 1), datetime(2026, 3, 1))
+    assert cycle_period("monthly", datetime(2026, 1, 15)) == (datetime(2025, 12, 1), datetime(2026, 1, 1))
+    print("✓ monthly: 上月一日至本月一日（跨年）")
+
+    try:
+        cycle_period("yearly", now)
+    except ValueError:
+        print("✓ 不支持的周期抛出 ValueError")
+    else:
+        raise AssertionError("不支持的周期没有报错")
+    return True
+
+
+def main():
+    results = []
+    for name, test in (("轧差", test_net_obligations), ("结算周期", test_cycle_period)):
+        try:
+            results.append((name, test()))
+        except AssertionError as e:
+            print(f"❌ {name}: {e}")
+            results.append((name, False))
+
+    print("\n" + "=" * 60)
+    print("测试结果汇总")
+    print("=" * 60)
+    all_passed = all(passed for _, passed in results)
+    for name, passed in results:
+        print(f"{name}: {'✓ 通过' if passed else '✗ 失败'}")
+    print("=" * 60)
+
+    if all_passed:
+        print("\n🎉 所有测试通过!")
+        return 0
+    print("\n❌ 部分测试失败，请检查")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,15 +2,21 @@
 营收分析报表 API
 支持日/周/月营收、菜品销量、订单统计等分析
 """
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Depends, Query
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
-from sqlalchemy import func, extract
+from sqlalchemy import extract
 from pydantic import BaseModel
 from typing import List, Optional
 from datetime import datetime, timedelta
-from storage.database.db import get_session
-from storage.database.shared.model import Orders, OrderItems, MenuItems, Stores, Payments
+from storage.database.db import get_db
+from storage.database.shared.model import Orders, MenuItems, Stores
+from services.order_query import count_order_items
+from services.sales_aggregation import (
+    GRANULARITIES, day_bounds, revenue_totals, payment_method_totals, menu_item_sales,
+    hourly_sales, order_status_totals
+)
+from services.revenue_rollup import rollup_revenue_series
 import logging
 
 # 创建 FastAPI 应用
@@ -134,46 +140,32 @@ def get_revenue_summary(
     store_id: int = Query(..., description="店铺ID"),
     period: str = Query("today", description="时间范围: today, yesterday, week, month, last_month, custom"),
     custom_start: Optional[str] = Query(None, description="自定义开始日期 (YYYY-MM-DD)"),
-    custom_end: Optional[str] = Query(None, description="自定义结束日期 (YYYY-MM-DD)")
+    custom_end: Optional[str] = Query(None, description="自定义结束日期 (YYYY-MM-DD)"),
+    db: Session = Depends(get_db)
 ):
     """
     营收汇总
     """
-    db = get_session()
-    try:
-        # 获取日期范围
-        start_date, end_date = get_date_range(period, custom_start, custom_end)
-        
-        # 查询订单数据
-        query = db.query(Orders).filter(
-            Orders.store_id == store_id,
-            func.date(Orders.created_at) >= start_date,
-            func.date(Orders.created_at) <= end_date,
-            Orders.order_status != 'cancelled'
-        )
+    # 获取日期范围
+    start_date, end_date = get_date_range(period, custom_start, custom_end)
         
-        orders = query.all()
+    start, end = day_bounds(start_date, end_date)
         
-        # 计算汇总数据
-        total_orders = len(orders)
-        total_amount = sum(order.total_amount for order in orders)
-        total_discount = sum(order.discount_amount for order in orders)
-        net_revenue = sum(order.final_amount for order in orders)
-        average_order_amount = net_revenue / total_orders if total_orders > 0 else 0
+    # 汇总在数据库中完成
+    total_orders, total_amount, total_discount, net_revenue = revenue_totals(db, store_id, start, end)
+    average_order_amount = net_revenue / total_orders if total_orders > 0 else 0
         
-        return RevenueSummary(
-            period=period,
-            start_date=str(start_date),
-            end_date=str(end_date),
-            total_orders=total_orders,
-            total_amount=round(total_amount, 2),
-            total_discount=round(total_discount, 2),
-            net_revenue=round(net_revenue, 2),
-            average_order_amount=round(average_order_amount, 2)
-        )
+    return RevenueSummary(
+        period=period,
+        start_date=str(start_date),
+        end_date=str(end_date),
+        total_orders=total_orders,
+        total_amount=round(total_amount, 2),
+        total_discount=round(total_discount, 2),
+        net_revenue=round(net_revenue, 2),
+        average_order_amount=round(average_order_amount, 2)
+    )
         
-    finally:
-        db.close()
 
 
 @app.get("/api/analytics/payment-methods", response_model=List[PaymentMethodSummary])
@@ -181,53 +173,31 @@ def get_payment_methods_summary(
     store_id: int = Query(..., description="店铺ID"),
     period: str = Query("today", description="时间范围: today, week, month, custom"),
     custom_start: Optional[str] = Query(None),
-    custom_end: Optional[str] = Query(None)
+    custom_end: Optional[str] = Query(None),
+    db: Session = Depends(get_db)
 ):
     """
     支付方式统计
     """
-    db = get_session()
-    try:
-        # 获取日期范围
-        start_date, end_date = get_date_range(period, custom_start, custom_end)
-        
-        # 查询支付数据
-        payments = db.query(Payments).join(Orders).filter(
-            Orders.store_id == store_id,
-            func.date(Payments.created_at) >= start_date,
-            func.date(Payments.created_at) <= end_date,
-            Payments.status == 'success'
-        ).all()
-        
-        # 按支付方式分组统计
-        payment_stats = {}
-        total_amount = 0
+    # 获取日期范围
+    start_date, end_date = get_date_range(period, custom_start, custom_end)
         
-        for payment in payments:
-            method = payment.payment_method
-            if method not in payment_stats:
-                payment_stats[method] = {"count": 0, "amount": 0}
-            payment_stats[method]["count"] += 1
-            payment_stats[method]["amount"] += payment.amount
-            total_amount += payment.amount
+    start, end = day_bounds(start_date, end_date)
         
-        # 转换为响应格式
-        result = []
-        for method, stats in payment_stats.items():
-            result.append(PaymentMethodSummary(
-                payment_method=method,
-                count=stats["count"],
-                amount=round(stats["amount"], 2),
-                percentage=round((stats["amount"] / total_amount * 100), 2) if total_amount > 0 else 0
-            ))
+    # 按支付方式分组统计（已按金额倒序）
+    payment_stats = payment_method_totals(db, store_id, start, end)
+    total_amount = sum(amount for _, _, amount in payment_stats)
         
-        # 按金额排序
-        result.sort(key=lambda x: x.amount, reverse=True)
-        
-        return result
+    return [
+        PaymentMethodSummary(
+            payment_method=method,
+            count=count,
+            amount=round(amount, 2),
+            percentage=round((amount / total_amount * 100), 2) if total_amount > 0 else 0
+        )
+        for method, count, amount in payment_stats
+    ]
         
-    finally:
-        db.close()
 
 
 @app.get("/api/analytics/menu-item-sales", response_model=List[MenuItemSales])
@@ -236,103 +206,71 @@ def get_menu_item_sales(
     period: str = Query("today", description="时间范围: today, week, month, custom"),
     custom_start: Optional[str] = Query(None),
     custom_end: Optional[str] = Query(None),
-    limit: int = Query(20, description="返回数量限制", ge=1, le=100)
+    limit: int = Query(20, description="返回数量限制", ge=1, le=100),
+    db: Session = Depends(get_db)
 ):
     """
     菜品销量统计
     """
-    db = get_session()
-    try:
-        # 获取日期范围
-        start_date, end_date = get_date_range(period, custom_start, custom_end)
-        
-        # 查询订单项数据
-        order_items = db.query(OrderItems).join(Orders).filter(
-            Orders.store_id == store_id,
-            func.date(Orders.created_at) >= start_date,
-            func.date(Orders.created_at) <= end_date,
-            Orders.order_status != 'cancelled'
-        ).all()
-        
-        # 按菜品分组统计
-        item_stats = {}
+    # 获取日期范围
+    start_date, end_date = get_date_range(period, custom_start, custom_end)
         
-        for item in order_items:
-            menu_item_id = item.menu_item_id or 0
-            key = (menu_item_id, item.menu_item_name)
-            
-            if key not in item_stats:
-                item_stats[key] = {"quantity": 0, "revenue": 0}
-            
-            item_stats[key]["quantity"] += item.quantity
-            item_stats[key]["revenue"] += item.subtotal
+    start, end = day_bounds(start_date, end_date)
         
-        # 转换为响应格式
-        result = []
-        for (menu_item_id, menu_item_name), stats in item_stats.items():
-            result.append(MenuItemSales(
-                menu_item_id=menu_item_id,
-                menu_item_name=menu_item_name,
-                quantity=stats["quantity"],
-                revenue=round(stats["revenue"], 2)
-            ))
+    # 按菜品分组统计（排序和截断在数据库完成）
+    item_stats = menu_item_sales(db, store_id, start, end, limit=limit)
         
-        # 按销量排序
-        result.sort(key=lambda x: x.quantity, reverse=True)
-        
-        return result[:limit]
+    return [
+        MenuItemSales(
+            menu_item_id=menu_item_id,
+            menu_item_name=menu_item_name,
+            quantity=quantity,
+            revenue=round(revenue, 2),
+            category_name=category_name
+        )
+        for menu_item_id, menu_item_name, quantity, revenue, category_name in item_stats
+    ]
         
-    finally:
-        db.close()
 
 
 @app.get("/api/analytics/hourly-sales", response_model=List[HourlySales])
 def get_hourly_sales(
     store_id: int = Query(..., description="店铺ID"),
     period: str = Query("today", description="时间范围: today, yesterday"),
-    custom_date: Optional[str] = Query(None, description="自定义日期 (YYYY-MM-DD)")
+    custom_date: Optional[str] = Query(None, description="自定义日期 (YYYY-MM-DD)"),
+    db: Session = Depends(get_db)
 ):
     """
     每小时销量统计
     """
-    db = get_session()
-    try:
-        # 获取日期
-        if custom_date:
-            target_date = datetime.strptime(custom_date, "%Y-%m-%d").date()
-        elif period == "yesterday":
-            target_date = datetime.now().date() - timedelta(days=1)
-        else:
-            target_date = datetime.now().date()
+    # 获取日期
+    if custom_date:
+        target_date = datetime.strptime(custom_date, "%Y-%m-%d").date()
+    elif period == "yesterday":
+        target_date = datetime.now().date() - timedelta(days=1)
+    else:
+        target_date = datetime.now().date()
         
-        # 查询订单数据
-        orders = db.query(Orders).filter(
-            Orders.store_id == store_id,
-            func.date(Orders.created_at) == target_date,
-            Orders.order_status != 'cancelled'
-        ).all()
+    start, end = day_bounds(target_date, target_date)
         
-        # 按小时分组统计
-        hourly_stats = {hour: {"count": 0, "revenue": 0} for hour in range(24)}
+    # 按小时分组统计（date_trunc 在数据库完成），补齐没有订单的小时
+    hourly_stats = {hour: {"count": 0, "revenue": 0} for hour in range(24)}
         
-        for order in orders:
-            hour = order.created_at.hour
-            hourly_stats[hour]["count"] += 1
-            hourly_stats[hour]["revenue"] += order.final_amount
+    for bucket, count, revenue in hourly_sales(db, store_id, start, end):
+        hourly_stats[bucket.hour]["count"] += count
+        hourly_stats[bucket.hour]["revenue"] += revenue
         
-        # 转换为响应格式
-        result = []
-        for hour in range(24):
-            result.append(HourlySales(
-                hour=hour,
-                order_count=hourly_stats[hour]["count"],
-                revenue=round(hourly_stats[hour]["revenue"], 2)
-            ))
+    # 转换为响应格式
+    result = []
+    for hour in range(24):
+        result.append(HourlySales(
+            hour=hour,
+            order_count=hourly_stats[hour]["count"],
+            revenue=round(hourly_stats[hour]["revenue"], 2)
+        ))
         
-        return result
+    return result
         
-    finally:
-        db.close()
 
 
 @app.get("/api/analytics/order-status", response_model=List[OrderStatusSummary])
@@ -340,127 +278,98 @@ def get_order_status_summary(
     store_id: int = Query(..., description="店铺ID"),
     period: str = Query("today", description="时间范围: today, week, month, custom"),
     custom_start: Optional[str] = Query(None),
-    custom_end: Optional[str] = Query(None)
+    custom_end: Optional[str] = Query(None),
+    db: Session = Depends(get_db)
 ):
     """
     订单状态统计
     """
-    db = get_session()
-    try:
-        # 获取日期范围
-        start_date, end_date = get_date_range(period, custom_start, custom_end)
-        
-        # 查询订单数据
-        orders = db.query(Orders).filter(
-            Orders.store_id == store_id,
-            func.date(Orders.created_at) >= start_date,
-            func.date(Orders.created_at) <= end_date
-        ).all()
-        
-        # 按状态分组统计
-        status_stats = {}
+    # 获取日期范围
+    start_date, end_date = get_date_range(period, custom_start, custom_end)
         
-        for order in orders:
-            status = order.order_status
-            if status not in status_stats:
-                status_stats[status] = {"count": 0, "amount": 0}
-            
-            status_stats[status]["count"] += 1
-            status_stats[status]["amount"] += order.final_amount
+    start, end = day_bounds(start_date, end_date)
         
-        # 转换为响应格式
-        result = []
-        for status, stats in status_stats.items():
-            result.append(OrderStatusSummary(
-                order_status=status,
-                count=stats["count"],
-                amount=round(stats["amount"], 2)
-            ))
-        
-        return result
+    # 按状态分组统计
+    return [
+        OrderStatusSummary(
+            order_status=status,
+            count=count,
+            amount=round(amount, 2)
+        )
+        for status, count, amount in order_status_totals(db, store_id, start, end)
+    ]
         
-    finally:
-        db.close()
 
 
 @app.get("/api/analytics/daily-revenue", response_model=List[DailyRevenue])
 def get_daily_revenue(
     store_id: int = Query(..., description="店铺ID"),
-    days: int = Query(7, description="查询天数", ge=1, le=365)
+    days: int = Query(7, description="查询天数", ge=1, le=365),
+    granularity: str = Query("day", description="时间粒度: day, week, month"),
+    db: Session = Depends(get_db)
 ):
     """
     每日营收趋势
     """
-    db = get_session()
-    try:
-        result = []
-        
-        for i in range(days):
-            date = datetime.now().date() - timedelta(days=i)
-            
-            # 查询当日订单
-            orders = db.query(Orders).filter(
-                Orders.store_id == store_id,
-                func.date(Orders.created_at) == date,
-                Orders.order_status != 'cancelled'
-            ).all()
-            
-            order_count = len(orders)
-            revenue = sum(order.final_amount for order in orders)
-            
-            result.append(DailyRevenue(
-                date=str(date),
-                order_count=order_count,
-                revenue=round(revenue, 2)
-            ))
+    if granularity not in GRANULARITIES:
+        raise HTTPException(status_code=400, detail=f"不支持的时间粒度: {granularity}")
+    
+    end_date = datetime.now().date()
+    start_date = end_date - timedelta(days=days - 1)
         
-        # 按日期升序排列
-        result.reverse()
+    # 读取每日营收汇总表，O(天数) 而不是 O(订单数)
+    series = rollup_revenue_series(db, store_id, start_date, end_date, granularity)
         
-        return result
+    return [
+        DailyRevenue(
+            date=str(bucket_date),
+            order_count=order_count,
+            revenue=round(revenue, 2)
+        )
+        for bucket_date, order_count, revenue in series
+    ]
         
-    finally:
-        db.close()
 
 
 @app.get("/api/analytics/top-orders")
 def get_top_orders(
     store_id: int = Query(..., description="店铺ID"),
     period: str = Query("today", description="时间范围: today, week, month"),
-    limit: int = Query(10, description="返回数量限制", ge=1, le=50)
+    limit: int = Query(10, description="返回数量限制", ge=1, le=50),
+    db: Session = Depends(get_db)
 ):
     """
     订单排行榜（按金额）
     """
-    db = get_session()
-    try:
-        # 获取日期范围
-        start_date, end_date = get_date_range(period)
-        
-        # 查询订单并排序
-        orders = db.query(Orders).filter(
-            Orders.store_id == store_id,
-            func.date(Orders.created_at) >= start_date,
-            func.date(Orders.created_at) <= end_date,
-            Orders.order_status != 'cancelled'
-        ).order_by(Orders.final_amount.desc()).limit(limit).all()
-        
-        result = []
-        for order in orders:
-            result.append({
-                "order_id": order.id,
-                "order_number": order.order_number,
-                "table_id": order.table_id,
-                "final_amount": order.final_amount,
-                "order_status": order.order_status,
-                "created_at": order.created_at.isoformat(),
-                "items_count": len(order.order_items)
-            })
-        
-        return result
+    # 获取日期范围
+    start_date, end_date = get_date_range(period)
+    start, end = day_bounds(start_date, end_date)
+        
+    # 查询订单并排序
+    orders = db.query(Orders).filter(
+        Orders.store_id == store_id,
+        Orders.created_at >= start,
+        Orders.created_at < end,
+        Orders.order_status != 'cancelled'
+    ).order_by(Orders.final_amount.desc()).limit(limit).all()
+        
+    # 订单项数量一次分组统计
+    items_count = count_order_items(db, [order.id for order in orders])
+        
+    result = []
+    for order in orders:
+        result.append({
+            "order_id": order.id,
+            "order_number": order.order_number,
+            "table_id": order.table_id,
+            "final_amount": order.final_amount,
+            "order_status": order.order_status,
+            "created_at": order.created_at.isoformat(),
+            "items_count": items_count.get(order.id, 0)
+        })
+        
+    return result
         
-    finally:
-        db.close()
 
 
 if __name__ == "__main__":
@@ -1,16 +1,19 @@
 """
 顾客端 API 接口
 """
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Depends, Query, Header, Response
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
 from pydantic import BaseModel, Field
 from typing import List, Optional
 from datetime import datetime
-from storage.database.db import get_session
-from storage.database.shared.model import Stores, MenuItems, MenuCategories, Orders, OrderItems, Tables
-import random
-import string
+from storage.database.db import get_db
+from storage.database.shared.model import Stores, Orders, Tables
+from services.revenue_rollup import apply_event, record_order_created
+from services.menu_cache import get_menu_snapshot, invalidate_menu, etag_matches
+from services.order_placement import place_order_items, OrderPlacementError
+from services.id_generator import next_order_number
+from services.table_occupancy import publish_order_event
 
 # 创建 FastAPI 应用
 app = FastAPI(title="扫码点餐系统 - 顾客端 API", version="1.0.0")
@@ -108,15 +111,6 @@ class OrderResponse(BaseModel):
     items: List[OrderItemResponse]
 
 
-# ============ 工具函数 ============
-
-def generate_order_number() -> str:
-    """生成订单号"""
-    now = datetime.now()
-    random_str = ''.join(random.choices(string.digits, k=4))
-    return f"ORD{now.strftime('%Y%m%d%H%M%S')}{random_str}"
-
-
 # ============ API 接口 ============
 
 @app.get("/")
@@ -135,83 +129,46 @@ def root():
 
 
 @app.get("/api/customer/shop", response_model=ShopInfo)
-def get_shop_info(store_id: int = Query(..., description="店铺ID")):
+def get_shop_info(store_id: int = Query(..., description="店铺ID"), db: Session = Depends(get_db)):
     """
     获取店铺信息
     """
-    db = get_session()
-    try:
-        shop = db.query(Stores).filter(Stores.id == store_id, Stores.is_active == True).first()
-        if not shop:
-            raise HTTPException(status_code=404, detail="店铺不存在或已关闭")
+    shop = db.query(Stores).filter(Stores.id == store_id, Stores.is_active == True).first()
+    if not shop:
+        raise HTTPException(status_code=404, detail="店铺不存在或已关闭")
         
-        return ShopInfo(
-            id=shop.id,
-            name=shop.name,
-            address=shop.address,
-            phone=shop.phone,
-            opening_hours=shop.opening_hours
-        )
-    finally:
-        db.close()
+    return ShopInfo(
+        id=shop.id,
+        name=shop.name,
+        address=shop.address,
+        phone=shop.phone,
+        opening_hours=shop.opening_hours
+    )
 
 
 @app.get("/api/customer/menu", response_model=List[CategoryInfo])
-def get_menu(store_id: int = Query(..., description="店铺ID")):
+def get_menu(
+    store_id: int = Query(..., description="店铺ID"),
+    if_none_match: Optional[str] = Header(None)
+):
     """
     获取菜品列表（按分类分组）
+    返回缓存的菜单快照，客户端携带 If-None-Match 且菜单未变化时返回 304
     """
-    db = get_session()
-    try:
-        # 查询店铺的所有分类
-        categories = db.query(MenuCategories).filter(
-            MenuCategories.store_id == store_id,
-            MenuCategories.is_active == True
-        ).order_by(MenuCategories.sort_order).all()
-        
-        result = []
-        for category in categories:
-            # 查询该分类下的菜品
-            items = db.query(MenuItems).filter(
-                MenuItems.category_id == category.id,
-                MenuItems.is_available == True
-            ).order_by(MenuItems.sort_order, MenuItems.id).all()
-            
-            menu_items = []
-            for item in items:
-                menu_items.append(MenuItemInfo(
-                    id=item.id,
-                    name=item.name,
-                    description=item.description,
-                    price=item.price,
-                    original_price=item.original_price,
-                    image_url=item.image_url,
-                    stock=item.stock,
-                    unit=item.unit,
-                    cooking_time=item.cooking_time,
-                    is_available=item.is_available,
-                    is_recommended=item.is_recommended
-                ))
-            
-            result.append(CategoryInfo(
-                id=category.id,
-                name=category.name,
-                description=category.description,
-                sort_order=category.sort_order,
-                items=menu_items
-            ))
-        
-        return result
-    finally:
-        db.close()
+    snapshot = get_menu_snapshot(store_id)
+    headers = {"ETag": snapshot.etag, "Cache-Control": "no-cache"}
+
+    if etag_matches(if_none_match, snapshot.etag):
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=snapshot.body, media_type="application/json", headers=headers)
 
 
 @app.post("/api/customer/order", response_model=OrderResponse)
-def create_order(request: CreateOrderRequest):
+def create_order(request: CreateOrderRequest, db: Session = Depends(get_db)):
     """
     创建订单
     """
-    db = get_session()
     try:
         # 验证店铺和桌号
         shop = db.query(Stores).filter(Stores.id == request.store_id).first()
@@ -226,7 +183,7 @@ def create_order(request: CreateOrderRequest):
             raise HTTPException(status_code=404, detail="桌号不存在或不属于该店铺")
         
         # 生成订单号
-        order_number = generate_order_number()
+        order_number = next_order_number(request.store_id)
 
         # 确定支付状态：如果选择"马上支付"则标记为已支付，"柜台支付"则标记为未支付
         if request.payment_method == 'immediate':
@@ -259,46 +216,18 @@ def create_order(request: CreateOrderRequest):
         db.add(order)
         db.flush()
         
-        # 创建订单项
-        order_items = []
-        for item_request in request.items:
-            # 获取菜品信息（快照）
-            menu_item = db.query(MenuItems).filter(MenuItems.id == item_request.menu_item_id).first()
-            if not menu_item:
-                raise HTTPException(status_code=404, detail=f"菜品ID {item_request.menu_item_id} 不存在")
-            
-            if menu_item.stock < item_request.quantity:
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"菜品 {menu_item.name} 库存不足，当前库存: {menu_item.stock}，需要: {item_request.quantity}"
-                )
-            
-            subtotal = menu_item.price * item_request.quantity
-            total_amount += subtotal
-            
-            order_item = OrderItems(
-                order_id=order.id,
-                menu_item_id=menu_item.id,
-                menu_item_name=menu_item.name,
-                menu_item_price=menu_item.price,
-                quantity=item_request.quantity,
-                subtotal=subtotal,
-                special_instructions=item_request.special_instructions,
-                status="pending"
-            )
-            db.add(order_item)
-            order_items.append(order_item)
+        # 锁定菜品、扣减库存、批量创建订单项
+        try:
+            order_items, total_amount = place_order_items(db, order, request.items)
+        except OrderPlacementError as e:
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
         
         # 更新订单金额
         order.total_amount = total_amount
         order.discount_amount = discount_amount
         order.final_amount = total_amount - discount_amount
         
-        # 提交事务
-        db.commit()
-        db.refresh(order)
-        
-        # 构建响应
+        # 构建响应（提交前构建，避免提交后逐个刷新订单项）
         response_items = []
         for oi in order_items:
             response_items.append(OrderItemResponse(
@@ -311,6 +240,13 @@ def create_order(request: CreateOrderRequest):
                 status=oi.status
             ))
         
+        # 提交事务
+        db.commit()
+        invalidate_menu(order.store_id)
+        apply_event(db, record_order_created, order)
+        db.refresh(order)
+        publish_order_event(order.store_id, order.table_id, order.id, order.order_status)
+        
         return OrderResponse(
             id=order.id,
             order_number=order.order_number,
@@ -335,57 +271,51 @@ def create_order(request: CreateOrderRequest):
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"创建订单失败: {str(e)}")
-    finally:
-        db.close()
 
 
 @app.get("/api/customer/order/{order_id}", response_model=OrderResponse)
-def get_order(order_id: int):
+def get_order(order_id: int, db: Session = Depends(get_db)):
     """
     获取订单详情
     """
-    db = get_session()
-    try:
-        order = db.query(Orders).filter(Orders.id == order_id).first()
-        if not order:
-            raise HTTPException(status_code=404, detail="订单不存在")
+    order = db.query(Orders).filter(Orders.id == order_id).first()
+    if not order:
+        raise HTTPException(status_code=404, detail="订单不存在")
         
-        # 获取桌号信息
-        table = db.query(Tables).filter(Tables.id == order.table_id).first()
-        table_number = table.table_number if table else ""
+    # 获取桌号信息
+    table = db.query(Tables).filter(Tables.id == order.table_id).first()
+    table_number = table.table_number if table else ""
         
-        # 构建订单项
-        response_items = []
-        for oi in order.order_items:
-            response_items.append(OrderItemResponse(
-                id=oi.id,
-                menu_item_name=oi.menu_item_name,
-                menu_item_price=oi.menu_item_price,
-                quantity=oi.quantity,
-                subtotal=oi.subtotal,
-                special_instructions=oi.special_instructions,
-                status=oi.status
-            ))
+    # 构建订单项
+    response_items = []
+    for oi in order.order_items:
+        response_items.append(OrderItemResponse(
+            id=oi.id,
+            menu_item_name=oi.menu_item_name,
+            menu_item_price=oi.menu_item_price,
+            quantity=oi.quantity,
+            subtotal=oi.subtotal,
+            special_instructions=oi.special_instructions,
+            status=oi.status
+        ))
         
-        return OrderResponse(
-            id=order.id,
-            order_number=order.order_number,
-            store_id=order.store_id,
-            table_id=order.table_id,
-            table_number=table_number,
-            customer_name=order.customer_name,
-            customer_phone=order.customer_phone,
-            total_amount=order.total_amount,
-            discount_amount=order.discount_amount,
-            final_amount=order.final_amount,
-            payment_status=order.payment_status,
-            order_status=order.order_status,
-            special_instructions=order.special_instructions,
-            created_at=order.created_at,
-            items=response_items
-        )
-    finally:
-        db.close()
+    return OrderResponse(
+        id=order.id,
+        order_number=order.order_number,
+        store_id=order.store_id,
+        table_id=order.table_id,
+        table_number=table_number,
+        customer_name=order.customer_name,
+        customer_phone=order.customer_phone,
+        total_amount=order.total_amount,
+        discount_amount=order.discount_amount,
+        final_amount=order.final_amount,
+        payment_status=order.payment_status,
+        order_status=order.order_status,
+        special_instructions=order.special_instructions,
+        created_at=order.created_at,
+        items=response_items
+    )
 
 
 if __name__ == "__main__":
@@ -94,11 +94,20 @@ def check_database():
 @router.get("/api/diagnostic/health")
 def health_check():
     """完整健康检查"""
+    from storage.database.db import get_pool_settings, get_pool_metrics
+    from utils.log.log_pipeline import get_log_pipeline_stats
+
     db_status = check_database()
 
     return {
         "status": "healthy" if db_status["connection_successful"] else "unhealthy",
         "database": db_status,
+        # 同步 / 异步引擎各自的连接池参数及每个 worker 的连接预算；
+        # 连接池占用、取连接等待时间直方图、慢查询（按引擎分别统计）
+        "pool_settings": get_pool_settings(),
+        "pool_metrics": get_pool_metrics(),
+        # 日志队列深度、队列满时丢弃的记录数、批次与 fsync 次数
+        "log_pipeline": get_log_pipeline_stats(),
         "environment": check_environment()["environment"]
     }
 
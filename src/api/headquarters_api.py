@@ -2,18 +2,19 @@
 总公司管理后台 API
 支持查看所有店铺的营收情况、人员情况、数据统计等
 """
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Depends, Query
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
-from sqlalchemy import func, desc, and_
+from sqlalchemy import func, and_
 from pydantic import BaseModel, Field
 from typing import Optional, List
 from datetime import datetime, timedelta
-from storage.database.db import get_session
+from storage.database.db import get_db
 from storage.database.shared.model import (
     Companies, Stores, Orders, DailyRevenue, Staff,
     Users, Roles, UserRoles, OrderItems, Members
 )
+from services.revenue_rollup import load_daily_revenue, merge_payment_methods
 import logging
 
 # 创建 FastAPI 应用
@@ -104,6 +105,15 @@ def get_date_range(days: int = 30) -> tuple:
     return start_date, end_date
 
 
+def get_day_range(days: int = 30) -> tuple:
+    """
+    获取按整天划分的日期范围（含今天），用于读取每日营收汇总表
+    """
+    end_date = datetime.now().date()
+    start_date = end_date - timedelta(days=days - 1)
+    return start_date, end_date
+
+
 # ============ API 接口 ============
 
 @app.get("/")
@@ -126,254 +136,219 @@ def root():
 
 
 @app.get("/api/headquarters/overall-stats", response_model=OverallStats)
-def get_overall_stats():
+def get_overall_stats(db: Session = Depends(get_db)):
     """
     获取总体统计
     """
-    db = get_session()
-    try:
-        # 店铺统计
-        total_stores = db.query(func.count(Stores.id)).scalar()
-        active_stores = db.query(func.count(Stores.id)).filter(
-            Stores.is_active == True
-        ).scalar()
+    # 店铺统计
+    total_stores = db.query(func.count(Stores.id)).scalar()
+    active_stores = db.query(func.count(Stores.id)).filter(
+        Stores.is_active == True
+    ).scalar()
         
-        # 订单和营收统计
-        total_orders = db.query(func.count(Orders.id)).scalar()
-        total_revenue = db.query(func.sum(Orders.final_amount)).scalar() or 0
+    # 订单和营收统计
+    total_orders = db.query(func.count(Orders.id)).scalar()
+    total_revenue = db.query(func.sum(Orders.final_amount)).scalar() or 0
         
-        # 会员统计
-        total_members = db.query(func.count(Members.id)).scalar()
+    # 会员统计
+    total_members = db.query(func.count(Members.id)).scalar()
         
-        # 员工统计
-        total_staff = db.query(func.count(Staff.id)).scalar()
+    # 员工统计
+    total_staff = db.query(func.count(Staff.id)).scalar()
         
-        return OverallStats(
-            total_stores=total_stores,
-            active_stores=active_stores,
-            total_orders=total_orders,
-            total_revenue=round(total_revenue, 2),
-            total_members=total_members,
-            total_staff=total_staff
-        )
+    return OverallStats(
+        total_stores=total_stores,
+        active_stores=active_stores,
+        total_orders=total_orders,
+        total_revenue=round(total_revenue, 2),
+        total_members=total_members,
+        total_staff=total_staff
+    )
         
-    finally:
-        db.close()
 
 
 @app.get("/api/headquarters/stores", response_model=List[StoreSummary])
 def get_stores(
     is_active: Optional[bool] = Query(None, description="是否激活"),
     skip: int = Query(0, ge=0),
-    limit: int = Query(20, ge=1, le=100)
+    limit: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_db)
 ):
     """
     获取店铺列表
     """
-    db = get_session()
-    try:
-        query = db.query(Stores)
+    query = db.query(Stores)
         
-        if is_active is not None:
-            query = query.filter(Stores.is_active == is_active)
+    if is_active is not None:
+        query = query.filter(Stores.is_active == is_active)
         
-        stores = query.order_by(Stores.created_at.desc()).offset(skip).limit(limit).all()
+    stores = query.order_by(Stores.created_at.desc()).offset(skip).limit(limit).all()
         
-        result = []
-        for store in stores:
-            result.append(StoreSummary(
-                id=store.id,
-                name=store.name,
-                address=store.address,
-                phone=store.phone,
-                manager_name=store.manager.name if store.manager else None,
-                is_active=store.is_active,
-                created_at=store.created_at
-            ))
+    result = []
+    for store in stores:
+        result.append(StoreSummary(
+            id=store.id,
+            name=store.name,
+            address=store.address,
+            phone=store.phone,
+            manager_name=store.manager.name if store.manager else None,
+            is_active=store.is_active,
+            created_at=store.created_at
+        ))
         
-        return result
+    return result
         
-    finally:
-        db.close()
 
 
 @app.get("/api/headquarters/stores/{store_id}/revenue", response_model=StoreRevenueStats)
 def get_store_revenue_stats(
     store_id: int,
-    days: int = Query(30, ge=1, le=365, description="统计天数")
+    days: int = Query(30, ge=1, le=365, description="统计天数"),
+    db: Session = Depends(get_db)
 ):
     """
     获取店铺营收统计
     """
-    db = get_session()
-    try:
-        # 验证店铺存在
-        store = db.query(Stores).filter(Stores.id == store_id).first()
-        if not store:
-            raise HTTPException(status_code=404, detail="店铺不存在")
-        
-        # 获取日期范围
-        start_date, end_date = get_date_range(days)
-        
-        # 查询订单统计
-        orders = db.query(Orders).filter(
-            and_(
-                Orders.store_id == store_id,
-                Orders.created_at >= start_date,
-                Orders.created_at <= end_date,
-                Orders.payment_status == 'paid'
-            )
-        ).all()
+    # 验证店铺存在
+    store = db.query(Stores).filter(Stores.id == store_id).first()
+    if not store:
+        raise HTTPException(status_code=404, detail="店铺不存在")
+        
+    # 获取日期范围
+    start_date, end_date = get_day_range(days)
+        
+    # 读取每日营收汇总（已支付订单口径）
+    rows = load_daily_revenue(db, start_date, end_date, store_id)
         
-        total_orders = len(orders)
-        total_revenue = sum(order.final_amount for order in orders)
-        average_order_value = total_revenue / total_orders if total_orders > 0 else 0
+    total_orders = sum(row.paid_orders for row in rows)
+    total_revenue = sum(row.paid_amount for row in rows)
+    average_order_value = total_revenue / total_orders if total_orders > 0 else 0
         
-        # 支付方式统计
-        payment_methods = {}
-        for order in orders:
-            method = order.payment_method or 'unknown'
-            if method not in payment_methods:
-                payment_methods[method] = {'count': 0, 'amount': 0}
-            payment_methods[method]['count'] += 1
-            payment_methods[method]['amount'] += order.final_amount
+    # 支付方式统计
+    payment_methods = merge_payment_methods(rows)
         
-        return StoreRevenueStats(
-            store_id=store.id,
-            store_name=store.name,
-            total_orders=total_orders,
-            total_revenue=round(total_revenue, 2),
-            average_order_value=round(average_order_value, 2),
-            payment_methods=payment_methods
-        )
+    return StoreRevenueStats(
+        store_id=store.id,
+        store_name=store.name,
+        total_orders=total_orders,
+        total_revenue=round(total_revenue, 2),
+        average_order_value=round(average_order_value, 2),
+        payment_methods=payment_methods
+    )
         
-    finally:
-        db.close()
 
 
 @app.get("/api/headquarters/stores/{store_id}/staff", response_model=StoreStaffStats)
-def get_store_staff_stats(store_id: int):
+def get_store_staff_stats(store_id: int, db: Session = Depends(get_db)):
     """
     获取店铺人员统计
     """
-    db = get_session()
-    try:
-        # 验证店铺存在
-        store = db.query(Stores).filter(Stores.id == store_id).first()
-        if not store:
-            raise HTTPException(status_code=404, detail="店铺不存在")
-        
-        # 查询员工
-        staff_list = db.query(Staff).filter(Staff.store_id == store_id).all()
-        
-        total_staff = len(staff_list)
-        active_staff = sum(1 for s in staff_list if s.is_active)
-        
-        # 按职位统计
-        staff_by_position = {}
-        for staff in staff_list:
-            position = staff.position
-            if position not in staff_by_position:
-                staff_by_position[position] = {'total': 0, 'active': 0}
-            staff_by_position[position]['total'] += 1
-            if staff.is_active:
-                staff_by_position[position]['active'] += 1
-        
-        return StoreStaffStats(
-            store_id=store.id,
-            store_name=store.name,
-            total_staff=total_staff,
-            active_staff=active_staff,
-            staff_by_position=staff_by_position
-        )
-        
-    finally:
-        db.close()
+    # 验证店铺存在
+    store = db.query(Stores).filter(Stores.id == store_id).first()
+    if not store:
+        raise HTTPException(status_code=404, detail="店铺不存在")
+        
+    # 查询员工
+    staff_list = db.query(Staff).filter(Staff.store_id == store_id).all()
+        
+    total_staff = len(staff_list)
+    active_staff = sum(1 for s in staff_list if s.is_active)
+        
+    # 按职位统计
+    staff_by_position = {}
+    for staff in staff_list:
+        position = staff.position
+        if position not in staff_by_position:
+            staff_by_position[position] = {'total': 0, 'active': 0}
+        staff_by_position[position]['total'] += 1
+        if staff.is_active:
+            staff_by_position[position]['active'] += 1
+        
+    return StoreStaffStats(
+        store_id=store.id,
+        store_name=store.name,
+        total_staff=total_staff,
+        active_staff=active_staff,
+        staff_by_position=staff_by_position
+    )
+        
 
 
 @app.get("/api/headquarters/stores/revenue-ranking")
 def get_revenue_ranking(
     days: int = Query(30, ge=1, le=365, description="统计天数"),
-    top: int = Query(10, ge=1, le=50, description="返回前N名")
+    top: int = Query(10, ge=1, le=50, description="返回前N名"),
+    db: Session = Depends(get_db)
 ):
     """
     获取店铺营收排名
     """
-    db = get_session()
-    try:
-        # 获取日期范围
-        start_date, end_date = get_date_range(days)
-        
-        # 查询每个店铺的营收
-        results = db.query(
-            Stores.id,
-            Stores.name,
-            func.count(Orders.id).label('total_orders'),
-            func.sum(Orders.final_amount).label('total_revenue')
-        ).outerjoin(Orders, and_(
-            Orders.store_id == Stores.id,
-            Orders.created_at >= start_date,
-            Orders.created_at <= end_date,
-            Orders.payment_status == 'paid'
-        )).group_by(Stores.id, Stores.name).order_by(
-            desc('total_revenue')
-        ).limit(top).all()
-        
-        ranking = []
-        for idx, result in enumerate(results, 1):
-            ranking.append({
-                "rank": idx,
-                "store_id": result.id,
-                "store_name": result.name,
-                "total_orders": result.total_orders or 0,
-                "total_revenue": round(result.total_revenue or 0, 2)
-            })
-        
-        return ranking
-        
-    finally:
-        db.close()
+    # 获取日期范围
+    start_date, end_date = get_day_range(days)
+        
+    # 查询每个店铺的营收（读取每日营收汇总表）
+    total_revenue = func.coalesce(func.sum(DailyRevenue.paid_amount), 0.0)
+    results = db.query(
+        Stores.id,
+        Stores.name,
+        func.coalesce(func.sum(DailyRevenue.paid_orders), 0).label('total_orders'),
+        total_revenue.label('total_revenue')
+    ).outerjoin(DailyRevenue, and_(
+        DailyRevenue.store_id == Stores.id,
+        DailyRevenue.date >= start_date,
+        DailyRevenue.date < end_date + timedelta(days=1)
+    )).group_by(Stores.id, Stores.name).order_by(
+        total_revenue.desc()
+    ).limit(top).all()
+        
+    ranking = []
+    for idx, result in enumerate(results, 1):
+        ranking.append({
+            "rank": idx,
+            "store_id": result.id,
+            "store_name": result.name,
+            "total_orders": result.total_orders or 0,
+            "total_revenue": round(result.total_revenue or 0, 2)
+        })
+        
+    return ranking
+        
 
 
 @app.get("/api/headquarters/revenue-trend", response_model=List[RevenueTrend])
 def get_revenue_trend(
-    days: int = Query(30, ge=1, le=365, description="统计天数")
+    days: int = Query(30, ge=1, le=365, description="统计天数"),
+    db: Session = Depends(get_db)
 ):
     """
     获取营收趋势
     """
-    db = get_session()
-    try:
-        # 获取日期范围
-        start_date, end_date = get_date_range(days)
-        
-        # 按天统计
-        results = db.query(
-            func.date(Orders.created_at).label('date'),
-            func.count(Orders.id).label('total_orders'),
-            func.sum(Orders.final_amount).label('total_revenue'),
-            func.count(func.distinct(Orders.store_id)).label('store_count')
-        ).filter(
-            and_(
-                Orders.created_at >= start_date,
-                Orders.created_at <= end_date,
-                Orders.payment_status == 'paid'
-            )
-        ).group_by(func.date(Orders.created_at)).order_by('date').all()
-        
-        trend = []
-        for result in results:
-            trend.append(RevenueTrend(
-                date=result.date.strftime('%Y-%m-%d'),
-                total_revenue=round(result.total_revenue or 0, 2),
-                total_orders=result.total_orders,
-                store_count=result.store_count
-            ))
-        
-        return trend
-        
-    finally:
-        db.close()
+    # 获取日期范围
+    start_date, end_date = get_day_range(days)
+        
+    # 按天统计（每日营收汇总表每个店铺每天一行）
+    total_orders = func.sum(DailyRevenue.paid_orders)
+    results = db.query(
+        DailyRevenue.date.label('date'),
+        total_orders.label('total_orders'),
+        func.sum(DailyRevenue.paid_amount).label('total_revenue'),
+        func.count(DailyRevenue.id).filter(DailyRevenue.paid_orders > 0).label('store_count')
+    ).filter(
+        DailyRevenue.date >= start_date,
+        DailyRevenue.date < end_date + timedelta(days=1)
+    ).group_by(DailyRevenue.date).having(total_orders > 0).order_by(DailyRevenue.date).all()
+        
+    trend = []
+    for result in results:
+        trend.append(RevenueTrend(
+            date=result.date.strftime('%Y-%m-%d'),
+            total_revenue=round(result.total_revenue or 0, 2),
+            total_orders=result.total_orders,
+            store_count=result.store_count
+        ))
+        
+    return trend
+        
 
 
 @app.get("/api/headquarters/staff", response_model=List[StaffInfo])
@@ -382,115 +357,109 @@ def get_all_staff(
     is_active: Optional[bool] = Query(None, description="是否在职"),
     position: Optional[str] = Query(None, description="职位筛选"),
     skip: int = Query(0, ge=0),
-    limit: int = Query(50, ge=1, le=200)
+    limit: int = Query(50, ge=1, le=200),
+    db: Session = Depends(get_db)
 ):
     """
     获取所有员工信息
     """
-    db = get_session()
-    try:
-        query = db.query(Staff).join(Users).join(Stores)
+    query = db.query(Staff).join(Users).join(Stores)
         
-        if store_id is not None:
-            query = query.filter(Staff.store_id == store_id)
+    if store_id is not None:
+        query = query.filter(Staff.store_id == store_id)
         
-        if is_active is not None:
-            query = query.filter(Staff.is_active == is_active)
+    if is_active is not None:
+        query = query.filter(Staff.is_active == is_active)
         
-        if position is not None:
-            query = query.filter(Staff.position == position)
+    if position is not None:
+        query = query.filter(Staff.position == position)
         
-        staff_list = query.order_by(Staff.created_at.desc()).offset(skip).limit(limit).all()
+    staff_list = query.order_by(Staff.created_at.desc()).offset(skip).limit(limit).all()
         
-        result = []
-        for staff in staff_list:
-            # 查询用户角色
-            user_roles = db.query(Roles).join(UserRoles).filter(
-                UserRoles.user_id == staff.user_id
-            ).all()
-            roles = [role.name for role in user_roles]
+    result = []
+    for staff in staff_list:
+        # 查询用户角色
+        user_roles = db.query(Roles).join(UserRoles).filter(
+            UserRoles.user_id == staff.user_id
+        ).all()
+        roles = [role.name for role in user_roles]
             
-            result.append(StaffInfo(
-                id=staff.id,
-                user_id=staff.user_id,
-                name=staff.user.name,
-                phone=staff.user.phone,
-                position=staff.position,
-                store_name=staff.store.name if staff.store else "未知店铺",
-                is_active=staff.is_active,
-                roles=roles
-            ))
+        result.append(StaffInfo(
+            id=staff.id,
+            user_id=staff.user_id,
+            name=staff.user.name,
+            phone=staff.user.phone,
+            position=staff.position,
+            store_name=staff.store.name if staff.store else "未知店铺",
+            is_active=staff.is_active,
+            roles=roles
+        ))
         
-        return result
+    return result
         
-    finally:
-        db.close()
 
 
 @app.get("/api/headquarters/members")
 def get_members_stats(
     days: int = Query(30, ge=1, le=365, description="统计天数"),
     skip: int = Query(0, ge=0),
-    limit: int = Query(20, ge=1, le=100)
+    limit: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_db)
 ):
     """
     获取会员统计
     """
-    db = get_session()
-    try:
-        # 获取日期范围
-        start_date, end_date = get_date_range(days)
-        
-        # 查询新注册会员
-        new_members = db.query(Members).filter(
-            Members.created_at >= start_date,
-            Members.created_at <= end_date
-        ).order_by(Members.created_at.desc()).offset(skip).limit(limit).all()
-        
-        # 总体会员统计
-        total_members = db.query(func.count(Members.id)).scalar()
-        active_members = db.query(func.count(Members.id)).filter(
-            Members.total_orders > 0
-        ).scalar()
-        
-        # 会员等级分布
-        level_distribution = db.query(
-            Members.level,
-            func.count(Members.id).label('count')
-        ).group_by(Members.level).all()
-        
-        # 总积分和总消费
-        total_points = db.query(func.sum(Members.points)).scalar() or 0
-        total_spent = db.query(func.sum(Members.total_spent)).scalar() or 0
-        
-        members_list = []
-        for member in new_members:
-            members_list.append({
-                "id": member.id,
-                "phone": member.phone,
-                "name": member.name,
-                "level": member.level,
-                "points": member.points,
-                "total_spent": member.total_spent,
-                "total_orders": member.total_orders,
-                "created_at": member.created_at
-            })
-        
-        return {
-            "total_members": total_members,
-            "active_members": active_members,
-            "new_members_count": len(new_members),
-            "total_points": total_points,
-            "total_spent": round(total_spent, 2),
-            "level_distribution": [
-                {"level": item.level, "count": item.count}
-                for item in level_distribution
-            ],
-            "new_members": members_list
-        }
+    # 获取日期范围
+    start_date, end_date = get_date_range(days)
+        
+    # 查询新注册会员
+    new_members = db.query(Members).filter(
+        Members.created_at >= start_date,
+        Members.created_at <= end_date
+    ).order_by(Members.created_at.desc()).offset(skip).limit(limit).all()
+        
+    # 总体会员统计
+    total_members = db.query(func.count(Members.id)).scalar()
+    active_members = db.query(func.count(Members.id)).filter(
+        Members.total_orders > 0
+    ).scalar()
+        
+    # 会员等级分布
+    level_distribution = db.query(
+        Members.level,
+        func.count(Members.id).label('count')
+    ).group_by(Members.level).all()
+        
+    # 总积分和总消费
+    total_points = db.query(func.sum(Members.points)).scalar() or 0
+    total_spent = db.query(func.sum(Members.total_spent)).scalar() or 0
+        
+    members_list = []
+    for member in new_members:
+        members_list.append({
+            "id": member.id,
+            "phone": member.phone,
+            "name": member.name,
+            "level": member.level,
+            "points": member.points,
+            "total_spent": member.total_spent,
+            "total_orders": member.total_orders,
+            "created_at": member.created_at
+        })
+        
+    return {
+        "total_members": total_members,
+        "active_members": active_members,
+        "new_members_count": len(new_members),
+        "total_points": total_points,
+        "total_spent": round(total_spent, 2),
+        "level_distribution": [
+            {"level": item.level, "count": item.count}
+            for item in level_distribution
+        ],
+        "new_members": members_list
+    }
         
-    finally:
-        db.close()
 
 
 if __name__ == "__main__":
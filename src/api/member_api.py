@@ -2,14 +2,20 @@
 会员管理 API
 支持会员信息查询、积分兑换、等级管理等
 """
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Depends, Query
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
 from pydantic import BaseModel, Field
 from typing import Optional, List
 from datetime import datetime
-from storage.database.db import get_session
-from storage.database.shared.model import Members, PointLogs, MemberLevelRules, Orders, OrderItems, Stores
+from storage.database.db import get_session, get_db
+from storage.database.shared.model import Members, PointLogs, Orders, OrderItems, Stores
+from services.member_levels import (
+    compute_member_discount,
+    get_level_info,
+    get_member_levels as get_level_snapshot,
+    get_next_level_info,
+)
 import logging
 
 # 创建 FastAPI 应用
@@ -113,84 +119,44 @@ class OrderInfo(BaseModel):
 
 # ============ 工具函数 ============
 
-def get_member_level_info(level: int) -> dict:
+def get_member_level_info(level: int, db: Optional[Session] = None) -> dict:
     """
-    获取会员等级信息
+    获取会员等级信息（读取等级规则快照；快照过期时复用传入的会话重新加载）
     """
-    db = get_session()
-    try:
-        level_rule = db.query(MemberLevelRules).filter(
-            MemberLevelRules.level == level
-        ).first()
-        
-        if level_rule:
-            return {
-                "level": level_rule.level,
-                "level_name": level_rule.level_name,
-                "min_points": level_rule.min_points,
-                "discount": level_rule.discount
-            }
-        else:
-            # 默认等级信息
-            return {
-                "level": level,
-                "level_name": "普通会员",
-                "min_points": 0,
-                "discount": 1.0
-            }
-    finally:
-        db.close()
+    return get_level_info(level, db)
 
 
-def get_next_level(current_level: int) -> Optional[dict]:
+def get_next_level(current_level: int, db: Optional[Session] = None) -> Optional[dict]:
     """
     获取下一等级信息
     """
-    db = get_session()
-    try:
-        next_level = db.query(MemberLevelRules).filter(
-            MemberLevelRules.level > current_level
-        ).order_by(MemberLevelRules.level).first()
-        
-        if next_level:
-            return {
-                "level": next_level.level,
-                "level_name": next_level.level_name,
-                "min_points": next_level.min_points,
-                "discount": next_level.discount
-            }
-        return None
-    finally:
-        db.close()
+    return get_next_level_info(current_level, db)
 
 
-def calculate_discount(member_id: int, order_amount: float) -> dict:
+def calculate_discount(member_id: int, order_amount: float, db: Optional[Session] = None) -> dict:
     """
-    计算会员折扣
+    计算会员折扣（未传 db 时自行创建会话，整个计算只占用一个连接）
     """
-    db = get_session()
+    own_session = db is None
+    if own_session:
+        db = get_session()
     try:
         member = db.query(Members).filter(Members.id == member_id).first()
         if not member:
             raise HTTPException(status_code=404, detail="会员不存在")
         
-        # 获取等级信息
-        level_info = get_member_level_info(member.level)
-        discount_rate = level_info["discount"]
-        
-        # 计算折扣金额
-        discount_amount = order_amount * (1 - discount_rate)
-        final_amount = order_amount - discount_amount
+        discount = compute_member_discount(member.level, order_amount, db)
         
         return {
             "member_id": member_id,
             "original_amount": order_amount,
-            "discount_amount": round(discount_amount, 2),
-            "final_amount": round(final_amount, 2),
-            "discount_rate": discount_rate
+            "discount_amount": discount["discount_amount"],
+            "final_amount": discount["final_amount"],
+            "discount_rate": discount["discount_rate"]
         }
     finally:
-        db.close()
+        if own_session:
+            db.close()
 
 
 # ============ API 接口 ============
@@ -220,31 +186,14 @@ def get_member_levels():
     """
     获取会员等级列表
     """
-    db = get_session()
-    try:
-        levels = db.query(MemberLevelRules).order_by(MemberLevelRules.level).all()
-        
-        result = []
-        for level in levels:
-            result.append({
-                "level": level.level,
-                "level_name": level.level_name,
-                "min_points": level.min_points,
-                "discount": level.discount
-            })
-        
-        return result
-        
-    finally:
-        db.close()
+    return get_level_snapshot().all()
 
 
 @app.post("/api/member/register", response_model=MemberInfo)
-def register_member(request: RegisterMemberRequest):
+def register_member(request: RegisterMemberRequest, db: Session = Depends(get_db)):
     """
     注册会员
     """
-    db = get_session()
     try:
         # 检查手机号是否已注册
         existing_member = db.query(Members).filter(Members.phone == request.phone).first()
@@ -254,12 +203,12 @@ def register_member(request: RegisterMemberRequest):
                 phone=existing_member.phone,
                 name=existing_member.name,
                 level=existing_member.level,
-                level_name=get_member_level_info(existing_member.level)["level_name"],
+                level_name=get_member_level_info(existing_member.level, db)["level_name"],
                 points=existing_member.points,
                 total_spent=existing_member.total_spent,
                 total_orders=existing_member.total_orders,
                 avatar_url=existing_member.avatar_url,
-                discount=get_member_level_info(existing_member.level)["discount"]
+                discount=get_member_level_info(existing_member.level, db)["discount"]
             )
         
         # 创建新会员
@@ -275,7 +224,7 @@ def register_member(request: RegisterMemberRequest):
         db.commit()
         db.refresh(member)
         
-        level_info = get_member_level_info(member.level)
+        level_info = get_member_level_info(member.level, db)
         
         logger.info(f"会员注册成功: {member.phone}")
         
@@ -296,122 +245,108 @@ def register_member(request: RegisterMemberRequest):
         db.rollback()
         logger.error(f"注册会员失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"注册会员失败: {str(e)}")
-    finally:
-        db.close()
 
 
 @app.get("/api/member/{member_id}", response_model=MemberInfoResponse)
-def get_member_info(member_id: int):
+def get_member_info(member_id: int, db: Session = Depends(get_db)):
     """
     获取会员信息
     """
-    db = get_session()
-    try:
-        member = db.query(Members).filter(Members.id == member_id).first()
-        if not member:
-            raise HTTPException(status_code=404, detail="会员不存在")
+    member = db.query(Members).filter(Members.id == member_id).first()
+    if not member:
+        raise HTTPException(status_code=404, detail="会员不存在")
         
-        level_info = get_member_level_info(member.level)
-        next_level = get_next_level(member.level)
-        
-        return MemberInfoResponse(
-            member=MemberInfo(
-                id=member.id,
-                phone=member.phone,
-                name=member.name,
-                level=member.level,
-                level_name=level_info["level_name"],
-                points=member.points,
-                total_spent=member.total_spent,
-                total_orders=member.total_orders,
-                avatar_url=member.avatar_url,
-                discount=level_info["discount"]
-            ),
-            next_level=next_level
-        )
+    level_info = get_member_level_info(member.level, db)
+    next_level = get_next_level(member.level, db)
+        
+    return MemberInfoResponse(
+        member=MemberInfo(
+            id=member.id,
+            phone=member.phone,
+            name=member.name,
+            level=member.level,
+            level_name=level_info["level_name"],
+            points=member.points,
+            total_spent=member.total_spent,
+            total_orders=member.total_orders,
+            avatar_url=member.avatar_url,
+            discount=level_info["discount"]
+        ),
+        next_level=next_level
+    )
         
-    finally:
-        db.close()
 
 
 @app.get("/api/member/phone/{phone}", response_model=MemberInfoResponse)
-def get_member_by_phone(phone: str):
+def get_member_by_phone(phone: str, db: Session = Depends(get_db)):
     """
     通过手机号获取会员
     """
-    db = get_session()
-    try:
-        member = db.query(Members).filter(Members.phone == phone).first()
-        if not member:
-            raise HTTPException(status_code=404, detail="会员不存在")
+    member = db.query(Members).filter(Members.phone == phone).first()
+    if not member:
+        raise HTTPException(status_code=404, detail="会员不存在")
         
-        level_info = get_member_level_info(member.level)
-        next_level = get_next_level(member.level)
-        
-        return MemberInfoResponse(
-            member=MemberInfo(
-                id=member.id,
-                phone=member.phone,
-                name=member.name,
-                level=member.level,
-                level_name=level_info["level_name"],
-                points=member.points,
-                total_spent=member.total_spent,
-                total_orders=member.total_orders,
-                avatar_url=member.avatar_url,
-                discount=level_info["discount"]
-            ),
-            next_level=next_level
-        )
+    level_info = get_member_level_info(member.level, db)
+    next_level = get_next_level(member.level, db)
+        
+    return MemberInfoResponse(
+        member=MemberInfo(
+            id=member.id,
+            phone=member.phone,
+            name=member.name,
+            level=member.level,
+            level_name=level_info["level_name"],
+            points=member.points,
+            total_spent=member.total_spent,
+            total_orders=member.total_orders,
+            avatar_url=member.avatar_url,
+            discount=level_info["discount"]
+        ),
+        next_level=next_level
+    )
         
-    finally:
-        db.close()
 
 
 @app.get("/api/member/{member_id}/points-logs", response_model=List[PointLogInfo])
 def get_points_logs(
     member_id: int,
     skip: int = Query(0, ge=0),
-    limit: int = Query(20, ge=1, le=100)
+    limit: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_db)
 ):
     """
     获取积分日志
     """
-    db = get_session()
-    try:
-        # 验证会员存在
-        member = db.query(Members).filter(Members.id == member_id).first()
-        if not member:
-            raise HTTPException(status_code=404, detail="会员不存在")
+    # 验证会员存在
+    member = db.query(Members).filter(Members.id == member_id).first()
+    if not member:
+        raise HTTPException(status_code=404, detail="会员不存在")
         
-        # 查询积分日志
-        logs = db.query(PointLogs).filter(
-            PointLogs.member_id == member_id
-        ).order_by(PointLogs.created_at.desc()).offset(skip).limit(limit).all()
-        
-        result = []
-        for log in logs:
-            order = db.query(Orders).filter(Orders.id == log.order_id).first()
-            result.append(PointLogInfo(
-                id=log.id,
-                points=log.points,
-                reason=log.reason,
-                created_at=log.created_at,
-                order_number=order.order_number if order else None
-            ))
+    # 查询积分日志
+    logs = db.query(PointLogs).filter(
+        PointLogs.member_id == member_id
+    ).order_by(PointLogs.created_at.desc()).offset(skip).limit(limit).all()
         
-        return result
+    result = []
+    for log in logs:
+        order = db.query(Orders).filter(Orders.id == log.order_id).first()
+        result.append(PointLogInfo(
+            id=log.id,
+            points=log.points,
+            reason=log.reason,
+            created_at=log.created_at,
+            order_number=order.order_number if order else None
+        ))
+        
+    return result
         
-    finally:
-        db.close()
 
 
 @app.post("/api/member/redeem")
-def redeem_points(request: RedeemPointsRequest):
+def redeem_points(request: RedeemPointsRequest, db: Session = Depends(get_db)):
     """
     积分兑换
     """
-    db = get_session()
     try:
         # 获取会员
         member = db.query(Members).filter(Members.id == request.member_id).first()
@@ -450,8 +385,6 @@ def redeem_points(request: RedeemPointsRequest):
         db.rollback()
         logger.error(f"积分兑换失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"积分兑换失败: {str(e)}")
-    finally:
-        db.close()
 
 
 @app.post("/api/member/apply-discount", response_model=DiscountResponse)
@@ -474,92 +407,34 @@ def get_member_orders(
     member_id: int,
     skip: int = Query(0, ge=0),
     limit: int = Query(20, ge=1, le=100),
-    status: Optional[str] = Query(None, description="订单状态筛选")
+    status: Optional[str] = Query(None, description="订单状态筛选"),
+    db: Session = Depends(get_db)
 ):
     """
     获取会员订单列表
     """
-    db = get_session()
-    try:
-        # 验证会员存在
-        member = db.query(Members).filter(Members.id == member_id).first()
-        if not member:
-            raise HTTPException(status_code=404, detail="会员不存在")
+    # 验证会员存在
+    member = db.query(Members).filter(Members.id == member_id).first()
+    if not member:
+        raise HTTPException(status_code=404, detail="会员不存在")
         
-        # 查询订单（假设订单通过 customer_phone 关联会员）
-        query = db.query(Orders).join(Stores).filter(
-            Orders.customer_phone == member.phone
-        )
-        
-        if status:
-            query = query.filter(Orders.order_status == status)
-        
-        orders = query.order_by(Orders.created_at.desc()).offset(skip).limit(limit).all()
-        
-        result = []
-        for order in orders:
-            # 获取订单项
-            order_items = db.query(OrderItems).filter(
-                OrderItems.order_id == order.id
-            ).all()
-            
-            items = []
-            for item in order_items:
-                items.append(OrderItemInfo(
-                    item_name=item.item_name,
-                    quantity=item.quantity,
-                    price=item.price,
-                    subtotal=item.price * item.quantity
-                ))
-            
-            result.append(OrderInfo(
-                id=order.id,
-                order_number=order.order_number,
-                store_name=order.store.name if order.store else "未知店铺",
-                table_number=order.table.table_number if order.table else None,
-                total_amount=order.total_amount,
-                discount_amount=order.discount_amount,
-                final_amount=order.final_amount,
-                payment_method=order.payment_method,
-                payment_status=order.payment_status,
-                order_status=order.order_status,
-                created_at=order.created_at,
-                payment_time=order.payment_time,
-                items=items
-            ))
-        
-        return result
-        
-    finally:
-        db.close()
-
-
-@app.get("/api/member/{member_id}/orders/{order_id}", response_model=OrderInfo)
-def get_member_order_detail(member_id: int, order_id: int):
-    """
-    获取会员订单详情
-    """
-    db = get_session()
-    try:
-        # 验证会员存在
-        member = db.query(Members).filter(Members.id == member_id).first()
-        if not member:
-            raise HTTPException(status_code=404, detail="会员不存在")
+    # 查询订单（假设订单通过 customer_phone 关联会员）
+    query = db.query(Orders).join(Stores).filter(
+        Orders.customer_phone == member.phone
+    )
         
-        # 查询订单
-        order = db.query(Orders).join(Stores).filter(
-            Orders.id == order_id,
-            Orders.customer_phone == member.phone
-        ).first()
+    if status:
+        query = query.filter(Orders.order_status == status)
         
-        if not order:
-            raise HTTPException(status_code=404, detail="订单不存在")
+    orders = query.order_by(Orders.created_at.desc()).offset(skip).limit(limit).all()
         
+    result = []
+    for order in orders:
         # 获取订单项
         order_items = db.query(OrderItems).filter(
             OrderItems.order_id == order.id
         ).all()
-        
+            
         items = []
         for item in order_items:
             items.append(OrderItemInfo(
@@ -568,8 +443,8 @@ def get_member_order_detail(member_id: int, order_id: int):
                 price=item.price,
                 subtotal=item.price * item.quantity
             ))
-        
-        return OrderInfo(
+            
+        result.append(OrderInfo(
             id=order.id,
             order_number=order.order_number,
             store_name=order.store.name if order.store else "未知店铺",
@@ -583,10 +458,61 @@ def get_member_order_detail(member_id: int, order_id: int):
             created_at=order.created_at,
             payment_time=order.payment_time,
             items=items
-        )
+        ))
+        
+    return result
+        
+
+
+@app.get("/api/member/{member_id}/orders/{order_id}", response_model=OrderInfo)
+def get_member_order_detail(member_id: int, order_id: int, db: Session = Depends(get_db)):
+    """
+    获取会员订单详情
+    """
+    # 验证会员存在
+    member = db.query(Members).filter(Members.id == member_id).first()
+    if not member:
+        raise HTTPException(status_code=404, detail="会员不存在")
+        
+    # 查询订单
+    order = db.query(Orders).join(Stores).filter(
+        Orders.id == order_id,
+        Orders.customer_phone == member.phone
+    ).first()
+        
+    if not order:
+        raise HTTPException(status_code=404, detail="订单不存在")
+        
+    # 获取订单项
+    order_items = db.query(OrderItems).filter(
+        OrderItems.order_id == order.id
+    ).all()
+        
+    items = []
+    for item in order_items:
+        items.append(OrderItemInfo(
+            item_name=item.item_name,
+            quantity=item.quantity,
+            price=item.price,
+            subtotal=item.price * item.quantity
+        ))
+        
+    return OrderInfo(
+        id=order.id,
+        order_number=order.order_number,
+        store_name=order.store.name if order.store else "未知店铺",
+        table_number=order.table.table_number if order.table else None,
+        total_amount=order.total_amount,
+        discount_amount=order.discount_amount,
+        final_amount=order.final_amount,
+        payment_method=order.payment_method,
+        payment_status=order.payment_status,
+        order_status=order.order_status,
+        created_at=order.created_at,
+        payment_time=order.payment_time,
+        items=items
+    )
         
-    finally:
-        db.close()
 
 
 if __name__ == "__main__":
@@ -2,13 +2,19 @@
 会员管理 API Router
 支持会员信息查询、积分兑换、等级管理等
 """
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Depends
 from sqlalchemy.orm import Session
 from pydantic import BaseModel, Field
 from typing import Optional, List
 from datetime import datetime
-from storage.database.db import get_session
-from storage.database.shared.model import Members, PointLogs, MemberLevelRules, Orders, OrderItems, Stores
+from storage.database.db import get_session, get_db
+from storage.database.shared.model import Members, PointLogs, Orders, OrderItems, Stores
+from services.member_levels import (
+    compute_member_discount,
+    get_level_info,
+    get_member_levels as get_level_snapshot,
+    get_next_level_info,
+)
 import logging
 
 # 创建 API Router
@@ -103,84 +109,44 @@ class OrderInfo(BaseModel):
 
 # ============ 工具函数 ============
 
-def get_member_level_info(level: int) -> dict:
+def get_member_level_info(level: int, db: Optional[Session] = None) -> dict:
     """
-    获取会员等级信息
+    获取会员等级信息（读取等级规则快照；快照过期时复用传入的会话重新加载）
     """
-    db = get_session()
-    try:
-        level_rule = db.query(MemberLevelRules).filter(
-            MemberLevelRules.level == level
-        ).first()
-        
-        if level_rule:
-            return {
-                "level": level_rule.level,
-                "level_name": level_rule.level_name,
-                "min_points": level_rule.min_points,
-                "discount": level_rule.discount
-            }
-        else:
-            # 默认等级信息
-            return {
-                "level": level,
-                "level_name": "普通会员",
-                "min_points": 0,
-                "discount": 1.0
-            }
-    finally:
-        db.close()
+    return get_level_info(level, db)
 
 
-def get_next_level(current_level: int) -> Optional[dict]:
+def get_next_level(current_level: int, db: Optional[Session] = None) -> Optional[dict]:
     """
     获取下一等级信息
     """
-    db = get_session()
-    try:
-        next_level = db.query(MemberLevelRules).filter(
-            MemberLevelRules.level > current_level
-        ).order_by(MemberLevelRules.level).first()
-        
-        if next_level:
-            return {
-                "level": next_level.level,
-                "level_name": next_level.level_name,
-                "min_points": next_level.min_points,
-                "discount": next_level.discount
-            }
-        return None
-    finally:
-        db.close()
+    return get_next_level_info(current_level, db)
 
 
-def calculate_discount(member_id: int, order_amount: float) -> dict:
+def calculate_discount(member_id: int, order_amount: float, db: Optional[Session] = None) -> dict:
     """
-    计算会员折扣
+    计算会员折扣（未传 db 时自行创建会话，整个计算只占用一个连接）
     """
-    db = get_session()
+    own_session = db is None
+    if own_session:
+        db = get_session()
     try:
         member = db.query(Members).filter(Members.id == member_id).first()
         if not member:
             raise HTTPException(status_code=404, detail="会员不存在")
         
-        # 获取等级信息
-        level_info = get_member_level_info(member.level)
-        discount_rate = level_info["discount"]
-        
-        # 计算折扣金额
-        discount_amount = order_amount * (1 - discount_rate)
-        final_amount = order_amount - discount_amount
+        discount = compute_member_discount(member.level, order_amount, db)
         
         return {
             "member_id": member_id,
             "original_amount": order_amount,
-            "discount_amount": round(discount_amount, 2),
-            "final_amount": round(final_amount, 2),
-            "discount_rate": discount_rate
+            "discount_amount": discount["discount_amount"],
+            "final_amount": discount["final_amount"],
+            "discount_rate": discount["discount_rate"]
         }
     finally:
-        db.close()
+        if own_session:
+            db.close()
 
 
 # ============ API 接口 ============
@@ -190,193 +156,160 @@ def get_member_levels():
     """
     获取会员等级列表
     """
-    db = get_session()
-    try:
-        levels = db.query(MemberLevelRules).order_by(MemberLevelRules.level).all()
-        return [
-            {
-                "level": level.level,
-                "level_name": level.level_name,
-                "min_points": level.min_points,
-                "discount": level.discount
-            }
-            for level in levels
-        ]
-    finally:
-        db.close()
+    return get_level_snapshot().all()
 
 
 @router.post("/register", response_model=MemberInfo)
-def register_member(req: RegisterMemberRequest):
+def register_member(req: RegisterMemberRequest, db: Session = Depends(get_db)):
     """
     注册会员
     """
-    db = get_session()
-    try:
-        # 检查手机号是否已注册
-        existing = db.query(Members).filter(Members.phone == req.phone).first()
-        if existing:
-            raise HTTPException(status_code=400, detail="该手机号已注册会员")
+    # 检查手机号是否已注册
+    existing = db.query(Members).filter(Members.phone == req.phone).first()
+    if existing:
+        raise HTTPException(status_code=400, detail="该手机号已注册会员")
         
-        # 创建新会员（默认等级为1）
-        member = Members(
-            phone=req.phone,
-            name=req.name or "会员",
-            level=1,
-            points=0,
-            total_spent=0.0,
-            total_orders=0
-        )
-        db.add(member)
-        db.commit()
-        db.refresh(member)
+    # 创建新会员（默认等级为1）
+    member = Members(
+        phone=req.phone,
+        name=req.name or "会员",
+        level=1,
+        points=0,
+        total_spent=0.0,
+        total_orders=0
+    )
+    db.add(member)
+    db.commit()
+    db.refresh(member)
         
-        # 获取等级信息
-        level_info = get_member_level_info(member.level)
+    # 获取等级信息
+    level_info = get_member_level_info(member.level, db)
         
-        return MemberInfo(
-            id=member.id,
-            phone=member.phone,
-            name=member.name,
-            level=member.level,
-            level_name=level_info["level_name"],
-            points=member.points,
-            total_spent=member.total_spent,
-            total_orders=member.total_orders,
-            avatar_url=member.avatar_url,
-            discount=level_info["discount"]
-        )
-    finally:
-        db.close()
+    return MemberInfo(
+        id=member.id,
+        phone=member.phone,
+        name=member.name,
+        level=member.level,
+        level_name=level_info["level_name"],
+        points=member.points,
+        total_spent=member.total_spent,
+        total_orders=member.total_orders,
+        avatar_url=member.avatar_url,
+        discount=level_info["discount"]
+    )
 
 
 @router.get("/{member_id}", response_model=MemberInfoResponse)
-def get_member_info(member_id: int):
+def get_member_info(member_id: int, db: Session = Depends(get_db)):
     """
     获取会员信息
     """
-    db = get_session()
-    try:
-        member = db.query(Members).filter(Members.id == member_id).first()
-        if not member:
-            raise HTTPException(status_code=404, detail="会员不存在")
+    member = db.query(Members).filter(Members.id == member_id).first()
+    if not member:
+        raise HTTPException(status_code=404, detail="会员不存在")
         
-        # 获取等级信息
-        level_info = get_member_level_info(member.level)
-        next_level_info = get_next_level(member.level)
+    # 获取等级信息
+    level_info = get_member_level_info(member.level, db)
+    next_level_info = get_next_level(member.level, db)
         
-        member_info = MemberInfo(
-            id=member.id,
-            phone=member.phone,
-            name=member.name,
-            level=member.level,
-            level_name=level_info["level_name"],
-            points=member.points,
-            total_spent=member.total_spent,
-            total_orders=member.total_orders,
-            avatar_url=member.avatar_url,
-            discount=level_info["discount"]
-        )
+    member_info = MemberInfo(
+        id=member.id,
+        phone=member.phone,
+        name=member.name,
+        level=member.level,
+        level_name=level_info["level_name"],
+        points=member.points,
+        total_spent=member.total_spent,
+        total_orders=member.total_orders,
+        avatar_url=member.avatar_url,
+        discount=level_info["discount"]
+    )
         
-        return MemberInfoResponse(
-            member=member_info,
-            next_level=next_level_info
-        )
-    finally:
-        db.close()
+    return MemberInfoResponse(
+        member=member_info,
+        next_level=next_level_info
+    )
 
 
 @router.get("/phone/{phone}", response_model=MemberInfoResponse)
-def get_member_by_phone(phone: str):
+def get_member_by_phone(phone: str, db: Session = Depends(get_db)):
     """
     通过手机号获取会员信息
     """
-    db = get_session()
-    try:
-        member = db.query(Members).filter(Members.phone == phone).first()
-        if not member:
-            raise HTTPException(status_code=404, detail="会员不存在")
+    member = db.query(Members).filter(Members.phone == phone).first()
+    if not member:
+        raise HTTPException(status_code=404, detail="会员不存在")
         
-        # 获取等级信息
-        level_info = get_member_level_info(member.level)
-        next_level_info = get_next_level(member.level)
+    # 获取等级信息
+    level_info = get_member_level_info(member.level, db)
+    next_level_info = get_next_level(member.level, db)
         
-        member_info = MemberInfo(
-            id=member.id,
-            phone=member.phone,
-            name=member.name,
-            level=member.level,
-            level_name=level_info["level_name"],
-            points=member.points,
-            total_spent=member.total_spent,
-            total_orders=member.total_orders,
-            avatar_url=member.avatar_url,
-            discount=level_info["discount"]
-        )
+    member_info = MemberInfo(
+        id=member.id,
+        phone=member.phone,
+        name=member.name,
+        level=member.level,
+        level_name=level_info["level_name"],
+        points=member.points,
+        total_spent=member.total_spent,
+        total_orders=member.total_orders,
+        avatar_url=member.avatar_url,
+        discount=level_info["discount"]
+    )
         
-        return MemberInfoResponse(
-            member=member_info,
-            next_level=next_level_info
-        )
-    finally:
-        db.close()
+    return MemberInfoResponse(
+        member=member_info,
+        next_level=next_level_info
+    )
 
 
 @router.get("/{member_id}/points-logs", response_model=List[PointLogInfo])
-def get_member_points_logs(member_id: int):
+def get_member_points_logs(member_id: int, db: Session = Depends(get_db)):
     """
     获取会员积分日志
     """
-    db = get_session()
-    try:
-        member = db.query(Members).filter(Members.id == member_id).first()
-        if not member:
-            raise HTTPException(status_code=404, detail="会员不存在")
+    member = db.query(Members).filter(Members.id == member_id).first()
+    if not member:
+        raise HTTPException(status_code=404, detail="会员不存在")
         
-        logs = db.query(PointLogs).filter(
-            PointLogs.member_id == member_id
-        ).order_by(PointLogs.created_at.desc()).limit(50).all()
+    logs = db.query(PointLogs).filter(
+        PointLogs.member_id == member_id
+    ).order_by(PointLogs.created_at.desc()).limit(50).all()
         
-        return [
-            PointLogInfo(
-                id=log.id,
-                points=log.points,
-                reason=log.reason,
-                created_at=log.created_at,
-                order_number=log.order_number
-            )
-            for log in logs
-        ]
-    finally:
-        db.close()
+    return [
+        PointLogInfo(
+            id=log.id,
+            points=log.points,
+            reason=log.reason,
+            created_at=log.created_at,
+            order_number=log.order_number
+        )
+        for log in logs
+    ]
 
 
 @router.post("/redeem")
-def redeem_points(req: RedeemPointsRequest):
+def redeem_points(req: RedeemPointsRequest, db: Session = Depends(get_db)):
     """
     积分兑换
     """
-    db = get_session()
-    try:
-        member = db.query(Members).filter(Members.id == req.member_id).first()
-        if not member:
-            raise HTTPException(status_code=404, detail="会员不存在")
+    member = db.query(Members).filter(Members.id == req.member_id).first()
+    if not member:
+        raise HTTPException(status_code=404, detail="会员不存在")
         
-        if member.points < req.points:
-            raise HTTPException(status_code=400, detail="积分不足")
+    if member.points < req.points:
+        raise HTTPException(status_code=400, detail="积分不足")
         
-        # 扣除积分
-        member.points -= req.points
-        db.add(PointLogs(
-            member_id=member.id,
-            points=-req.points,
-            reason=req.reason
-        ))
-        db.commit()
+    # 扣除积分
+    member.points -= req.points
+    db.add(PointLogs(
+        member_id=member.id,
+        points=-req.points,
+        reason=req.reason
+    ))
+    db.commit()
         
-        return {"message": "积分兑换成功", "remaining_points": member.points}
-    finally:
-        db.close()
+    return {"message": "积分兑换成功", "remaining_points": member.points}
 
 
 @router.post("/apply-discount", response_model=DiscountResponse)
@@ -389,76 +322,24 @@ def apply_discount(req: ApplyDiscountRequest):
 
 
 @router.get("/{member_id}/orders", response_model=List[OrderInfo])
-def get_member_orders(member_id: int, limit: int = 10):
+def get_member_orders(member_id: int, limit: int = 10, db: Session = Depends(get_db)):
     """
     获取会员订单列表
     """
-    db = get_session()
-    try:
-        member = db.query(Members).filter(Members.id == member_id).first()
-        if not member:
-            raise HTTPException(status_code=404, detail="会员不存在")
-        
-        orders = db.query(Orders).filter(
-            Orders.member_id == member_id
-        ).order_by(Orders.created_at.desc()).limit(limit).all()
+    member = db.query(Members).filter(Members.id == member_id).first()
+    if not member:
+        raise HTTPException(status_code=404, detail="会员不存在")
         
-        result = []
-        for order in orders:
-            order_items = db.query(OrderItems).filter(
-                OrderItems.order_id == order.id
-            ).all()
-            
-            items = [
-                OrderItemInfo(
-                    item_name=oi.menu_item_name or "",
-                    quantity=oi.quantity,
-                    price=float(oi.price),
-                    subtotal=float(oi.subtotal)
-                )
-                for oi in order_items
-            ]
-            
-            result.append(OrderInfo(
-                id=order.id,
-                order_number=order.order_number,
-                store_name=order.store.name if order.store else "",
-                table_number=order.table.table_number if order.table else None,
-                total_amount=float(order.total_amount),
-                discount_amount=float(order.discount_amount or 0),
-                final_amount=float(order.total_amount - (order.discount_amount or 0)),
-                payment_method=order.payment_method,
-                payment_status=order.payment_status,
-                order_status=order.order_status,
-                created_at=order.created_at,
-                payment_time=order.payment_time,
-                items=items
-            ))
-        
-        return result
-    finally:
-        db.close()
-
-
-@router.get("/{member_id}/orders/{order_id}", response_model=OrderInfo)
-def get_member_order_detail(member_id: int, order_id: int):
-    """
-    获取会员订单详情
-    """
-    db = get_session()
-    try:
-        order = db.query(Orders).filter(
-            Orders.id == order_id,
-            Orders.member_id == member_id
-        ).first()
-        
-        if not order:
-            raise HTTPException(status_code=404, detail="订单不存在")
+    orders = db.query(Orders).filter(
+        Orders.member_id == member_id
+    ).order_by(Orders.created_at.desc()).limit(limit).all()
         
+    result = []
+    for order in orders:
         order_items = db.query(OrderItems).filter(
             OrderItems.order_id == order.id
         ).all()
-        
+            
         items = [
             OrderItemInfo(
                 item_name=oi.menu_item_name or "",
@@ -468,8 +349,8 @@ def get_member_order_detail(member_id: int, order_id: int):
             )
             for oi in order_items
         ]
-        
-        return OrderInfo(
+            
+        result.append(OrderInfo(
             id=order.id,
             order_number=order.order_number,
             store_name=order.store.name if order.store else "",
@@ -483,6 +364,50 @@ def get_member_order_detail(member_id: int, order_id: int):
             created_at=order.created_at,
             payment_time=order.payment_time,
             items=items
+        ))
+        
+    return result
+
+
+@router.get("/{member_id}/orders/{order_id}", response_model=OrderInfo)
+def get_member_order_detail(member_id: int, order_id: int, db: Session = Depends(get_db)):
+    """
+    获取会员订单详情
+    """
+    order = db.query(Orders).filter(
+        Orders.id == order_id,
+        Orders.member_id == member_id
+    ).first()
+        
+    if not order:
+        raise HTTPException(status_code=404, detail="订单不存在")
+        
+    order_items = db.query(OrderItems).filter(
+        OrderItems.order_id == order.id
+    ).all()
+        
+    items = [
+        OrderItemInfo(
+            item_name=oi.menu_item_name or "",
+            quantity=oi.quantity,
+            price=float(oi.price),
+            subtotal=float(oi.subtotal)
         )
-    finally:
-        db.close()
+        for oi in order_items
+    ]
+        
+    return OrderInfo(
+        id=order.id,
+        order_number=order.order_number,
+        store_name=order.store.name if order.store else "",
+        table_number=order.table.table_number if order.table else None,
+        total_amount=float(order.total_amount),
+        discount_amount=float(order.discount_amount or 0),
+        final_amount=float(order.total_amount - (order.discount_amount or 0)),
+        payment_method=order.payment_method,
+        payment_status=order.payment_status,
+        order_status=order.order_status,
+        created_at=order.created_at,
+        payment_time=order.payment_time,
+        items=items
+    )
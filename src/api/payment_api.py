@@ -2,16 +2,16 @@
 支付功能 API
 支持微信支付、支付宝等多种支付方式
 """
-from fastapi import FastAPI, HTTPException, Query, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Depends, Query, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
 from pydantic import BaseModel, Field
 from typing import Optional
 from datetime import datetime
-import random
-import string
-from storage.database.db import get_session
+from storage.database.db import get_session, get_db
 from storage.database.shared.model import Orders, Payments, Members, PointLogs
+from services.revenue_rollup import apply_event, record_order_paid
+from services.id_generator import next_transaction_id
 import asyncio
 import logging
 
@@ -73,13 +73,6 @@ class PaymentCallbackRequest(BaseModel):
 
 # ============ 工具函数 ============
 
-def generate_transaction_id() -> str:
-    """生成交易号"""
-    now = datetime.now()
-    random_str = ''.join(random.choices(string.digits, k=8))
-    return f"TXN{now.strftime('%Y%m%d%H%M%S')}{random_str}"
-
-
 async def process_payment_success(payment_id: int, db: Session):
     """
     处理支付成功
@@ -95,11 +88,13 @@ async def process_payment_success(payment_id: int, db: Session):
         
         # 更新支付状态
         payment.status = "success"
-        payment.transaction_id = payment.transaction_id or generate_transaction_id()
+        payment.transaction_id = payment.transaction_id or next_transaction_id()
         payment.payment_time = datetime.now()
         
         # 更新订单支付状态
-        order = db.query(Orders).filter(Orders.id == payment.order_id).first()
+        # 锁定订单行直到提交，重复 / 并发回调在此排队，只有第一次看到未支付状态
+        order = db.query(Orders).filter(Orders.id == payment.order_id).with_for_update().first()
+        was_paid = order is not None and order.payment_status == "paid"
         if order:
             order.payment_status = "paid"
             order.payment_method = payment.payment_method
@@ -107,6 +102,10 @@ async def process_payment_success(payment_id: int, db: Session):
         
         db.commit()
         
+        # 更新每日营收汇总（重复回调不重复计入）
+        if order and not was_paid:
+            apply_event(db, record_order_paid, order)
+        
         # 增加会员积分（如果顾客是会员）
         if order and order.customer_phone:
             member = db.query(Members).filter(Members.phone == order.customer_phone).first()
@@ -156,11 +155,10 @@ def root():
 
 
 @app.post("/api/payment/create", response_model=PaymentResponse)
-def create_payment(request: CreatePaymentRequest, background_tasks: BackgroundTasks):
+def create_payment(request: CreatePaymentRequest, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
     """
     创建支付订单
     """
-    db = get_session()
     try:
         # 获取订单
         order = db.query(Orders).filter(Orders.id == request.order_id).first()
@@ -226,36 +224,30 @@ def create_payment(request: CreatePaymentRequest, background_tasks: BackgroundTa
         db.rollback()
         logger.error(f"创建支付订单失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"创建支付订单失败: {str(e)}")
-    finally:
-        db.close()
 
 
 @app.get("/api/payment/{payment_id}/status", response_model=PaymentStatusResponse)
-def get_payment_status(payment_id: int):
+def get_payment_status(payment_id: int, db: Session = Depends(get_db)):
     """
     查询支付状态
     """
-    db = get_session()
-    try:
-        payment = db.query(Payments).filter(Payments.id == payment_id).first()
-        if not payment:
-            raise HTTPException(status_code=404, detail="支付记录不存在")
+    payment = db.query(Payments).filter(Payments.id == payment_id).first()
+    if not payment:
+        raise HTTPException(status_code=404, detail="支付记录不存在")
         
-        order = db.query(Orders).filter(Orders.id == payment.order_id).first()
+    order = db.query(Orders).filter(Orders.id == payment.order_id).first()
         
-        return PaymentStatusResponse(
-            payment_id=payment.id,
-            order_id=payment.order_id,
-            order_number=order.order_number if order else "",
-            amount=payment.amount,
-            payment_method=payment.payment_method,
-            status=payment.status,
-            transaction_id=payment.transaction_id,
-            paid_at=payment.payment_time
-        )
+    return PaymentStatusResponse(
+        payment_id=payment.id,
+        order_id=payment.order_id,
+        order_number=order.order_number if order else "",
+        amount=payment.amount,
+        payment_method=payment.payment_method,
+        status=payment.status,
+        transaction_id=payment.transaction_id,
+        paid_at=payment.payment_time
+    )
         
-    finally:
-        db.close()
 
 
 @app.post("/api/payment/callback")
@@ -310,11 +302,10 @@ def payment_callback(request: PaymentCallbackRequest, background_tasks: Backgrou
 
 
 @app.post("/api/payment/{payment_id}/cancel")
-def cancel_payment(payment_id: int):
+def cancel_payment(payment_id: int, db: Session = Depends(get_db)):
     """
     取消支付
     """
-    db = get_session()
     try:
         payment = db.query(Payments).filter(Payments.id == payment_id).first()
         if not payment:
@@ -344,8 +335,6 @@ def cancel_payment(payment_id: int):
         db.rollback()
         logger.error(f"取消支付失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"取消支付失败: {str(e)}")
-    finally:
-        db.close()
 
 
 @app.get("/api/payment/methods")
@@ -8,8 +8,11 @@ from sqlalchemy.orm import Session
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 from datetime import datetime
-from storage.database.db import get_session
+from storage.database.db import get_db
 from storage.database.shared.model import Users, Roles, UserRoles, Stores, Companies
+from services.permission_engine import (
+    get_user_permissions, accessible_store_ids, invalidate_user, invalidate_roles
+)
 
 # 创建 FastAPI 应用
 app = FastAPI(title="扫码点餐系统 - 权限管理API", version="1.0.0")
@@ -167,7 +170,7 @@ def check_user_permission(db: Session, user_id: int, permission: str, store_id:
     检查用户是否有指定权限
     
     Args:
-        db: 数据库会话
+        db: 数据库会话（缓存未命中时用于加载权限）
         user_id: 用户ID
         permission: 要检查的权限
         store_id: 店铺ID（用于店铺级权限检查）
@@ -175,39 +178,16 @@ def check_user_permission(db: Session, user_id: int, permission: str, store_id:
     Returns:
         bool: 是否有权限
     """
-    # 获取用户的所有角色
-    user_roles = db.query(UserRoles).filter(UserRoles.user_id == user_id).all()
-    
-    if not user_roles:
-        return False
-    
-    for user_role in user_roles:
-        role = db.query(Roles).filter(Roles.id == user_role.role_id).first()
-        if not role:
-            continue
-        
-        # 获取角色权限
-        permissions = role.permissions.get("permissions", []) if role.permissions else []
-        
-        # 检查是否拥有全部权限
-        if "all:access" in permissions:
-            return True
-        
-        # 检查具体权限
-        if permission in permissions:
-            # 如果是店铺级权限，检查店铺ID
-            if store_id and user_role.store_id:
-                if user_role.store_id != store_id:
-                    continue
-            return True
-    
-    return False
+    # 生效权限由 permission_engine 编译并缓存，命中时不访问数据库
+    return get_user_permissions(user_id, db).has(permission, store_id)
 
 
 def get_user_stores(db: Session, user_id: int) -> List[int]:
     """
     获取用户有权限的店铺ID列表
     
+    管理员和总公司可以访问所有启用店铺，店长和店员通过Staff表获取店铺ID
+    
     Args:
         db: 数据库会话
         user_id: 用户ID
@@ -215,38 +195,7 @@ def get_user_stores(db: Session, user_id: int) -> List[int]:
     Returns:
         店铺ID列表
     """
-    # 获取用户的所有角色
-    user_roles = db.query(UserRoles).filter(UserRoles.user_id == user_id).all()
-    
-    store_ids = []
-    
-    for user_role in user_roles:
-        role = db.query(Roles).filter(Roles.id == user_role.role_id).first()
-        if not role:
-            continue
-        
-        permissions = role.permissions.get("permissions", []) if role.permissions else []
-        
-        # 管理员可以访问所有店铺
-        if "all:access" in permissions:
-            stores = db.query(Stores).filter(Stores.is_active == True).all()
-            store_ids.extend([s.id for s in stores])
-            continue
-        
-        # 总公司可以访问所有店铺
-        if "store:create" in permissions and "store:update" in permissions:
-            stores = db.query(Stores).filter(Stores.is_active == True).all()
-            store_ids.extend([s.id for s in stores])
-            continue
-        
-        # 店长和店员通过Staff表获取店铺ID
-        from storage.database.shared.model import Staff
-        staff = db.query(Staff).filter(Staff.user_id == user_id).first()
-        if staff and staff.is_active:
-            store_ids.append(staff.store_id)
-    
-    # 去重
-    return list(set(store_ids))
+    return sorted(accessible_store_ids(user_id, db))
 
 
 # ============ API 接口 ============
@@ -271,267 +220,240 @@ def root():
 
 
 @app.post("/api/permission/init-roles")
-def init_roles():
+def init_roles(db: Session = Depends(get_db)):
     """
     初始化系统角色
     如果角色已存在则更新权限，不存在则创建
     """
-    db = get_session()
-    try:
-        count = initialize_roles(db)
-        return {
-            "message": f"成功初始化/更新 {count} 个角色",
-            "roles": list(ROLE_PERMISSIONS.keys())
-        }
-    finally:
-        db.close()
+    count = initialize_roles(db)
+    invalidate_roles()
+    return {
+        "message": f"成功初始化/更新 {count} 个角色",
+        "roles": list(ROLE_PERMISSIONS.keys())
+    }
 
 
 @app.get("/api/permission/roles", response_model=List[RoleResponse])
-def get_roles():
+def get_roles(db: Session = Depends(get_db)):
     """
     获取所有角色
     """
-    db = get_session()
-    try:
-        roles = db.query(Roles).all()
-        return [
-            RoleResponse(
-                id=role.id,
-                name=role.name,
-                description=role.description,
-                permissions=role.permissions.get("permissions", []) if role.permissions else [],
-                created_at=role.created_at
-            )
-            for role in roles
-        ]
-    finally:
-        db.close()
+    roles = db.query(Roles).all()
+    return [
+        RoleResponse(
+            id=role.id,
+            name=role.name,
+            description=role.description,
+            permissions=role.permissions.get("permissions", []) if role.permissions else [],
+            created_at=role.created_at
+        )
+        for role in roles
+    ]
 
 
 @app.post("/api/permission/role", response_model=RoleResponse)
-def create_role(request: RoleCreateRequest):
+def create_role(request: RoleCreateRequest, db: Session = Depends(get_db)):
     """
     创建角色
     """
-    db = get_session()
-    try:
-        # 检查角色名称是否已存在
-        existing_role = db.query(Roles).filter(Roles.name == request.name).first()
-        if existing_role:
-            raise HTTPException(status_code=400, detail="角色名称已存在")
+    # 检查角色名称是否已存在
+    existing_role = db.query(Roles).filter(Roles.name == request.name).first()
+    if existing_role:
+        raise HTTPException(status_code=400, detail="角色名称已存在")
         
-        role = Roles(
-            name=request.name,
-            description=request.description,
-            permissions={"permissions": request.permissions}
-        )
-        db.add(role)
-        db.commit()
-        db.refresh(role)
+    role = Roles(
+        name=request.name,
+        description=request.description,
+        permissions={"permissions": request.permissions}
+    )
+    db.add(role)
+    db.commit()
+    db.refresh(role)
+    invalidate_roles()
         
-        return RoleResponse(
-            id=role.id,
-            name=role.name,
-            description=role.description,
-            permissions=role.permissions.get("permissions", []),
-            created_at=role.created_at
-        )
-    finally:
-        db.close()
+    return RoleResponse(
+        id=role.id,
+        name=role.name,
+        description=role.description,
+        permissions=role.permissions.get("permissions", []),
+        created_at=role.created_at
+    )
 
 
 @app.post("/api/permission/user-role", response_model=UserRoleResponse)
-def assign_user_role(request: UserRoleCreateRequest):
+def assign_user_role(request: UserRoleCreateRequest, db: Session = Depends(get_db)):
     """
     分配用户角色
     """
-    db = get_session()
-    try:
-        # 检查用户是否存在
-        user = db.query(Users).filter(Users.id == request.user_id).first()
-        if not user:
-            raise HTTPException(status_code=404, detail="用户不存在")
+    # 检查用户是否存在
+    user = db.query(Users).filter(Users.id == request.user_id).first()
+    if not user:
+        raise HTTPException(status_code=404, detail="用户不存在")
         
-        # 检查角色是否存在
-        role = db.query(Roles).filter(Roles.id == request.role_id).first()
-        if not role:
-            raise HTTPException(status_code=404, detail="角色不存在")
+    # 检查角色是否存在
+    role = db.query(Roles).filter(Roles.id == request.role_id).first()
+    if not role:
+        raise HTTPException(status_code=404, detail="角色不存在")
         
-        # 检查是否已经分配过该角色
-        existing = db.query(UserRoles).filter(
-            UserRoles.user_id == request.user_id,
-            UserRoles.role_id == request.role_id
-        ).first()
-        if existing:
-            raise HTTPException(status_code=400, detail="用户已分配该角色")
+    # 检查是否已经分配过该角色
+    existing = db.query(UserRoles).filter(
+        UserRoles.user_id == request.user_id,
+        UserRoles.role_id == request.role_id
+    ).first()
+    if existing:
+        raise HTTPException(status_code=400, detail="用户已分配该角色")
         
-        # 店员角色必须有店铺ID，需要创建Staff记录
-        if role.name == "店员":
-            if not request.store_id:
-                raise HTTPException(status_code=400, detail="店员角色必须指定店铺ID")
+    # 店员角色必须有店铺ID，需要创建Staff记录
+    if role.name == "店员":
+        if not request.store_id:
+            raise HTTPException(status_code=400, detail="店员角色必须指定店铺ID")
             
-            # 检查店铺是否存在
-            store = db.query(Stores).filter(Stores.id == request.store_id).first()
-            if not store:
-                raise HTTPException(status_code=404, detail="店铺不存在")
+        # 检查店铺是否存在
+        store = db.query(Stores).filter(Stores.id == request.store_id).first()
+        if not store:
+            raise HTTPException(status_code=404, detail="店铺不存在")
             
-            # 检查是否已有Staff记录
-            from storage.database.shared.model import Staff
-            existing_staff = db.query(Staff).filter(
-                Staff.user_id == request.user_id,
-                Staff.store_id == request.store_id
-            ).first()
+        # 检查是否已有Staff记录
+        from storage.database.shared.model import Staff
+        existing_staff = db.query(Staff).filter(
+            Staff.user_id == request.user_id,
+            Staff.store_id == request.store_id
+        ).first()
             
-            if not existing_staff:
-                # 创建Staff记录
-                staff = Staff(
-                    user_id=request.user_id,
-                    store_id=request.store_id,
-                    position="店员",
-                    is_active=True
-                )
-                db.add(staff)
+        if not existing_staff:
+            # 创建Staff记录
+            staff = Staff(
+                user_id=request.user_id,
+                store_id=request.store_id,
+                position="店员",
+                is_active=True
+            )
+            db.add(staff)
         
-        user_role = UserRoles(
-            user_id=request.user_id,
-            role_id=request.role_id
-        )
-        db.add(user_role)
-        db.commit()
-        db.refresh(user_role)
+    user_role = UserRoles(
+        user_id=request.user_id,
+        role_id=request.role_id
+    )
+    db.add(user_role)
+    db.commit()
+    db.refresh(user_role)
+    invalidate_user(request.user_id)
         
-        # 获取店铺ID
-        store_id = request.store_id
-        if not store_id:
-            from storage.database.shared.model import Staff
-            staff = db.query(Staff).filter(Staff.user_id == request.user_id).first()
-            if staff:
-                store_id = staff.store_id
+    # 获取店铺ID
+    store_id = request.store_id
+    if not store_id:
+        from storage.database.shared.model import Staff
+        staff = db.query(Staff).filter(Staff.user_id == request.user_id).first()
+        if staff:
+            store_id = staff.store_id
         
-        return UserRoleResponse(
-            id=user_role.id,
-            user_id=user_role.user_id,
-            user_name=user.name,
-            role_id=user_role.role_id,
-            role_name=role.name,
-            store_id=store_id,
-            created_at=user_role.created_at
-        )
-    finally:
-        db.close()
+    return UserRoleResponse(
+        id=user_role.id,
+        user_id=user_role.user_id,
+        user_name=user.name,
+        role_id=user_role.role_id,
+        role_name=role.name,
+        store_id=store_id,
+        created_at=user_role.created_at
+    )
 
 
 @app.get("/api/permission/user/{user_id}/roles", response_model=List[UserRoleResponse])
-def get_user_roles(user_id: int):
+def get_user_roles(user_id: int, db: Session = Depends(get_db)):
     """
     获取用户的所有角色
     """
-    db = get_session()
-    try:
-        # 检查用户是否存在
-        user = db.query(Users).filter(Users.id == user_id).first()
-        if not user:
-            raise HTTPException(status_code=404, detail="用户不存在")
+    # 检查用户是否存在
+    user = db.query(Users).filter(Users.id == user_id).first()
+    if not user:
+        raise HTTPException(status_code=404, detail="用户不存在")
         
-        user_roles = db.query(UserRoles).filter(UserRoles.user_id == user_id).all()
+    user_roles = db.query(UserRoles).filter(UserRoles.user_id == user_id).all()
         
-        result = []
-        for ur in user_roles:
-            role = db.query(Roles).filter(Roles.id == ur.role_id).first()
-            if role:
-                # 查找关联的店铺ID（通过Staff表）
-                store_id = None
-                from storage.database.shared.model import Staff
-                staff = db.query(Staff).filter(Staff.user_id == ur.user_id).first()
-                if staff:
-                    store_id = staff.store_id
+    result = []
+    for ur in user_roles:
+        role = db.query(Roles).filter(Roles.id == ur.role_id).first()
+        if role:
+            # 查找关联的店铺ID（通过Staff表）
+            store_id = None
+            from storage.database.shared.model import Staff
+            staff = db.query(Staff).filter(Staff.user_id == ur.user_id).first()
+            if staff:
+                store_id = staff.store_id
                 
-                result.append(UserRoleResponse(
-                    id=ur.id,
-                    user_id=ur.user_id,
-                    user_name=user.name,
-                    role_id=ur.role_id,
-                    role_name=role.name,
-                    store_id=store_id,
-                    created_at=ur.created_at
-                ))
+            result.append(UserRoleResponse(
+                id=ur.id,
+                user_id=ur.user_id,
+                user_name=user.name,
+                role_id=ur.role_id,
+                role_name=role.name,
+                store_id=store_id,
+                created_at=ur.created_at
+            ))
         
-        return result
-    finally:
-        db.close()
+    return result
 
 
 @app.delete("/api/permission/user-role/{user_role_id}")
-def remove_user_role(user_role_id: int):
+def remove_user_role(user_role_id: int, db: Session = Depends(get_db)):
     """
     移除用户角色
     """
-    db = get_session()
-    try:
-        user_role = db.query(UserRoles).filter(UserRoles.id == user_role_id).first()
-        if not user_role:
-            raise HTTPException(status_code=404, detail="用户角色关联不存在")
+    user_role = db.query(UserRoles).filter(UserRoles.id == user_role_id).first()
+    if not user_role:
+        raise HTTPException(status_code=404, detail="用户角色关联不存在")
         
-        db.delete(user_role)
-        db.commit()
+    user_id = user_role.user_id
+    db.delete(user_role)
+    db.commit()
+    invalidate_user(user_id)
         
-        return {"message": "成功移除用户角色"}
-    finally:
-        db.close()
+    return {"message": "成功移除用户角色"}
 
 
 @app.post("/api/permission/check")
-def check_permission(request: PermissionCheckRequest):
+def check_permission(request: PermissionCheckRequest, db: Session = Depends(get_db)):
     """
     检查用户是否有指定权限
     """
-    db = get_session()
-    try:
-        has_permission = check_user_permission(
-            db,
-            request.user_id,
-            request.permission,
-            request.store_id
-        )
+    has_permission = check_user_permission(
+        db,
+        request.user_id,
+        request.permission,
+        request.store_id
+    )
         
-        return {
-            "has_permission": has_permission,
-            "user_id": request.user_id,
-            "permission": request.permission
-        }
-    finally:
-        db.close()
+    return {
+        "has_permission": has_permission,
+        "user_id": request.user_id,
+        "permission": request.permission
+    }
 
 
 @app.get("/api/permission/user/{user_id}/stores")
-def get_user_accessible_stores(user_id: int):
+def get_user_accessible_stores(user_id: int, db: Session = Depends(get_db)):
     """
     获取用户有权限的店铺列表
     """
-    db = get_session()
-    try:
-        # 检查用户是否存在
-        user = db.query(Users).filter(Users.id == user_id).first()
-        if not user:
-            raise HTTPException(status_code=404, detail="用户不存在")
+    # 检查用户是否存在
+    user = db.query(Users).filter(Users.id == user_id).first()
+    if not user:
+        raise HTTPException(status_code=404, detail="用户不存在")
         
-        store_ids = get_user_stores(db, user_id)
+    store_ids = get_user_stores(db, user_id)
         
-        # 获取店铺详细信息
-        stores = db.query(Stores).filter(Stores.id.in_(store_ids)).all()
+    # 获取店铺详细信息
+    stores = db.query(Stores).filter(Stores.id.in_(store_ids)).all()
         
-        return [
-            {
-                "id": store.id,
-                "name": store.name,
-                "address": store.address,
-                "is_active": store.is_active
-            }
-            for store in stores
-        ]
-    finally:
-        db.close()
+    return [
+        {
+            "id": store.id,
+            "name": store.name,
+            "address": store.address,
+            "is_active": store.is_active
+        }
+        for store in stores
+    ]
 
 
 if __name__ == "__main__":
@@ -2,15 +2,18 @@
 小票打印 API
 支持小票打印、小票模板配置、功能区设置
 """
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Depends, Query
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 from datetime import datetime
-from storage.database.db import get_session
+from storage.database.db import get_db
 from storage.database.shared.model import Orders, OrderItems, Stores, Tables, Users, Payments
-from jinja2 import Template
+from services.receipt_renderer import (
+    MAX_BATCH_ORDERS, ReceiptContext, compile_sections, render_sections, render_receipt,
+    load_receipt_contexts
+)
 import logging
 
 # 创建 FastAPI 应用
@@ -65,6 +68,12 @@ class PrintReceiptRequest(BaseModel):
     config_id: Optional[int] = Field(None, description="小票配置ID（不传则使用默认配置）")
 
 
+class BatchRenderRequest(BaseModel):
+    """批量渲染小票请求"""
+    order_ids: List[int] = Field(..., description="订单ID列表")
+    config_id: Optional[int] = Field(None, description="小票配置ID（不传则使用默认配置）")
+
+
 # ============ 小票模板 ============
 
 # 默认小票功能区配置
@@ -176,32 +185,15 @@ def generate_receipt_content(
     Returns:
         小票文本内容
     """
-    # 按排序排序功能区
-    sorted_sections = sorted(
-        [s for s in sections if s.get("is_enabled", True)],
-        key=lambda x: x.get("sort_order", 0)
+    # 功能区模板按配置编译一次后缓存，不再每次重新解析
+    return render_sections(
+        compile_sections(sections),
+        order=order,
+        store=store,
+        table=table,
+        items=items,
+        member_info=member_info
     )
-    
-    receipt_content = ""
-    
-    for section in sorted_sections:
-        template_str = section.get("template", "")
-        if not template_str:
-            continue
-        
-        # 渲染模板
-        template = Template(template_str)
-        content = template.render(
-            order=order,
-            store=store,
-            table=table,
-            items=items,
-            member_info=member_info
-        )
-        
-        receipt_content += content + "\n"
-    
-    return receipt_content.strip()
 
 
 def get_member_info(db: Session, order: Orders) -> str:
@@ -231,6 +223,20 @@ def get_default_config() -> List[Dict[str, Any]]:
     return DEFAULT_RECEIPT_SECTIONS
 
 
+def load_receipt_context(db: Session, order_id: int) -> ReceiptContext:
+    """加载单个订单的小票数据（一条查询），数据不完整时抛出 404"""
+    context = load_receipt_contexts(db, [order_id]).get(order_id)
+    if context is None:
+        raise HTTPException(status_code=404, detail="订单不存在")
+    if context.store is None:
+        raise HTTPException(status_code=404, detail="店铺不存在")
+    if context.table is None:
+        raise HTTPException(status_code=404, detail="桌号不存在")
+    if not context.items:
+        raise HTTPException(status_code=404, detail="订单项不存在")
+    return context
+
+
 # ============ API 接口 ============
 
 @app.get("/")
@@ -246,121 +252,104 @@ def root():
             "GET /api/receipt/store/{store_id}/config": "获取店铺的小票配置",
             "PUT /api/receipt/config/{config_id}": "更新小票配置",
             "GET /api/receipt/default-config": "获取默认小票配置",
-            "GET /api/receipt/preview/{order_id}": "预览小票"
+            "GET /api/receipt/preview/{order_id}": "预览小票",
+            "POST /api/receipt/batch-render": "批量渲染小票"
         }
     }
 
 
 @app.post("/api/receipt/print")
-def print_receipt(request: PrintReceiptRequest):
+def print_receipt(request: PrintReceiptRequest, db: Session = Depends(get_db)):
     """
     打印小票
     """
-    db = get_session()
-    try:
-        # 获取订单
-        order = db.query(Orders).filter(Orders.id == request.order_id).first()
-        if not order:
-            raise HTTPException(status_code=404, detail="订单不存在")
-        
-        # 获取店铺信息
-        store = db.query(Stores).filter(Stores.id == order.store_id).first()
-        if not store:
-            raise HTTPException(status_code=404, detail="店铺不存在")
-        
-        # 获取桌号信息
-        table = db.query(Tables).filter(Tables.id == order.table_id).first()
-        if not table:
-            raise HTTPException(status_code=404, detail="桌号不存在")
+    # 订单、店铺、桌号、订单项和会员信息一条查询取回
+    context = load_receipt_context(db, request.order_id)
+    order = context.order
         
-        # 获取订单项
-        items = db.query(OrderItems).filter(OrderItems.order_id == order.id).all()
-        if not items:
-            raise HTTPException(status_code=404, detail="订单项不存在")
+    # 获取小票配置（这里暂时使用默认配置，实际应该从数据库读取）
+    sections = get_default_config()
         
-        # 获取会员信息
-        member_info = get_member_info(db, order)
+    # 生成小票内容
+    receipt_content = render_receipt(compile_sections(sections), context)
         
-        # 获取小票配置（这里暂时使用默认配置，实际应该从数据库读取）
-        sections = get_default_config()
+    # 模拟打印（实际使用时，这里会调用打印机API）
+    logger.info(f"打印小票: 订单ID={order.order_number}, 打印份数={request.copy_count}")
         
-        # 生成小票内容
-        receipt_content = generate_receipt_content(
-            order,
-            store,
-            table,
-            items,
-            member_info,
-            sections
-        )
-        
-        # 模拟打印（实际使用时，这里会调用打印机API）
-        logger.info(f"打印小票: 订单ID={order.order_number}, 打印份数={request.copy_count}")
-        
-        return {
-            "message": "小票打印成功",
-            "order_id": order.id,
-            "order_number": order.order_number,
-            "copy_count": request.copy_count,
-            "receipt_content": receipt_content,
-            "printer_name": request.printer_name or "默认打印机"
-        }
+    return {
+        "message": "小票打印成功",
+        "order_id": order.id,
+        "order_number": order.order_number,
+        "copy_count": request.copy_count,
+        "receipt_content": receipt_content,
+        "printer_name": request.printer_name or "默认打印机"
+    }
         
-    finally:
-        db.close()
 
 
 @app.get("/api/receipt/preview/{order_id}")
-def preview_receipt(order_id: int):
+def preview_receipt(order_id: int, db: Session = Depends(get_db)):
     """
     预览小票
     """
-    db = get_session()
-    try:
-        # 获取订单
-        order = db.query(Orders).filter(Orders.id == order_id).first()
-        if not order:
-            raise HTTPException(status_code=404, detail="订单不存在")
-        
-        # 获取店铺信息
-        store = db.query(Stores).filter(Stores.id == order.store_id).first()
-        if not store:
-            raise HTTPException(status_code=404, detail="店铺不存在")
+    # 订单、店铺、桌号、订单项和会员信息一条查询取回
+    context = load_receipt_context(db, order_id)
+    order = context.order
         
-        # 获取桌号信息
-        table = db.query(Tables).filter(Tables.id == order.table_id).first()
-        if not table:
-            raise HTTPException(status_code=404, detail="桌号不存在")
+    # 获取小票配置（暂时使用默认配置）
+    sections = get_default_config()
         
-        # 获取订单项
-        items = db.query(OrderItems).filter(OrderItems.order_id == order.id).all()
-        if not items:
-            raise HTTPException(status_code=404, detail="订单项不存在")
+    # 生成小票内容
+    receipt_content = render_receipt(compile_sections(sections), context)
         
-        # 获取会员信息
-        member_info = get_member_info(db, order)
-        
-        # 获取小票配置（暂时使用默认配置）
-        sections = get_default_config()
+    return {
+        "order_id": order.id,
+        "order_number": order.order_number,
+        "receipt_content": receipt_content
+    }
         
-        # 生成小票内容
-        receipt_content = generate_receipt_content(
-            order,
-            store,
-            table,
-            items,
-            member_info,
-            sections
-        )
+
+
+@app.post("/api/receipt/batch-render")
+def batch_render_receipts(request: BatchRenderRequest, db: Session = Depends(get_db)):
+    """
+    批量渲染小票（日结补打等场景）
+    所有订单的数据一条查询取回，模板只编译一次；按请求顺序返回，单个订单失败不影响其他订单
+    """
+    if len(request.order_ids) > MAX_BATCH_ORDERS:
+        raise HTTPException(status_code=400, detail=f"单次最多渲染 {MAX_BATCH_ORDERS} 张小票")
+    
+    contexts = load_receipt_contexts(db, request.order_ids)
+    # 获取小票配置（暂时使用默认配置）
+    templates = compile_sections(get_default_config())
         
-        return {
-            "order_id": order.id,
-            "order_number": order.order_number,
+    results = []
+    for order_id in request.order_ids:
+        context = contexts.get(order_id)
+        if context is None:
+            results.append({"order_id": order_id, "success": False, "error": "订单不存在"})
+            continue
+        if context.store is None or context.table is None or not context.items:
+            results.append({"order_id": order_id, "success": False, "error": "订单数据不完整"})
+            continue
+        try:
+            receipt_content = render_receipt(templates, context)
+        except Exception as e:
+            logger.error(f"渲染小票失败: 订单ID={order_id}, {str(e)}")
+            results.append({"order_id": order_id, "success": False, "error": f"渲染失败: {str(e)}"})
+            continue
+        results.append({
+            "order_id": order_id,
+            "order_number": context.order.order_number,
+            "success": True,
             "receipt_content": receipt_content
-        }
+        })
         
-    finally:
-        db.close()
+    return {
+        "message": f"批量渲染完成，共 {len(results)} 张小票",
+        "success_count": sum(1 for r in results if r["success"]),
+        "results": results
+    }
 
 
 @app.get("/api/receipt/default-config")
@@ -2,26 +2,41 @@
 餐饮系统完整 API 服务
 整合顾客端、管理端、厨房端、传菜端等所有接口
 """
-from fastapi import FastAPI, HTTPException, Query, Body, Form, UploadFile, WebSocket, WebSocketDisconnect, APIRouter
+from fastapi import FastAPI, HTTPException, Depends, Query, Body, Form, UploadFile, WebSocket, WebSocketDisconnect, APIRouter
 from sqlalchemy.orm import Session
-from sqlalchemy import text, func
+from sqlalchemy import text, select
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict
 from datetime import datetime
-import random
-import string
 import json
 import logging
 
+import anyio
+
 import sys
 import os
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
-from storage.database.db import get_session
+from storage.database.db import get_session, get_db, get_async_session
 from storage.database.shared.model import (
     Companies, Users, Stores, MenuCategories, MenuItems,
     Tables, Orders, OrderItems, MemberLevelRules
 )
+from services.order_query import list_store_orders, MAX_LIST_LIMIT
+from services.revenue_rollup import (
+    apply_event, apply_event_async, record_order_created, record_order_paid,
+    record_order_status_change, record_amount_change, load_daily_revenue
+)
+from services.ws_hub import ConnectionManager
+from services.menu_cache import invalidate_menu
+from services.order_placement import place_order_items, OrderPlacementError
+from services.qrcode_cache import get_or_upload_qrcode
+from services.id_generator import next_order_number
+from services.sales_aggregation import day_bounds, inventory_sales
+from services.table_occupancy import (
+    TABLE_STATE_MESSAGE, get_store_occupancy, invalidate_store_tables,
+    record_order_event, apply_table_message
+)
 
 logger = logging.getLogger(__name__)
 
@@ -115,6 +130,12 @@ async def startup_event():
     logger.info("=" * 60)
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """关闭 WebSocket 消息代理"""
+    await manager.stop()
+
+
 # ============ 诊断端点 ============
 
 @app.get("/system/reinit")
@@ -137,6 +158,8 @@ def reinit_system():
         else:
             logger.warning("⚠ Failed to reinitialize test data")
         
+        invalidate_menu()
+        
         return {
             "status": "success",
             "message": "System reinitialized successfully"
@@ -153,183 +176,24 @@ def reinit_system():
 
 # ============ WebSocket 连接管理 ============
 
-class ConnectionManager:
-    """WebSocket 连接管理器"""
-    
-    def __init__(self):
-        # store_id -> {connection_id: WebSocket}
-        self.store_connections: Dict[int, Dict[str, WebSocket]] = {}
-        # order_id -> {connection_id: WebSocket} 顾客订阅订单
-        self.order_connections: Dict[int, Dict[str, WebSocket]] = {}
-        # table_id -> {connection_id: WebSocket} 桌号连接（顾客端）
-        self.table_connections: Dict[int, Dict[str, WebSocket]] = {}
-    
-    async def connect_to_store(self, websocket: WebSocket, store_id: int, connection_id: str):
-        """连接到店铺（用于店员端）"""
-        await websocket.accept()
-        if store_id not in self.store_connections:
-            self.store_connections[store_id] = {}
-        self.store_connections[store_id][connection_id] = websocket
-        logger.info(f"WebSocket连接到店铺: store_id={store_id}, connection_id={connection_id}")
-        
-        # 发送连接成功消息
-        await websocket.send_json({
-            "type": "connected",
-            "message": "连接成功",
-            "store_id": store_id,
-            "connection_id": connection_id,
-            "timestamp": datetime.now().isoformat()
-        })
-    
-    async def connect_to_order(self, websocket: WebSocket, order_id: int, connection_id: str):
-        """连接到订单（用于顾客端）"""
-        await websocket.accept()
-        if order_id not in self.order_connections:
-            self.order_connections[order_id] = {}
-        self.order_connections[order_id][connection_id] = websocket
-        logger.info(f"WebSocket连接到订单: order_id={order_id}, connection_id={connection_id}")
-        
-        # 发送连接成功消息
-        await websocket.send_json({
-            "type": "connected",
-            "message": "连接成功",
-            "order_id": order_id,
-            "connection_id": connection_id,
-            "timestamp": datetime.now().isoformat()
-        })
-    
-    async def connect_to_table(self, websocket: WebSocket, table_id: int, connection_id: str):
-        """连接到桌号（用于顾客端）"""
-        await websocket.accept()
-        if table_id not in self.table_connections:
-            self.table_connections[table_id] = {}
-        self.table_connections[table_id][connection_id] = websocket
-        logger.info(f"WebSocket连接到桌号: table_id={table_id}, connection_id={connection_id}")
-        
-        # 发送连接成功消息
-        await websocket.send_json({
-            "type": "connected",
-            "message": "连接成功",
-            "table_id": table_id,
-            "connection_id": connection_id,
-            "timestamp": datetime.now().isoformat()
-        })
-    
-    def disconnect(self, store_id: int = None, order_id: int = None, table_id: int = None, connection_id: str = None):
-        """断开连接"""
-        if store_id and store_id in self.store_connections:
-            if connection_id and connection_id in self.store_connections[store_id]:
-                del self.store_connections[store_id][connection_id]
-                logger.info(f"断开店铺连接: store_id={store_id}, connection_id={connection_id}")
-        
-        if order_id and order_id in self.order_connections:
-            if connection_id and connection_id in self.order_connections[order_id]:
-                del self.order_connections[order_id][connection_id]
-                logger.info(f"断开订单连接: order_id={order_id}, connection_id={connection_id}")
-        
-        if table_id and table_id in self.table_connections:
-            if connection_id and connection_id in self.table_connections[table_id]:
-                del self.table_connections[table_id][connection_id]
-                logger.info(f"断开桌号连接: table_id={table_id}, connection_id={connection_id}")
-    
-    async def broadcast_to_store(self, store_id: int, message: dict):
-        """向店铺的所有连接广播消息"""
-        if store_id not in self.store_connections:
-            return
-        
-        disconnected = []
-        for connection_id, websocket in self.store_connections[store_id].items():
-            try:
-                await websocket.send_json(message)
-            except Exception as e:
-                logger.error(f"发送消息失败: store_id={store_id}, connection_id={connection_id}, error={str(e)}")
-                disconnected.append(connection_id)
-        
-        # 清理断开的连接
-        for connection_id in disconnected:
-            del self.store_connections[store_id][connection_id]
-    
-    async def broadcast_to_order(self, order_id: int, message: dict):
-        """向订单的所有连接广播消息（顾客端）"""
-        if order_id not in self.order_connections:
-            return
-        
-        disconnected = []
-        for connection_id, websocket in self.order_connections[order_id].items():
-            try:
-                await websocket.send_json(message)
-            except Exception as e:
-                logger.error(f"发送消息失败: order_id={order_id}, connection_id={connection_id}, error={str(e)}")
-                disconnected.append(connection_id)
-        
-        # 清理断开的连接
-        for connection_id in disconnected:
-            del self.order_connections[order_id][connection_id]
-    
-    async def broadcast_to_table(self, table_id: int, message: dict):
-        """向桌号的所有连接广播消息（顾客端）"""
-        if table_id not in self.table_connections:
-            return
-        
-        disconnected = []
-        for connection_id, websocket in self.table_connections[table_id].items():
-            try:
-                await websocket.send_json(message)
-            except Exception as e:
-                logger.error(f"发送消息失败: table_id={table_id}, connection_id={connection_id}, error={str(e)}")
-                disconnected.append(connection_id)
-        
-        # 清理断开的连接
-        for connection_id in disconnected:
-            del self.table_connections[table_id][connection_id]
-    
-    async def broadcast_order_status(self, order_id: int, order_data: dict):
-        """
-        广播订单状态更新
-        同时推送到店铺（店员端）和订单（顾客端）
-        """
-        message = {
-            "type": "order_status_update",
-            "order": order_data,
-            "timestamp": datetime.now().isoformat()
-        }
-        
-        # 推送到店铺
-        if "store_id" in order_data:
-            await self.broadcast_to_store(order_data["store_id"], message)
-        
-        # 推送到订单
-        await self.broadcast_to_order(order_id, message)
-    
-    async def broadcast_new_order(self, order_data: dict):
-        """广播新订单到店铺"""
-        message = {
-            "type": "new_order",
-            "order": order_data,
-            "timestamp": datetime.now().isoformat()
-        }
-        
-        if "store_id" in order_data:
-            await self.broadcast_to_store(order_data["store_id"], message)
-    
-    async def broadcast_payment_status(self, order_id: int, payment_data: dict):
-        """广播支付状态更新"""
-        message = {
-            "type": "payment_status_update",
-            "payment": payment_data,
-            "timestamp": datetime.now().isoformat()
-        }
-        
-        # 推送到店铺
-        if "store_id" in payment_data:
-            await self.broadcast_to_store(payment_data["store_id"], message)
-        
-        # 推送到订单
-        await self.broadcast_to_order(order_id, message)
-
+# 连接管理器由 services.ws_hub 统一实现，多 worker 部署时通过 WS_BROKER=postgres
+# 经 Postgres LISTEN/NOTIFY 在 worker 之间转发推送
 
 # 全局连接管理器
 manager = ConnectionManager()
+# 其他 worker 推送的桌台状态同步到本进程的占用缓存
+manager.add_listener(TABLE_STATE_MESSAGE, apply_table_message)
+
+
+async def publish_table_state(order: Orders):
+    """订单事件后更新桌台占用缓存，并把桌台状态推送到店铺（推送失败不影响请求）"""
+    message = record_order_event(order.store_id, order.table_id, order.id, order.order_status)
+    if message is None:
+        return
+    try:
+        await manager.broadcast_to_store(order.store_id, message)
+    except Exception as ws_error:
+        logger.error(f"桌台状态推送失败: {str(ws_error)}")
 
 
 # ============ 数据模型 ============
@@ -448,65 +312,48 @@ class UpdateItemStatusRequest(BaseModel):
     item_status: str
 
 
-# ============ 辅助函数 ============
-
-def generate_order_number():
-    """生成订单号"""
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    random_str = ''.join(random.choices(string.digits, k=4))
-    return f"ORD{timestamp}{random_str}"
-
-
 # ============ 店铺和基础信息 ============
 
 @app.get("/store")
-def get_store_info():
+def get_store_info(db: Session = Depends(get_db)):
     """获取店铺信息（默认返回第一个店铺）"""
-    db = get_session()
-    try:
-        store = db.query(Stores).filter(Stores.is_active == True).first()
-        if not store:
-            raise HTTPException(status_code=404, detail="未找到店铺")
+    store = db.query(Stores).filter(Stores.is_active == True).first()
+    if not store:
+        raise HTTPException(status_code=404, detail="未找到店铺")
         
-        return {
-            "id": store.id,
-            "name": store.name,
-            "address": store.address,
-            "phone": store.phone,
-            "opening_hours": store.opening_hours
-        }
-    finally:
-        db.close()
+    return {
+        "id": store.id,
+        "name": store.name,
+        "address": store.address,
+        "phone": store.phone,
+        "opening_hours": store.opening_hours
+    }
 
 
 # ============ 菜品分类 ============
 
 @app.get("/menu-categories/", response_model=List[CategoryInfo])
-def get_menu_categories(store_id: Optional[int] = None):
+def get_menu_categories(store_id: Optional[int] = None, db: Session = Depends(get_db)):
     """获取菜品分类列表"""
-    db = get_session()
-    try:
-        query = db.query(MenuCategories)
-        if store_id:
-            query = query.filter(MenuCategories.store_id == store_id)
-        else:
-            # 如果没有指定store_id，获取第一个店铺的分类
-            first_store = db.query(Stores).first()
-            if first_store:
-                query = query.filter(MenuCategories.store_id == first_store.id)
-        
-        categories = query.order_by(MenuCategories.sort_order).all()
-        return [
-            CategoryInfo(
-                id=cat.id,
-                name=cat.name,
-                description=cat.description,
-                sort_order=cat.sort_order or 0
-            )
-            for cat in categories
-        ]
-    finally:
-        db.close()
+    query = db.query(MenuCategories)
+    if store_id:
+        query = query.filter(MenuCategories.store_id == store_id)
+    else:
+        # 如果没有指定store_id，获取第一个店铺的分类
+        first_store = db.query(Stores).first()
+        if first_store:
+            query = query.filter(MenuCategories.store_id == first_store.id)
+        
+    categories = query.order_by(MenuCategories.sort_order).all()
+    return [
+        CategoryInfo(
+            id=cat.id,
+            name=cat.name,
+            description=cat.description,
+            sort_order=cat.sort_order or 0
+        )
+        for cat in categories
+    ]
 
 
 # ============ 菜品管理 ============
@@ -514,281 +361,244 @@ def get_menu_categories(store_id: Optional[int] = None):
 @app.get("/menu-items/", response_model=List[MenuItemInfo])
 def get_menu_items(
     category_id: Optional[int] = None,
-    store_id: Optional[int] = None
+    store_id: Optional[int] = None,
+    db: Session = Depends(get_db)
 ):
     """获取菜品列表"""
-    db = get_session()
-    try:
-        query = db.query(MenuItems)
+    # 分类名称随菜品一次 JOIN 取回，避免逐行懒加载 item.category
+    query = db.query(MenuItems, MenuCategories.name).outerjoin(
+        MenuCategories, MenuCategories.id == MenuItems.category_id
+    )
         
-        if store_id:
-            query = query.filter(MenuItems.store_id == store_id)
-        else:
-            # 如果没有指定store_id，获取第一个店铺的菜品
-            first_store = db.query(Stores).first()
-            if first_store:
-                query = query.filter(MenuItems.store_id == first_store.id)
-        
-        if category_id:
-            query = query.filter(MenuItems.category_id == category_id)
-        
-        items = query.order_by(MenuItems.sort_order).all()
-        
-        return [
-            MenuItemInfo(
-                id=item.id,
-                name=item.name,
-                description=item.description,
-                price=float(item.price),
-                image_url=item.image_url,
-                stock=item.stock,
-                is_available=item.is_available,
-                is_recommended=item.is_recommended,
-                category_id=item.category_id,
-                category_name=item.category.name if item.category else None,
-                sort_order=item.sort_order or 0
-            )
-            for item in items
-        ]
-    finally:
-        db.close()
-
-
-@app.post("/menu-items/", response_model=MenuItemInfo)
-def create_menu_item(item: MenuItemCreate):
-    """创建菜品"""
-    db = get_session()
-    try:
-        # 获取店铺ID
+    if store_id:
+        query = query.filter(MenuItems.store_id == store_id)
+    else:
+        # 如果没有指定store_id，获取第一个店铺的菜品
         first_store = db.query(Stores).first()
-        if not first_store:
-            raise HTTPException(status_code=404, detail="未找到店铺")
+        if first_store:
+            query = query.filter(MenuItems.store_id == first_store.id)
         
-        # 获取最大sort_order
-        max_sort = db.query(MenuItems).filter(
-            MenuItems.store_id == first_store.id
-        ).count()
+    if category_id:
+        query = query.filter(MenuItems.category_id == category_id)
         
-        db_item = MenuItems(
-            store_id=first_store.id,
-            category_id=item.category_id,
+    items = query.order_by(MenuItems.sort_order).all()
+        
+    return [
+        MenuItemInfo(
+            id=item.id,
             name=item.name,
             description=item.description,
-            price=item.price,
+            price=float(item.price),
             image_url=item.image_url,
             stock=item.stock,
             is_available=item.is_available,
             is_recommended=item.is_recommended,
-            sort_order=max_sort + 1
-        )
-        
-        db.add(db_item)
-        db.commit()
-        db.refresh(db_item)
-        
-        return MenuItemInfo(
-            id=db_item.id,
-            name=db_item.name,
-            description=db_item.description,
-            price=float(db_item.price),
-            image_url=db_item.image_url,
-            stock=db_item.stock,
-            is_available=db_item.is_available,
-            is_recommended=db_item.is_recommended,
-            category_id=db_item.category_id,
-            category_name=db_item.category.name if db_item.category else None,
-            sort_order=db_item.sort_order or 0
+            category_id=item.category_id,
+            category_name=category_name,
+            sort_order=item.sort_order or 0
         )
-    finally:
-        db.close()
+        for item, category_name in items
+    ]
+
+
+@app.post("/menu-items/", response_model=MenuItemInfo)
+def create_menu_item(item: MenuItemCreate, db: Session = Depends(get_db)):
+    """创建菜品"""
+    # 获取店铺ID
+    first_store = db.query(Stores).first()
+    if not first_store:
+        raise HTTPException(status_code=404, detail="未找到店铺")
+        
+    # 获取最大sort_order
+    max_sort = db.query(MenuItems).filter(
+        MenuItems.store_id == first_store.id
+    ).count()
+        
+    db_item = MenuItems(
+        store_id=first_store.id,
+        category_id=item.category_id,
+        name=item.name,
+        description=item.description,
+        price=item.price,
+        image_url=item.image_url,
+        stock=item.stock,
+        is_available=item.is_available,
+        is_recommended=item.is_recommended,
+        sort_order=max_sort + 1
+    )
+        
+    db.add(db_item)
+    db.commit()
+    invalidate_menu(db_item.store_id)
+    db.refresh(db_item)
+        
+    return MenuItemInfo(
+        id=db_item.id,
+        name=db_item.name,
+        description=db_item.description,
+        price=float(db_item.price),
+        image_url=db_item.image_url,
+        stock=db_item.stock,
+        is_available=db_item.is_available,
+        is_recommended=db_item.is_recommended,
+        category_id=db_item.category_id,
+        category_name=db_item.category.name if db_item.category else None,
+        sort_order=db_item.sort_order or 0
+    )
 
 
 @app.patch("/menu-items/{item_id}", response_model=MenuItemInfo)
-def update_menu_item(item_id: int, item: MenuItemUpdate):
+def update_menu_item(item_id: int, item: MenuItemUpdate, db: Session = Depends(get_db)):
     """更新菜品"""
-    db = get_session()
-    try:
-        db_item = db.query(MenuItems).filter(MenuItems.id == item_id).first()
-        if not db_item:
-            raise HTTPException(status_code=404, detail="菜品不存在")
-        
-        update_data = item.dict(exclude_unset=True)
-        for key, value in update_data.items():
-            setattr(db_item, key, value)
-        
-        db.commit()
-        db.refresh(db_item)
-        
-        return MenuItemInfo(
-            id=db_item.id,
-            name=db_item.name,
-            description=db_item.description,
-            price=float(db_item.price),
-            image_url=db_item.image_url,
-            stock=db_item.stock,
-            is_available=db_item.is_available,
-            is_recommended=db_item.is_recommended,
-            category_id=db_item.category_id,
-            category_name=db_item.category.name if db_item.category else None,
-            sort_order=db_item.sort_order or 0
-        )
-    finally:
-        db.close()
+    db_item = db.query(MenuItems).filter(MenuItems.id == item_id).first()
+    if not db_item:
+        raise HTTPException(status_code=404, detail="菜品不存在")
+        
+    update_data = item.dict(exclude_unset=True)
+    for key, value in update_data.items():
+        setattr(db_item, key, value)
+        
+    db.commit()
+    invalidate_menu(db_item.store_id)
+    db.refresh(db_item)
+        
+    return MenuItemInfo(
+        id=db_item.id,
+        name=db_item.name,
+        description=db_item.description,
+        price=float(db_item.price),
+        image_url=db_item.image_url,
+        stock=db_item.stock,
+        is_available=db_item.is_available,
+        is_recommended=db_item.is_recommended,
+        category_id=db_item.category_id,
+        category_name=db_item.category.name if db_item.category else None,
+        sort_order=db_item.sort_order or 0
+    )
 
 
 @app.delete("/menu-items/{item_id}")
-def delete_menu_item(item_id: int):
+def delete_menu_item(item_id: int, db: Session = Depends(get_db)):
     """删除菜品"""
-    db = get_session()
-    try:
-        db_item = db.query(MenuItems).filter(MenuItems.id == item_id).first()
-        if not db_item:
-            raise HTTPException(status_code=404, detail="菜品不存在")
+    db_item = db.query(MenuItems).filter(MenuItems.id == item_id).first()
+    if not db_item:
+        raise HTTPException(status_code=404, detail="菜品不存在")
         
-        db.delete(db_item)
-        db.commit()
-        return {"message": "菜品删除成功"}
-    finally:
-        db.close()
+    store_id = db_item.store_id
+    db.delete(db_item)
+    db.commit()
+    invalidate_menu(store_id)
+    return {"message": "菜品删除成功"}
 
 
 # ============ 桌号管理 ============
 
 @app.get("/tables/", response_model=List[TableInfo])
-def get_tables(store_id: Optional[int] = None):
-    """获取桌号列表"""
-    db = get_session()
-    try:
-        query = db.query(Tables)
-        
-        if store_id:
-            query = query.filter(Tables.store_id == store_id)
-        else:
-            # 如果没有指定store_id，获取第一个店铺的桌号
-            first_store = db.query(Stores).first()
-            if first_store:
-                query = query.filter(Tables.store_id == first_store.id)
-        
-        tables = query.order_by(Tables.table_number).all()
-        
-        # 检查是否有正在进行的订单
-        result = []
-        for table in tables:
-            active_order = db.query(Orders).filter(
-                Orders.table_id == table.id,
-                Orders.order_status.in_(['pending', 'confirmed', 'preparing', 'ready', 'serving'])
-            ).first()
-            
-            result.append(TableInfo(
-                id=table.id,
-                table_number=table.table_number,
-                seats=table.seats,
-                is_active=table.is_active,
-                is_occupied=bool(active_order)
-            ))
-        
-        return result
-    finally:
-        db.close()
+def get_tables(store_id: Optional[int] = None, db: Session = Depends(get_db)):
+    """获取桌号列表（读取桌台占用缓存，订单变化通过店铺 WebSocket 推送 table_state）"""
+    if not store_id:
+        # 如果没有指定store_id，获取第一个店铺的桌号
+        first_store = db.query(Stores).first()
+        if not first_store:
+            return []
+        store_id = first_store.id
+        
+    return [
+        TableInfo(
+            id=table["id"],
+            table_number=table["table_number"],
+            seats=table["seats"],
+            is_active=table["is_active"],
+            is_occupied=table["is_occupied"]
+        )
+        for table in get_store_occupancy(store_id, db).list()
+    ]
 
 
 @app.post("/tables/", response_model=TableInfo)
-def create_table(table: TableCreate):
+def create_table(table: TableCreate, db: Session = Depends(get_db)):
     """创建桌号"""
-    db = get_session()
-    try:
-        first_store = db.query(Stores).first()
-        if not first_store:
-            raise HTTPException(status_code=404, detail="未找到店铺")
-        
-        db_table = Tables(
-            store_id=first_store.id,
-            table_number=table.table_number,
-            seats=table.seats,
-            is_active=table.is_active
-        )
-        
-        db.add(db_table)
-        db.commit()
-        db.refresh(db_table)
-        
-        return TableInfo(
-            id=db_table.id,
-            table_number=db_table.table_number,
-            seats=db_table.seats,
-            is_active=db_table.is_active,
-            is_occupied=False
-        )
-    finally:
-        db.close()
+    first_store = db.query(Stores).first()
+    if not first_store:
+        raise HTTPException(status_code=404, detail="未找到店铺")
+        
+    db_table = Tables(
+        store_id=first_store.id,
+        table_number=table.table_number,
+        seats=table.seats,
+        is_active=table.is_active
+    )
+        
+    db.add(db_table)
+    db.commit()
+    db.refresh(db_table)
+    invalidate_store_tables(db_table.store_id)
+        
+    return TableInfo(
+        id=db_table.id,
+        table_number=db_table.table_number,
+        seats=db_table.seats,
+        is_active=db_table.is_active,
+        is_occupied=False
+    )
 
 
 @app.patch("/tables/{table_id}", response_model=TableInfo)
-def update_table(table_id: int, table: TableUpdate):
+def update_table(table_id: int, table: TableUpdate, db: Session = Depends(get_db)):
     """更新桌号"""
-    db = get_session()
-    try:
-        db_table = db.query(Tables).filter(Tables.id == table_id).first()
-        if not db_table:
-            raise HTTPException(status_code=404, detail="桌号不存在")
+    db_table = db.query(Tables).filter(Tables.id == table_id).first()
+    if not db_table:
+        raise HTTPException(status_code=404, detail="桌号不存在")
         
-        update_data = table.dict(exclude_unset=True)
-        for key, value in update_data.items():
-            setattr(db_table, key, value)
+    update_data = table.dict(exclude_unset=True)
+    for key, value in update_data.items():
+        setattr(db_table, key, value)
         
-        db.commit()
-        db.refresh(db_table)
+    db.commit()
+    db.refresh(db_table)
+    invalidate_store_tables(db_table.store_id)
         
-        return TableInfo(
-            id=db_table.id,
-            table_number=db_table.table_number,
-            seats=db_table.seats,
-            is_active=db_table.is_active,
-            is_occupied=False
-        )
-    finally:
-        db.close()
+    return TableInfo(
+        id=db_table.id,
+        table_number=db_table.table_number,
+        seats=db_table.seats,
+        is_active=db_table.is_active,
+        is_occupied=False
+    )
 
 
 @app.delete("/tables/{table_id}")
-def delete_table(table_id: int):
+def delete_table(table_id: int, db: Session = Depends(get_db)):
     """删除桌号"""
-    db = get_session()
-    try:
-        db_table = db.query(Tables).filter(Tables.id == table_id).first()
-        if not db_table:
-            raise HTTPException(status_code=404, detail="桌号不存在")
+    db_table = db.query(Tables).filter(Tables.id == table_id).first()
+    if not db_table:
+        raise HTTPException(status_code=404, detail="桌号不存在")
         
-        db.delete(db_table)
-        db.commit()
-        return {"message": "桌号删除成功"}
-    finally:
-        db.close()
+    db.delete(db_table)
+    db.commit()
+    invalidate_store_tables(db_table.store_id)
+    return {"message": "桌号删除成功"}
 
 
 @app.post("/tables/generate-qr")
-def generate_qrcode(data: Dict[str, int]):
+def generate_qrcode(data: Dict[str, int], db: Session = Depends(get_db)):
     """生成桌号二维码（模拟）"""
     table_id = data.get("table_id")
     if not table_id:
         raise HTTPException(status_code=400, detail="缺少table_id参数")
     
-    db = get_session()
-    try:
-        table = db.query(Tables).filter(Tables.id == table_id).first()
-        if not table:
-            raise HTTPException(status_code=404, detail="桌号不存在")
+    table = db.query(Tables).filter(Tables.id == table_id).first()
+    if not table:
+        raise HTTPException(status_code=404, detail="桌号不存在")
         
-        # 生成模拟二维码URL
-        qr_code_url = f"https://api.qrserver.com/v1/create-qr-code/?size=200x200&data=table_{table.id}"
+    # 生成模拟二维码URL
+    qr_code_url = f"https://api.qrserver.com/v1/create-qr-code/?size=200x200&data=table_{table.id}"
         
-        return {
-            "table_id": table.id,
-            "table_number": table.table_number,
-            "qr_code_url": qr_code_url
-        }
-    finally:
-        db.close()
+    return {
+        "table_id": table.id,
+        "table_number": table.table_number,
+        "qr_code_url": qr_code_url
+    }
 
 
 # ============ 订单管理 ============
@@ -797,12 +607,12 @@ def generate_qrcode(data: Dict[str, int]):
 def get_orders_test(
     status: Optional[str] = None,
     table_id: Optional[int] = None,
-    store_id: Optional[int] = None
+    store_id: Optional[int] = None,
+    db: Session = Depends(get_db)
 ):
     """获取订单列表 - 测试版本（不带 response_model）"""
     print(f"DEBUG: get_orders_test called")
     
-    db = get_session()
     try:
         query = db.query(Orders)
         
@@ -843,164 +653,125 @@ def get_orders_test(
         print(f"ERROR: {e}")
         traceback.print_exc()
         return {"error": str(e)}
-    finally:
-        db.close()
 
 
 @app.get("/orders/", response_model=List[OrderResponse])
 def get_orders(
     status: Optional[str] = None,
     table_id: Optional[int] = None,
-    store_id: Optional[int] = None
+    store_id: Optional[int] = None,
+    before_id: Optional[int] = Query(None, description="分页游标：返回该订单之前（更早）的订单"),
+    limit: Optional[int] = Query(None, description="返回数量限制", ge=1, le=MAX_LIST_LIMIT),
+    db: Session = Depends(get_db)
 ):
     """获取订单列表"""
-    print(f"DEBUG: get_orders called with status={status}, table_id={table_id}, store_id={store_id}")
-    
-    db = get_session()
     try:
-        query = db.query(Orders)
-        
-        if store_id:
-            query = query.filter(Orders.store_id == store_id)
-        else:
+        if not store_id:
             first_store = db.query(Stores).first()
-            if first_store:
-                query = query.filter(Orders.store_id == first_store.id)
-        
-        if status:
-            query = query.filter(Orders.order_status == status)
-        
-        if table_id:
-            query = query.filter(Orders.table_id == table_id)
-        
-        orders = query.order_by(Orders.created_at.desc()).all()
-        
-        print(f"DEBUG: Found {len(orders)} orders in database")
-        
+            if not first_store:
+                return []
+            store_id = first_store.id
+
+        # 订单+桌号一次JOIN，订单项批量预加载，避免逐单查询
+        orders = list_store_orders(
+            db,
+            store_id,
+            status=status,
+            table_id=table_id,
+            before_id=before_id,
+            limit=limit
+        )
+
         result = []
-        for order in orders:
-            try:
-                # 获取桌号
-                table = db.query(Tables).filter(Tables.id == order.table_id).first()
-                table_number = table.table_number if table else ""
-                
-                # 构建订单项
-                order_items = []
-                for oi in order.order_items:
-                    order_items.append(OrderItemResponse(
-                        id=oi.id,
-                        menu_item_id=oi.menu_item_id,
-                        menu_item_name=oi.menu_item_name,
-                        price=float(oi.menu_item_price),
-                        quantity=oi.quantity,
-                        subtotal=float(oi.subtotal),
-                        special_instructions=oi.special_instructions,
-                        item_status=oi.status or order.order_status  # 修复：使用 status 而不是 item_status
-                    ))
-                
-                order_response = OrderResponse(
-                    id=order.id,
-                    order_number=order.order_number or "",
-                    store_id=order.store_id,
-                    table_id=order.table_id,
-                    table_number=table_number,
-                    total_amount=float(order.total_amount),
-                    payment_method=order.payment_method or "",
-                    payment_status=order.payment_status or "unpaid",
-                    status=order.order_status,
-                    created_at=order.created_at.isoformat() if order.created_at else "",
-                    items=order_items
+        for order, table_number in orders:
+            order_items = [
+                OrderItemResponse(
+                    id=oi.id,
+                    menu_item_id=oi.menu_item_id,
+                    menu_item_name=oi.menu_item_name,
+                    price=float(oi.menu_item_price),
+                    quantity=oi.quantity,
+                    subtotal=float(oi.subtotal),
+                    special_instructions=oi.special_instructions,
+                    item_status=oi.status or order.order_status  # 修复：使用 status 而不是 item_status
                 )
-                result.append(order_response)
-            except Exception as e:
-                import traceback
-                print(f"Error processing order {order.id}: {e}")
-                traceback.print_exc()
-                continue
-        
-        print(f"DEBUG: Returning {len(result)} orders")
+                for oi in order.order_items
+            ]
+
+            result.append(OrderResponse(
+                id=order.id,
+                order_number=order.order_number or "",
+                store_id=order.store_id,
+                table_id=order.table_id,
+                table_number=table_number,
+                total_amount=float(order.total_amount),
+                payment_method=order.payment_method or "",
+                payment_status=order.payment_status or "unpaid",
+                status=order.order_status,
+                created_at=order.created_at.isoformat() if order.created_at else "",
+                items=order_items
+            ))
+
         return result
     except Exception as e:
-        import traceback
-        print(f"Error in get_orders: {e}")
-        traceback.print_exc()
+        logger.error(f"获取订单列表失败: {e}", exc_info=True)
         raise
-    finally:
-        db.close()
 
 
 @app.post("/orders/", response_model=OrderResponse)
 async def create_order(order: CreateOrderRequest):
     """创建订单"""
-    db = get_session()
+    db = await get_async_session()
     try:
-        first_store = db.query(Stores).first()
-        if not first_store:
-            raise HTTPException(status_code=404, detail="未找到店铺")
-        
-        table = db.query(Tables).filter(Tables.id == order.table_id).first()
+        table = await db.get(Tables, order.table_id)
         if not table:
             raise HTTPException(status_code=404, detail="桌号不存在")
         
-        # 计算总金额
-        total_amount = 0
-        order_items_data = []
-        
-        for item_req in order.items:
-            menu_item = db.query(MenuItems).filter(MenuItems.id == item_req.menu_item_id).first()
-            if not menu_item:
-                raise HTTPException(status_code=404, detail=f"菜品ID {item_req.menu_item_id} 不存在")
-            
-            if not menu_item.is_available:
-                raise HTTPException(status_code=400, detail=f"菜品 {menu_item.name} 已下架")
-            
-            if menu_item.stock < item_req.quantity:
-                raise HTTPException(status_code=400, detail=f"菜品 {menu_item.name} 库存不足")
-            
-            subtotal = float(menu_item.price) * item_req.quantity
-            total_amount += subtotal
-            
-            order_items_data.append({
-                "menu_item_id": menu_item.id,
-                "menu_item_name": menu_item.name,
-                "menu_item_price": float(menu_item.price),
-                "quantity": item_req.quantity,
-                "subtotal": subtotal,
-                "special_instructions": item_req.special_instructions
-            })
-        
-        # 创建订单（第一步：确认下单，不处理支付）
+        # 创建订单（第一步：确认下单，不处理支付），订单归属桌号所在店铺
         db_order = Orders(
-            order_number=generate_order_number(),
-            store_id=first_store.id,
+            order_number=next_order_number(table.store_id),
+            store_id=table.store_id,
             table_id=order.table_id,
-            total_amount=total_amount,
+            total_amount=0,
             discount_amount=0,
-            final_amount=total_amount,
+            final_amount=0,
             payment_method="",  # 支付方式将在第二步设置
             payment_status="unpaid",  # 初始状态为未支付
             order_status="preparing"  # 直接进入制作流程
         )
 
         db.add(db_order)
-        db.flush()
-
-        # 创建订单项
-        for item_data in order_items_data:
-            order_item = OrderItems(
-                order_id=db_order.id,
-                status="preparing",  # 菜品直接进入制作状态
-                **item_data
+        await db.flush()
+
+        # 锁定菜品、扣减库存、批量创建订单项（菜品直接进入制作状态）
+        try:
+            created_items, total_amount = await db.run_sync(
+                place_order_items, db_order, order.items, "preparing"
             )
-            db.add(order_item)
-        
-        # 更新菜品库存
-        for item_req in order.items:
-            menu_item = db.query(MenuItems).filter(MenuItems.id == item_req.menu_item_id).first()
-            menu_item.stock -= item_req.quantity
+        except OrderPlacementError as e:
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+        db_order.total_amount = total_amount
+        db_order.final_amount = total_amount
+
+        order_items_data = [
+            {
+                "menu_item_id": oi.menu_item_id,
+                "menu_item_name": oi.menu_item_name,
+                "menu_item_price": float(oi.menu_item_price),
+                "quantity": oi.quantity,
+                "subtotal": float(oi.subtotal),
+                "special_instructions": oi.special_instructions
+            }
+            for oi in created_items
+        ]
         
-        db.commit()
-        db.refresh(db_order)
+        await db.commit()
+        invalidate_menu(table.store_id)
+        # created_at 由数据库生成，提交后显式加载
+        await db.refresh(db_order)
+        await apply_event_async(db, record_order_created, db_order)
+        await publish_table_state(db_order)
         
         # 广播新订单到店员端（WebSocket通知）
         try:
@@ -1028,7 +799,7 @@ async def create_order(order: CreateOrderRequest):
         
         # 构建订单项
         order_items = []
-        for oi in db_order.order_items:
+        for oi in created_items:
             order_items.append(OrderItemResponse(
                 id=oi.id,
                 menu_item_id=oi.menu_item_id,
@@ -1054,13 +825,13 @@ async def create_order(order: CreateOrderRequest):
             items=order_items
         )
     except HTTPException:
-        db.rollback()
+        await db.rollback()
         raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=f"创建订单失败: {str(e)}")
     finally:
-        db.close()
+        await db.close()
 
 
 @app.post("/orders/{order_id}/confirm-payment")
@@ -1069,9 +840,12 @@ async def confirm_payment(order_id: int, req: ConfirmPaymentRequest):
     确认支付（第二步）
     顾客选择支付方式后调用此接口
     """
-    db = get_session()
+    db = await get_async_session()
     try:
-        order = db.query(Orders).filter(Orders.id == order_id).first()
+        # 锁定订单行直到提交：并发的重复确认会等待本次提交，随后看到已支付并返回 400
+        order = (await db.execute(
+            select(Orders).where(Orders.id == order_id).with_for_update()
+        )).scalar_one_or_none()
         if not order:
             raise HTTPException(status_code=404, detail="订单不存在")
         
@@ -1095,7 +869,9 @@ async def confirm_payment(order_id: int, req: ConfirmPaymentRequest):
         else:
             raise HTTPException(status_code=400, detail=f"不支持的支付方式: {req.payment_method}")
         
-        db.commit()
+        await db.commit()
+        if order.payment_status == "paid":
+            await apply_event_async(db, record_order_paid, order)
         
         # 广播支付状态更新（WebSocket通知）
         try:
@@ -1122,65 +898,61 @@ async def confirm_payment(order_id: int, req: ConfirmPaymentRequest):
             "payment_status": order.payment_status
         }
     except HTTPException:
-        db.rollback()
+        await db.rollback()
         raise
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=f"确认支付失败: {str(e)}")
     finally:
-        db.close()
+        await db.close()
 
 
 @app.get("/orders/{order_id}", response_model=OrderResponse)
-def get_order(order_id: int):
+def get_order(order_id: int, db: Session = Depends(get_db)):
     """获取订单详情"""
-    db = get_session()
-    try:
-        order = db.query(Orders).filter(Orders.id == order_id).first()
-        if not order:
-            raise HTTPException(status_code=404, detail="订单不存在")
-        
-        # 获取桌号
-        table = db.query(Tables).filter(Tables.id == order.table_id).first()
-        table_number = table.table_number if table else ""
-        
-        # 构建订单项
-        order_items = []
-        for oi in order.order_items:
-            order_items.append(OrderItemResponse(
-                id=oi.id,
-                menu_item_id=oi.menu_item_id,
-                menu_item_name=oi.menu_item_name,
-                price=float(oi.menu_item_price),
-                quantity=oi.quantity,
-                subtotal=float(oi.subtotal),
-                special_instructions=oi.special_instructions,
-                item_status=oi.status
-            ))
-        
-        return OrderResponse(
-            id=order.id,
-            order_number=order.order_number,
-            store_id=order.store_id,
-            table_id=order.table_id,
-            table_number=table_number,
-            total_amount=float(order.total_amount),
-            payment_method=order.payment_method,
-            payment_status=order.payment_status,
-            status=order.order_status,
-            created_at=order.created_at.isoformat() if order.created_at else "",
-            items=order_items
-        )
-    finally:
-        db.close()
+    order = db.query(Orders).filter(Orders.id == order_id).first()
+    if not order:
+        raise HTTPException(status_code=404, detail="订单不存在")
+        
+    # 获取桌号
+    table = db.query(Tables).filter(Tables.id == order.table_id).first()
+    table_number = table.table_number if table else ""
+        
+    # 构建订单项
+    order_items = []
+    for oi in order.order_items:
+        order_items.append(OrderItemResponse(
+            id=oi.id,
+            menu_item_id=oi.menu_item_id,
+            menu_item_name=oi.menu_item_name,
+            price=float(oi.menu_item_price),
+            quantity=oi.quantity,
+            subtotal=float(oi.subtotal),
+            special_instructions=oi.special_instructions,
+            item_status=oi.status
+        ))
+        
+    return OrderResponse(
+        id=order.id,
+        order_number=order.order_number,
+        store_id=order.store_id,
+        table_id=order.table_id,
+        table_number=table_number,
+        total_amount=float(order.total_amount),
+        payment_method=order.payment_method,
+        payment_status=order.payment_status,
+        status=order.order_status,
+        created_at=order.created_at.isoformat() if order.created_at else "",
+        items=order_items
+    )
 
 
 @app.patch("/orders/{order_id}/status")
 async def update_order_status(order_id: int, req: UpdateOrderStatusRequest):
     """更新订单状态"""
-    db = get_session()
+    db = await get_async_session()
     try:
-        order = db.query(Orders).filter(Orders.id == order_id).first()
+        order = await db.get(Orders, order_id)
         if not order:
             raise HTTPException(status_code=404, detail="订单不存在")
         
@@ -1205,7 +977,9 @@ async def update_order_status(order_id: int, req: UpdateOrderStatusRequest):
             )
         
         order.order_status = new_status
-        db.commit()
+        await db.commit()
+        await apply_event_async(db, record_order_status_change, order, current_status)
+        await publish_table_state(order)
         
         # 广播订单状态更新（WebSocket通知）
         try:
@@ -1227,18 +1001,18 @@ async def update_order_status(order_id: int, req: UpdateOrderStatusRequest):
         
         return {"message": "订单状态更新成功", "status": new_status}
     finally:
-        db.close()
+        await db.close()
 
 
 @app.patch("/orders/{order_id}/items/{item_id}/status")
 async def update_order_item_status(order_id: int, item_id: int, req: UpdateItemStatusRequest):
     """更新订单项状态"""
-    db = get_session()
+    db = await get_async_session()
     try:
-        order_item = db.query(OrderItems).filter(
+        order_item = await db.scalar(select(OrderItems).where(
             OrderItems.id == item_id,
             OrderItems.order_id == order_id
-        ).first()
+        ))
         
         if not order_item:
             raise HTTPException(status_code=404, detail="订单项不存在")
@@ -1262,54 +1036,55 @@ async def update_order_item_status(order_id: int, item_id: int, req: UpdateItemS
             )
         
         order_item.status = new_status
-        db.commit()
+        await db.commit()
 
         # 如果菜品被取消，重新计算订单金额
         if new_status == 'cancelled':
             # 查询该订单的所有菜品
-            all_items = db.query(OrderItems).filter(OrderItems.order_id == order_id).all()
+            all_items = (await db.scalars(select(OrderItems).where(OrderItems.order_id == order_id))).all()
             # 只计算未取消的菜品金额
             new_total_amount = sum(item.subtotal for item in all_items if item.status != 'cancelled')
             # 更新订单金额
-            order = db.query(Orders).filter(Orders.id == order_id).first()
+            order = await db.get(Orders, order_id)
             if order:
+                old_total, old_final = order.total_amount, order.final_amount
                 order.total_amount = new_total_amount
                 order.final_amount = new_total_amount  # 同时更新实付金额
-                db.commit()
+                await db.commit()
+                await apply_event_async(db, record_amount_change, order, old_total, old_final)
                 logger.info(f"订单 {order.order_number} 取消菜品，金额重新计算为 {new_total_amount}")
 
         # 检查是否所有菜品都已上菜，如果是则更新订单状态为 completed
         if new_status == 'served':
             # 查询该订单的所有菜品
-            all_items = db.query(OrderItems).filter(OrderItems.order_id == order_id).all()
+            all_items = (await db.scalars(select(OrderItems).where(OrderItems.order_id == order_id))).all()
             # 检查是否所有菜品都是 served 状态
             all_served = all(item.status == 'served' for item in all_items)
 
             if all_served:
                 # 更新订单状态为 completed，但不设置支付状态
-                order = db.query(Orders).filter(Orders.id == order_id).first()
+                order = await db.get(Orders, order_id)
                 if order:
                     order.order_status = 'completed'
-                    db.commit()
+                    await db.commit()
                     logger.info(f"订单 {order.order_number} 所有菜品已上菜，订单状态更新为 completed")
 
         # 检查订单是否可以完成（所有菜品都是served或cancelled状态）
-        all_items = db.query(OrderItems).filter(OrderItems.order_id == order_id).all()
+        all_items = (await db.scalars(select(OrderItems).where(OrderItems.order_id == order_id))).all()
         all_finished = all(item.status in ['served', 'cancelled'] for item in all_items)
 
         if all_finished:
             # 更新订单状态为 completed，但不设置支付状态
-            order = db.query(Orders).filter(Orders.id == order_id).first()
+            order = await db.get(Orders, order_id)
             if order and order.order_status != 'completed':
                 order.order_status = 'completed'
-                db.commit()
+                await db.commit()
                 logger.info(f"订单 {order.order_number} 所有菜品已处理（上菜或取消），订单状态更新为 completed")
 
         # 广播订单项状态更新（WebSocket通知）
         try:
-            import asyncio
             # 获取订单信息
-            order = db.query(Orders).filter(Orders.id == order_id).first()
+            order = await db.get(Orders, order_id)
             if order:
                 order_data = {
                     "id": order.id,
@@ -1326,9 +1101,14 @@ async def update_order_item_status(order_id: int, item_id: int, req: UpdateItemS
         except Exception as ws_error:
             logger.error(f"WebSocket通知失败: {str(ws_error)}")
 
+        # 所有菜品处理完时订单已完成，同步桌台状态
+        order = await db.get(Orders, order_id)
+        if order:
+            await publish_table_state(order)
+
         return {"message": "菜品状态更新成功", "item_status": new_status}
     finally:
-        db.close()
+        await db.close()
 
 
 # 订单流程配置路由
@@ -1351,7 +1131,8 @@ def generate_styled_qrcode(
     foreground_color: str = Form(default="black"),
     background_color: str = Form(default="white"),
     logo_ratio: float = Form(default=0.2),
-    logo: Optional[UploadFile] = None
+    logo: Optional[UploadFile] = None,
+    db: Session = Depends(get_db)
 ):
     """
     生成带样式的二维码
@@ -1364,21 +1145,20 @@ def generate_styled_qrcode(
     from storage.s3.s3_storage import S3SyncStorage
     import os
 
-    db = get_session()
-    try:
-        # 验证桌号是否存在
-        table = db.query(Tables).filter(Tables.id == table_id).first()
-        if not table:
-            raise HTTPException(status_code=404, detail=f"桌号ID {table_id} 不存在")
+    # 验证桌号是否存在
+    table = db.query(Tables).filter(Tables.id == table_id).first()
+    if not table:
+        raise HTTPException(status_code=404, detail=f"桌号ID {table_id} 不存在")
 
-        # 读取logo数据
-        logo_data = None
-        if logo:
-            logo_data = logo.file.read()
+    # 读取logo数据
+    logo_data = None
+    if logo:
+        logo_data = logo.file.read()
 
-        # 生成二维码内容（前端期望的格式）
-        qrcode_content = f"{base_url}/customer_order_v2.html?table={table.table_number}"
+    # 生成二维码内容（前端期望的格式）
+    qrcode_content = f"{base_url}/customer_order_v2.html?table={table.table_number}"
 
+    def render_qrcode() -> bytes:
         # 生成二维码图片
         qr = qrcode.QRCode(
             version=1,
@@ -1424,42 +1204,41 @@ def generate_styled_qrcode(
         # 将图片转换为字节流
         img_byte_arr = io.BytesIO()
         img.save(img_byte_arr, format='PNG')
-        img_bytes = img_byte_arr.getvalue()
-
-        # 上传到S3
-        storage = S3SyncStorage(
-            endpoint_url=os.getenv("COZE_BUCKET_ENDPOINT_URL"),
-            access_key="",
-            secret_key="",
-            bucket_name=os.getenv("COZE_BUCKET_NAME"),
-            region="cn-beijing",
-        )
-
-        # 生成文件名
-        color_fg = foreground_color.replace('#', '')
-        color_bg = background_color.replace('#', '')
-        file_name = f"qrcode_table{table.table_number}_{color_fg}_{color_bg}.png"
-
-        qrcode_key = storage.upload_file(
-            file_content=img_bytes,
-            file_name=file_name,
-            content_type="image/png"
-        )
+        return img_byte_arr.getvalue()
+
+    # 上传到S3
+    storage = S3SyncStorage(
+        endpoint_url=os.getenv("COZE_BUCKET_ENDPOINT_URL"),
+        access_key="",
+        secret_key="",
+        bucket_name=os.getenv("COZE_BUCKET_NAME"),
+        region="cn-beijing",
+    )
+
+    # 输入（内容、颜色、logo、比例）相同的二维码已上传过时直接复用，不再渲染和上传
+    qrcode_key, _ = get_or_upload_qrcode(
+        storage,
+        render_qrcode,
+        qrcode_content,
+        foreground_color,
+        background_color,
+        logo_data,
+        logo_ratio,
+        variant="styled-table"
+    )
+
+    # 生成签名URL
+    qrcode_url = storage.generate_presigned_url(
+        key=qrcode_key,
+        expire_time=3600
+    )
 
-        # 生成签名URL
-        qrcode_url = storage.generate_presigned_url(
-            key=qrcode_key,
-            expire_time=3600
-        )
-
-        return {
-            "qrcode_url": qrcode_url,
-            "qrcode_content": qrcode_content,
-            "table_id": table.id,
-            "table_number": table.table_number
-        }
-    finally:
-        db.close()
+    return {
+        "qrcode_url": qrcode_url,
+        "qrcode_content": qrcode_content,
+        "table_id": table.id,
+        "table_number": table.table_number
+    }
 
 
 @app.get("/health")
@@ -1583,10 +1362,8 @@ async def websocket_store(
             
             # 处理心跳
             if message.get("type") == "ping":
-                await websocket.send_json({
-                    "type": "pong",
-                    "timestamp": datetime.now().isoformat()
-                })
+                # 经发送队列回复，writer 任务是该连接唯一的发送方
+                manager.pong("store", store_id, connection_id)
     except WebSocketDisconnect:
         manager.disconnect(store_id=store_id, connection_id=connection_id)
     except Exception as e:
@@ -1617,10 +1394,8 @@ async def websocket_order(
             
             # 处理心跳
             if message.get("type") == "ping":
-                await websocket.send_json({
-                    "type": "pong",
-                    "timestamp": datetime.now().isoformat()
-                })
+                # 经发送队列回复，writer 任务是该连接唯一的发送方
+                manager.pong("order", order_id, connection_id)
     except WebSocketDisconnect:
         manager.disconnect(order_id=order_id, connection_id=connection_id)
     except Exception as e:
@@ -1651,10 +1426,8 @@ async def websocket_table(
             
             # 处理心跳
             if message.get("type") == "ping":
-                await websocket.send_json({
-                    "type": "pong",
-                    "timestamp": datetime.now().isoformat()
-                })
+                # 经发送队列回复，writer 任务是该连接唯一的发送方
+                manager.pong("table", table_id, connection_id)
     except WebSocketDisconnect:
         manager.disconnect(table_id=table_id, connection_id=connection_id)
     except Exception as e:
@@ -1665,479 +1438,436 @@ async def websocket_table(
 # ============ 厨师做菜流程 API ============
 
 @app.put("/orders/{order_id}/status")
-def update_order_status(order_id: int, request: UpdateOrderStatusRequest):
+def update_order_status(order_id: int, request: UpdateOrderStatusRequest, db: Session = Depends(get_db)):
     """更新订单状态（厨师使用）"""
-    db = get_session()
-    try:
-        order = db.query(Orders).filter(Orders.id == order_id).first()
-        if not order:
-            raise HTTPException(status_code=404, detail=f"订单ID {order_id} 不存在")
-        
-        # 验证状态值
-        valid_statuses = ['pending', 'confirmed', 'preparing', 'ready', 'serving', 'completed', 'cancelled']
-        if request.status not in valid_statuses:
-            raise HTTPException(status_code=400, detail=f"无效的状态值: {request.status}")
-        
-        order.order_status = request.status
-        db.commit()
+    order = db.query(Orders).filter(Orders.id == order_id).first()
+    if not order:
+        raise HTTPException(status_code=404, detail=f"订单ID {order_id} 不存在")
+        
+    # 验证状态值
+    valid_statuses = ['pending', 'confirmed', 'preparing', 'ready', 'serving', 'completed', 'cancelled']
+    if request.status not in valid_statuses:
+        raise HTTPException(status_code=400, detail=f"无效的状态值: {request.status}")
+        
+    old_status = order.order_status
+    order.order_status = request.status
+    db.commit()
+    apply_event(db, record_order_status_change, order, old_status)
+    table_message = record_order_event(order.store_id, order.table_id, order.id, order.order_status)
+    if table_message is not None:
+        try:
+            # 同步接口运行在线程池中，推送交回事件循环执行
+            anyio.from_thread.run(manager.broadcast_to_store, order.store_id, table_message)
+        except Exception as ws_error:
+            logger.error(f"桌台状态推送失败: {str(ws_error)}")
         
-        logger.info(f"订单 {order_id} 状态更新为: {request.status}")
+    logger.info(f"订单 {order_id} 状态更新为: {request.status}")
         
-        return {
-            "message": "订单状态更新成功",
-            "order_id": order_id,
-            "status": request.status
-        }
-    finally:
-        db.close()
+    return {
+        "message": "订单状态更新成功",
+        "order_id": order_id,
+        "status": request.status
+    }
 
 
 @app.put("/order-items/{item_id}/status")
-def update_order_item_status(item_id: int, request: UpdateItemStatusRequest):
+def update_order_item_status(item_id: int, request: UpdateItemStatusRequest, db: Session = Depends(get_db)):
     """更新订单项状态（厨师使用）"""
-    db = get_session()
-    try:
-        order_item = db.query(OrderItems).filter(OrderItems.id == item_id).first()
-        if not order_item:
-            raise HTTPException(status_code=404, detail=f"订单项ID {item_id} 不存在")
+    order_item = db.query(OrderItems).filter(OrderItems.id == item_id).first()
+    if not order_item:
+        raise HTTPException(status_code=404, detail=f"订单项ID {item_id} 不存在")
         
-        # 验证状态值
-        valid_statuses = ['pending', 'confirmed', 'preparing', 'ready', 'serving', 'completed']
-        if request.item_status not in valid_statuses:
-            raise HTTPException(status_code=400, detail=f"无效的状态值: {request.item_status}")
+    # 验证状态值
+    valid_statuses = ['pending', 'confirmed', 'preparing', 'ready', 'serving', 'completed']
+    if request.item_status not in valid_statuses:
+        raise HTTPException(status_code=400, detail=f"无效的状态值: {request.item_status}")
         
-        order_item.status = request.item_status
-        db.commit()
+    order_item.status = request.item_status
+    db.commit()
         
-        logger.info(f"订单项 {item_id} 状态更新为: {request.item_status}")
+    logger.info(f"订单项 {item_id} 状态更新为: {request.item_status}")
         
-        return {
-            "message": "订单项状态更新成功",
-            "item_id": item_id,
-            "status": request.item_status
-        }
-    finally:
-        db.close()
+    return {
+        "message": "订单项状态更新成功",
+        "item_id": item_id,
+        "status": request.item_status
+    }
 
 
 # ============ 店铺设置流程 API ============
 
 @app.put("/store")
-def update_store(request: dict):
+def update_store(request: dict, db: Session = Depends(get_db)):
     """更新店铺信息"""
-    db = get_session()
-    try:
-        first_store = db.query(Stores).first()
-        if not first_store:
-            raise HTTPException(status_code=404, detail="未找到店铺")
+    first_store = db.query(Stores).first()
+    if not first_store:
+        raise HTTPException(status_code=404, detail="未找到店铺")
         
-        # 更新可更新的字段
-        update_fields = ['name', 'address', 'phone', 'opening_hours']
-        for field in update_fields:
-            if field in request:
-                setattr(first_store, field, request[field])
+    # 更新可更新的字段
+    update_fields = ['name', 'address', 'phone', 'opening_hours']
+    for field in update_fields:
+        if field in request:
+            setattr(first_store, field, request[field])
         
-        db.commit()
-        db.refresh(first_store)
+    db.commit()
+    db.refresh(first_store)
         
-        return {
-            "id": first_store.id,
-            "name": first_store.name,
-            "address": first_store.address,
-            "phone": first_store.phone,
-            "opening_hours": first_store.opening_hours
-        }
-    finally:
-        db.close()
+    return {
+        "id": first_store.id,
+        "name": first_store.name,
+        "address": first_store.address,
+        "phone": first_store.phone,
+        "opening_hours": first_store.opening_hours
+    }
 
 
 @app.post("/menu-items/", response_model=dict)
-def create_menu_item(item: MenuItemCreate):
+def create_menu_item(item: MenuItemCreate, db: Session = Depends(get_db)):
     """新增菜品"""
-    db = get_session()
-    try:
-        # 验证分类是否存在
-        category = db.query(MenuCategories).filter(MenuCategories.id == item.category_id).first()
-        if not category:
-            raise HTTPException(status_code=404, detail=f"分类ID {item.category_id} 不存在")
-        
-        db_item = MenuItems(
-            category_id=item.category_id,
-            name=item.name,
-            description=item.description,
-            price=item.price,
-            image_url=item.image_url,
-            stock=item.stock,
-            is_available=item.is_available,
-            is_recommended=item.is_recommended,
-            sort_order=item.sort_order
-        )
-        
-        db.add(db_item)
-        db.commit()
-        db.refresh(db_item)
+    # 验证分类是否存在
+    category = db.query(MenuCategories).filter(MenuCategories.id == item.category_id).first()
+    if not category:
+        raise HTTPException(status_code=404, detail=f"分类ID {item.category_id} 不存在")
+        
+    db_item = MenuItems(
+        category_id=item.category_id,
+        name=item.name,
+        description=item.description,
+        price=item.price,
+        image_url=item.image_url,
+        stock=item.stock,
+        is_available=item.is_available,
+        is_recommended=item.is_recommended,
+        sort_order=item.sort_order
+    )
+        
+    db.add(db_item)
+    db.commit()
+    invalidate_menu(category.store_id)
+    db.refresh(db_item)
         
-        return {
-            "id": db_item.id,
-            "message": "菜品创建成功"
-        }
-    finally:
-        db.close()
+    return {
+        "id": db_item.id,
+        "message": "菜品创建成功"
+    }
 
 
 @app.put("/menu-items/{item_id}")
-def update_menu_item(item_id: int, item: MenuItemUpdate):
+def update_menu_item(item_id: int, item: MenuItemUpdate, db: Session = Depends(get_db)):
     """修改菜品"""
-    db = get_session()
-    try:
-        db_item = db.query(MenuItems).filter(MenuItems.id == item_id).first()
-        if not db_item:
-            raise HTTPException(status_code=404, detail=f"菜品ID {item_id} 不存在")
+    db_item = db.query(MenuItems).filter(MenuItems.id == item_id).first()
+    if not db_item:
+        raise HTTPException(status_code=404, detail=f"菜品ID {item_id} 不存在")
         
-        # 更新字段
-        update_data = item.dict(exclude_unset=True)
-        for key, value in update_data.items():
-            setattr(db_item, key, value)
+    # 更新字段
+    update_data = item.dict(exclude_unset=True)
+    for key, value in update_data.items():
+        setattr(db_item, key, value)
         
-        db.commit()
-        db.refresh(db_item)
+    db.commit()
+    invalidate_menu(db_item.store_id)
+    db.refresh(db_item)
         
-        return {
-            "id": db_item.id,
-            "message": "菜品更新成功"
-        }
-    finally:
-        db.close()
+    return {
+        "id": db_item.id,
+        "message": "菜品更新成功"
+    }
 
 
 @app.delete("/menu-items/{item_id}")
-def delete_menu_item(item_id: int):
+def delete_menu_item(item_id: int, db: Session = Depends(get_db)):
     """删除菜品"""
-    db = get_session()
-    try:
-        db_item = db.query(MenuItems).filter(MenuItems.id == item_id).first()
-        if not db_item:
-            raise HTTPException(status_code=404, detail=f"菜品ID {item_id} 不存在")
+    db_item = db.query(MenuItems).filter(MenuItems.id == item_id).first()
+    if not db_item:
+        raise HTTPException(status_code=404, detail=f"菜品ID {item_id} 不存在")
         
-        db.delete(db_item)
-        db.commit()
+    store_id = db_item.store_id
+    db.delete(db_item)
+    db.commit()
+    invalidate_menu(store_id)
         
-        return {
-            "message": "菜品删除成功"
-        }
-    finally:
-        db.close()
+    return {
+        "message": "菜品删除成功"
+    }
 
 
 @app.post("/tables/", response_model=TableInfo)
-def create_table(table: TableCreate):
+def create_table(table: TableCreate, db: Session = Depends(get_db)):
     """创建桌号"""
-    db = get_session()
-    try:
-        first_store = db.query(Stores).first()
-        if not first_store:
-            raise HTTPException(status_code=404, detail="未找到店铺")
-        
-        db_table = Tables(
-            store_id=first_store.id,
-            table_number=table.table_number,
-            seats=table.seats,
-            is_active=table.is_active
-        )
-        
-        db.add(db_table)
-        db.commit()
-        db.refresh(db_table)
-        
-        return TableInfo(
-            id=db_table.id,
-            table_number=db_table.table_number,
-            seats=db_table.seats,
-            is_active=db_table.is_active,
-            is_occupied=False
-        )
-    finally:
-        db.close()
+    first_store = db.query(Stores).first()
+    if not first_store:
+        raise HTTPException(status_code=404, detail="未找到店铺")
+        
+    db_table = Tables(
+        store_id=first_store.id,
+        table_number=table.table_number,
+        seats=table.seats,
+        is_active=table.is_active
+    )
+        
+    db.add(db_table)
+    db.commit()
+    db.refresh(db_table)
+    invalidate_store_tables(db_table.store_id)
+        
+    return TableInfo(
+        id=db_table.id,
+        table_number=db_table.table_number,
+        seats=db_table.seats,
+        is_active=db_table.is_active,
+        is_occupied=False
+    )
 
 
 @app.post("/tables/{table_id}")
-def update_table(table_id: int, table: TableUpdate):
+def update_table(table_id: int, table: TableUpdate, db: Session = Depends(get_db)):
     """修改桌号"""
-    db = get_session()
-    try:
-        db_table = db.query(Tables).filter(Tables.id == table_id).first()
-        if not db_table:
-            raise HTTPException(status_code=404, detail=f"桌号不存在")
-        
-        # 更新字段
-        update_data = table.dict(exclude_unset=True)
-        for key, value in update_data.items():
-            setattr(db_table, key, value)
-        
-        db.commit()
-        db.refresh(db_table)
-        
-        return TableInfo(
-            id=db_table.id,
-            table_number=db_table.table_number,
-            seats=db_table.seats,
-            is_active=db_table.is_active,
-            is_occupied=False
-        )
-    finally:
-        db.close()
+    db_table = db.query(Tables).filter(Tables.id == table_id).first()
+    if not db_table:
+        raise HTTPException(status_code=404, detail=f"桌号不存在")
+        
+    # 更新字段
+    update_data = table.dict(exclude_unset=True)
+    for key, value in update_data.items():
+        setattr(db_table, key, value)
+        
+    db.commit()
+    db.refresh(db_table)
+    invalidate_store_tables(db_table.store_id)
+        
+    return TableInfo(
+        id=db_table.id,
+        table_number=db_table.table_number,
+        seats=db_table.seats,
+        is_active=db_table.is_active,
+        is_occupied=False
+    )
 
 
 @app.delete("/tables/{table_id}")
-def delete_table(table_id: int):
+def delete_table(table_id: int, db: Session = Depends(get_db)):
     """删除桌号"""
-    db = get_session()
-    try:
-        db_table = db.query(Tables).filter(Tables.id == table_id).first()
-        if not db_table:
-            raise HTTPException(status_code=404, detail="桌号不存在")
+    db_table = db.query(Tables).filter(Tables.id == table_id).first()
+    if not db_table:
+        raise HTTPException(status_code=404, detail="桌号不存在")
         
-        db.delete(db_table)
-        db.commit()
+    db.delete(db_table)
+    db.commit()
+    invalidate_store_tables(db_table.store_id)
         
-        return {
-            "message": "桌号删除成功"
-        }
-    finally:
-        db.close()
+    return {
+        "message": "桌号删除成功"
+    }
 
 
 # ============ 财务统计流程 API ============
 
 @app.get("/stats/daily")
-def get_daily_stats(date: Optional[str] = None):
+def get_daily_stats(date: Optional[str] = None, db: Session = Depends(get_db)):
     """今日营业额统计"""
-    db = get_session()
-    try:
-        from datetime import date as date_type
+    from datetime import date as date_type
         
-        # 默认查询今天
-        if not date:
-            query_date = date_type.today()
-        else:
-            query_date = date_type.fromisoformat(date)
+    # 默认查询今天
+    if not date:
+        query_date = date_type.today()
+    else:
+        query_date = date_type.fromisoformat(date)
         
-        # 查询当天的订单
-        orders = db.query(Orders).filter(
-            Orders.created_at >= query_date,
-            Orders.created_at < query_date
-        ).all()
+    # 读取当天各店铺的汇总行（daily_revenue 由订单事件增量维护）
+    rows = load_daily_revenue(db, query_date, query_date)
         
-        # 计算统计数据
-        total_orders = len(orders)
-        total_amount = sum(o.total_amount for o in orders)
-        paid_orders = [o for o in orders if o.payment_status == "paid"]
-        paid_amount = sum(o.total_amount for o in paid_orders)
+    # 计算统计数据
+    total_orders = sum(r.total_orders for r in rows)
+    total_amount = sum(r.total_amount for r in rows)
+    paid_orders = sum(r.paid_orders for r in rows)
+    paid_amount = sum(r.paid_amount for r in rows)
         
-        return {
-            "date": query_date.isoformat(),
-            "total_orders": total_orders,
-            "total_amount": float(total_amount),
-            "paid_orders": len(paid_orders),
-            "paid_amount": float(paid_amount),
-            "unpaid_orders": total_orders - len(paid_orders),
-            "unpaid_amount": float(total_amount - paid_amount)
-        }
-    finally:
-        db.close()
+    return {
+        "date": query_date.isoformat(),
+        "total_orders": total_orders,
+        "total_amount": float(total_amount),
+        "paid_orders": paid_orders,
+        "paid_amount": float(paid_amount),
+        "unpaid_orders": total_orders - paid_orders,
+        "unpaid_amount": float(total_amount - paid_amount)
+    }
 
 
 @app.get("/stats/tables")
-def get_table_stats(date: Optional[str] = None):
+def get_table_stats(date: Optional[str] = None, db: Session = Depends(get_db)):
     """桌次统计（翻台率）"""
-    db = get_session()
-    try:
-        from datetime import date as date_type
-        
-        # 默认查询今天
-        if not date:
-            query_date = date_type.today()
-        else:
-            query_date = date_type.fromisoformat(date)
+    from datetime import date as date_type
         
-        # 查询当天的订单
-        orders = db.query(Orders).filter(
-            Orders.created_at >= query_date,
-            Orders.created_at < query_date
-        ).all()
-        
-        # 统计每个桌号的使用次数
-        table_stats = {}
-        for order in orders:
-            table_id = order.table_id
-            if table_id not in table_stats:
-                table_stats[table_id] = {
-                    "table_id": table_id,
-                    "table_number": order.table_number if hasattr(order, 'table_number') else str(table_id),
-                    "order_count": 0,
-                    "total_amount": 0.0
-                }
-            table_stats[table_id]["order_count"] += 1
-            table_stats[table_id]["total_amount"] += float(order.total_amount)
+    # 默认查询今天
+    if not date:
+        query_date = date_type.today()
+    else:
+        query_date = date_type.fromisoformat(date)
+        
+    # 查询当天的订单
+    orders = db.query(Orders).filter(
+        Orders.created_at >= query_date,
+        Orders.created_at < query_date
+    ).all()
+        
+    # 统计每个桌号的使用次数
+    table_stats = {}
+    for order in orders:
+        table_id = order.table_id
+        if table_id not in table_stats:
+            table_stats[table_id] = {
+                "table_id": table_id,
+                "table_number": order.table_number if hasattr(order, 'table_number') else str(table_id),
+                "order_count": 0,
+                "total_amount": 0.0
+            }
+        table_stats[table_id]["order_count"] += 1
+        table_stats[table_id]["total_amount"] += float(order.total_amount)
         
-        # 转换为列表
-        result = list(table_stats.values())
-        result.sort(key=lambda x: x["order_count"], reverse=True)
+    # 转换为列表
+    result = list(table_stats.values())
+    result.sort(key=lambda x: x["order_count"], reverse=True)
         
-        return {
-            "date": query_date.isoformat(),
-            "total_tables": len(result),
-            "table_stats": result
-        }
-    finally:
-        db.close()
+    return {
+        "date": query_date.isoformat(),
+        "total_tables": len(result),
+        "table_stats": result
+    }
 
 
 @app.get("/stats/menu-sales")
-def get_menu_sales_stats(date: Optional[str] = None):
+def get_menu_sales_stats(date: Optional[str] = None, db: Session = Depends(get_db)):
     """菜品销售统计"""
-    db = get_session()
-    try:
-        from datetime import date as date_type
-        from sqlalchemy import func
+    from datetime import date as date_type
         
-        # 默认查询今天
-        if not date:
-            query_date = date_type.today()
-        else:
-            query_date = date_type.fromisoformat(date)
-        
-        # 查询当天的订单项
-        order_items = db.query(OrderItems).join(Orders).filter(
-            Orders.created_at >= query_date,
-            Orders.created_at < query_date
-        ).all()
-        
-        # 统计每个菜品的销量
-        menu_stats = {}
-        for item in order_items:
-            menu_item_id = item.menu_item_id
-            if menu_item_id not in menu_stats:
-                menu_stats[menu_item_id] = {
-                    "menu_item_id": menu_item_id,
-                    "menu_item_name": item.menu_item_name,
-                    "total_quantity": 0,
-                    "total_amount": 0.0
-                }
-            menu_stats[menu_item_id]["total_quantity"] += item.quantity
-            menu_stats[menu_item_id]["total_amount"] += float(item.subtotal)
+    # 默认查询今天
+    if not date:
+        query_date = date_type.today()
+    else:
+        query_date = date_type.fromisoformat(date)
+        
+    # 查询当天的订单项
+    order_items = db.query(OrderItems).join(Orders).filter(
+        Orders.created_at >= query_date,
+        Orders.created_at < query_date
+    ).all()
+        
+    # 统计每个菜品的销量
+    menu_stats = {}
+    for item in order_items:
+        menu_item_id = item.menu_item_id
+        if menu_item_id not in menu_stats:
+            menu_stats[menu_item_id] = {
+                "menu_item_id": menu_item_id,
+                "menu_item_name": item.menu_item_name,
+                "total_quantity": 0,
+                "total_amount": 0.0
+            }
+        menu_stats[menu_item_id]["total_quantity"] += item.quantity
+        menu_stats[menu_item_id]["total_amount"] += float(item.subtotal)
         
-        # 转换为列表
-        result = list(menu_stats.values())
-        result.sort(key=lambda x: x["total_quantity"], reverse=True)
+    # 转换为列表
+    result = list(menu_stats.values())
+    result.sort(key=lambda x: x["total_quantity"], reverse=True)
         
-        return {
-            "date": query_date.isoformat(),
-            "total_items": len(result),
-            "menu_stats": result
-        }
-    finally:
-        db.close()
+    return {
+        "date": query_date.isoformat(),
+        "total_items": len(result),
+        "menu_stats": result
+    }
 
 
 @app.get("/stats/inventory")
-def get_inventory_stats():
-    """库存统计"""
-    db = get_session()
-    try:
-        # 查询所有菜品
-        menu_items = db.query(MenuItems).all()
-        
-        result = []
-        for item in menu_items:
-            # 查询今天的销量
-            from datetime import date as date_type, timedelta
-            today = date_type.today()
-            tomorrow = today + timedelta(days=1)
-            
-            sold_quantity = db.query(func.sum(OrderItems.quantity)).join(Orders).filter(
-                OrderItems.menu_item_id == item.id,
-                Orders.created_at >= today,
-                Orders.created_at < tomorrow
-            ).scalar() or 0
-            
-            result.append({
-                "menu_item_id": item.id,
-                "menu_item_name": item.name,
-                "category_name": item.category.name if item.category else "",
-                "stock": item.stock,
-                "sold_today": int(sold_quantity),
-                "remaining": item.stock - int(sold_quantity),
-                "price": float(item.price)
-            })
-        
-        return {
-            "total_items": len(result),
-            "inventory_stats": result
+def get_inventory_stats(
+    store_id: Optional[int] = None,
+    date: Optional[str] = None,
+    days: int = Query(1, description="统计天数（截至 date 当天）", ge=1, le=31),
+    db: Session = Depends(get_db)
+):
+    """库存统计（一条聚合查询，按店铺过滤，销量区间为截至 date 的 days 天）"""
+    from datetime import date as date_type, timedelta
+        
+    end_date = date_type.fromisoformat(date) if date else date_type.today()
+    start_date = end_date - timedelta(days=days - 1)
+    start, end = day_bounds(start_date, end_date)
+        
+    result = []
+    for item_id, name, category_name, stock, price, sold_quantity in inventory_sales(db, start, end, store_id):
+        stats = {
+            "menu_item_id": item_id,
+            "menu_item_name": name,
+            "category_name": category_name or "",
+            "stock": stock,
+            "sold_quantity": sold_quantity,
+            "price": price
         }
-    finally:
-        db.close()
+        if days == 1:
+            # 兼容旧字段：只有单日统计时当日销量、剩余量才有意义
+            stats["sold_today"] = sold_quantity
+            stats["remaining"] = stock - sold_quantity
+        result.append(stats)
+        
+    return {
+        "store_id": store_id,
+        "start_date": start_date.isoformat(),
+        "end_date": end_date.isoformat(),
+        "total_items": len(result),
+        "inventory_stats": result
+    }
 
 
 @app.get("/revenue/")
 def get_revenue(
     start_date: Optional[str] = None,
-    end_date: Optional[str] = None
+    end_date: Optional[str] = None,
+    db: Session = Depends(get_db)
 ):
     """收入报表"""
-    db = get_session()
-    try:
-        from datetime import date as date_type, timedelta
-        
-        # 默认查询最近7天
-        if not start_date:
-            end_date_obj = date_type.today()
-            start_date_obj = end_date_obj - timedelta(days=7)
-        else:
-            start_date_obj = date_type.fromisoformat(start_date)
-            end_date_obj = date_type.fromisoformat(end_date) if end_date else date_type.today()
-        
-        # 查询日期范围内的订单
-        orders = db.query(Orders).filter(
-            Orders.created_at >= start_date_obj,
-            Orders.created_at < end_date_obj
-        ).all()
+    from datetime import date as date_type, timedelta
         
-        # 按日期统计
-        daily_revenue = {}
-        for order in orders:
-            order_date = order.created_at.date().isoformat()
-            if order_date not in daily_revenue:
-                daily_revenue[order_date] = {
-                    "date": order_date,
-                    "order_count": 0,
-                    "total_amount": 0.0,
-                    "paid_amount": 0.0
-                }
-            daily_revenue[order_date]["order_count"] += 1
-            daily_revenue[order_date]["total_amount"] += float(order.total_amount)
-            if order.payment_status == "paid":
-                daily_revenue[order_date]["paid_amount"] += float(order.total_amount)
+    # 默认查询最近7天
+    if not start_date:
+        end_date_obj = date_type.today()
+        start_date_obj = end_date_obj - timedelta(days=7)
+    else:
+        start_date_obj = date_type.fromisoformat(start_date)
+        end_date_obj = date_type.fromisoformat(end_date) if end_date else date_type.today()
+        
+    # 读取汇总表，区间为 [start_date, end_date)
+    rows = load_daily_revenue(db, start_date_obj, end_date_obj - timedelta(days=1))
+        
+    # 按日期合并各店铺
+    daily_revenue = {}
+    for row in rows:
+        row_date = row.date.date().isoformat()
+        if row_date not in daily_revenue:
+            daily_revenue[row_date] = {
+                "date": row_date,
+                "order_count": 0,
+                "total_amount": 0.0,
+                "paid_amount": 0.0
+            }
+        daily_revenue[row_date]["order_count"] += row.total_orders
+        daily_revenue[row_date]["total_amount"] += float(row.total_amount)
+        daily_revenue[row_date]["paid_amount"] += float(row.paid_amount)
         
-        # 转换为列表并排序
-        result = list(daily_revenue.values())
-        result.sort(key=lambda x: x["date"])
+    # 转换为列表并排序
+    result = list(daily_revenue.values())
+    result.sort(key=lambda x: x["date"])
         
-        total_revenue = sum(r["total_amount"] for r in result)
-        total_paid = sum(r["paid_amount"] for r in result)
-        total_orders = sum(r["order_count"] for r in result)
+    total_revenue = sum(r["total_amount"] for r in result)
+    total_paid = sum(r["paid_amount"] for r in result)
+    total_orders = sum(r["order_count"] for r in result)
         
-        return {
-            "start_date": start_date_obj.isoformat(),
-            "end_date": end_date_obj.isoformat(),
-            "total_orders": total_orders,
-            "total_revenue": float(total_revenue),
-            "total_paid": float(total_paid),
-            "unpaid_amount": float(total_revenue - total_paid),
-            "daily_revenue": result
-        }
-    finally:
-        db.close()
+    return {
+        "start_date": start_date_obj.isoformat(),
+        "end_date": end_date_obj.isoformat(),
+        "total_orders": total_orders,
+        "total_revenue": float(total_revenue),
+        "total_paid": float(total_paid),
+        "unpaid_amount": float(total_revenue - total_paid),
+        "daily_revenue": result
+    }
 
 
 
@@ -2149,9 +1879,12 @@ async def process_payment(order_id: int, req: dict = Body(default=None)):
     将柜台支付的订单标记为已支付
     支持实收金额和找零计算
     """
-    db = get_session()
+    db = await get_async_session()
     try:
-        order = db.query(Orders).filter(Orders.id == order_id).first()
+        # 锁定订单行直到提交，同一订单的并发收款只有一次能标记为已支付
+        order = (await db.execute(
+            select(Orders).where(Orders.id == order_id).with_for_update()
+        )).scalar_one_or_none()
         if not order:
             raise HTTPException(status_code=404, detail="订单不存在")
 
@@ -2167,6 +1900,8 @@ async def process_payment(order_id: int, req: dict = Body(default=None)):
         if not received_amount or received_amount <= 0:
             received_amount = order.final_amount
 
+        old_status = order.order_status
+
         # 更新支付状态
         order.payment_status = "paid"
         order.payment_method = order.payment_method or "counter"
@@ -2181,7 +1916,10 @@ async def process_payment(order_id: int, req: dict = Body(default=None)):
         else:
             order.special_instructions = f"实收：¥{received_amount:.2f}，找零：¥{change_amount:.2f}"
 
-        db.commit()
+        await db.commit()
+        await apply_event_async(db, record_order_paid, order)
+        await apply_event_async(db, record_order_status_change, order, old_status)
+        await publish_table_state(order)
 
         # 广播支付状态更新
         try:
@@ -2210,60 +1948,56 @@ async def process_payment(order_id: int, req: dict = Body(default=None)):
             "change_amount": change_amount
         }
     finally:
-        db.close()
+        await db.close()
 
 
 # ============ 打印小票 API ============
 @app.get("/api/orders/{order_id}/receipt")
-def get_order_receipt(order_id: int):
+def get_order_receipt(order_id: int, db: Session = Depends(get_db)):
     """获取订单小票数据"""
-    db = get_session()
-    try:
-        order = db.query(Orders).filter(Orders.id == order_id).first()
-        if not order:
-            raise HTTPException(status_code=404, detail="订单不存在")
-
-        # 获取桌号
-        table = db.query(Tables).filter(Tables.id == order.table_id).first()
-        table_number = table.table_number if table else ""
-
-        # 获取订单项
-        items = []
-        for oi in order.order_items:
-            items.append({
-                "name": oi.menu_item_name,
-                "quantity": oi.quantity,
-                "price": float(oi.menu_item_price),
-                "subtotal": float(oi.subtotal)
-            })
-
-        # 解析实收和找零信息（从 special_instructions 中）
-        received_amount = float(order.final_amount)  # 默认使用实付金额
-        change_amount = 0.0
+    order = db.query(Orders).filter(Orders.id == order_id).first()
+    if not order:
+        raise HTTPException(status_code=404, detail="订单不存在")
+
+    # 获取桌号
+    table = db.query(Tables).filter(Tables.id == order.table_id).first()
+    table_number = table.table_number if table else ""
+
+    # 获取订单项
+    items = []
+    for oi in order.order_items:
+        items.append({
+            "name": oi.menu_item_name,
+            "quantity": oi.quantity,
+            "price": float(oi.menu_item_price),
+            "subtotal": float(oi.subtotal)
+        })
 
-        if order.special_instructions:
-            # 尝试从备注中提取实收和找零
-            import re
-            match = re.search(r'实收：¥([\d.]+)，找零：¥([\d.]+)', order.special_instructions)
-            if match:
-                received_amount = float(match.group(1))
-                change_amount = float(match.group(2))
-
-        # 构建小票数据
-        receipt_data = {
-            "order_number": order.order_number,
-            "table_number": table_number,
-            "items": items,
-            "subtotal": float(order.final_amount),
-            "received_amount": received_amount,
-            "change_amount": change_amount,
-            "order_time": order.created_at.strftime("%Y-%m-%d %H:%M:%S"),
-            "payment_method": order.payment_method or "未支付"
-        }
+    # 解析实收和找零信息（从 special_instructions 中）
+    received_amount = float(order.final_amount)  # 默认使用实付金额
+    change_amount = 0.0
+
+    if order.special_instructions:
+        # 尝试从备注中提取实收和找零
+        import re
+        match = re.search(r'实收：¥([\d.]+)，找零：¥([\d.]+)', order.special_instructions)
+        if match:
+            received_amount = float(match.group(1))
+            change_amount = float(match.group(2))
+
+    # 构建小票数据
+    receipt_data = {
+        "order_number": order.order_number,
+        "table_number": table_number,
+        "items": items,
+        "subtotal": float(order.final_amount),
+        "received_amount": received_amount,
+        "change_amount": change_amount,
+        "order_time": order.created_at.strftime("%Y-%m-%d %H:%M:%S"),
+        "payment_method": order.payment_method or "未支付"
+    }
 
-        return receipt_data
-    finally:
-        db.close()
+    return receipt_data
 
 
 # ============ FastAPI 应用实例 ============
@@ -2,7 +2,7 @@
 餐饮系统增强 API
 提供菜品图片上传、会员二维码、优惠系统等增强功能
 """
-from fastapi import FastAPI, HTTPException, Query, Form, UploadFile
+from fastapi import FastAPI, HTTPException, Depends, Query, Form, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
 from pydantic import BaseModel, Field
@@ -15,12 +15,17 @@ import sys
 import os
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
-from storage.database.db import get_session
+from storage.database.db import get_session, get_db
 from storage.database.shared.model import (
     Companies, Stores, MenuItems, Members, MemberQRCodes,
-    DiscountConfig, MemberLevelRules, Orders
+    DiscountConfig, Orders
 )
 from coze_coding_dev_sdk.s3 import S3SyncStorage
+from services.qrcode_cache import get_or_upload_qrcode
+from services.member_levels import get_level_info, get_member_levels
+from services.discount_engine import (
+    CompiledDiscount, get_store_discounts, invalidate_discount_rules, load_discount_rule, quote_order
+)
 
 logger = logging.getLogger(__name__)
 
@@ -134,6 +139,12 @@ class ApplyDiscountResponse(BaseModel):
     member_info: Optional[dict] = None
 
 
+class DiscountQuoteRequest(BaseModel):
+    """批量计算优惠请求（同一店铺的多个购物车）"""
+    store_id: int
+    carts: List[ApplyDiscountRequest] = Field(..., min_length=1, max_length=200)
+
+
 # ============ 工具函数 ============
 
 def get_storage():
@@ -147,29 +158,9 @@ def get_storage():
     )
 
 
-def get_member_level_info(level: int) -> dict:
-    """获取会员等级信息"""
-    db = get_session()
-    try:
-        level_rule = db.query(MemberLevelRules).filter(
-            MemberLevelRules.level == level
-        ).first()
-        
-        if level_rule:
-            return {
-                "level": level_rule.level,
-                "level_name": level_rule.level_name,
-                "min_points": level_rule.min_points,
-                "discount": level_rule.discount
-            }
-        return {
-            "level": level,
-            "level_name": "普通会员",
-            "min_points": 0,
-            "discount": 1.0
-        }
-    finally:
-        db.close()
+def get_member_level_info(level: int, db: Optional[Session] = None) -> dict:
+    """获取会员等级信息（读取等级规则快照；快照过期时复用传入的会话重新加载）"""
+    return get_level_info(level, db)
 
 
 # ============ 菜品图片上传 ============
@@ -238,7 +229,7 @@ async def upload_menu_item_image(
 # ============ 会员二维码 ============
 
 @app.get("/api/member/{member_id}/qrcode", response_model=MemberQRCodeResponse)
-def get_member_qrcode(member_id: int, days_valid: int = Query(default=30, ge=1, le=365)):
+def get_member_qrcode(member_id: int, days_valid: int = Query(default=30, ge=1, le=365), db: Session = Depends(get_db)):
     """
     获取会员二维码
     如果不存在则自动生成
@@ -247,7 +238,6 @@ def get_member_qrcode(member_id: int, days_valid: int = Query(default=30, ge=1,
     from qrcode.constants import ERROR_CORRECT_H
     from PIL import Image
     
-    db = get_session()
     try:
         # 验证会员是否存在
         member = db.query(Members).filter(Members.id == member_id).first()
@@ -258,47 +248,43 @@ def get_member_qrcode(member_id: int, days_valid: int = Query(default=30, ge=1,
         now = datetime.now()
         valid_until = now + timedelta(days=days_valid)
         
-        qrcode = db.query(MemberQRCodes).filter(
+        member_qrcode = db.query(MemberQRCodes).filter(
             MemberQRCodes.member_id == member_id,
             MemberQRCodes.is_active == True,
             MemberQRCodes.valid_until > now
         ).first()
         
         # 如果不存在或已过期，生成新的
-        if not qrcode:
+        if not member_qrcode:
             # 删除旧的二维码
             db.query(MemberQRCodes).filter(MemberQRCodes.member_id == member_id).delete()
             
-            # 生成二维码内容（包含会员ID和加密验证）
-            qr_content = f"MEMBER:{member.id}:{now.strftime('%Y%m%d%H%M%S')}"
+            # 生成二维码内容（会员ID + 入会时间，同一会员的内容固定，过期续期时复用已上传的图片）
+            qr_content = f"MEMBER:{member.id}:{member.created_at.strftime('%Y%m%d%H%M%S')}"
             
-            # 生成二维码图片
-            qr = qrcode.QRCode(
-                version=1,
-                error_correction=ERROR_CORRECT_H,
-                box_size=10,
-                border=4,
-            )
-            qr.add_data(qr_content)
-            qr.make(fit=True)
-            
-            # 转换为图片
-            img = qr.make_image(fill_color="black", back_color="white")
-            img = img.convert('RGB')
-            
-            # 将图片转换为字节流
-            img_byte_arr = io.BytesIO()
-            img.save(img_byte_arr, format='PNG')
-            img_bytes = img_byte_arr.getvalue()
+            def render_qrcode() -> bytes:
+                # 生成二维码图片
+                qr = qrcode.QRCode(
+                    version=1,
+                    error_correction=ERROR_CORRECT_H,
+                    box_size=10,
+                    border=4,
+                )
+                qr.add_data(qr_content)
+                qr.make(fit=True)
+                
+                # 转换为图片
+                img = qr.make_image(fill_color="black", back_color="white")
+                img = img.convert('RGB')
+                
+                # 将图片转换为字节流
+                img_byte_arr = io.BytesIO()
+                img.save(img_byte_arr, format='PNG')
+                return img_byte_arr.getvalue()
             
-            # 上传到S3
+            # 上传到S3（已上传过同一内容的二维码时直接复用）
             storage = get_storage()
-            file_name = f"member_qrcode_{member.id}_{now.strftime('%Y%m%d%H%M%S')}.png"
-            qrcode_key = storage.upload_file(
-                file_content=img_bytes,
-                file_name=file_name,
-                content_type="image/png"
-            )
+            qrcode_key, _ = get_or_upload_qrcode(storage, render_qrcode, qr_content, variant="member")
             
             # 生成签名URL
             qrcode_url = storage.generate_presigned_url(
@@ -307,7 +293,7 @@ def get_member_qrcode(member_id: int, days_valid: int = Query(default=30, ge=1,
             )
             
             # 创建二维码记录
-            qrcode = MemberQRCodes(
+            member_qrcode = MemberQRCodes(
                 member_id=member.id,
                 qr_code_url=qrcode_url,
                 qr_code_key=qrcode_key,
@@ -315,14 +301,14 @@ def get_member_qrcode(member_id: int, days_valid: int = Query(default=30, ge=1,
                 valid_until=valid_until,
                 is_active=True
             )
-            db.add(qrcode)
+            db.add(member_qrcode)
             db.commit()
         else:
-            qrcode_url = qrcode.qr_code_url
-            valid_until = qrcode.valid_until
+            qrcode_url = member_qrcode.qr_code_url
+            valid_until = member_qrcode.valid_until
         
         # 获取等级信息
-        level_info = get_member_level_info(member.level)
+        level_info = get_member_level_info(member.level, db)
         
         return MemberQRCodeResponse(
             member_id=member.id,
@@ -334,67 +320,61 @@ def get_member_qrcode(member_id: int, days_valid: int = Query(default=30, ge=1,
         db.rollback()
         logger.error(f"获取会员二维码失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"获取会员二维码失败: {str(e)}")
-    finally:
-        db.close()
 
 
 # ============ 会员验证 ============
 
 @app.post("/api/member/verify", response_model=MemberVerificationResponse)
-def verify_member(request: MemberVerificationRequest):
+def verify_member(request: MemberVerificationRequest, db: Session = Depends(get_db)):
     """
     验证会员信息
     支持通过手机号或二维码内容验证
     """
-    db = get_session()
-    try:
-        member = None
-        
-        # 判断是通过手机号还是二维码验证
-        if request.identifier.startswith("MEMBER:"):
-            # 通过二维码验证
-            parts = request.identifier.split(":")
-            if len(parts) >= 2:
-                try:
-                    member_id = int(parts[1])
-                    member = db.query(Members).filter(Members.id == member_id).first()
-                except ValueError:
-                    pass
-        else:
-            # 通过手机号验证
-            member = db.query(Members).filter(
-                Members.phone == request.identifier
-            ).first()
-        
-        if not member:
-            raise HTTPException(status_code=404, detail="会员不存在")
+    member = None
+        
+    # 判断是通过手机号还是二维码验证
+    if request.identifier.startswith("MEMBER:"):
+        # 通过二维码验证
+        parts = request.identifier.split(":")
+        if len(parts) >= 2:
+            try:
+                member_id = int(parts[1])
+                member = db.query(Members).filter(Members.id == member_id).first()
+            except ValueError:
+                pass
+    else:
+        # 通过手机号验证
+        member = db.query(Members).filter(
+            Members.phone == request.identifier
+        ).first()
         
-        # 更新二维码扫描次数（如果是二维码验证）
-        if request.identifier.startswith("MEMBER:"):
-            qrcode = db.query(MemberQRCodes).filter(
-                MemberQRCodes.member_id == member.id,
-                MemberQRCodes.is_active == True
-            ).first()
-            if qrcode:
-                qrcode.scan_count += 1
-                qrcode.last_scan_time = datetime.now()
-                db.commit()
+    if not member:
+        raise HTTPException(status_code=404, detail="会员不存在")
         
-        # 获取等级信息
-        level_info = get_member_level_info(member.level)
+    # 更新二维码扫描次数（如果是二维码验证）
+    if request.identifier.startswith("MEMBER:"):
+        qrcode = db.query(MemberQRCodes).filter(
+            MemberQRCodes.member_id == member.id,
+            MemberQRCodes.is_active == True
+        ).first()
+        if qrcode:
+            qrcode.scan_count += 1
+            qrcode.last_scan_time = datetime.now()
+            db.commit()
         
-        return MemberVerificationResponse(
-            member_id=member.id,
-            phone=member.phone,
-            name=member.name,
-            level=member.level,
-            level_name=level_info["level_name"],
-            points=member.points,
-            discount=level_info["discount"],
-            avatar_url=member.avatar_url
-        )
-    finally:
-        db.close()
+    # 获取等级信息
+    level_info = get_member_level_info(member.level, db)
+        
+    return MemberVerificationResponse(
+        member_id=member.id,
+        phone=member.phone,
+        name=member.name,
+        level=member.level,
+        level_name=level_info["level_name"],
+        points=member.points,
+        discount=level_info["discount"],
+        avatar_url=member.avatar_url
+    )
 
 
 # ============ 优惠配置 ============
@@ -403,13 +383,13 @@ def verify_member(request: MemberVerificationRequest):
 def create_discount_config(
     config: DiscountConfigCreate,
     store_id: Optional[int] = None,
-    company_id: Optional[int] = None
+    company_id: Optional[int] = None,
+    db: Session = Depends(get_db)
 ):
     """
     创建优惠配置
     必须指定 store_id 或 company_id 其中一个
     """
-    db = get_session()
     try:
         if not store_id and not company_id:
             raise HTTPException(status_code=400, detail="必须指定店铺ID或公司ID")
@@ -454,6 +434,7 @@ def create_discount_config(
         db.add(db_config)
         db.commit()
         db.refresh(db_config)
+        invalidate_discount_rules()
         
         logger.info(f"优惠配置创建成功: config_id={db_config.id}")
         
@@ -477,62 +458,56 @@ def create_discount_config(
         db.rollback()
         logger.error(f"创建优惠配置失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"创建优惠配置失败: {str(e)}")
-    finally:
-        db.close()
 
 
 @app.get("/api/discount-config", response_model=List[DiscountConfigResponse])
 def get_discount_configs(
     store_id: Optional[int] = None,
     company_id: Optional[int] = None,
-    is_active: Optional[bool] = None
+    is_active: Optional[bool] = None,
+    db: Session = Depends(get_db)
 ):
     """
     获取优惠配置列表
     """
-    db = get_session()
-    try:
-        query = db.query(DiscountConfig)
+    query = db.query(DiscountConfig)
         
-        if store_id:
-            query = query.filter(DiscountConfig.store_id == store_id)
+    if store_id:
+        query = query.filter(DiscountConfig.store_id == store_id)
         
-        if company_id:
-            query = query.filter(DiscountConfig.company_id == company_id)
-        
-        if is_active is not None:
-            query = query.filter(DiscountConfig.is_active == is_active)
-        
-        configs = query.order_by(DiscountConfig.created_at.desc()).all()
-        
-        result = []
-        for config in configs:
-            result.append(DiscountConfigResponse(
-                id=config.id,
-                store_id=config.store_id,
-                company_id=config.company_id,
-                discount_type=config.discount_type,
-                discount_value=float(config.discount_value),
-                min_amount=float(config.min_amount) if config.min_amount else None,
-                max_discount=float(config.max_discount) if config.max_discount else None,
-                member_level=config.member_level,
-                points_required=config.points_required,
-                description=config.description,
-                valid_from=config.valid_from.isoformat() if config.valid_from else None,
-                valid_until=config.valid_until.isoformat() if config.valid_until else None,
-                is_active=config.is_active,
-                created_at=config.created_at.isoformat()
-            ))
-        
-        return result
-    finally:
-        db.close()
+    if company_id:
+        query = query.filter(DiscountConfig.company_id == company_id)
+        
+    if is_active is not None:
+        query = query.filter(DiscountConfig.is_active == is_active)
+        
+    configs = query.order_by(DiscountConfig.created_at.desc()).all()
+        
+    result = []
+    for config in configs:
+        result.append(DiscountConfigResponse(
+            id=config.id,
+            store_id=config.store_id,
+            company_id=config.company_id,
+            discount_type=config.discount_type,
+            discount_value=float(config.discount_value),
+            min_amount=float(config.min_amount) if config.min_amount else None,
+            max_discount=float(config.max_discount) if config.max_discount else None,
+            member_level=config.member_level,
+            points_required=config.points_required,
+            description=config.description,
+            valid_from=config.valid_from.isoformat() if config.valid_from else None,
+            valid_until=config.valid_until.isoformat() if config.valid_until else None,
+            is_active=config.is_active,
+            created_at=config.created_at.isoformat()
+        ))
+        
+    return result
 
 
 @app.patch("/api/discount-config/{config_id}", response_model=DiscountConfigResponse)
-def update_discount_config(config_id: int, config: DiscountConfigUpdate):
+def update_discount_config(config_id: int, config: DiscountConfigUpdate, db: Session = Depends(get_db)):
     """更新优惠配置"""
-    db = get_session()
     try:
         db_config = db.query(DiscountConfig).filter(DiscountConfig.id == config_id).first()
         if not db_config:
@@ -551,6 +526,7 @@ def update_discount_config(config_id: int, config: DiscountConfigUpdate):
         
         db.commit()
         db.refresh(db_config)
+        invalidate_discount_rules()
         
         logger.info(f"优惠配置更新成功: config_id={db_config.id}")
         
@@ -574,210 +550,94 @@ def update_discount_config(config_id: int, config: DiscountConfigUpdate):
         db.rollback()
         logger.error(f"更新优惠配置失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"更新优惠配置失败: {str(e)}")
-    finally:
-        db.close()
 
 
 @app.delete("/api/discount-config/{config_id}")
-def delete_discount_config(config_id: int):
+def delete_discount_config(config_id: int, db: Session = Depends(get_db)):
     """删除优惠配置"""
-    db = get_session()
-    try:
-        db_config = db.query(DiscountConfig).filter(DiscountConfig.id == config_id).first()
-        if not db_config:
-            raise HTTPException(status_code=404, detail="优惠配置不存在")
+    db_config = db.query(DiscountConfig).filter(DiscountConfig.id == config_id).first()
+    if not db_config:
+        raise HTTPException(status_code=404, detail="优惠配置不存在")
         
-        db.delete(db_config)
-        db.commit()
+    db.delete(db_config)
+    db.commit()
+    invalidate_discount_rules()
         
-        logger.info(f"优惠配置删除成功: config_id={config_id}")
+    logger.info(f"优惠配置删除成功: config_id={config_id}")
         
-        return {"message": "优惠配置删除成功"}
-    finally:
-        db.close()
+    return {"message": "优惠配置删除成功"}
 
 
 # ============ 应用优惠 ============
 
 @app.post("/api/discount/apply", response_model=ApplyDiscountResponse)
-def apply_discount(request: ApplyDiscountRequest, store_id: Optional[int] = None):
+def apply_discount(request: ApplyDiscountRequest, store_id: Optional[int] = None, db: Session = Depends(get_db)):
     """
     应用优惠
-    计算订单的最优优惠
+    计算订单的最优优惠（未指定优惠配置时，从店铺及其所属公司的规则中选优惠金额最大的一条）
     """
-    db = get_session()
-    try:
-        original_amount = request.order_amount
-        total_discount = 0.0
-        discount_info = {
-            "applied_discounts": [],
-            "member_discount": None,
-            "points_discount": None,
-            "custom_discount": None
+    member = None
+    if request.member_id:
+        member = db.query(Members).filter(Members.id == request.member_id).first()
+
+    index = get_store_discounts(store_id, db) if store_id else None
+    selected_rule = None
+    if request.discount_config_id:
+        selected_rule = index.rules.get(request.discount_config_id) if index else None
+        if selected_rule is None:
+            selected_rule = load_discount_rule(db, request.discount_config_id)
+
+    return ApplyDiscountResponse(**quote_order(
+        request.order_amount,
+        get_member_levels(db),
+        member=member,
+        member_points=request.member_points,
+        index=index,
+        selected_rule=selected_rule,
+        rule_selected=bool(request.discount_config_id)
+    ))
+
+
+@app.post("/api/discount/quote", response_model=List[ApplyDiscountResponse])
+def quote_discounts(request: DiscountQuoteRequest, db: Session = Depends(get_db)):
+    """
+    批量计算优惠
+    同一店铺的多个购物车共用一份优惠索引和等级规则快照，会员和指定的优惠配置各用一条查询加载
+    """
+    index = get_store_discounts(request.store_id, db)
+    levels = get_member_levels(db)
+
+    member_ids = {cart.member_id for cart in request.carts if cart.member_id}
+    members = {}
+    if member_ids:
+        members = {
+            m.id: m for m in db.query(Members).filter(Members.id.in_(member_ids)).all()
         }
-        member_info = None
-        
-        # 1. 会员等级折扣
-        if request.member_id:
-            member = db.query(Members).filter(Members.id == request.member_id).first()
-            if member:
-                level_info = get_member_level_info(member.level)
-                member_discount_rate = level_info["discount"]
-                member_discount = original_amount * (1 - member_discount_rate)
-                
-                if member_discount > 0:
-                    discount_info["member_discount"] = {
-                        "type": "member_level",
-                        "level": member.level,
-                        "level_name": level_info["level_name"],
-                        "discount_rate": member_discount_rate,
-                        "discount_amount": round(member_discount, 2)
-                    }
-                    total_discount += member_discount
-                    discount_info["applied_discounts"].append("会员等级折扣")
-                
-                member_info = {
-                    "member_id": member.id,
-                    "level": member.level,
-                    "level_name": level_info["level_name"],
-                    "points": member.points
-                }
-        
-        # 2. 积分抵扣（1积分 = 0.01元）
-        if request.member_points and request.member_points > 0:
-            points_discount = request.member_points * 0.01
-            # 限制：积分抵扣不超过订单金额的50%
-            max_points_discount = original_amount * 0.5
-            if points_discount > max_points_discount:
-                points_discount = max_points_discount
-            
-            if points_discount > 0:
-                discount_info["points_discount"] = {
-                    "type": "points",
-                    "points_used": int(request.member_points),
-                    "discount_amount": round(points_discount, 2)
-                }
-                total_discount += points_discount
-                discount_info["applied_discounts"].append("积分抵扣")
-        
-        # 3. 自定义优惠配置
-        if request.discount_config_id:
-            discount_config = db.query(DiscountConfig).filter(
-                DiscountConfig.id == request.discount_config_id,
-                DiscountConfig.is_active == True
-            ).first()
-            
-            if discount_config:
-                now = datetime.now()
-                
-                # 检查日期有效性
-                if discount_config.valid_from and now < discount_config.valid_from:
-                    pass
-                elif discount_config.valid_until and now > discount_config.valid_until:
-                    pass
-                elif discount_config.member_level and member_info and member_info["level"] < discount_config.member_level:
-                    pass
-                elif discount_config.points_required and (not member_info or member_info["points"] < discount_config.points_required):
-                    pass
-                else:
-                    # 应用优惠
-                    config_discount = 0.0
-                    if discount_config.discount_type == "percentage":
-                        config_discount = original_amount * (discount_config.discount_value / 100)
-                    elif discount_config.discount_type == "fixed":
-                        config_discount = discount_config.discount_value
-                    elif discount_config.discount_type == "points" and request.member_points:
-                        # 积分兑换优惠
-                        config_discount = min(request.member_points, discount_config.points_required) * (discount_config.discount_value / 100)
-                    
-                    # 应用最大优惠限制
-                    if discount_config.max_discount and config_discount > discount_config.max_discount:
-                        config_discount = discount_config.max_discount
-                    
-                    if config_discount > 0:
-                        discount_info["custom_discount"] = {
-                            "type": discount_config.discount_type,
-                            "config_id": discount_config.id,
-                            "discount_value": float(discount_config.discount_value),
-                            "discount_amount": round(config_discount, 2)
-                        }
-                        total_discount += config_discount
-                        discount_info["applied_discounts"].append("自定义优惠")
-        
-        # 4. 查找所有有效的优惠配置（未指定特定配置时）
-        if not request.discount_config_id:
-            query = db.query(DiscountConfig).filter(DiscountConfig.is_active == True)
-            
-            if store_id:
-                query = query.filter(DiscountConfig.store_id == store_id)
-            
-            # 获取第一个公司的ID（用于公司级别的优惠）
-            first_company = db.query(Companies).first()
-            if first_company:
-                query = query.filter(
-                    (DiscountConfig.store_id == store_id) | (DiscountConfig.company_id == first_company.id)
-                )
-            
-            configs = query.all()
-            
-            for config in configs:
-                now = datetime.now()
-                
-                # 检查日期有效性
-                if config.valid_from and now < config.valid_from:
-                    continue
-                if config.valid_until and now > config.valid_until:
-                    continue
-                
-                # 检查会员等级
-                if config.member_level and member_info and member_info["level"] < config.member_level:
-                    continue
-                
-                # 检查所需积分
-                if config.points_required and (not member_info or member_info["points"] < config.points_required):
-                    continue
-                
-                # 检查最低消费
-                if config.min_amount and original_amount < config.min_amount:
-                    continue
-                
-                # 应用优惠
-                config_discount = 0.0
-                if config.discount_type == "percentage":
-                    config_discount = original_amount * (config.discount_value / 100)
-                elif config.discount_type == "fixed":
-                    config_discount = config.discount_value
-                
-                # 应用最大优惠限制
-                if config.max_discount and config_discount > config.max_discount:
-                    config_discount = config.max_discount
-                
-                if config_discount > 0:
-                    discount_info["custom_discount"] = {
-                        "type": config.discount_type,
-                        "config_id": config.id,
-                        "discount_value": float(config.discount_value),
-                        "discount_amount": round(config_discount, 2)
-                    }
-                    total_discount += config_discount
-                    discount_info["applied_discounts"].append("自动应用优惠")
-                    break  # 只应用一个最优优惠
-        
-        # 计算最终金额
-        final_amount = original_amount - total_discount
-        if final_amount < 0:
-            final_amount = 0
-            total_discount = original_amount
-        
-        return ApplyDiscountResponse(
-            original_amount=round(original_amount, 2),
-            discount_amount=round(total_discount, 2),
-            final_amount=round(final_amount, 2),
-            discount_info=discount_info,
-            member_info=member_info
-        )
-    finally:
-        db.close()
+
+    selected_rules = {
+        cart.discount_config_id: index.rules.get(cart.discount_config_id)
+        for cart in request.carts if cart.discount_config_id
+    }
+    missing = [config_id for config_id, rule in selected_rules.items() if rule is None]
+    if missing:
+        for config in db.query(DiscountConfig).filter(
+            DiscountConfig.id.in_(missing),
+            DiscountConfig.is_active == True
+        ).all():
+            selected_rules[config.id] = CompiledDiscount(config)
+
+    return [
+        ApplyDiscountResponse(**quote_order(
+            cart.order_amount,
+            levels,
+            member=members.get(cart.member_id) if cart.member_id else None,
+            member_points=cart.member_points,
+            index=index,
+            selected_rule=selected_rules.get(cart.discount_config_id) if cart.discount_config_id else None,
+            rule_selected=bool(cart.discount_config_id)
+        ))
+        for cart in request.carts
+    ]
 
 
 @app.get("/health")
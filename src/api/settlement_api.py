@@ -2,7 +2,7 @@
 跨店铺结算与第三方积分互通 API
 支持跨店铺积分结算、第三方积分兑换、积分协议管理等功能
 """
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Depends, Query
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
 from pydantic import BaseModel, Field
@@ -10,11 +10,14 @@ from typing import Optional, List
 from datetime import datetime, date
 from decimal import Decimal
 
-from src.storage.database.db import get_session
+from src.storage.database.db import get_db
 from src.storage.database.shared.model import (
     StorePointSettlements, ThirdPartyPointAgreements, PointExchangeLogs,
-    Stores, Members, PointLogs, Orders
+    Stores, Members, PointLogs, Orders, StoreSettlementTransfers
 )
+from services.point_exchange_quota import get_daily_usage, reserve_daily_points
+from services.settlement_netting import SETTLEMENT_CYCLES, run_settlement_cycle
+from sqlalchemy import func, or_
 import logging
 
 # 创建 FastAPI 应用
@@ -179,17 +182,7 @@ def validate_point_exchange(
     if agreement.valid_until and now > agreement.valid_until:
         return False, "协议已过期", agreement
     
-    # 检查每日限额
-    if agreement.max_points_per_day:
-        today_start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-        today_exchange = db.query(PointExchangeLogs).filter(
-            PointExchangeLogs.agreement_id == agreement_id,
-            PointExchangeLogs.created_at >= today_start,
-            PointExchangeLogs.status == "success"
-        ).count()
-        
-        if today_exchange + points > agreement.max_points_per_day:
-            return False, f"超过每日最大兑换限额（已使用：{today_exchange}，限额：{agreement.max_points_per_day}）", agreement
+    # 每日限额在兑换事务中通过 reserve_daily_points 原子占用，这里不再统计兑换日志
     
     # 检查单笔订单限额
     if agreement.max_points_per_order and points > agreement.max_points_per_order:
@@ -232,13 +225,12 @@ def root():
 # ============ 跨店铺结算接口 ============
 
 @app.post("/api/settlement/store", response_model=StoreSettlementResponse)
-def create_store_settlement(request: StoreSettlementRequest):
+def create_store_settlement(request: StoreSettlementRequest, db: Session = Depends(get_db)):
     """
     创建跨店铺结算
     
     功能：记录会员在一个店铺消费时使用另一个店铺的积分
     """
-    db = get_session()
     try:
         # 验证请求
         is_valid, error_msg = validate_store_settlement(
@@ -315,16 +307,13 @@ def create_store_settlement(request: StoreSettlementRequest):
         logger.error(f"创建跨店铺结算失败：{str(e)}")
         db.rollback()
         raise HTTPException(status_code=500, detail=f"创建结算失败：{str(e)}")
-    finally:
-        db.close()
 
 
 @app.get("/api/settlement/store/{settlement_id}", response_model=StoreSettlementResponse)
-def get_store_settlement(settlement_id: int):
+def get_store_settlement(settlement_id: int, db: Session = Depends(get_db)):
     """
     获取结算详情
     """
-    db = get_session()
     try:
         settlement = db.query(StorePointSettlements).filter(
             StorePointSettlements.id == settlement_id
@@ -358,8 +347,6 @@ def get_store_settlement(settlement_id: int):
     except Exception as e:
         logger.error(f"获取结算详情失败：{str(e)}")
         raise HTTPException(status_code=500, detail=f"获取结算详情失败：{str(e)}")
-    finally:
-        db.close()
 
 
 @app.get("/api/settlement/store/list")
@@ -371,12 +358,12 @@ def get_store_settlement_list(
     date_from: Optional[str] = Query(None, description="开始日期 (YYYY-MM-DD)"),
     date_to: Optional[str] = Query(None, description="结束日期 (YYYY-MM-DD)"),
     page: int = Query(1, ge=1, description="页码"),
-    page_size: int = Query(20, ge=1, le=100, description="每页数量")
+    page_size: int = Query(20, ge=1, le=100, description="每页数量"),
+    db: Session = Depends(get_db)
 ):
     """
     获取结算列表（分页）
     """
-    db = get_session()
     try:
         query = db.query(StorePointSettlements)
         
@@ -434,18 +421,104 @@ def get_store_settlement_list(
     except Exception as e:
         logger.error(f"获取结算列表失败：{str(e)}")
         raise HTTPException(status_code=500, detail=f"获取结算列表失败：{str(e)}")
-    finally:
-        db.close()
+
+
+@app.post("/api/settlement/store/run-cycle")
+def run_store_settlement_cycle(
+    cycle: Optional[str] = Query(None, description="结算周期: daily, weekly, monthly（默认 STORE_SETTLEMENT_CYCLE）"),
+    db: Session = Depends(get_db)
+):
+    """
+    执行一次跨店铺结算轧差
+
+    结算最近一个已结束周期（及之前遗漏）的 pending 记录，按店铺对写入净额划转；通常由定时任务调用
+    """
+    if cycle and cycle not in SETTLEMENT_CYCLES:
+        raise HTTPException(status_code=400, detail=f"不支持的结算周期：{cycle}")
+    
+    try:
+        summary = run_settlement_cycle(db, cycle)
+        db.commit()
+        return summary
+    except Exception as e:
+        logger.error(f"跨店铺结算失败：{str(e)}")
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"跨店铺结算失败：{str(e)}")
+
+
+@app.get("/api/settlement/transfers")
+def get_settlement_transfers(
+    store_id: Optional[int] = Query(None, description="店铺ID（付款或收款）"),
+    cycle: Optional[str] = Query(None, description="结算周期"),
+    status: Optional[str] = Query(None, description="划转状态"),
+    page: int = Query(1, ge=1, description="页码"),
+    page_size: int = Query(20, ge=1, le=100, description="每页数量"),
+    db: Session = Depends(get_db)
+):
+    """
+    获取跨店铺结算净额划转（分页）
+    """
+    try:
+        query = db.query(StoreSettlementTransfers)
+        
+        if store_id:
+            query = query.filter(or_(
+                StoreSettlementTransfers.from_store_id == store_id,
+                StoreSettlementTransfers.to_store_id == store_id
+            ))
+        if cycle:
+            query = query.filter(StoreSettlementTransfers.cycle == cycle)
+        if status:
+            query = query.filter(StoreSettlementTransfers.status == status)
+        
+        total = query.count()
+        transfers = query.order_by(
+            StoreSettlementTransfers.period_end.desc(),
+            StoreSettlementTransfers.id
+        ).offset((page - 1) * page_size).limit(page_size).all()
+        
+        # 一次查询取回本页涉及的店铺名称
+        store_ids = {t.from_store_id for t in transfers} | {t.to_store_id for t in transfers}
+        store_names = dict(
+            db.query(Stores.id, Stores.name).filter(Stores.id.in_(store_ids)).all()
+        ) if store_ids else {}
+        
+        return {
+            "total": total,
+            "page": page,
+            "page_size": page_size,
+            "data": [
+                {
+                    "id": t.id,
+                    "cycle": t.cycle,
+                    "period_start": t.period_start,
+                    "period_end": t.period_end,
+                    "from_store_id": t.from_store_id,
+                    "from_store_name": store_names.get(t.from_store_id, "未知"),
+                    "to_store_id": t.to_store_id,
+                    "to_store_name": store_names.get(t.to_store_id, "未知"),
+                    "net_points": t.net_points,
+                    "net_amount": t.net_amount,
+                    "settlement_count": t.settlement_count,
+                    "status": t.status,
+                    "created_at": t.created_at
+                }
+                for t in transfers
+            ]
+        }
+        
+    except Exception as e:
+        logger.error(f"获取结算划转失败：{str(e)}")
+        raise HTTPException(status_code=500, detail=f"获取结算划转失败：{str(e)}")
 
 
 # ============ 第三方积分协议接口 ============
 
 @app.post("/api/settlement/third-party-agreements")
-def create_third_party_agreement(request: ThirdPartyAgreementRequest):
+def create_third_party_agreement(request: ThirdPartyAgreementRequest, db: Session = Depends(get_db)):
     """
     创建第三方积分协议
     """
-    db = get_session()
     try:
         # 检查店铺是否存在
         store = db.query(Stores).filter(Stores.id == request.store_id).first()
@@ -496,20 +569,18 @@ def create_third_party_agreement(request: ThirdPartyAgreementRequest):
         logger.error(f"创建第三方积分协议失败：{str(e)}")
         db.rollback()
         raise HTTPException(status_code=500, detail=f"创建协议失败：{str(e)}")
-    finally:
-        db.close()
 
 
 @app.get("/api/settlement/third-party-agreements")
 def get_third_party_agreements(
     store_id: Optional[int] = Query(None, description="店铺ID"),
     status: Optional[str] = Query(None, description="状态"),
-    agreement_type: Optional[str] = Query(None, description="协议类型")
+    agreement_type: Optional[str] = Query(None, description="协议类型"),
+    db: Session = Depends(get_db)
 ):
     """
     获取第三方积分协议列表
     """
-    db = get_session()
     try:
         query = db.query(ThirdPartyPointAgreements)
         
@@ -554,16 +625,13 @@ def get_third_party_agreements(
     except Exception as e:
         logger.error(f"获取协议列表失败：{str(e)}")
         raise HTTPException(status_code=500, detail=f"获取协议列表失败：{str(e)}")
-    finally:
-        db.close()
 
 
 @app.get("/api/settlement/third-party-agreements/{agreement_id}")
-def get_third_party_agreement_detail(agreement_id: int):
+def get_third_party_agreement_detail(agreement_id: int, db: Session = Depends(get_db)):
     """
     获取第三方积分协议详情
     """
-    db = get_session()
     try:
         agreement = db.query(ThirdPartyPointAgreements).filter(
             ThirdPartyPointAgreements.id == agreement_id
@@ -618,14 +686,12 @@ def get_third_party_agreement_detail(agreement_id: int):
     except Exception as e:
         logger.error(f"获取协议详情失败：{str(e)}")
         raise HTTPException(status_code=500, detail=f"获取协议详情失败：{str(e)}")
-    finally:
-        db.close()
 
 
 # ============ 积分兑换接口 ============
 
 @app.post("/api/settlement/exchange-points", response_model=PointExchangeResponse)
-def exchange_points(request: PointExchangeRequest):
+def exchange_points(request: PointExchangeRequest, db: Session = Depends(get_db)):
     """
     积分兑换
     
@@ -633,7 +699,6 @@ def exchange_points(request: PointExchangeRequest):
     - inbound: 第三方积分 -> 本方积分（增加会员积分）
     - outbound: 本方积分 -> 第三方积分（扣除会员积分）
     """
-    db = get_session()
     try:
         # 验证兑换请求
         is_valid, error_msg, agreement = validate_point_exchange(
@@ -646,6 +711,22 @@ def exchange_points(request: PointExchangeRequest):
         if not is_valid:
             raise HTTPException(status_code=400, detail=error_msg)
         
+        # 占用每日限额（与兑换同一事务提交，失败回滚时释放）
+        if agreement.max_points_per_day:
+            used = reserve_daily_points(
+                db,
+                request.agreement_id,
+                request.points,
+                agreement.max_points_per_day
+            )
+            if used is None:
+                db.rollback()
+                used = get_daily_usage(db, request.agreement_id)
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"超过每日最大兑换限额（已使用：{used}，限额：{agreement.max_points_per_day}）"
+                )
+        
         # 计算目标积分
         if request.exchange_type == "inbound":
             # 第三方 -> 本方
@@ -672,8 +753,7 @@ def exchange_points(request: PointExchangeRequest):
         )
         
         db.add(exchange_log)
-        db.commit()
-        db.refresh(exchange_log)
+        db.flush()
         
         # 获取会员和店铺信息
         member = db.query(Members).filter(Members.id == request.member_id).first()
@@ -742,8 +822,6 @@ def exchange_points(request: PointExchangeRequest):
         logger.error(f"积分兑换失败：{str(e)}")
         db.rollback()
         raise HTTPException(status_code=500, detail=f"积分兑换失败：{str(e)}")
-    finally:
-        db.close()
 
 
 @app.get("/api/settlement/exchange-logs")
@@ -754,12 +832,12 @@ def get_exchange_logs(
     exchange_type: Optional[str] = Query(None, description="兑换类型"),
     status: Optional[str] = Query(None, description="状态"),
     page: int = Query(1, ge=1, description="页码"),
-    page_size: int = Query(20, ge=1, le=100, description="每页数量")
+    page_size: int = Query(20, ge=1, le=100, description="每页数量"),
+    db: Session = Depends(get_db)
 ):
     """
     获取积分兑换日志（分页）
     """
-    db = get_session()
     try:
         query = db.query(PointExchangeLogs)
         
@@ -824,8 +902,6 @@ def get_exchange_logs(
     except Exception as e:
         logger.error(f"获取兑换日志失败：{str(e)}")
         raise HTTPException(status_code=500, detail=f"获取兑换日志失败：{str(e)}")
-    finally:
-        db.close()
 
 
 # ============ 统计接口 ============
@@ -834,69 +910,88 @@ def get_exchange_logs(
 def get_settlement_statistics(
     store_id: Optional[int] = Query(None, description="店铺ID"),
     date_from: Optional[str] = Query(None, description="开始日期 (YYYY-MM-DD)"),
-    date_to: Optional[str] = Query(None, description="结束日期 (YYYY-MM-DD)")
+    date_to: Optional[str] = Query(None, description="结束日期 (YYYY-MM-DD)"),
+    db: Session = Depends(get_db)
 ):
     """
     获取结算统计信息
     """
-    db = get_session()
     try:
-        # 跨店铺结算统计
-        settlement_query = db.query(StorePointSettlements)
+        date_start = datetime.strptime(date_from, "%Y-%m-%d") if date_from else None
+        date_end = datetime.strptime(date_to, "%Y-%m-%d") if date_to else None
+        
+        # 跨店铺结算统计（一条聚合查询）
+        settlement_status = StorePointSettlements.status
+        settlement_query = db.query(
+            func.count(StorePointSettlements.id).label("total"),
+            func.count(StorePointSettlements.id).filter(settlement_status == "pending").label("pending"),
+            func.count(StorePointSettlements.id).filter(settlement_status == "completed").label("completed"),
+            func.coalesce(func.sum(StorePointSettlements.points), 0).label("points"),
+            func.coalesce(func.sum(StorePointSettlements.settlement_amount), 0).label("amount")
+        )
         
         if store_id:
-            settlement_query = settlement_query.filter(
-                (StorePointSettlements.source_store_id == store_id) |
-                (StorePointSettlements.target_store_id == store_id)
-            )
-        if date_from:
-            settlement_query = settlement_query.filter(
-                StorePointSettlements.settlement_date >= datetime.strptime(date_from, "%Y-%m-%d")
-            )
-        if date_to:
-            settlement_query = settlement_query.filter(
-                StorePointSettlements.settlement_date <= datetime.strptime(date_to, "%Y-%m-%d")
-            )
-        
-        settlements = settlement_query.all()
-        
-        total_settlements = len(settlements)
-        pending_settlements = len([s for s in settlements if s.status == "pending"])
-        completed_settlements = len([s for s in settlements if s.status == "completed"])
-        total_points = sum(s.points for s in settlements)
-        total_amount = sum(s.settlement_amount or 0 for s in settlements)
-        
-        # 第三方积分兑换统计
-        exchange_query = db.query(PointExchangeLogs)
+            settlement_query = settlement_query.filter(or_(
+                StorePointSettlements.source_store_id == store_id,
+                StorePointSettlements.target_store_id == store_id
+            ))
+        if date_start:
+            settlement_query = settlement_query.filter(StorePointSettlements.settlement_date >= date_start)
+        if date_end:
+            settlement_query = settlement_query.filter(StorePointSettlements.settlement_date <= date_end)
+        
+        settlements = settlement_query.one()
+        
+        total_settlements = settlements.total
+        pending_settlements = settlements.pending
+        completed_settlements = settlements.completed
+        total_points = int(settlements.points)
+        total_amount = float(settlements.amount)
+        
+        # 第三方积分兑换统计（一条聚合查询）
+        exchange_status = PointExchangeLogs.status
+        exchange_success = exchange_status == "success"
+        exchange_query = db.query(
+            func.count(PointExchangeLogs.id).label("total"),
+            func.count(PointExchangeLogs.id).filter(exchange_success).label("success"),
+            func.count(PointExchangeLogs.id).filter(exchange_status == "failed").label("failed"),
+            func.coalesce(func.sum(PointExchangeLogs.target_points).filter(
+                exchange_success, PointExchangeLogs.exchange_type == "inbound"
+            ), 0).label("inbound_points"),
+            func.coalesce(func.sum(PointExchangeLogs.source_points).filter(
+                exchange_success, PointExchangeLogs.exchange_type == "outbound"
+            ), 0).label("outbound_points")
+        )
         
         if store_id:
             exchange_query = exchange_query.filter(PointExchangeLogs.store_id == store_id)
-        if date_from:
-            exchange_query = exchange_query.filter(
-                PointExchangeLogs.created_at >= datetime.strptime(date_from, "%Y-%m-%d")
-            )
-        if date_to:
-            exchange_query = exchange_query.filter(
-                PointExchangeLogs.created_at <= datetime.strptime(date_to, "%Y-%m-%d")
-            )
-        
-        exchanges = exchange_query.all()
-        
-        total_exchanges = len(exchanges)
-        success_exchanges = len([e for e in exchanges if e.status == "success"])
-        failed_exchanges = len([e for e in exchanges if e.status == "failed"])
-        total_inbound_points = sum(e.target_points for e in exchanges if e.exchange_type == "inbound" and e.status == "success")
-        total_outbound_points = sum(e.source_points for e in exchanges if e.exchange_type == "outbound" and e.status == "success")
-        
-        # 第三方协议统计
-        agreement_query = db.query(ThirdPartyPointAgreements)
+        if date_start:
+            exchange_query = exchange_query.filter(PointExchangeLogs.created_at >= date_start)
+        if date_end:
+            exchange_query = exchange_query.filter(PointExchangeLogs.created_at <= date_end)
+        
+        exchanges = exchange_query.one()
+        
+        total_exchanges = exchanges.total
+        success_exchanges = exchanges.success
+        failed_exchanges = exchanges.failed
+        total_inbound_points = int(exchanges.inbound_points)
+        total_outbound_points = int(exchanges.outbound_points)
+        
+        # 第三方协议统计（一条聚合查询）
+        agreement_query = db.query(
+            func.count(ThirdPartyPointAgreements.id).label("total"),
+            func.count(ThirdPartyPointAgreements.id).filter(
+                ThirdPartyPointAgreements.status == "active"
+            ).label("active")
+        )
         if store_id:
             agreement_query = agreement_query.filter(ThirdPartyPointAgreements.store_id == store_id)
         
-        agreements = agreement_query.all()
+        agreements = agreement_query.one()
         
-        total_agreements = len(agreements)
-        active_agreements = len([a for a in agreements if a.status == "active"])
+        total_agreements = agreements.total
+        active_agreements = agreements.active
         
         return {
             "cross_store_settlements": {
@@ -928,8 +1023,6 @@ def get_settlement_statistics(
     except Exception as e:
         logger.error(f"获取结算统计失败：{str(e)}")
         raise HTTPException(status_code=500, detail=f"获取结算统计失败：{str(e)}")
-    finally:
-        db.close()
 
 
 if __name__ == "__main__":
@@ -2,18 +2,19 @@
 简化的数据初始化端点
 直接在 API 路由中初始化数据，避免复杂的依赖
 """
-from fastapi import APIRouter, HTTPException
-from storage.database.db import get_session
+from fastapi import APIRouter, HTTPException, Depends
+from sqlalchemy.orm import Session
+from storage.database.db import get_db
 from storage.database.shared.model import (
     Companies, Stores, MenuCategories, MenuItems, Tables
 )
+from services.menu_cache import invalidate_menu
 
 router = APIRouter(tags=["simple-init"])
 
 @router.post("/api/simple-init")
-def simple_init():
+def simple_init(db: Session = Depends(get_db)):
     """简化版数据初始化"""
-    db = get_session()
 
     try:
         # 先检查是否已有公司
@@ -159,6 +160,7 @@ def simple_init():
                 print(f"Created table: {i}号桌")
 
         db.commit()
+        invalidate_menu(store.id)
 
         # 统计创建的数据
         category_count = db.query(MenuCategories).filter(MenuCategories.store_id == store.id).count()
@@ -181,5 +183,3 @@ def simple_init():
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        db.close()
@@ -2,14 +2,18 @@
 店员端 API 接口
 用于店员接收订单、确认订单、更新订单状态等
 """
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Depends, Query
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
 from pydantic import BaseModel, Field
 from typing import List, Optional
 from datetime import datetime
-from storage.database.db import get_session
+from storage.database.db import get_db
 from storage.database.shared.model import Stores, Tables, Orders, OrderItems, OrderStatusLogs, Users
+from services.order_query import list_store_order_summaries
+from services.revenue_rollup import apply_event, record_order_status_change
+from services.menu_cache import invalidate_menu
+from services.table_occupancy import get_store_occupancy, publish_order_event
 
 # 创建 FastAPI 应用
 app = FastAPI(title="扫码点餐系统 - 店员端 API", version="1.0.0")
@@ -118,117 +122,107 @@ def root():
 def get_orders(
     store_id: int = Query(..., description="店铺ID"),
     status: Optional[str] = Query(None, description="订单状态筛选"),
-    limit: int = Query(50, description="返回数量限制", ge=1, le=100)
+    before_id: Optional[int] = Query(None, description="分页游标：返回该订单之前（更早）的订单"),
+    limit: int = Query(50, description="返回数量限制", ge=1, le=100),
+    db: Session = Depends(get_db)
 ):
     """
     获取订单列表
     """
-    db = get_session()
-    try:
-        query = db.query(Orders).filter(Orders.store_id == store_id)
-        
-        if status:
-            query = query.filter(Orders.order_status == status)
-        
-        orders = query.order_by(Orders.created_at.desc()).limit(limit).all()
-        
-        result = []
-        for order in orders:
-            # 获取桌号信息
-            table = db.query(Tables).filter(Tables.id == order.table_id).first()
-            table_number = table.table_number if table else ""
-            
-            result.append(OrderListResponse(
-                id=order.id,
-                order_number=order.order_number,
-                table_id=order.table_id,
-                table_number=table_number,
-                customer_name=order.customer_name,
-                customer_phone=order.customer_phone,
-                total_amount=order.total_amount,
-                final_amount=order.final_amount,
-                payment_status=order.payment_status,
-                order_status=order.order_status,
-                created_at=order.created_at,
-                items_count=len(order.order_items)
-            ))
-        
-        return result
-        
-    finally:
-        db.close()
-
+    # 订单+桌号一次JOIN，订单项数量一次GROUP BY，不加载订单项
+    orders = list_store_order_summaries(
+        db,
+        store_id,
+        status=status,
+        before_id=before_id,
+        limit=limit
+    )
 
-@app.get("/api/staff/order/{order_id}", response_model=OrderDetailResponse)
-def get_order_detail(order_id: int):
-    """
-    获取订单详情
-    """
-    db = get_session()
-    try:
-        order = db.query(Orders).filter(Orders.id == order_id).first()
-        if not order:
-            raise HTTPException(status_code=404, detail="订单不存在")
-        
-        # 获取桌号信息
-        table = db.query(Tables).filter(Tables.id == order.table_id).first()
-        table_number = table.table_number if table else ""
-        
-        # 构建订单项
-        items = []
-        for oi in order.order_items:
-            items.append({
-                "id": oi.id,
-                "menu_item_name": oi.menu_item_name,
-                "menu_item_price": oi.menu_item_price,
-                "quantity": oi.quantity,
-                "subtotal": oi.subtotal,
-                "special_instructions": oi.special_instructions,
-                "status": oi.status
-            })
-        
-        # 构建状态日志
-        logs = []
-        for log in order.order_status_logs:
-            operator = db.query(Users).filter(Users.id == log.operator_id).first()
-            logs.append({
-                "id": log.id,
-                "from_status": log.from_status,
-                "to_status": log.to_status,
-                "created_at": log.created_at,
-                "operator_name": operator.name if operator else log.operator_name,
-                "notes": log.notes
-            })
-        
-        return OrderDetailResponse(
+    return [
+        OrderListResponse(
             id=order.id,
             order_number=order.order_number,
-            store_id=order.store_id,
             table_id=order.table_id,
             table_number=table_number,
             customer_name=order.customer_name,
             customer_phone=order.customer_phone,
             total_amount=order.total_amount,
-            discount_amount=order.discount_amount,
             final_amount=order.final_amount,
             payment_status=order.payment_status,
             order_status=order.order_status,
-            special_instructions=order.special_instructions,
             created_at=order.created_at,
-            items=items,
-            status_logs=logs
+            items_count=items_count
         )
+        for order, table_number, items_count in orders
+    ]
+
+
+
+@app.get("/api/staff/order/{order_id}", response_model=OrderDetailResponse)
+def get_order_detail(order_id: int, db: Session = Depends(get_db)):
+    """
+    获取订单详情
+    """
+    order = db.query(Orders).filter(Orders.id == order_id).first()
+    if not order:
+        raise HTTPException(status_code=404, detail="订单不存在")
+        
+    # 获取桌号信息
+    table = db.query(Tables).filter(Tables.id == order.table_id).first()
+    table_number = table.table_number if table else ""
+        
+    # 构建订单项
+    items = []
+    for oi in order.order_items:
+        items.append({
+            "id": oi.id,
+            "menu_item_name": oi.menu_item_name,
+            "menu_item_price": oi.menu_item_price,
+            "quantity": oi.quantity,
+            "subtotal": oi.subtotal,
+            "special_instructions": oi.special_instructions,
+            "status": oi.status
+        })
+        
+    # 构建状态日志
+    logs = []
+    for log in order.order_status_logs:
+        operator = db.query(Users).filter(Users.id == log.operator_id).first()
+        logs.append({
+            "id": log.id,
+            "from_status": log.from_status,
+            "to_status": log.to_status,
+            "created_at": log.created_at,
+            "operator_name": operator.name if operator else log.operator_name,
+            "notes": log.notes
+        })
+        
+    return OrderDetailResponse(
+        id=order.id,
+        order_number=order.order_number,
+        store_id=order.store_id,
+        table_id=order.table_id,
+        table_number=table_number,
+        customer_name=order.customer_name,
+        customer_phone=order.customer_phone,
+        total_amount=order.total_amount,
+        discount_amount=order.discount_amount,
+        final_amount=order.final_amount,
+        payment_status=order.payment_status,
+        order_status=order.order_status,
+        special_instructions=order.special_instructions,
+        created_at=order.created_at,
+        items=items,
+        status_logs=logs
+    )
         
-    finally:
-        db.close()
 
 
 @app.put("/api/staff/order/status")
-def update_order_status(request: OrderUpdateRequest):
+def update_order_status(request: OrderUpdateRequest, db: Session = Depends(get_db)):
     """
     更新订单状态
     """
-    db = get_session()
     try:
         # 获取订单
         order = db.query(Orders).filter(Orders.id == request.order_id).first()
@@ -268,6 +262,10 @@ def update_order_status(request: OrderUpdateRequest):
                     item.menu_item.stock += item.quantity
         
         db.commit()
+        if request.order_status == 'cancelled':
+            invalidate_menu(order.store_id)
+        apply_event(db, record_order_status_change, order, status_log.from_status)
+        publish_order_event(order.store_id, order.table_id, order.id, order.order_status)
         
         return {
             "message": "订单状态更新成功",
@@ -282,16 +280,13 @@ def update_order_status(request: OrderUpdateRequest):
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"更新订单状态失败: {str(e)}")
-    finally:
-        db.close()
 
 
 @app.put("/api/staff/order-item/status")
-def update_order_item_status(request: OrderItemUpdateRequest):
+def update_order_item_status(request: OrderItemUpdateRequest, db: Session = Depends(get_db)):
     """
     更新订单项状态
     """
-    db = get_session()
     try:
         # 获取订单项
         order_item = db.query(OrderItems).filter(OrderItems.id == request.order_item_id).first()
@@ -315,42 +310,27 @@ def update_order_item_status(request: OrderItemUpdateRequest):
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"更新订单项状态失败: {str(e)}")
-    finally:
-        db.close()
 
 
 @app.get("/api/staff/store/{store_id}/tables")
-def get_store_tables(store_id: int):
+def get_store_tables(store_id: int, db: Session = Depends(get_db)):
     """
     获取店铺的桌号列表
+    读取桌台占用缓存，current_order_id / current_order_status 为最近的进行中订单
     """
-    db = get_session()
-    try:
-        tables = db.query(Tables).filter(
-            Tables.store_id == store_id
-        ).order_by(Tables.table_number).all()
-        
-        result = []
-        for table in tables:
-            # 获取该桌号的最新订单
-            latest_order = db.query(Orders).filter(
-                Orders.table_id == table.id
-            ).order_by(Orders.created_at.desc()).first()
-            
-            result.append({
-                "id": table.id,
-                "table_number": table.table_number,
-                "table_name": table.table_name,
-                "seats": table.seats,
-                "is_active": table.is_active,
-                "current_order_id": latest_order.id if latest_order and latest_order.order_status in ['pending', 'confirmed', 'preparing', 'ready', 'serving'] else None,
-                "current_order_status": latest_order.order_status if latest_order and latest_order.order_status in ['pending', 'confirmed', 'preparing', 'ready', 'serving'] else None
-            })
-        
-        return result
+    return [
+        {
+            "id": table["id"],
+            "table_number": table["table_number"],
+            "table_name": table["table_name"],
+            "seats": table["seats"],
+            "is_active": table["is_active"],
+            "current_order_id": table["current_order_id"],
+            "current_order_status": table["current_order_status"]
+        }
+        for table in get_store_occupancy(store_id, db).list()
+    ]
         
-    finally:
-        db.close()
 
 
 if __name__ == "__main__":
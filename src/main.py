@@ -3,9 +3,10 @@ import asyncio
 import json
 import traceback
 import logging
-from typing import Any, Dict, Iterable, AsyncIterable, AsyncGenerator, Optional
+from typing import Any, Dict, Iterable, AsyncIterable, AsyncGenerator, Optional, Set
 import threading
 import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import uvicorn
 import time
 import sys
@@ -34,6 +35,7 @@ def flush_cozeloop():
         except:
             pass
 from fastapi.responses import StreamingResponse, JSONResponse
+from starlette.background import BackgroundTask
 from langchain_core.runnables import RunnableConfig
 from langgraph.graph import StateGraph, END
 from langgraph.graph.state import CompiledStateGraph
@@ -52,6 +54,8 @@ from utils.messages.server import (
     create_message_end_dict,
     create_message_error_dict,
     MESSAGE_END_CODE_CANCELED,
+    MESSAGE_TYPE_ANSWER,
+    MESSAGE_TYPE_THINKING,
 )
 
 setup_logging(
@@ -77,6 +81,48 @@ from utils.log.loop_trace import init_run_config, init_agent_config
 # 超时配置常量
 TIMEOUT_SECONDS = 900  # 15分钟
 
+# 同时执行的流式任务上限（也是流式生产者线程池的大小），超过时 /stream_run 返回 429
+STREAM_MAX_CONCURRENCY = int(os.getenv("STREAM_MAX_CONCURRENCY", "32"))
+# 每个流式任务的消息队列容量，队列满时生产者线程等待消费者
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "256"))
+# 合并连续 token 片段时单条消息的最大字符数
+STREAM_COALESCE_MAX_CHARS = int(os.getenv("STREAM_COALESCE_MAX_CHARS", "2048"))
+# 生产者等待队列空间时检查停止标记的间隔（秒）
+_PRODUCER_PUT_POLL_SECONDS = 1.0
+# 流结束标记
+_STREAM_END = object()
+# 可以合并的流式 token 消息类型
+_TOKEN_MESSAGE_TYPES = (MESSAGE_TYPE_ANSWER, MESSAGE_TYPE_THINKING)
+
+
+def _is_token_chunk(msg: Dict[str, Any]) -> bool:
+    """未结束的流式 answer / thinking 片段"""
+    msg_type = msg.get("type")
+    if msg_type not in _TOKEN_MESSAGE_TYPES or msg.get("finish"):
+        return False
+    return isinstance((msg.get("content") or {}).get(msg_type), str)
+
+
+def _can_merge(head: Dict[str, Any], nxt: Dict[str, Any]) -> bool:
+    """nxt 是否是 head 所在消息的后续片段"""
+    msg_type = head["type"]
+    return (
+        nxt.get("type") == msg_type
+        and nxt.get("msg_id") == head.get("msg_id")
+        and nxt.get("reply_id") == head.get("reply_id")
+        and isinstance((nxt.get("content") or {}).get(msg_type), str)
+    )
+
+
+def _merge_chunk(head: Dict[str, Any], nxt: Dict[str, Any]) -> Dict[str, Any]:
+    """把 nxt 的文本追加到 head，序号和结束标记取 nxt 的值"""
+    msg_type = head["type"]
+    head["content"][msg_type] += nxt["content"][msg_type]
+    head["sequence_id"] = nxt.get("sequence_id", head.get("sequence_id"))
+    head["finish"] = nxt.get("finish", False)
+    return head
+
+
 class GraphService:
     def __init__(self):
         if not graph_helper.is_agent_proj():
@@ -84,6 +130,49 @@ class GraphService:
 
         # 用于跟踪正在运行的任务（使用asyncio.Task）
         self.running_tasks: Dict[str, asyncio.Task] = {}
+
+        # 流式任务的生产者线程池（所有请求共享，大小固定）
+        self._stream_executor = ThreadPoolExecutor(
+            max_workers=STREAM_MAX_CONCURRENCY, thread_name_prefix="graph-stream"
+        )
+        # 已准入的流式任务名额（名额编号集合），以及每个任务的消息队列（用于统计队列深度）
+        self._stream_slots: Set[int] = set()
+        self._next_stream_slot = 0
+        self._stream_lock = threading.Lock()
+        self._stream_queues: Dict[str, asyncio.Queue] = {}
+        self._rejected_streams = 0
+        self._coalesced_chunks = 0
+
+    def try_admit_stream(self) -> Optional[int]:
+        """流式任务准入：未达到 STREAM_MAX_CONCURRENCY 时占用一个名额并返回名额编号，已满时返回 None"""
+        with self._stream_lock:
+            if len(self._stream_slots) >= STREAM_MAX_CONCURRENCY:
+                self._rejected_streams += 1
+                return None
+            self._next_stream_slot += 1
+            slot = self._next_stream_slot
+            self._stream_slots.add(slot)
+            return slot
+
+    def release_stream(self, slot: int):
+        """释放名额（幂等：生成器结束和响应后台任务都会调用，只有第一次生效）"""
+        with self._stream_lock:
+            self._stream_slots.discard(slot)
+
+    def stream_metrics(self) -> Dict[str, Any]:
+        """流式任务统计：运行中任务数、队列深度、拒绝次数、合并的片段数"""
+        queues = list(self._stream_queues.values())
+        depths = [q.qsize() for q in queues]
+        return {
+            "active_runs": len(self._stream_slots),
+            "max_concurrency": STREAM_MAX_CONCURRENCY,
+            "running_tasks": len(self.running_tasks),
+            "queue_depth_total": sum(depths),
+            "queue_depth_max": max(depths, default=0),
+            "queue_size": STREAM_QUEUE_SIZE,
+            "rejected": self._rejected_streams,
+            "coalesced_chunks": self._coalesced_chunks,
+        }
     
     
     def _get_graph(self, ctx=Context):
@@ -268,12 +357,32 @@ class GraphService:
         run_config["configurable"] = {"thread_id": session_id}
         stream_input = to_stream_input(client_msg)
 
-        # 使用后台线程拉取同步流，并通过事件循环安全地推送到异步队列
+        # 在共享线程池中拉取同步流，推送到有界异步队列；队列满时生产者线程等待，消费者退出后生产者停止
         loop = asyncio.get_running_loop()
-        q: asyncio.Queue = asyncio.Queue()
+        q: asyncio.Queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        stop = threading.Event()
         context = contextvars.copy_context()
         start_time = time.time()
+
+        def put(item) -> bool:
+            """阻塞地放入队列，消费者已退出时返回 False"""
+            try:
+                future = asyncio.run_coroutine_threadsafe(q.put(item), loop)
+            except RuntimeError:
+                # 事件循环已关闭
+                return False
+            while True:
+                try:
+                    future.result(timeout=_PRODUCER_PUT_POLL_SECONDS)
+                    return True
+                except FutureTimeoutError:
+                    if stop.is_set():
+                        future.cancel()
+                        return False
+
         def producer():
+            last_seq = 0
+            server_msgs_iter = None
             try:
                 items = graph.stream(stream_input, stream_mode="messages", config=run_config, context=ctx)
                 server_msgs_iter = agent_iter_server_messages(
@@ -284,8 +393,9 @@ class GraphService:
                     run_id=ctx.run_id,
                     log_id=ctx.logid,
                 )
-                last_seq = 0
                 for sm in server_msgs_iter:
+                    if stop.is_set():
+                        return
                     # 主动检查执行时间，及时中断
                     if time.time() - start_time > TIMEOUT_SECONDS:
                         logger.error(f"Agent execution timeout after {TIMEOUT_SECONDS}s for run_id: {ctx.run_id}")
@@ -299,9 +409,10 @@ class GraphService:
                             reply_id=getattr(sm, 'reply_id', ''),
                             sequence_id=last_seq + 1,
                         )
-                        loop.call_soon_threadsafe(q.put_nowait, timeout_msg)
+                        put(timeout_msg)
+                        return
+                    if not put(sm.dict()):
                         return
-                    loop.call_soon_threadsafe(q.put_nowait, sm.dict())
                     last_seq = sm.sequence_id
             except Exception as ex:
                 end_msg = create_message_end_dict(
@@ -314,21 +425,47 @@ class GraphService:
                     reply_id="",
                     sequence_id=last_seq + 1,
                 )
-                loop.call_soon_threadsafe(q.put_nowait, end_msg)
+                put(end_msg)
             finally:
-                loop.call_soon_threadsafe(q.put_nowait, None)
-
-        threading.Thread(target=lambda: context.run(producer), daemon=True).start()
+                # 消费者提前退出时关闭迭代器，停止图的执行
+                close = getattr(server_msgs_iter, "close", None)
+                if stop.is_set() and close is not None:
+                    try:
+                        close()
+                    except Exception as ce:
+                        logger.warning(f"Failed to close stream for run_id {ctx.run_id}: {ce}")
+                if not stop.is_set():
+                    put(_STREAM_END)
+
+        self._stream_queues[ctx.run_id] = q
+        self._stream_executor.submit(context.run, producer)
 
         try:
+            pending = None
             while True:
-                item = await q.get()
-                if item is None:
+                item = pending if pending is not None else await q.get()
+                pending = None
+                if item is _STREAM_END:
                     break
+                # 合并队列中已经到达的连续 token 片段，减少 SSE 编码和发送次数；不为凑批而等待
+                if _is_token_chunk(item):
+                    msg_type = item["type"]
+                    while not q.empty() and len(item["content"][msg_type]) < STREAM_COALESCE_MAX_CHARS:
+                        nxt = q.get_nowait()
+                        if nxt is _STREAM_END or not _can_merge(item, nxt):
+                            pending = nxt
+                            break
+                        _merge_chunk(item, nxt)
+                        self._coalesced_chunks += 1
+                        if item.get("finish"):
+                            break
                 yield item
         except asyncio.CancelledError:
             logger.info(f"Stream cancelled for run_id: {ctx.run_id}")
             raise
+        finally:
+            stop.set()
+            self._stream_queues.pop(ctx.run_id, None)
 
 
 service = GraphService()
@@ -447,8 +584,22 @@ async def http_stream_run(request: Request):
         logger.error(f"JSON decode error in http_stream_run: {e}, traceback: {traceback.format_exc()}")
         raise HTTPException(status_code=400, detail=f"Invalid JSON format:{extract_core_stack()}")
 
+    # 准入控制：流式任务已满时直接拒绝，避免请求堆积
+    slot = service.try_admit_stream()
+    if slot is None:
+        logger.warning(f"Rejecting /stream_run for run_id {run_id}: {STREAM_MAX_CONCURRENCY} streams already running")
+        raise HTTPException(status_code=429, detail="Too many concurrent stream runs, please retry later",
+                            headers={"Retry-After": "1"})
+
     # 包装stream_sse为可取消的任务
     async def cancellable_stream():
+        try:
+            async for chunk in _stream_with_cancel():
+                yield chunk
+        finally:
+            service.release_stream(slot)
+
+    async def _stream_with_cancel():
         # 将真正的流式任务登记到 running_tasks，确保 /cancel 能定位到它
         task = asyncio.current_task()
         if task:
@@ -490,7 +641,9 @@ async def http_stream_run(request: Request):
             yield service._sse_event(error_msg)
 
     # 注意：StreamingResponse会在后台运行generator
-    response = StreamingResponse(cancellable_stream(), media_type="text/event-stream")
+    # 客户端在响应体开始迭代前断开时生成器的 finally 不会执行，由后台任务兜底释放名额
+    response = StreamingResponse(cancellable_stream(), media_type="text/event-stream",
+                                 background=BackgroundTask(service.release_stream, slot))
     return response
 
 @app.post("/cancel/{run_id}")
@@ -553,6 +706,12 @@ async def health_check():
         raise HTTPException(status_code=503, detail=str(e))
 
 
+@app.get("/stream_stats")
+async def http_stream_stats():
+    """流式任务统计：运行中任务数、消息队列深度、429 拒绝次数"""
+    return service.stream_metrics()
+
+
 @app.get(path="/graph_parameter")
 async def http_graph_inout_parameter(request: Request):
     return service.graph_inout_schema()
@@ -0,0 +1,348 @@
+"""
+优惠规则引擎
+每个店铺的优惠配置（店铺级 + 所属公司的公司级）编译为进程内索引，计算优惠时不再逐条扫描和判断：
+- 公司级规则按店铺的 company_id 取得，一条查询加载店铺适用的全部规则
+- 生效中的规则按适用会员等级分桶，桶内按最低消费排序，用 bisect 找出满足等级和最低消费的候选
+- 有效期由索引内的时间点调度处理：只在到达某条规则的生效/到期时间时重建生效集合，单次请求不再检查日期
+- 自动优惠在所有候选中选优惠金额最大的一条，而不是第一条满足条件的
+- 索引最多缓存 DISCOUNT_RULE_CACHE_TTL 秒，修改优惠配置后调用 invalidate_discount_rules 立即失效
+"""
+import os
+import threading
+import time
+from bisect import bisect_right
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import or_, select
+from sqlalchemy.orm import Session
+
+from storage.database.db import get_session
+from storage.database.shared.model import DiscountConfig, Members, Stores
+from services.member_levels import MemberLevelSnapshot
+
+# 店铺优惠索引的存活时间（秒）
+DISCOUNT_RULE_CACHE_TTL = float(os.getenv("DISCOUNT_RULE_CACHE_TTL", "60"))
+
+# 积分抵扣：1 积分 = 0.01 元，最多抵扣订单金额的 50%
+POINT_VALUE = 0.01
+MAX_POINTS_DISCOUNT_RATIO = 0.5
+
+# 可以自动应用的优惠类型（积分兑换类优惠需要顾客指定）
+AUTO_DISCOUNT_TYPES = ("percentage", "fixed")
+
+
+def _epoch(value: Optional[datetime]) -> Optional[float]:
+    """日期转为时间戳（不带时区的按本地时间处理）"""
+    return value.timestamp() if value is not None else None
+
+
+class CompiledDiscount:
+    """编译后的一条优惠规则"""
+
+    __slots__ = (
+        "id", "store_id", "company_id", "discount_type", "discount_value", "min_amount",
+        "max_discount", "member_level", "points_required", "valid_from", "valid_until"
+    )
+
+    def __init__(self, config: DiscountConfig):
+        self.id = config.id
+        self.store_id = config.store_id
+        self.company_id = config.company_id
+        self.discount_type = config.discount_type
+        self.discount_value = float(config.discount_value)
+        self.min_amount = float(config.min_amount) if config.min_amount else 0.0
+        self.max_discount = float(config.max_discount) if config.max_discount else None
+        self.member_level = config.member_level or 0
+        self.points_required = config.points_required or 0
+        self.valid_from = _epoch(config.valid_from)
+        self.valid_until = _epoch(config.valid_until)
+
+    def active_at(self, now: float) -> bool:
+        if self.valid_from is not None and now < self.valid_from:
+            return False
+        if self.valid_until is not None and now > self.valid_until:
+            return False
+        return True
+
+    def eligible(self, order_amount: float, member_level: int, points: int) -> bool:
+        """等级、积分、最低消费条件（不含有效期）"""
+        return (
+            member_level >= self.member_level
+            and points >= self.points_required
+            and order_amount >= self.min_amount
+        )
+
+    def discount_for(self, order_amount: float, member_points: Optional[int] = None) -> float:
+        """按类型计算优惠金额，并应用最大优惠限制"""
+        discount = 0.0
+        if self.discount_type == "percentage":
+            discount = order_amount * (self.discount_value / 100)
+        elif self.discount_type == "fixed":
+            discount = self.discount_value
+        elif self.discount_type == "points" and member_points:
+            discount = min(member_points, self.points_required) * (self.discount_value / 100)
+        if self.max_discount and discount > self.max_discount:
+            discount = self.max_discount
+        return discount
+
+    def as_info(self, discount_amount: float) -> dict:
+        return {
+            "type": self.discount_type,
+            "config_id": self.id,
+            "discount_value": self.discount_value,
+            "discount_amount": round(discount_amount, 2)
+        }
+
+
+class _LevelBucket:
+    """同一适用等级的规则，按最低消费排序"""
+
+    __slots__ = ("min_amounts", "rules")
+
+    def __init__(self, rules: List[CompiledDiscount]):
+        self.rules = sorted(rules, key=lambda r: (r.min_amount, r.id))
+        self.min_amounts = [r.min_amount for r in self.rules]
+
+    def candidates(self, order_amount: float) -> List[CompiledDiscount]:
+        return self.rules[:bisect_right(self.min_amounts, order_amount)]
+
+
+class StoreDiscountIndex:
+    """一个店铺适用的优惠规则索引"""
+
+    def __init__(self, store_id: int, rules: Iterable[CompiledDiscount], now: Optional[float] = None):
+        self.store_id = store_id
+        self.rules: Dict[int, CompiledDiscount] = {r.id: r for r in rules}
+        self.loaded_at = time.monotonic()
+        self._lock = threading.Lock()
+        # 尚未到达的生效/到期时间点（升序）
+        self._transitions: List[float] = []
+        self._levels: List[int] = []
+        self._buckets: List[_LevelBucket] = []
+        self._schedule(time.time() if now is None else now)
+
+    def is_fresh(self) -> bool:
+        return time.monotonic() - self.loaded_at < DISCOUNT_RULE_CACHE_TTL
+
+    def _schedule(self, now: float):
+        """按当前时间重建生效集合，并记录之后的切换时间点"""
+        transitions = set()
+        active: Dict[int, List[CompiledDiscount]] = {}
+        for rule in self.rules.values():
+            if rule.valid_from is not None and rule.valid_from > now:
+                transitions.add(rule.valid_from)
+            if rule.valid_until is not None and rule.valid_until >= now:
+                # 到期时间当刻仍然有效，之后才失效
+                transitions.add(rule.valid_until)
+            if rule.discount_type in AUTO_DISCOUNT_TYPES and rule.active_at(now):
+                active.setdefault(rule.member_level, []).append(rule)
+
+        self._transitions = sorted(transitions)
+        levels = sorted(active)
+        # 整体替换，并发读取的请求看到的是旧集合或新集合
+        self._levels, self._buckets = levels, [_LevelBucket(active[level]) for level in levels]
+
+    def _advance(self, now: float):
+        """到达切换时间点时重建生效集合（未到达时只比较最近的一个时间点）"""
+        if not self._transitions or self._transitions[0] > now:
+            return
+        with self._lock:
+            if self._transitions and self._transitions[0] <= now:
+                self._schedule(now)
+
+    def best_discount(
+        self,
+        order_amount: float,
+        member_level: int = 0,
+        points: int = 0,
+        now: Optional[float] = None,
+    ) -> Optional[Tuple[CompiledDiscount, float]]:
+        """
+        当前生效的自动优惠中优惠金额最大的一条: (规则, 优惠金额)，没有可用规则时返回 None
+
+        member_level / points 为会员的等级和积分，非会员传 0（有等级或积分要求的规则不适用）。
+        """
+        self._advance(time.time() if now is None else now)
+        levels, buckets = self._levels, self._buckets
+        best: Optional[Tuple[CompiledDiscount, float]] = None
+        for bucket in buckets[:bisect_right(levels, member_level)]:
+            for rule in bucket.candidates(order_amount):
+                if points < rule.points_required:
+                    continue
+                discount = rule.discount_for(order_amount)
+                if discount > 0 and (best is None or discount > best[1]):
+                    best = (rule, discount)
+        return best
+
+
+_indexes: Dict[int, StoreDiscountIndex] = {}
+# 每次失效加一，加载期间发生失效的结果不写入缓存
+_generation = 0
+_lock = threading.Lock()
+
+
+def load_store_rules(db: Session, store_id: int) -> List[CompiledDiscount]:
+    """一条查询加载店铺适用的启用规则：店铺级规则 + 店铺所属公司的公司级规则"""
+    company_id = select(Stores.company_id).where(Stores.id == store_id).scalar_subquery()
+    configs = db.query(DiscountConfig).filter(
+        DiscountConfig.is_active == True,
+        or_(DiscountConfig.store_id == store_id, DiscountConfig.company_id == company_id)
+    ).all()
+    return [CompiledDiscount(config) for config in configs]
+
+
+def get_store_discounts(
+    store_id: int,
+    db: Optional[Session] = None,
+    session_factory: Callable[[], Session] = get_session,
+) -> StoreDiscountIndex:
+    """获取店铺的优惠索引，缓存命中时不访问数据库（未传 db 时按需创建会话）"""
+    index = _indexes.get(store_id)
+    if index is not None and index.is_fresh():
+        return index
+
+    generation = _generation
+    own_session = db is None
+    if own_session:
+        db = session_factory()
+    try:
+        rules = load_store_rules(db, store_id)
+    finally:
+        if own_session:
+            db.close()
+
+    index = StoreDiscountIndex(store_id, rules)
+    with _lock:
+        if _generation == generation:
+            _indexes[store_id] = index
+    return index
+
+
+def invalidate_discount_rules():
+    """优惠配置修改后使全部店铺索引失效（公司级规则会影响多个店铺）"""
+    global _generation
+    with _lock:
+        _generation += 1
+        _indexes.clear()
+
+
+def load_discount_rule(db: Session, config_id: int) -> Optional[CompiledDiscount]:
+    """按 ID 加载一条启用的规则（顾客指定的优惠不在店铺索引中时使用）"""
+    config = db.query(DiscountConfig).filter(
+        DiscountConfig.id == config_id,
+        DiscountConfig.is_active == True
+    ).first()
+    return CompiledDiscount(config) if config else None
+
+
+def quote_order(
+    order_amount: float,
+    levels: MemberLevelSnapshot,
+    member: Optional[Members] = None,
+    member_points: Optional[int] = None,
+    index: Optional[StoreDiscountIndex] = None,
+    selected_rule: Optional[CompiledDiscount] = None,
+    rule_selected: bool = False,
+    now: Optional[float] = None,
+) -> dict:
+    """
+    计算一笔订单的优惠: original_amount / discount_amount / final_amount / discount_info / member_info
+
+    依次叠加会员等级折扣、积分抵扣和一条优惠配置：
+    rule_selected 为 True 时只考虑顾客指定的 selected_rule（不存在或不满足条件时不应用），
+    否则从店铺索引中自动选择优惠金额最大的规则。
+    """
+    now = time.time() if now is None else now
+    total_discount = 0.0
+    discount_info = {
+        "applied_discounts": [],
+        "member_discount": None,
+        "points_discount": None,
+        "custom_discount": None
+    }
+    member_info = None
+
+    # 1. 会员等级折扣
+    if member is not None:
+        level_info = levels.level_info(member.level)
+        member_discount_rate = level_info["discount"]
+        member_discount = order_amount * (1 - member_discount_rate)
+        if member_discount > 0:
+            discount_info["member_discount"] = {
+                "type": "member_level",
+                "level": member.level,
+                "level_name": level_info["level_name"],
+                "discount_rate": member_discount_rate,
+                "discount_amount": round(member_discount, 2)
+            }
+            total_discount += member_discount
+            discount_info["applied_discounts"].append("会员等级折扣")
+        member_info = {
+            "member_id": member.id,
+            "level": member.level,
+            "level_name": level_info["level_name"],
+            "points": member.points
+        }
+
+    # 2. 积分抵扣
+    if member_points and member_points > 0:
+        points_discount = min(member_points * POINT_VALUE, order_amount * MAX_POINTS_DISCOUNT_RATIO)
+        if points_discount > 0:
+            discount_info["points_discount"] = {
+                "type": "points",
+                "points_used": int(member_points),
+                "discount_amount": round(points_discount, 2)
+            }
+            total_discount += points_discount
+            discount_info["applied_discounts"].append("积分抵扣")
+
+    # 3. 优惠配置
+    level = member.level if member is not None else 0
+    points = member.points if member is not None else 0
+    if rule_selected:
+        if (
+            selected_rule is not None
+            and selected_rule.active_at(now)
+            and selected_rule.eligible(order_amount, level, points)
+        ):
+            config_discount = selected_rule.discount_for(order_amount, member_points)
+            if config_discount > 0:
+                discount_info["custom_discount"] = selected_rule.as_info(config_discount)
+                total_discount += config_discount
+                discount_info["applied_discounts"].append("自定义优惠")
+    elif index is not None:
+        best = index.best_discount(order_amount, level, points, now)
+        if best is not None:
+            rule, config_discount = best
+            discount_info["custom_discount"] = rule.as_info(config_discount)
+            total_discount += config_discount
+            discount_info["applied_discounts"].append("自动应用优惠")
+
+    final_amount = order_amount - total_discount
+    if final_amount < 0:
+        final_amount = 0
+        total_discount = order_amount
+
+    return {
+        "original_amount": round(order_amount, 2),
+        "discount_amount": round(total_discount, 2),
+        "final_amount": round(final_amount, 2),
+        "discount_info": discount_info,
+        "member_info": member_info
+    }
+
+
+__all__ = [
+    "DISCOUNT_RULE_CACHE_TTL",
+    "POINT_VALUE",
+    "MAX_POINTS_DISCOUNT_RATIO",
+    "AUTO_DISCOUNT_TYPES",
+    "CompiledDiscount",
+    "StoreDiscountIndex",
+    "load_store_rules",
+    "get_store_discounts",
+    "invalidate_discount_rules",
+    "load_discount_rule",
+    "quote_order",
+]
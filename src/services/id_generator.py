@@ -0,0 +1,290 @@
+"""
+订单号 / 交易号生成服务（Snowflake 风格）
+64 位整数 ID 由三部分组成，按生成时间递增，发号时不访问数据库：
+
+    | 41 位毫秒时间戳（自 ID_EPOCH_MS 起） | 10 位 worker ID | 12 位毫秒内序号 |
+
+- 每个进程一个生成器，同一毫秒内序号递增（每毫秒最多 4096 个），进程之间不需要协调
+- 序号用完或系统时钟回拨时沿用/借用下一毫秒，不等待也不报错，保证同一 worker 内严格递增
+- worker ID 取环境变量 ID_WORKER_ID（0~1023，由部署方保证每个进程不同）；
+  未配置时从数据库表 id_worker_leases 租用一个未被占用的 ID，后台线程按 ID_WORKER_LEASE_TTL / 3 续租，
+  续租失败到租约到期前停止发号（抛 RuntimeError），不会与接手该 ID 的进程重复；
+  无法取得 worker ID 时直接报错，不做哈希派生。fork 出的子进程会重新租用
+- 订单号形如 ORD + 19 位 ID + 4 位店铺号，字符串顺序即生成顺序
+"""
+import atexit
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# 自定义纪元：2024-01-01 00:00:00 UTC（41 位毫秒时间戳约可用 69 年）
+ID_EPOCH_MS = int(os.getenv("ID_EPOCH_MS", "1704067200000"))
+
+WORKER_ID_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_ID_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+WORKER_ID_SHIFT = SEQUENCE_BITS
+TIMESTAMP_SHIFT = SEQUENCE_BITS + WORKER_ID_BITS
+
+# 订单号 / 交易号前缀
+ORDER_NUMBER_PREFIX = "ORD"
+TRANSACTION_ID_PREFIX = "TXN"
+# ID 的十进制位数（63 位整数最多 19 位），补零后字符串可按字典序排序
+ID_DIGITS = 19
+# 订单号末尾的店铺号位数（超出部分取模，仅用于人工识别，不参与唯一性）
+STORE_DIGITS = 4
+
+
+# worker ID 租约时长（秒），续租间隔为其三分之一
+ID_WORKER_LEASE_TTL = float(os.getenv("ID_WORKER_LEASE_TTL", "60"))
+# 租约到期前提前停止发号的比例，抵消本机与数据库的计时误差
+_LEASE_SAFETY_RATIO = 0.1
+
+
+def _lease_dsn() -> str:
+    """租约使用的数据库连接串：ID_WORKER_LEASE_DSN，默认 PGDATABASE_URL（转换为 libpq 格式）"""
+    url = os.getenv("ID_WORKER_LEASE_DSN") or os.getenv("PGDATABASE_URL") or ""
+    if not url:
+        raise RuntimeError("未设置 ID_WORKER_ID，且没有 ID_WORKER_LEASE_DSN / PGDATABASE_URL 用于租用 worker ID")
+    for prefix in ("postgresql+psycopg2://", "postgresql+asyncpg://", "postgres://"):
+        if url.startswith(prefix):
+            return "postgresql://" + url[len(prefix):]
+    return url
+
+
+class WorkerLease:
+    """
+    从 id_worker_leases 租用的 worker ID
+
+    取得和续租都以数据库时间计算到期时间；本地按单调时钟记录有效期，
+    有效期在数据库到期之前结束，过期后生成器拒绝发号，直到续租成功。
+    """
+
+    def __init__(self, dsn: str, ttl: float = ID_WORKER_LEASE_TTL):
+        self.dsn = dsn
+        self.ttl = ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.pid = os.getpid()
+        self.worker_id: Optional[int] = None
+        self.valid_until = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _execute(self, sql: str, params: tuple) -> list:
+        import psycopg2
+
+        conn = psycopg2.connect(self.dsn)
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(sql, params)
+                return cur.fetchall() if cur.description else []
+        finally:
+            conn.close()
+
+    def _extend(self, started: float):
+        self.valid_until = started + self.ttl * (1 - _LEASE_SAFETY_RATIO)
+
+    def is_valid(self) -> bool:
+        return time.monotonic() < self.valid_until
+
+    def acquire(self, attempts: int = 5) -> int:
+        """租用一个空闲（或租约已过期）的 worker ID，全部被占用时抛 RuntimeError"""
+        for _ in range(attempts):
+            candidates = self._execute("""
+                SELECT w FROM generate_series(0, %s) AS w
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM id_worker_leases l WHERE l.worker_id = w AND l.expires_at >= now()
+                )
+                ORDER BY random() LIMIT 8
+            """, (MAX_WORKER_ID,))
+            if not candidates:
+                break
+            for (worker_id,) in candidates:
+                started = time.monotonic()
+                # 只有空闲或已过期的 ID 会被写入，并发争抢同一 ID 时只有一方拿到 RETURNING
+                rows = self._execute("""
+                    INSERT INTO id_worker_leases (worker_id, owner, leased_at, expires_at)
+                    VALUES (%s, %s, now(), now() + make_interval(secs => %s))
+                    ON CONFLICT (worker_id) DO UPDATE
+                        SET owner = EXCLUDED.owner, leased_at = now(), expires_at = EXCLUDED.expires_at
+                        WHERE id_worker_leases.expires_at < now()
+                    RETURNING worker_id
+                """, (worker_id, self.owner, self.ttl))
+                if rows:
+                    self.worker_id = worker_id
+                    self._extend(started)
+                    logger.info(f"租用 worker ID: {worker_id} (owner={self.owner})")
+                    return worker_id
+        raise RuntimeError(f"没有可用的 worker ID（0~{MAX_WORKER_ID} 均已被租用）")
+
+    def renew(self) -> bool:
+        """续租，租约已被其他进程接手时返回 False"""
+        started = time.monotonic()
+        rows = self._execute("""
+            UPDATE id_worker_leases
+            SET expires_at = now() + make_interval(secs => %s)
+            WHERE worker_id = %s AND owner = %s
+            RETURNING worker_id
+        """, (self.ttl, self.worker_id, self.owner))
+        if rows:
+            self._extend(started)
+        return bool(rows)
+
+    def release(self):
+        """进程退出时释放租约（fork 出的子进程不释放父进程的租约）"""
+        self._stop.set()
+        if self.worker_id is None or os.getpid() != self.pid:
+            return
+        try:
+            self._execute(
+                "DELETE FROM id_worker_leases WHERE worker_id = %s AND owner = %s",
+                (self.worker_id, self.owner)
+            )
+        except Exception as e:
+            logger.error(f"释放 worker ID 租约失败: {str(e)}")
+
+    def _renew_loop(self):
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                if not self.renew():
+                    self.valid_until = 0.0
+                    logger.error(f"worker ID {self.worker_id} 的租约已被接手，停止发号")
+                    return
+            except Exception as e:
+                # 数据库不可用时继续重试，本地有效期到期后发号会报错
+                logger.error(f"worker ID {self.worker_id} 续租失败: {str(e)}")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._renew_loop, name="id-worker-lease", daemon=True)
+        self._thread.start()
+        atexit.register(self.release)
+
+
+def configured_worker_id() -> Optional[int]:
+    """环境变量 ID_WORKER_ID 指定的 worker ID，未配置时返回 None"""
+    configured = os.getenv("ID_WORKER_ID")
+    if not configured:
+        return None
+    worker_id = int(configured)
+    if not 0 <= worker_id <= MAX_WORKER_ID:
+        raise ValueError(f"ID_WORKER_ID 必须在 0~{MAX_WORKER_ID} 之间: {worker_id}")
+    return worker_id
+
+
+class SnowflakeGenerator:
+    """单个 worker 的 ID 生成器（线程安全，锁只在本进程的线程之间竞争）"""
+
+    def __init__(self, worker_id: int, epoch_ms: int = ID_EPOCH_MS, lease: Optional[WorkerLease] = None):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"worker_id 必须在 0~{MAX_WORKER_ID} 之间: {worker_id}")
+        self.worker_id = worker_id
+        self.epoch_ms = epoch_ms
+        self.lease = lease
+        self._worker_bits = worker_id << WORKER_ID_SHIFT
+        self._last_ms = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+        # 时钟回拨或序号用完时借用未来毫秒的次数
+        self.borrowed = 0
+
+    def _now_ms(self) -> int:
+        return time.time_ns() // 1_000_000 - self.epoch_ms
+
+    def next_id(self) -> int:
+        if self.lease is not None and not self.lease.is_valid():
+            raise RuntimeError(f"worker ID {self.worker_id} 的租约已失效，停止发号")
+        now = self._now_ms()
+        with self._lock:
+            if now > self._last_ms:
+                self._last_ms = now
+                self._sequence = 0
+            else:
+                # 同一毫秒内（或时钟回拨）：继续使用上次的毫秒，序号用完后进入下一毫秒
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    self._last_ms += 1
+                if self._last_ms > now:
+                    self.borrowed += 1
+            return (self._last_ms << TIMESTAMP_SHIFT) | self._worker_bits | self._sequence
+
+    def parse(self, value: int) -> dict:
+        """拆分 ID：生成时间（毫秒时间戳）、worker ID、序号"""
+        return {
+            "timestamp_ms": (value >> TIMESTAMP_SHIFT) + self.epoch_ms,
+            "worker_id": (value >> WORKER_ID_SHIFT) & MAX_WORKER_ID,
+            "sequence": value & MAX_SEQUENCE
+        }
+
+
+_generator: Optional[SnowflakeGenerator] = None
+_lock = threading.Lock()
+
+
+def get_generator() -> SnowflakeGenerator:
+    """当前进程的生成器（首次调用时创建：使用 ID_WORKER_ID，未配置时从数据库租用）"""
+    global _generator
+    generator = _generator
+    if generator is None:
+        with _lock:
+            if _generator is None:
+                worker_id = configured_worker_id()
+                if worker_id is not None:
+                    _generator = SnowflakeGenerator(worker_id)
+                else:
+                    lease = WorkerLease(_lease_dsn())
+                    lease.acquire()
+                    lease.start()
+                    _generator = SnowflakeGenerator(lease.worker_id, lease=lease)
+            generator = _generator
+    return generator
+
+
+def _reset_after_fork():
+    # 子进程不能沿用父进程的生成器（worker ID 与序号状态会重复），首次发号时重新租用
+    global _generator, _lock
+    _generator = None
+    _lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def next_id() -> int:
+    return get_generator().next_id()
+
+
+def next_order_number(store_id: Optional[int] = None) -> str:
+    """订单号：ORD + 19 位 ID + 4 位店铺号（未指定店铺时为 0000）"""
+    store_tag = (store_id or 0) % (10 ** STORE_DIGITS)
+    return f"{ORDER_NUMBER_PREFIX}{next_id():0{ID_DIGITS}d}{store_tag:0{STORE_DIGITS}d}"
+
+
+def next_transaction_id() -> str:
+    """交易号：TXN + 19 位 ID"""
+    return f"{TRANSACTION_ID_PREFIX}{next_id():0{ID_DIGITS}d}"
+
+
+__all__ = [
+    "ID_EPOCH_MS",
+    "MAX_WORKER_ID",
+    "MAX_SEQUENCE",
+    "ORDER_NUMBER_PREFIX",
+    "TRANSACTION_ID_PREFIX",
+    "ID_WORKER_LEASE_TTL",
+    "WorkerLease",
+    "configured_worker_id",
+    "SnowflakeGenerator",
+    "get_generator",
+    "next_id",
+    "next_order_number",
+    "next_transaction_id",
+]
@@ -0,0 +1,192 @@
+"""
+会员等级规则快照
+member_level_rules 只有几行且很少变化，整表加载为进程内只读快照，等级与折扣计算不再访问数据库：
+- 按等级排序的规则数组，按等级 / 按积分查找都用 bisect
+- 每次重新加载内容有变化时版本号加一，调用方可据此判断快照是否更新
+- 快照最多缓存 MEMBER_LEVEL_CACHE_TTL 秒，过期后用调用方的会话重新加载（未传会话时按需创建）
+- 修改等级规则后调用 invalidate_member_levels 立即失效
+"""
+import os
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from storage.database.db import get_session
+from storage.database.shared.model import MemberLevelRules
+
+# 等级规则快照的存活时间（秒）
+MEMBER_LEVEL_CACHE_TTL = float(os.getenv("MEMBER_LEVEL_CACHE_TTL", "300"))
+
+# 没有对应规则时的默认等级名称
+DEFAULT_LEVEL_NAME = "普通会员"
+
+
+class LevelRule:
+    """一条会员等级规则"""
+
+    __slots__ = ("level", "level_name", "min_points", "discount")
+
+    def __init__(self, level: int, level_name: str, min_points: int, discount: float):
+        self.level = level
+        self.level_name = level_name
+        self.min_points = min_points
+        self.discount = discount
+
+    def key(self) -> Tuple[int, str, int, float]:
+        return self.level, self.level_name, self.min_points, self.discount
+
+    def as_dict(self) -> dict:
+        return {
+            "level": self.level,
+            "level_name": self.level_name,
+            "min_points": self.min_points,
+            "discount": self.discount
+        }
+
+
+class MemberLevelSnapshot:
+    """等级规则的只读快照"""
+
+    __slots__ = ("version", "rules", "_levels", "_by_points", "_min_points", "loaded_at")
+
+    def __init__(self, rules: Iterable[LevelRule], version: int = 0):
+        self.version = version
+        self.rules: Tuple[LevelRule, ...] = tuple(sorted(rules, key=lambda r: r.level))
+        self._levels: List[int] = [r.level for r in self.rules]
+        # 按积分门槛排序（门槛相同时取等级高的），用于按积分确定等级
+        self._by_points: Tuple[LevelRule, ...] = tuple(sorted(self.rules, key=lambda r: (r.min_points, r.level)))
+        self._min_points: List[int] = [r.min_points for r in self._by_points]
+        self.loaded_at = time.monotonic()
+
+    def is_fresh(self) -> bool:
+        return time.monotonic() - self.loaded_at < MEMBER_LEVEL_CACHE_TTL
+
+    def same_rules(self, other: "MemberLevelSnapshot") -> bool:
+        return [r.key() for r in self.rules] == [r.key() for r in other.rules]
+
+    def rule(self, level: int) -> Optional[LevelRule]:
+        """等级对应的规则，不存在时返回 None"""
+        i = bisect_left(self._levels, level)
+        if i < len(self._levels) and self._levels[i] == level:
+            return self.rules[i]
+        return None
+
+    def level_info(self, level: int) -> dict:
+        """等级信息，没有规则的等级按普通会员、无折扣处理"""
+        rule = self.rule(level)
+        if rule is not None:
+            return rule.as_dict()
+        return {
+            "level": level,
+            "level_name": DEFAULT_LEVEL_NAME,
+            "min_points": 0,
+            "discount": 1.0
+        }
+
+    def next_level(self, level: int) -> Optional[dict]:
+        """比 level 高的最低一级，已是最高等级时返回 None"""
+        i = bisect_right(self._levels, level)
+        return self.rules[i].as_dict() if i < len(self.rules) else None
+
+    def rule_for_points(self, points: int) -> Optional[LevelRule]:
+        """积分可达到的最高门槛对应的规则，积分不足任何门槛时返回 None"""
+        i = bisect_right(self._min_points, points)
+        return self._by_points[i - 1] if i else None
+
+    def all(self) -> List[dict]:
+        return [r.as_dict() for r in self.rules]
+
+
+_snapshot: Optional[MemberLevelSnapshot] = None
+# 每次失效加一，加载期间发生失效的结果不写入缓存
+_generation = 0
+_lock = threading.Lock()
+
+
+def load_member_levels(db: Session) -> List[LevelRule]:
+    """从数据库加载全部等级规则（一条查询）"""
+    rows = db.query(
+        MemberLevelRules.level,
+        MemberLevelRules.level_name,
+        MemberLevelRules.min_points,
+        MemberLevelRules.discount
+    ).all()
+    return [LevelRule(row.level, row.level_name, row.min_points, row.discount) for row in rows]
+
+
+def get_member_levels(
+    db: Optional[Session] = None,
+    session_factory: Callable[[], Session] = get_session,
+) -> MemberLevelSnapshot:
+    """获取等级规则快照，缓存命中时不访问数据库（未传 db 时按需创建会话）"""
+    global _snapshot
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.is_fresh():
+        return snapshot
+
+    generation = _generation
+    own_session = db is None
+    if own_session:
+        db = session_factory()
+    try:
+        rules = load_member_levels(db)
+    finally:
+        if own_session:
+            db.close()
+
+    with _lock:
+        current = _snapshot
+        fresh = MemberLevelSnapshot(rules, current.version if current is not None else 0)
+        if current is None or not fresh.same_rules(current):
+            fresh.version += 1
+        if _generation == generation:
+            _snapshot = fresh
+    return fresh
+
+
+def get_level_info(level: int, db: Optional[Session] = None) -> dict:
+    """等级信息（等级名称、积分门槛、折扣）"""
+    return get_member_levels(db).level_info(level)
+
+
+def get_next_level_info(level: int, db: Optional[Session] = None) -> Optional[dict]:
+    """下一等级信息"""
+    return get_member_levels(db).next_level(level)
+
+
+def compute_member_discount(level: int, order_amount: float, db: Optional[Session] = None) -> dict:
+    """按会员等级计算折扣: discount_rate / discount_amount / final_amount"""
+    discount_rate = get_member_levels(db).level_info(level)["discount"]
+    discount_amount = order_amount * (1 - discount_rate)
+    return {
+        "discount_rate": discount_rate,
+        "discount_amount": round(discount_amount, 2),
+        "final_amount": round(order_amount - discount_amount, 2)
+    }
+
+
+def invalidate_member_levels():
+    """等级规则修改后使快照失效，下次访问时重新加载"""
+    global _generation
+    with _lock:
+        _generation += 1
+        if _snapshot is not None:
+            # 保留版本号，只让快照过期
+            _snapshot.loaded_at = float("-inf")
+
+
+__all__ = [
+    "MEMBER_LEVEL_CACHE_TTL",
+    "DEFAULT_LEVEL_NAME",
+    "LevelRule",
+    "MemberLevelSnapshot",
+    "load_member_levels",
+    "get_member_levels",
+    "get_level_info",
+    "get_next_level_info",
+    "compute_member_discount",
+    "invalidate_member_levels",
+]
@@ -0,0 +1,170 @@
+"""
+顾客端菜单快照缓存
+每个店铺缓存一份已序列化的分类菜单（JSON 字节 + ETag），扫码点餐的菜单请求直接返回缓存，
+缓存未命中时用一条 JOIN 查询构建整份菜单。
+
+菜品增删改、库存变化时调用 invalidate_menu 使该店铺的快照失效；
+多 worker 部署时其他 worker 的快照最多在 MENU_CACHE_TTL 秒后过期重建。
+ETag 由菜单内容计算，各 worker 对同一份菜单给出相同的 ETag。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import and_
+from sqlalchemy.orm import Session
+
+from storage.database.db import get_session
+from storage.database.shared.model import MenuCategories, MenuItems
+
+# 快照最长存活时间（秒），兜底跨 worker 的失效
+MENU_CACHE_TTL = float(os.getenv("MENU_CACHE_TTL", "60"))
+
+
+class MenuSnapshot:
+    """店铺菜单快照"""
+
+    __slots__ = ("store_id", "version", "body", "etag", "built_at")
+
+    def __init__(self, store_id: int, version: int, body: bytes, etag: str):
+        self.store_id = store_id
+        self.version = version
+        self.body = body
+        self.etag = etag
+        self.built_at = time.monotonic()
+
+    def is_fresh(self, version: int) -> bool:
+        return self.version == version and time.monotonic() - self.built_at < MENU_CACHE_TTL
+
+
+_snapshots: Dict[int, MenuSnapshot] = {}
+_versions: Dict[int, int] = {}
+_lock = threading.Lock()
+_build_locks: Dict[int, threading.Lock] = {}
+
+
+def build_menu(db: Session, store_id: int) -> List[dict]:
+    """
+    构建店铺分类菜单（一条查询）
+
+    分类 LEFT JOIN 可售菜品，按分类排序、菜品排序一次取回后在内存中分组，
+    没有可售菜品的分类也会返回（items 为空）。
+    """
+    rows = db.query(MenuCategories, MenuItems).outerjoin(
+        MenuItems, and_(
+            MenuItems.category_id == MenuCategories.id,
+            MenuItems.is_available == True
+        )
+    ).filter(
+        MenuCategories.store_id == store_id,
+        MenuCategories.is_active == True
+    ).order_by(
+        MenuCategories.sort_order, MenuCategories.id, MenuItems.sort_order, MenuItems.id
+    ).all()
+
+    result = []
+    by_category: Dict[int, dict] = {}
+    for category, item in rows:
+        entry = by_category.get(category.id)
+        if entry is None:
+            entry = {
+                "id": category.id,
+                "name": category.name,
+                "description": category.description,
+                "sort_order": category.sort_order,
+                "items": []
+            }
+            by_category[category.id] = entry
+            result.append(entry)
+
+        if item is not None:
+            entry["items"].append({
+                "id": item.id,
+                "name": item.name,
+                "description": item.description,
+                "price": float(item.price),
+                "original_price": float(item.original_price) if item.original_price is not None else None,
+                "image_url": item.image_url,
+                "stock": item.stock,
+                "unit": item.unit,
+                "cooking_time": item.cooking_time,
+                "is_available": item.is_available,
+                "is_recommended": item.is_recommended
+            })
+
+    return result
+
+
+def _build_snapshot(store_id: int, version: int, session_factory: Callable[[], Session]) -> MenuSnapshot:
+    db = session_factory()
+    try:
+        menu = build_menu(db, store_id)
+    finally:
+        db.close()
+
+    body = json.dumps(menu, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+    return MenuSnapshot(store_id, version, body, etag)
+
+
+def get_menu_snapshot(store_id: int, session_factory: Callable[[], Session] = get_session) -> MenuSnapshot:
+    """
+    获取店铺菜单快照，缓存命中时不访问数据库
+
+    同一店铺并发未命中时只有一个请求构建，其余请求等待后复用结果。
+    """
+    version = _versions.get(store_id, 0)
+    snapshot = _snapshots.get(store_id)
+    if snapshot is not None and snapshot.is_fresh(version):
+        return snapshot
+
+    with _lock:
+        build_lock = _build_locks.setdefault(store_id, threading.Lock())
+
+    with build_lock:
+        version = _versions.get(store_id, 0)
+        snapshot = _snapshots.get(store_id)
+        if snapshot is not None and snapshot.is_fresh(version):
+            return snapshot
+
+        snapshot = _build_snapshot(store_id, version, session_factory)
+        # 构建期间发生失效时不写入，下一次请求重新构建
+        if _versions.get(store_id, 0) == version:
+            _snapshots[store_id] = snapshot
+        return snapshot
+
+
+def invalidate_menu(store_id: Optional[int] = None):
+    """使店铺菜单快照失效（store_id 为空时清空全部）"""
+    with _lock:
+        if store_id is None:
+            for key in set(_versions) | set(_snapshots):
+                _versions[key] = _versions.get(key, 0) + 1
+            _snapshots.clear()
+            return
+        _versions[store_id] = _versions.get(store_id, 0) + 1
+        _snapshots.pop(store_id, None)
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """判断 If-None-Match 请求头是否命中 ETag（支持 * 和逗号分隔的多个值、弱校验前缀）"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+__all__ = [
+    "MENU_CACHE_TTL",
+    "MenuSnapshot",
+    "build_menu",
+    "get_menu_snapshot",
+    "invalidate_menu",
+    "etag_matches",
+]
@@ -0,0 +1,120 @@
+"""
+下单服务
+restaurant_api 与 customer_api 共用的下单路径：无论订单有多少行，
+锁定菜品、扣减库存、写入订单项都只需要固定条数的 SQL。
+
+1. SELECT ... WHERE id IN (...) ORDER BY id FOR UPDATE 一次锁定全部菜品行
+   （按 id 排序加锁，并发订单之间不会死锁）
+2. 在锁内校验存在/上架/库存，避免并发下单超卖
+3. UPDATE ... SET stock = stock - CASE id ... END 一条语句扣减全部库存
+4. INSERT ... RETURNING 批量写入订单项
+"""
+from typing import Dict, Iterable, List, Tuple
+
+from sqlalchemy import case, insert, update
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+
+from storage.database.shared.model import MenuItems, OrderItems, Orders
+
+
+class OrderPlacementError(Exception):
+    """下单校验失败（菜品不存在、已下架、库存不足），status_code 对应 HTTP 状态码"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def _requested_quantities(lines: Iterable) -> Dict[int, int]:
+    """同一菜品出现在多行时合并数量"""
+    quantities: Dict[int, int] = {}
+    for line in lines:
+        quantities[line.menu_item_id] = quantities.get(line.menu_item_id, 0) + line.quantity
+    return quantities
+
+
+def lock_menu_items(db: Session, store_id: int, menu_item_ids: Iterable[int]) -> Dict[int, MenuItems]:
+    """一条查询按 id 顺序锁定店铺的菜品行: {menu_item_id: MenuItems}"""
+    items = db.query(MenuItems).filter(
+        MenuItems.id.in_(sorted(set(menu_item_ids))),
+        MenuItems.store_id == store_id
+    ).order_by(MenuItems.id).with_for_update().all()
+    return {item.id: item for item in items}
+
+
+def place_order_items(
+    db: Session,
+    order: Orders,
+    lines: List,
+    item_status: str = "pending",
+) -> Tuple[List[OrderItems], float]:
+    """
+    为已 flush 的订单锁定菜品、扣减库存并批量写入订单项（调用方负责提交）
+
+    Args:
+        order: 已 flush（有 id）的订单
+        lines: 下单行，需要有 menu_item_id / quantity / special_instructions 属性
+        item_status: 订单项初始状态
+
+    Returns:
+        (订单项列表, 订单总额)
+
+    Raises:
+        OrderPlacementError: 菜品不存在、已下架或库存不足
+    """
+    quantities = _requested_quantities(lines)
+    if not quantities:
+        raise OrderPlacementError(400, "订单中没有菜品")
+    menu_items = lock_menu_items(db, order.store_id, quantities)
+
+    for menu_item_id, quantity in quantities.items():
+        menu_item = menu_items.get(menu_item_id)
+        if menu_item is None:
+            raise OrderPlacementError(404, f"菜品ID {menu_item_id} 不存在")
+        if not menu_item.is_available:
+            raise OrderPlacementError(400, f"菜品 {menu_item.name} 已下架")
+        if menu_item.stock < quantity:
+            raise OrderPlacementError(
+                400, f"菜品 {menu_item.name} 库存不足，当前库存: {menu_item.stock}，需要: {quantity}"
+            )
+
+    # 行已锁定且校验通过，一条 UPDATE 扣减全部库存
+    db.execute(
+        update(MenuItems)
+        .where(MenuItems.id.in_(quantities))
+        .values(stock=MenuItems.stock - case(quantities, value=MenuItems.id))
+        .execution_options(synchronize_session=False)
+    )
+    for menu_item_id, quantity in quantities.items():
+        # 同步内存中的库存值，但不标记为脏数据，flush 时不会再产生 UPDATE
+        item = menu_items[menu_item_id]
+        set_committed_value(item, "stock", item.stock - quantity)
+
+    rows = []
+    total_amount = 0.0
+    for line in lines:
+        menu_item = menu_items[line.menu_item_id]
+        subtotal = float(menu_item.price) * line.quantity
+        total_amount += subtotal
+        rows.append({
+            "order_id": order.id,
+            "menu_item_id": menu_item.id,
+            "menu_item_name": menu_item.name,
+            "menu_item_price": float(menu_item.price),
+            "quantity": line.quantity,
+            "subtotal": subtotal,
+            "special_instructions": line.special_instructions,
+            "status": item_status,
+        })
+
+    order_items = list(db.scalars(insert(OrderItems).returning(OrderItems), rows))
+    return order_items, total_amount
+
+
+__all__ = [
+    "OrderPlacementError",
+    "lock_menu_items",
+    "place_order_items",
+]
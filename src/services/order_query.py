@@ -0,0 +1,125 @@
+"""
+订单列表查询服务
+为厨房屏、店员端等高频轮询接口提供无 N+1 的批量查询路径
+"""
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func, select, tuple_
+from sqlalchemy.orm import Session, selectinload
+
+from storage.database.shared.model import Orders, OrderItems, Tables
+
+# 单次列表查询的最大返回数量
+MAX_LIST_LIMIT = 500
+
+
+def _store_orders_query(
+    db: Session,
+    store_id: int,
+    status: Optional[str] = None,
+    table_id: Optional[int] = None,
+    before_id: Optional[int] = None,
+):
+    """
+    构建店铺订单查询
+
+    按 (created_at, id) 倒序做键集分页，store_id 等值过滤 + created_at 排序
+    可以直接走 ix_orders_store_created 索引，状态/桌号过滤在索引扫描上完成。
+    """
+    query = (
+        db.query(Orders, Tables.table_number)
+        .outerjoin(Tables, Tables.id == Orders.table_id)
+        .filter(Orders.store_id == store_id)
+    )
+
+    if status:
+        query = query.filter(Orders.order_status == status)
+
+    if table_id:
+        query = query.filter(Orders.table_id == table_id)
+
+    if before_id:
+        # 游标行的创建时间通过子查询取得，整个分页仍是一条语句
+        cursor_created_at = (
+            select(Orders.created_at)
+            .where(Orders.id == before_id)
+            .scalar_subquery()
+        )
+        query = query.filter(
+            tuple_(Orders.created_at, Orders.id) < tuple_(cursor_created_at, before_id)
+        )
+
+    return query.order_by(Orders.created_at.desc(), Orders.id.desc())
+
+
+def list_store_orders(
+    db: Session,
+    store_id: int,
+    status: Optional[str] = None,
+    table_id: Optional[int] = None,
+    before_id: Optional[int] = None,
+    limit: Optional[int] = None,
+) -> List[Tuple[Orders, str]]:
+    """
+    获取店铺订单列表（含订单项）
+
+    订单与桌号一次 JOIN 取回，订单项通过 selectinload 一次 IN 查询批量加载，
+    无论订单多少条都只有两次数据库往返。
+
+    Returns:
+        [(订单, 桌号), ...]，订单的 order_items 已预加载
+    """
+    query = _store_orders_query(db, store_id, status, table_id, before_id)
+    query = query.options(selectinload(Orders.order_items))
+
+    if limit:
+        query = query.limit(min(limit, MAX_LIST_LIMIT))
+
+    return [(order, table_number or "") for order, table_number in query.all()]
+
+
+def list_store_order_summaries(
+    db: Session,
+    store_id: int,
+    status: Optional[str] = None,
+    before_id: Optional[int] = None,
+    limit: int = 50,
+) -> List[Tuple[Orders, str, int]]:
+    """
+    获取店铺订单摘要列表（只含订单项数量，不加载订单项）
+
+    Returns:
+        [(订单, 桌号, 订单项数量), ...]
+    """
+    orders = _store_orders_query(db, store_id, status, before_id=before_id)
+    orders = orders.limit(min(limit, MAX_LIST_LIMIT)).all()
+    if not orders:
+        return []
+
+    items_count = count_order_items(db, [order.id for order, _ in orders])
+    return [
+        (order, table_number or "", items_count.get(order.id, 0))
+        for order, table_number in orders
+    ]
+
+
+def count_order_items(db: Session, order_ids: List[int]) -> Dict[int, int]:
+    """批量统计订单项数量: {order_id: count}"""
+    if not order_ids:
+        return {}
+
+    rows = (
+        db.query(OrderItems.order_id, func.count(OrderItems.id))
+        .filter(OrderItems.order_id.in_(order_ids))
+        .group_by(OrderItems.order_id)
+        .all()
+    )
+    return {order_id: count for order_id, count in rows}
+
+
+__all__ = [
+    "MAX_LIST_LIMIT",
+    "list_store_orders",
+    "list_store_order_summaries",
+    "count_order_items",
+]
@@ -0,0 +1,245 @@
+"""
+权限解析服务
+把每个角色的权限列表编译为 frozenset，并按用户缓存生效权限和可访问店铺，
+权限校验在缓存命中时是纯内存的集合查找，不访问数据库。
+
+- 角色表整体缓存（角色数量很少），create_role / init-roles 后调用 invalidate_roles
+- 用户生效权限按 user_id 缓存 PERMISSION_CACHE_TTL 秒，分配/移除角色后调用 invalidate_user
+- 管理员、总公司角色可访问全部启用店铺，启用店铺 ID 集合全局共享一份缓存
+"""
+import os
+import threading
+import time
+from typing import Callable, Dict, FrozenSet, Iterable, Optional
+
+from sqlalchemy.orm import Session
+
+from storage.database.db import get_session
+from storage.database.shared.model import Roles, Staff, Stores, UserRoles
+
+# 用户权限 / 角色 / 店铺缓存的存活时间（秒）
+PERMISSION_CACHE_TTL = float(os.getenv("PERMISSION_CACHE_TTL", "60"))
+
+# 拥有全部权限
+ALL_ACCESS = "all:access"
+# 同时拥有这两项权限的角色（总公司）可以管理全部店铺
+_GLOBAL_STORE_PERMISSIONS = frozenset({"store:create", "store:update"})
+
+
+class CompiledRole:
+    """编译后的角色权限"""
+
+    __slots__ = ("id", "name", "permissions", "all_access", "all_stores")
+
+    def __init__(self, role_id: int, name: str, permissions: Iterable[str]):
+        self.id = role_id
+        self.name = name
+        self.permissions: FrozenSet[str] = frozenset(permissions)
+        self.all_access = ALL_ACCESS in self.permissions
+        # 全局角色的权限不限定店铺
+        self.all_stores = self.all_access or _GLOBAL_STORE_PERMISSIONS <= self.permissions
+
+
+def compile_role(role_id: int, name: str, permissions: Optional[dict]) -> CompiledRole:
+    """编译 Roles.permissions（{"permissions": [...]}）"""
+    return CompiledRole(role_id, name, (permissions or {}).get("permissions", []))
+
+
+class UserPermissions:
+    """用户的生效权限快照"""
+
+    __slots__ = (
+        "user_id", "all_access", "global_permissions", "store_permissions",
+        "all_stores", "staff_store_ids", "loaded_at"
+    )
+
+    def __init__(
+        self,
+        user_id: int,
+        roles: Iterable[CompiledRole],
+        staff_store_ids: Iterable[int],
+    ):
+        global_permissions = set()
+        store_permissions = set()
+        all_access = False
+        all_stores = False
+        for role in roles:
+            all_access = all_access or role.all_access
+            if role.all_stores:
+                all_stores = True
+                global_permissions |= role.permissions
+            else:
+                store_permissions |= role.permissions
+
+        self.user_id = user_id
+        self.all_access = all_access
+        self.all_stores = all_stores
+        # 全局角色的权限对任意店铺生效；店铺级角色的权限只在本人任职的店铺生效
+        self.global_permissions: FrozenSet[str] = frozenset(global_permissions)
+        self.store_permissions: FrozenSet[str] = frozenset(store_permissions)
+        self.staff_store_ids: FrozenSet[int] = frozenset(staff_store_ids)
+        self.loaded_at = time.monotonic()
+
+    def is_fresh(self) -> bool:
+        return time.monotonic() - self.loaded_at < PERMISSION_CACHE_TTL
+
+    def has(self, permission: str, store_id: Optional[int] = None) -> bool:
+        """是否拥有权限（store_id 为空时不限定店铺）"""
+        if self.all_access or permission in self.global_permissions:
+            return True
+        if permission not in self.store_permissions:
+            return False
+        return store_id is None or store_id in self.staff_store_ids
+
+
+_roles: Dict[int, CompiledRole] = {}
+_roles_loaded_at: Optional[float] = None
+_active_store_ids: Optional[FrozenSet[int]] = None
+_stores_loaded_at: Optional[float] = None
+_users: Dict[int, UserPermissions] = {}
+# 每次失效加一，加载期间发生失效的结果不写入缓存
+_generation = 0
+_lock = threading.Lock()
+
+
+def _expired(loaded_at: Optional[float]) -> bool:
+    return loaded_at is None or time.monotonic() - loaded_at >= PERMISSION_CACHE_TTL
+
+
+def _get_roles(db: Session) -> Dict[int, CompiledRole]:
+    """全部角色（一条查询，缓存）"""
+    global _roles, _roles_loaded_at
+    if _expired(_roles_loaded_at):
+        rows = db.query(Roles.id, Roles.name, Roles.permissions).all()
+        roles = {row.id: compile_role(row.id, row.name, row.permissions) for row in rows}
+        with _lock:
+            _roles, _roles_loaded_at = roles, time.monotonic()
+    return _roles
+
+
+def _get_active_store_ids(db: Session) -> FrozenSet[int]:
+    """全部启用店铺 ID（一条查询，缓存）"""
+    global _active_store_ids, _stores_loaded_at
+    if _active_store_ids is None or _expired(_stores_loaded_at):
+        ids = frozenset(row.id for row in db.query(Stores.id).filter(Stores.is_active == True))
+        with _lock:
+            _active_store_ids, _stores_loaded_at = ids, time.monotonic()
+    return _active_store_ids
+
+
+def load_user_permissions(db: Session, user_id: int) -> UserPermissions:
+    """从数据库加载用户生效权限（角色 ID 与任职店铺各一条查询，不读缓存）"""
+    roles = _get_roles(db)
+    role_ids = [row.role_id for row in db.query(UserRoles.role_id).filter(UserRoles.user_id == user_id)]
+    compiled = [roles[role_id] for role_id in role_ids if role_id in roles]
+    if len(compiled) < len(role_ids):
+        # 有角色不在缓存中（其他 worker 新建的角色），重新加载角色表
+        invalidate_roles()
+        roles = _get_roles(db)
+        compiled = [roles[role_id] for role_id in role_ids if role_id in roles]
+
+    staff_store_ids = []
+    if compiled:
+        # 没有任何角色的用户不授予店铺访问权限，不需要查询任职店铺
+        staff_store_ids = [
+            row.store_id for row in db.query(Staff.store_id).filter(
+                Staff.user_id == user_id,
+                Staff.is_active == True
+            )
+        ]
+    return UserPermissions(user_id, compiled, staff_store_ids)
+
+
+def get_user_permissions(
+    user_id: int,
+    db: Optional[Session] = None,
+    session_factory: Callable[[], Session] = get_session,
+) -> UserPermissions:
+    """获取用户生效权限，缓存命中时不访问数据库（未传 db 时按需创建会话）"""
+    cached = _users.get(user_id)
+    if cached is not None and cached.is_fresh():
+        return cached
+
+    generation = _generation
+    own_session = db is None
+    if own_session:
+        db = session_factory()
+    try:
+        permissions = load_user_permissions(db, user_id)
+    finally:
+        if own_session:
+            db.close()
+
+    with _lock:
+        if _generation == generation:
+            _users[user_id] = permissions
+    return permissions
+
+
+def check_permission(
+    user_id: int,
+    permission: str,
+    store_id: Optional[int] = None,
+    db: Optional[Session] = None,
+) -> bool:
+    """检查用户是否拥有权限"""
+    return get_user_permissions(user_id, db).has(permission, store_id)
+
+
+def accessible_store_ids(user_id: int, db: Optional[Session] = None) -> FrozenSet[int]:
+    """用户可访问的店铺 ID 集合"""
+    permissions = get_user_permissions(user_id, db)
+    if not permissions.all_stores:
+        return permissions.staff_store_ids
+
+    own_session = db is None and _expired(_stores_loaded_at)
+    if own_session:
+        db = get_session()
+    try:
+        return _get_active_store_ids(db) | permissions.staff_store_ids
+    finally:
+        if own_session:
+            db.close()
+
+
+def invalidate_user(user_id: Optional[int] = None):
+    """使用户权限缓存失效（user_id 为空时清空全部用户）"""
+    global _generation
+    with _lock:
+        _generation += 1
+        if user_id is None:
+            _users.clear()
+        else:
+            _users.pop(user_id, None)
+
+
+def invalidate_roles():
+    """角色变化后使角色缓存失效，所有用户的生效权限随之失效"""
+    global _roles_loaded_at, _generation
+    with _lock:
+        _generation += 1
+        _roles_loaded_at = None
+        _users.clear()
+
+
+def invalidate_stores():
+    """店铺启用/停用后使启用店铺缓存失效"""
+    global _stores_loaded_at
+    with _lock:
+        _stores_loaded_at = None
+
+
+__all__ = [
+    "PERMISSION_CACHE_TTL",
+    "ALL_ACCESS",
+    "CompiledRole",
+    "UserPermissions",
+    "compile_role",
+    "load_user_permissions",
+    "get_user_permissions",
+    "check_permission",
+    "accessible_store_ids",
+    "invalidate_user",
+    "invalidate_roles",
+    "invalidate_stores",
+]
@@ -0,0 +1,73 @@
+"""
+第三方积分兑换每日限额
+按 (协议, 日期) 在 point_exchange_daily_usage 中累计已兑换积分，
+兑换时用一条条件 upsert 原子地占用额度，校验复杂度为 O(1)，不再统计兑换日志。
+
+占用额度与兑换在同一个事务中提交，兑换失败回滚时额度随之释放；
+同一协议同一天的并发兑换在该行上串行，不会超出限额。
+"""
+from datetime import date, datetime, time
+from typing import Optional
+
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from storage.database.shared.model import PointExchangeDailyUsage
+
+
+def _day_start(day: date) -> datetime:
+    """用量行的日期键：当天零点"""
+    return datetime.combine(day, time.min)
+
+
+def reserve_daily_points(
+    db: Session,
+    agreement_id: int,
+    points: int,
+    limit: int,
+    day: Optional[date] = None,
+) -> Optional[int]:
+    """
+    在 (协议, 日期) 用量行上占用 points 积分额度（不提交事务）
+
+    Returns:
+        占用后的当日累计积分；超出 limit 时返回 None，用量不变
+    """
+    if points > limit:
+        return None
+
+    table = PointExchangeDailyUsage.__table__
+    stmt = insert(table).values(
+        agreement_id=agreement_id,
+        usage_date=_day_start(day or date.today()),
+        points_used=points,
+        exchange_count=1,
+        updated_at=func.now(),
+    )
+    stmt = stmt.on_conflict_do_update(
+        constraint='point_exchange_daily_usage_agreement_date_key',
+        set_={
+            "points_used": table.c.points_used + stmt.excluded.points_used,
+            "exchange_count": table.c.exchange_count + 1,
+            "updated_at": func.now(),
+        },
+        # 冲突行加上本次积分超出限额时不更新，RETURNING 不返回行
+        where=table.c.points_used + stmt.excluded.points_used <= limit,
+    ).returning(table.c.points_used)
+    return db.execute(stmt).scalar()
+
+
+def get_daily_usage(db: Session, agreement_id: int, day: Optional[date] = None) -> int:
+    """协议当日已兑换积分"""
+    used = db.query(PointExchangeDailyUsage.points_used).filter(
+        PointExchangeDailyUsage.agreement_id == agreement_id,
+        PointExchangeDailyUsage.usage_date == _day_start(day or date.today())
+    ).scalar()
+    return used or 0
+
+
+__all__ = [
+    "reserve_daily_points",
+    "get_daily_usage",
+]
@@ -0,0 +1,142 @@
+"""
+二维码图片缓存（按内容寻址）
+以 (二维码内容, 前景色, 背景色, logo 字节, logo 比例) 的哈希作为缓存键，映射到已上传的对象 key。
+输入相同的请求直接复用已上传的图片，跳过渲染和上传。
+
+- 进程内 LRU：摘要 -> 对象 key，命中后最多每 QRCODE_CACHE_VERIFY_TTL 秒用 file_exists 确认一次对象仍在
+- LRU 未命中时按文件名前缀在存储中查找（其他 worker 或重启前上传过的同一张图）
+- 都没有时才调用 render 渲染并上传
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+# LRU 最多缓存的对象 key 数量
+QRCODE_CACHE_SIZE = int(os.getenv("QRCODE_CACHE_SIZE", "2048"))
+# LRU 命中后重新确认对象存在的间隔（秒）
+QRCODE_CACHE_VERIFY_TTL = float(os.getenv("QRCODE_CACHE_VERIFY_TTL", "300"))
+
+# 上传时使用的文件名前缀，对象 key 形如 qrcode_<摘要>_<随机后缀>.png
+_FILE_PREFIX = "qrcode_"
+
+# (bucket, 摘要) -> (对象 key, 上次确认存在的时间)
+_entries: "OrderedDict[Tuple[str, str], Tuple[str, float]]" = OrderedDict()
+_lock = threading.Lock()
+
+
+def qrcode_digest(
+    content: str,
+    foreground_color: str = "black",
+    background_color: str = "white",
+    logo_data: Optional[bytes] = None,
+    logo_ratio: float = 0.2,
+    variant: str = "",
+) -> str:
+    """计算二维码输入的内容摘要（variant 用于区分不同的渲染样式）"""
+    h = hashlib.sha256()
+    for part in (variant, content, foreground_color.lower(), background_color.lower(), repr(float(logo_ratio))):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    h.update(hashlib.sha256(logo_data).digest() if logo_data else b"-")
+    return h.hexdigest()[:40]
+
+
+def _bucket_of(storage) -> str:
+    return os.environ.get("COZE_BUCKET_NAME") or getattr(storage, "bucket_name", "") or ""
+
+
+def _remember(cache_key: Tuple[str, str], object_key: str):
+    with _lock:
+        _entries[cache_key] = (object_key, time.monotonic())
+        _entries.move_to_end(cache_key)
+        while len(_entries) > QRCODE_CACHE_SIZE:
+            _entries.popitem(last=False)
+
+
+def _lookup(storage, cache_key: Tuple[str, str]) -> Optional[str]:
+    with _lock:
+        entry = _entries.get(cache_key)
+        if entry is not None:
+            _entries.move_to_end(cache_key)
+    if entry is None:
+        return None
+
+    object_key, verified_at = entry
+    if time.monotonic() - verified_at < QRCODE_CACHE_VERIFY_TTL:
+        return object_key
+    if storage.file_exists(file_key=object_key):
+        _remember(cache_key, object_key)
+        return object_key
+
+    with _lock:
+        _entries.pop(cache_key, None)
+    return None
+
+
+def _find_uploaded(storage, digest: str) -> Optional[str]:
+    """按文件名前缀查找已上传过的同一张图"""
+    try:
+        result = storage.list_files(prefix=f"{_FILE_PREFIX}{digest}_", max_keys=1)
+    except Exception:
+        return None
+    keys = result.get("keys") or []
+    return keys[0] if keys else None
+
+
+def get_or_upload_qrcode(
+    storage,
+    render: Callable[[], bytes],
+    content: str,
+    foreground_color: str = "black",
+    background_color: str = "white",
+    logo_data: Optional[bytes] = None,
+    logo_ratio: float = 0.2,
+    variant: str = "",
+) -> Tuple[str, bool]:
+    """
+    获取输入对应的二维码对象 key，不存在时调用 render 渲染并上传
+
+    Args:
+        storage: S3SyncStorage 实例
+        render: 渲染二维码 PNG 字节的函数（仅在未命中时调用）
+        variant: 渲染样式标识，同样的输入用不同样式渲染时需要区分
+
+    Returns:
+        (对象 key, 是否命中缓存)
+    """
+    digest = qrcode_digest(content, foreground_color, background_color, logo_data, logo_ratio, variant)
+    cache_key = (_bucket_of(storage), digest)
+
+    object_key = _lookup(storage, cache_key)
+    if object_key is None:
+        object_key = _find_uploaded(storage, digest)
+    if object_key is not None:
+        _remember(cache_key, object_key)
+        return object_key, True
+
+    object_key = storage.upload_file(
+        file_content=render(),
+        file_name=f"{_FILE_PREFIX}{digest}.png",
+        content_type="image/png"
+    )
+    _remember(cache_key, object_key)
+    return object_key, False
+
+
+def forget_qrcode(object_key: str):
+    """对象被删除后移除指向它的缓存项"""
+    with _lock:
+        for cache_key in [k for k, (key, _) in _entries.items() if key == object_key]:
+            _entries.pop(cache_key, None)
+
+
+__all__ = [
+    "QRCODE_CACHE_SIZE",
+    "QRCODE_CACHE_VERIFY_TTL",
+    "qrcode_digest",
+    "get_or_upload_qrcode",
+    "forget_qrcode",
+]
@@ -0,0 +1,145 @@
+"""
+小票渲染服务
+- 功能区模板编译一次后缓存，按配置内容（或调用方给出的配置 ID/版本）作为缓存键，
+  打印、预览、批量渲染都不再重复解析模板
+- load_receipt_contexts 用一条 JOIN 查询取回 N 个订单的订单、店铺、桌号、会员和订单项
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from jinja2 import Environment, Template
+from sqlalchemy.orm import Session
+
+from storage.database.shared.model import Members, OrderItems, Orders, Stores, Tables
+
+# 已编译配置的缓存数量上限
+MAX_COMPILED_CONFIGS = 64
+# 单次批量渲染的最大订单数
+MAX_BATCH_ORDERS = 500
+
+# 与 jinja2.Template(...) 相同的默认设置，渲染结果保持一致
+_environment = Environment()
+_compiled: "OrderedDict[str, Tuple[Template, ...]]" = OrderedDict()
+_lock = threading.Lock()
+
+
+class ReceiptContext:
+    """渲染一张小票所需的数据"""
+
+    __slots__ = ("order", "store", "table", "items", "member")
+
+    def __init__(self, order: Orders, store: Optional[Stores], table: Optional[Tables], member: Optional[Members]):
+        self.order = order
+        self.store = store
+        self.table = table
+        self.items: List[OrderItems] = []
+        self.member = member
+
+    @property
+    def member_info(self) -> str:
+        if not self.order.customer_phone or self.member is None:
+            return "非会员"
+        return f"{self.member.name} (积分:{self.member.points})"
+
+
+def sections_key(sections: List[Dict[str, Any]]) -> str:
+    """按功能区配置内容计算缓存键（内容相同的配置共用编译结果）"""
+    payload = json.dumps(
+        [(s.get("is_enabled", True), s.get("sort_order", 0), s.get("template") or "") for s in sections],
+        ensure_ascii=False,
+    )
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def compile_sections(sections: List[Dict[str, Any]], cache_key: Optional[str] = None) -> Tuple[Template, ...]:
+    """
+    编译启用的功能区模板（按 sort_order 排序），结果按 cache_key 缓存
+
+    cache_key 可以传 "配置ID:版本"，不传时按配置内容计算。
+    """
+    key = cache_key or sections_key(sections)
+    with _lock:
+        compiled = _compiled.get(key)
+        if compiled is not None:
+            _compiled.move_to_end(key)
+            return compiled
+
+    enabled = sorted(
+        [s for s in sections if s.get("is_enabled", True)],
+        key=lambda x: x.get("sort_order", 0)
+    )
+    compiled = tuple(
+        _environment.from_string(s["template"]) for s in enabled if s.get("template")
+    )
+
+    with _lock:
+        _compiled[key] = compiled
+        _compiled.move_to_end(key)
+        while len(_compiled) > MAX_COMPILED_CONFIGS:
+            _compiled.popitem(last=False)
+    return compiled
+
+
+def render_sections(templates: Iterable[Template], **variables) -> str:
+    """依次渲染已编译的功能区模板并拼接为小票文本"""
+    return "".join(template.render(variables) + "\n" for template in templates).strip()
+
+
+def render_receipt(templates: Iterable[Template], context: ReceiptContext) -> str:
+    """用已编译的模板渲染一张小票"""
+    return render_sections(
+        templates,
+        order=context.order,
+        store=context.store,
+        table=context.table,
+        items=context.items,
+        member_info=context.member_info,
+    )
+
+
+def load_receipt_contexts(db: Session, order_ids: Iterable[int]) -> Dict[int, ReceiptContext]:
+    """
+    一条查询加载多个订单的小票数据: {order_id: ReceiptContext}
+
+    订单 LEFT JOIN 店铺、桌号、会员（按手机号）和订单项，按订单 ID、订单项 ID 排序后在内存中分组；
+    不存在的订单不在结果中，缺失的店铺/桌号为 None 由调用方处理。
+    """
+    ids = sorted(set(order_ids))
+    if not ids:
+        return {}
+
+    rows = db.query(Orders, Stores, Tables, Members, OrderItems).outerjoin(
+        Stores, Stores.id == Orders.store_id
+    ).outerjoin(
+        Tables, Tables.id == Orders.table_id
+    ).outerjoin(
+        Members, Members.phone == Orders.customer_phone
+    ).outerjoin(
+        OrderItems, OrderItems.order_id == Orders.id
+    ).filter(
+        Orders.id.in_(ids)
+    ).order_by(Orders.id, OrderItems.id).all()
+
+    contexts: Dict[int, ReceiptContext] = {}
+    for order, store, table, member, item in rows:
+        context = contexts.get(order.id)
+        if context is None:
+            context = ReceiptContext(order, store, table, member)
+            contexts[order.id] = context
+        if item is not None:
+            context.items.append(item)
+    return contexts
+
+
+__all__ = [
+    "MAX_BATCH_ORDERS",
+    "ReceiptContext",
+    "sections_key",
+    "compile_sections",
+    "render_sections",
+    "render_receipt",
+    "load_receipt_contexts",
+]
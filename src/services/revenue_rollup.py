@@ -0,0 +1,356 @@
+"""
+每日营收汇总（daily_revenue）增量维护服务
+
+订单创建、支付、取消、金额变化时按 (store_id, 日期) 增量更新汇总行，
+趋势类报表直接读取汇总表，查询复杂度为 O(天数) 而不是 O(订单数)。
+历史区间或事件遗漏时，可用 rebuild_daily_revenue 从订单表整体重算。
+
+计数口径（订单按创建日期归属）：
+- total_orders / total_amount / total_discount: 当日全部订单
+- cancelled_orders / total_refund: 已取消订单数 / 已取消订单实付金额
+- net_revenue: 未取消订单实付金额
+- paid_orders / paid_amount: 已支付订单数 / 已支付订单实付金额
+- payment_methods: {支付方式: {"count": 笔数, "amount": 金额}}（已支付订单）
+- peak_hours: {小时: 订单数}（当日全部订单）
+"""
+import logging
+from datetime import date, datetime, time, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import case, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from storage.database.shared.model import DailyRevenue, Orders
+from services.sales_aggregation import GRANULARITIES, truncate_date, next_bucket
+
+logger = logging.getLogger(__name__)
+
+
+def _day_start(day: date) -> datetime:
+    """汇总行的日期键：当天零点"""
+    return datetime.combine(day, time.min)
+
+
+def _order_day(order: Orders) -> date:
+    return (order.created_at or datetime.now()).date()
+
+
+def _lock_day_row(db: Session, store_id: int, day: date) -> DailyRevenue:
+    """
+    获取并锁定 (store_id, 日期) 汇总行，不存在时先插入零值行
+
+    INSERT ... ON CONFLICT DO NOTHING + SELECT ... FOR UPDATE，
+    并发事件对同一行的更新会串行执行，不会丢失计数。
+    """
+    day_start = _day_start(day)
+    db.execute(
+        insert(DailyRevenue).values(
+            store_id=store_id,
+            date=day_start,
+            total_orders=0,
+            total_amount=0.0,
+            total_discount=0.0,
+            total_refund=0.0,
+            net_revenue=0.0,
+            paid_orders=0,
+            paid_amount=0.0,
+            cancelled_orders=0,
+            payment_methods={},
+            peak_hours={},
+        ).on_conflict_do_nothing(constraint='daily_revenue_store_date_key')
+    )
+    row = db.query(DailyRevenue).filter(
+        DailyRevenue.store_id == store_id,
+        DailyRevenue.date == day_start
+    ).with_for_update().one()
+    row.updated_at = datetime.now()
+    return row
+
+
+def _add_payment(row: DailyRevenue, method: Optional[str], amount: float, count: int = 1):
+    """累加已支付订单数/金额及支付方式分布"""
+    # JSON 字段不会追踪原地修改，必须整体重新赋值
+    methods = dict(row.payment_methods or {})
+    key = method or 'unknown'
+    stats = dict(methods.get(key) or {"count": 0, "amount": 0.0})
+    stats["count"] += count
+    stats["amount"] = round(stats["amount"] + amount, 2)
+    methods[key] = stats
+    row.payment_methods = methods
+    row.paid_orders += count
+    row.paid_amount += amount
+
+
+# ============ 增量事件 ============
+
+def record_order_created(db: Session, order: Orders):
+    """订单创建：计入当日订单数、金额和高峰时段（已支付订单同时计入支付）"""
+    row = _lock_day_row(db, order.store_id, _order_day(order))
+    row.total_orders += 1
+    row.total_amount += order.total_amount or 0.0
+    row.total_discount += order.discount_amount or 0.0
+    row.net_revenue += order.final_amount or 0.0
+
+    hours = dict(row.peak_hours or {})
+    hour = str((order.created_at or datetime.now()).hour)
+    hours[hour] = hours.get(hour, 0) + 1
+    row.peak_hours = hours
+
+    if order.payment_status == 'paid':
+        _add_payment(row, order.payment_method, order.final_amount or 0.0)
+
+    if order.order_status == 'cancelled':
+        row.cancelled_orders += 1
+        row.total_refund += order.final_amount or 0.0
+        row.net_revenue -= order.final_amount or 0.0
+
+
+def record_order_paid(db: Session, order: Orders):
+    """订单支付完成（unpaid -> paid）"""
+    row = _lock_day_row(db, order.store_id, _order_day(order))
+    _add_payment(row, order.payment_method, order.final_amount or 0.0)
+
+
+def record_order_status_change(db: Session, order: Orders, old_status: str):
+    """订单状态变化：只有进入/离开 cancelled 会影响汇总"""
+    new_status = order.order_status
+    if (old_status == 'cancelled') == (new_status == 'cancelled'):
+        return
+
+    sign = 1 if new_status == 'cancelled' else -1
+    amount = order.final_amount or 0.0
+    row = _lock_day_row(db, order.store_id, _order_day(order))
+    row.cancelled_orders += sign
+    row.total_refund += sign * amount
+    row.net_revenue -= sign * amount
+
+
+def record_amount_change(db: Session, order: Orders, old_total: float, old_final: float):
+    """订单金额变化（如取消单个菜品后重算金额）"""
+    delta_total = (order.total_amount or 0.0) - (old_total or 0.0)
+    delta_final = (order.final_amount or 0.0) - (old_final or 0.0)
+    if not delta_total and not delta_final:
+        return
+
+    row = _lock_day_row(db, order.store_id, _order_day(order))
+    row.total_amount += delta_total
+    if order.order_status == 'cancelled':
+        row.total_refund += delta_final
+    else:
+        row.net_revenue += delta_final
+    if order.payment_status == 'paid':
+        _add_payment(row, order.payment_method, delta_final, count=0)
+
+
+def apply_event(db: Session, handler, *args):
+    """
+    在已提交的会话上应用一个汇总事件（单独的短事务）
+
+    汇总失败不影响业务本身，只记录错误；遗漏的数据可通过 rebuild_daily_revenue 修复。
+    事件在 SAVEPOINT 中执行，失败时只回滚 SAVEPOINT：会话整体回滚会让会话中的全部对象过期，
+    调用方随后访问订单等对象的属性会重新查询（AsyncSession 下直接抛 MissingGreenlet）。
+    """
+    try:
+        with db.begin_nested():
+            handler(db, *args)
+    except Exception as e:
+        logger.error(f"更新每日营收汇总失败: {str(e)}")
+    try:
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"提交每日营收汇总失败: {str(e)}")
+
+
+async def apply_event_async(db, handler, *args):
+    """
+    apply_event 的 AsyncSession 版本
+
+    事件处理函数通过 run_sync 在异步连接上执行，复用同一套同步逻辑；同样只回滚 SAVEPOINT。
+    """
+    try:
+        async with db.begin_nested():
+            await db.run_sync(handler, *args)
+    except Exception as e:
+        logger.error(f"更新每日营收汇总失败: {str(e)}")
+    try:
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        logger.error(f"提交每日营收汇总失败: {str(e)}")
+
+
+# ============ 重算 / 回填 ============
+
+def rebuild_daily_revenue(
+    db: Session,
+    start_date: date,
+    end_date: date,
+    store_id: Optional[int] = None,
+) -> int:
+    """
+    从订单表重算 [start_date, end_date] 区间的汇总行（调用方负责提交）
+
+    三条分组查询（按日汇总、按小时、按支付方式）完成整个区间，
+    然后删除区间内旧的汇总行并批量写入新行。
+
+    Returns:
+        写入的汇总行数
+    """
+    start = _day_start(start_date)
+    end = _day_start(end_date + timedelta(days=1))
+    filters = [Orders.created_at >= start, Orders.created_at < end]
+    if store_id is not None:
+        filters.append(Orders.store_id == store_id)
+
+    day = func.date_trunc('day', Orders.created_at)
+    cancelled = Orders.order_status == 'cancelled'
+    paid = Orders.payment_status == 'paid'
+
+    totals = db.query(
+        Orders.store_id,
+        day,
+        func.count(Orders.id),
+        func.coalesce(func.sum(Orders.total_amount), 0.0),
+        func.coalesce(func.sum(Orders.discount_amount), 0.0),
+        func.count(case((cancelled, Orders.id))),
+        func.coalesce(func.sum(case((cancelled, Orders.final_amount), else_=0.0)), 0.0),
+        func.coalesce(func.sum(case((cancelled, 0.0), else_=Orders.final_amount)), 0.0),
+        func.count(case((paid, Orders.id))),
+        func.coalesce(func.sum(case((paid, Orders.final_amount), else_=0.0)), 0.0),
+    ).filter(*filters).group_by(Orders.store_id, day).all()
+
+    hour = func.extract('hour', Orders.created_at)
+    hourly = db.query(
+        Orders.store_id, day, hour, func.count(Orders.id)
+    ).filter(*filters).group_by(Orders.store_id, day, hour).all()
+
+    method = func.coalesce(Orders.payment_method, 'unknown')
+    methods = db.query(
+        Orders.store_id, day, method,
+        func.count(Orders.id),
+        func.coalesce(func.sum(Orders.final_amount), 0.0),
+    ).filter(*filters, paid).group_by(Orders.store_id, day, method).all()
+
+    peak_hours: Dict[Tuple[int, date], Dict[str, int]] = {}
+    for sid, bucket, h, count in hourly:
+        peak_hours.setdefault((sid, bucket.date()), {})[str(int(h))] = int(count)
+
+    payment_methods: Dict[Tuple[int, date], Dict[str, dict]] = {}
+    for sid, bucket, name, count, amount in methods:
+        payment_methods.setdefault((sid, bucket.date()), {})[name or 'unknown'] = {
+            "count": int(count), "amount": round(float(amount), 2)
+        }
+
+    delete_query = db.query(DailyRevenue).filter(
+        DailyRevenue.date >= start,
+        DailyRevenue.date < end
+    )
+    if store_id is not None:
+        delete_query = delete_query.filter(DailyRevenue.store_id == store_id)
+    delete_query.delete(synchronize_session=False)
+
+    now = datetime.now()
+    rows = []
+    for (sid, bucket, orders_count, total_amount, total_discount, cancelled_count,
+         refund, net_revenue, paid_count, paid_amount) in totals:
+        key = (sid, bucket.date())
+        rows.append({
+            "store_id": sid,
+            "date": _day_start(bucket.date()),
+            "total_orders": int(orders_count),
+            "total_amount": float(total_amount),
+            "total_discount": float(total_discount),
+            "total_refund": float(refund),
+            "net_revenue": float(net_revenue),
+            "paid_orders": int(paid_count),
+            "paid_amount": float(paid_amount),
+            "cancelled_orders": int(cancelled_count),
+            "payment_methods": payment_methods.get(key, {}),
+            "peak_hours": peak_hours.get(key, {}),
+            "updated_at": now,
+        })
+
+    if rows:
+        db.execute(insert(DailyRevenue), rows)
+
+    logger.info(f"重算每日营收汇总: {start_date} ~ {end_date}, store_id={store_id}, 写入 {len(rows)} 行")
+    return len(rows)
+
+
+# ============ 读取 ============
+
+def load_daily_revenue(
+    db: Session,
+    start_date: date,
+    end_date: date,
+    store_id: Optional[int] = None,
+) -> List[DailyRevenue]:
+    """读取 [start_date, end_date] 区间的汇总行（走 ix_daily_revenue_store_date 索引）"""
+    query = db.query(DailyRevenue).filter(
+        DailyRevenue.date >= _day_start(start_date),
+        DailyRevenue.date < _day_start(end_date + timedelta(days=1))
+    )
+    if store_id is not None:
+        query = query.filter(DailyRevenue.store_id == store_id)
+    return query.order_by(DailyRevenue.date, DailyRevenue.store_id).all()
+
+
+def rollup_revenue_series(
+    db: Session,
+    store_id: int,
+    start_date: date,
+    end_date: date,
+    granularity: str = "day",
+) -> List[Tuple[date, int, float]]:
+    """
+    基于汇总表的营收趋势，口径与 sales_aggregation.revenue_series 一致（排除已取消订单）
+
+    Returns:
+        [(桶起始日期, 订单数, 实收金额), ...]，按日期升序，空桶补零
+    """
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"不支持的时间粒度: {granularity}")
+
+    buckets: Dict[date, Tuple[int, float]] = {}
+    for row in load_daily_revenue(db, start_date, end_date, store_id):
+        key = truncate_date(row.date.date(), granularity)
+        count, revenue = buckets.get(key, (0, 0.0))
+        buckets[key] = (
+            count + row.total_orders - row.cancelled_orders,
+            revenue + float(row.net_revenue),
+        )
+
+    result = []
+    current = truncate_date(start_date, granularity)
+    while current <= end_date:
+        count, revenue = buckets.get(current, (0, 0.0))
+        result.append((current, count, revenue))
+        current = next_bucket(current, granularity)
+    return result
+
+
+def merge_payment_methods(rows: List[DailyRevenue]) -> Dict[str, dict]:
+    """合并多行的支付方式统计"""
+    merged: Dict[str, dict] = {}
+    for row in rows:
+        for name, stats in (row.payment_methods or {}).items():
+            target = merged.setdefault(name, {"count": 0, "amount": 0.0})
+            target["count"] += stats.get("count", 0)
+            target["amount"] = round(target["amount"] + stats.get("amount", 0.0), 2)
+    return merged
+
+
+__all__ = [
+    "record_order_created",
+    "record_order_paid",
+    "record_order_status_change",
+    "record_amount_change",
+    "apply_event",
+    "apply_event_async",
+    "rebuild_daily_revenue",
+    "load_daily_revenue",
+    "rollup_revenue_series",
+    "merge_payment_methods",
+]
@@ -0,0 +1,288 @@
+"""
+营收聚合查询服务
+把 SUM/COUNT/GROUP BY 下推到数据库执行，只返回紧凑的元组结果，
+避免把整段时间的订单 ORM 对象全部加载到 Python 里累加。
+
+所有时间过滤都使用半开区间 [start, end)，直接比较 created_at 字段，
+可以命中 ix_orders_store_created 索引（func.date(created_at) 会让索引失效）。
+"""
+from datetime import date, datetime, time, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from storage.database.shared.model import (
+    Orders, OrderItems, MenuItems, MenuCategories, Payments
+)
+
+# 趋势查询支持的时间粒度（与 Postgres date_trunc 的字段名一致）
+GRANULARITIES = ("day", "week", "month")
+
+
+def day_bounds(start_date: date, end_date: date) -> Tuple[datetime, datetime]:
+    """
+    将闭区间日期 [start_date, end_date] 转换为半开时间区间 [start, end)
+    """
+    start = datetime.combine(start_date, time.min)
+    end = datetime.combine(end_date + timedelta(days=1), time.min)
+    return start, end
+
+
+def _order_filters(store_id: int, start: datetime, end: datetime, exclude_cancelled: bool = True):
+    """订单通用过滤条件：店铺 + 半开时间区间（+ 排除已取消）"""
+    filters = [
+        Orders.store_id == store_id,
+        Orders.created_at >= start,
+        Orders.created_at < end,
+    ]
+    if exclude_cancelled:
+        filters.append(Orders.order_status != 'cancelled')
+    return filters
+
+
+def revenue_totals(db: Session, store_id: int, start: datetime, end: datetime) -> Tuple[int, float, float, float]:
+    """
+    营收汇总
+
+    Returns:
+        (订单数, 订单总额, 折扣总额, 实收总额)
+    """
+    row = db.query(
+        func.count(Orders.id),
+        func.coalesce(func.sum(Orders.total_amount), 0.0),
+        func.coalesce(func.sum(Orders.discount_amount), 0.0),
+        func.coalesce(func.sum(Orders.final_amount), 0.0),
+    ).filter(*_order_filters(store_id, start, end)).one()
+
+    return int(row[0]), float(row[1]), float(row[2]), float(row[3])
+
+
+def payment_method_totals(db: Session, store_id: int, start: datetime, end: datetime) -> List[Tuple[str, int, float]]:
+    """
+    按支付方式统计成功支付
+
+    Returns:
+        [(支付方式, 笔数, 金额), ...]，按金额倒序
+    """
+    amount = func.coalesce(func.sum(Payments.amount), 0.0)
+    rows = db.query(
+        Payments.payment_method,
+        func.count(Payments.id),
+        amount,
+    ).join(Orders, Orders.id == Payments.order_id).filter(
+        Orders.store_id == store_id,
+        Payments.created_at >= start,
+        Payments.created_at < end,
+        Payments.status == 'success',
+    ).group_by(Payments.payment_method).order_by(amount.desc()).all()
+
+    return [(method, int(count), float(total)) for method, count, total in rows]
+
+
+def menu_item_sales(
+    db: Session,
+    store_id: int,
+    start: datetime,
+    end: datetime,
+    limit: Optional[int] = None,
+) -> List[Tuple[int, str, int, float, Optional[str]]]:
+    """
+    菜品销量统计（按菜品ID+快照名称分组，排序和截断都在数据库完成）
+
+    Returns:
+        [(菜品ID, 菜品名称, 销量, 销售额, 分类名称), ...]，按销量倒序
+    """
+    menu_item_id = func.coalesce(OrderItems.menu_item_id, 0)
+    quantity = func.coalesce(func.sum(OrderItems.quantity), 0)
+
+    query = db.query(
+        menu_item_id,
+        OrderItems.menu_item_name,
+        quantity,
+        func.coalesce(func.sum(OrderItems.subtotal), 0.0),
+        func.max(MenuCategories.name),
+    ).join(
+        Orders, Orders.id == OrderItems.order_id
+    ).outerjoin(
+        MenuItems, MenuItems.id == OrderItems.menu_item_id
+    ).outerjoin(
+        MenuCategories, MenuCategories.id == MenuItems.category_id
+    ).filter(
+        *_order_filters(store_id, start, end)
+    ).group_by(
+        menu_item_id, OrderItems.menu_item_name
+    ).order_by(quantity.desc())
+
+    if limit:
+        query = query.limit(limit)
+
+    return [
+        (int(item_id), name, int(qty), float(revenue), category_name)
+        for item_id, name, qty, revenue, category_name in query.all()
+    ]
+
+
+def inventory_sales(
+    db: Session,
+    start: datetime,
+    end: datetime,
+    store_id: Optional[int] = None,
+) -> List[Tuple[int, str, Optional[str], int, float, int]]:
+    """
+    库存与销量（一条查询：菜品 LEFT JOIN 分类和按 menu_item_id 分组的区间销量子查询）
+
+    store_id 为空时统计全部店铺；销量不含已取消订单（取消时库存已恢复）。
+
+    Returns:
+        [(菜品ID, 菜品名称, 分类名称, 库存, 价格, 销量), ...]，按菜品ID排序
+    """
+    order_filters = [
+        Orders.created_at >= start,
+        Orders.created_at < end,
+        Orders.order_status != 'cancelled',
+    ]
+    if store_id:
+        order_filters.append(Orders.store_id == store_id)
+
+    sold = db.query(
+        OrderItems.menu_item_id.label("menu_item_id"),
+        func.sum(OrderItems.quantity).label("quantity"),
+    ).join(
+        Orders, Orders.id == OrderItems.order_id
+    ).filter(
+        *order_filters
+    ).group_by(OrderItems.menu_item_id).subquery()
+
+    query = db.query(
+        MenuItems.id,
+        MenuItems.name,
+        MenuCategories.name,
+        MenuItems.stock,
+        MenuItems.price,
+        func.coalesce(sold.c.quantity, 0),
+    ).outerjoin(
+        MenuCategories, MenuCategories.id == MenuItems.category_id
+    ).outerjoin(
+        sold, sold.c.menu_item_id == MenuItems.id
+    )
+    if store_id:
+        query = query.filter(MenuItems.store_id == store_id)
+
+    return [
+        (item_id, name, category_name, stock, float(price), int(qty))
+        for item_id, name, category_name, stock, price, qty in query.order_by(MenuItems.id).all()
+    ]
+
+
+def hourly_sales(db: Session, store_id: int, start: datetime, end: datetime) -> List[Tuple[datetime, int, float]]:
+    """
+    按小时统计订单（date_trunc('hour')）
+
+    Returns:
+        [(整点时间, 订单数, 实收金额), ...]，只包含有订单的小时
+    """
+    hour = func.date_trunc('hour', Orders.created_at)
+    rows = db.query(
+        hour,
+        func.count(Orders.id),
+        func.coalesce(func.sum(Orders.final_amount), 0.0),
+    ).filter(
+        *_order_filters(store_id, start, end)
+    ).group_by(hour).order_by(hour).all()
+
+    return [(bucket, int(count), float(revenue)) for bucket, count, revenue in rows]
+
+
+def order_status_totals(db: Session, store_id: int, start: datetime, end: datetime) -> List[Tuple[str, int, float]]:
+    """
+    按订单状态统计（包含已取消订单）
+
+    Returns:
+        [(订单状态, 订单数, 实收金额), ...]
+    """
+    rows = db.query(
+        Orders.order_status,
+        func.count(Orders.id),
+        func.coalesce(func.sum(Orders.final_amount), 0.0),
+    ).filter(
+        *_order_filters(store_id, start, end, exclude_cancelled=False)
+    ).group_by(Orders.order_status).all()
+
+    return [(status, int(count), float(amount)) for status, count, amount in rows]
+
+
+def truncate_date(value: date, granularity: str) -> date:
+    """按粒度截断日期，与 date_trunc 语义一致（周从周一开始）"""
+    if granularity == "week":
+        return value - timedelta(days=value.weekday())
+    if granularity == "month":
+        return value.replace(day=1)
+    return value
+
+
+def next_bucket(value: date, granularity: str) -> date:
+    """下一个时间桶的起始日期"""
+    if granularity == "week":
+        return value + timedelta(days=7)
+    if granularity == "month":
+        return (value.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return value + timedelta(days=1)
+
+
+def revenue_series(
+    db: Session,
+    store_id: int,
+    start_date: date,
+    end_date: date,
+    granularity: str = "day",
+) -> List[Tuple[date, int, float]]:
+    """
+    营收趋势（一条 GROUP BY date_trunc 查询返回整个区间）
+
+    数据库只返回有订单的时间桶，空桶在 Python 中按粒度补零，
+    所以结果是连续的时间序列，长度为 O(桶数) 而不是 O(订单数)。
+
+    Returns:
+        [(桶起始日期, 订单数, 实收金额), ...]，按日期升序
+    """
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"不支持的时间粒度: {granularity}")
+
+    start, end = day_bounds(start_date, end_date)
+    bucket = func.date_trunc(granularity, Orders.created_at)
+    rows = db.query(
+        bucket,
+        func.count(Orders.id),
+        func.coalesce(func.sum(Orders.final_amount), 0.0),
+    ).filter(
+        *_order_filters(store_id, start, end)
+    ).group_by(bucket).all()
+
+    buckets: Dict[date, Tuple[int, float]] = {
+        bucket_start.date(): (int(count), float(revenue))
+        for bucket_start, count, revenue in rows
+    }
+
+    result = []
+    current = truncate_date(start_date, granularity)
+    while current <= end_date:
+        count, revenue = buckets.get(current, (0, 0.0))
+        result.append((current, count, revenue))
+        current = next_bucket(current, granularity)
+    return result
+
+
+__all__ = [
+    "GRANULARITIES",
+    "truncate_date",
+    "next_bucket",
+    "revenue_series",
+    "day_bounds",
+    "revenue_totals",
+    "payment_method_totals",
+    "menu_item_sales",
+    "inventory_sales",
+    "hourly_sales",
+    "order_status_totals",
+]
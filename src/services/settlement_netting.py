@@ -0,0 +1,225 @@
+"""
+跨店铺积分结算轧差
+每个结算周期结束后执行一次：
+1. 一条 UPDATE ... RETURNING 把周期结束前的全部 pending 结算记录标记为 completed，
+   同一语句内按 (来源店铺, 目标店铺) 汇总，得到店铺间应付矩阵
+2. 对每对店铺轧差（A->B 与 B->A 相抵），只写一条净额划转记录
+3. 按该周期结算的第三方协议更新 last_settlement_date
+
+结算记录的方向：会员在目标店铺消费、使用来源店铺的积分，来源店铺欠目标店铺 settlement_amount。
+周期内遗漏的历史 pending 记录会在下一次执行时一并结算，重复执行不会重复结算。
+"""
+import logging
+import os
+from datetime import datetime, time, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func, or_, select, update
+from sqlalchemy.orm import Session
+
+from storage.database.shared.model import (
+    StorePointSettlements, StoreSettlementTransfers, ThirdPartyPointAgreements
+)
+
+logger = logging.getLogger(__name__)
+
+SETTLEMENT_CYCLES = ("daily", "weekly", "monthly")
+# 店铺间结算的默认周期
+STORE_SETTLEMENT_CYCLE = os.getenv("STORE_SETTLEMENT_CYCLE", "daily")
+
+
+class Obligation:
+    """一对店铺之间单方向的应付汇总"""
+
+    __slots__ = ("points", "amount", "count")
+
+    def __init__(self, points: int = 0, amount: float = 0.0, count: int = 0):
+        self.points = points
+        self.amount = amount
+        self.count = count
+
+
+class NetTransfer:
+    """轧差后的净额划转：from_store 应付 to_store"""
+
+    __slots__ = ("from_store_id", "to_store_id", "net_points", "net_amount", "settlement_count")
+
+    def __init__(self, from_store_id: int, to_store_id: int, net_points: int, net_amount: float, settlement_count: int):
+        self.from_store_id = from_store_id
+        self.to_store_id = to_store_id
+        self.net_points = net_points
+        self.net_amount = net_amount
+        self.settlement_count = settlement_count
+
+
+def cycle_period(cycle: str, now: Optional[datetime] = None) -> Tuple[datetime, datetime]:
+    """
+    now 之前最近一个已结束的结算周期: [开始, 结束)
+
+    daily: 昨天；weekly: 上周一至本周一；monthly: 上月一日至本月一日
+    """
+    if cycle not in SETTLEMENT_CYCLES:
+        raise ValueError(f"不支持的结算周期: {cycle}")
+    today = (now or datetime.now()).date()
+    if cycle == "daily":
+        end = today
+        start = end - timedelta(days=1)
+    elif cycle == "weekly":
+        end = today - timedelta(days=today.weekday())
+        start = end - timedelta(days=7)
+    else:
+        end = today.replace(day=1)
+        start = (end - timedelta(days=1)).replace(day=1)
+    return datetime.combine(start, time.min), datetime.combine(end, time.min)
+
+
+def net_obligations(matrix: Dict[Tuple[int, int], Obligation]) -> List[NetTransfer]:
+    """
+    对店铺应付矩阵轧差: {(来源店铺, 目标店铺): Obligation} -> 净额划转列表
+
+    每对店铺最多一条记录，方向由净金额决定（金额相等时按净积分），双向完全抵消的店铺对不产生记录。
+    net_amount、net_points 都不为负：积分按划转方向轧差，两个方向的积分汇率不同、
+    净积分与净金额方向相反时，该划转的 net_points 记为 0（结算以金额为准）。
+    """
+    transfers = []
+    for (a, b), forward in matrix.items():
+        backward = matrix.get((b, a))
+        if backward is not None and (b, a) < (a, b):
+            # 反方向的店铺对已经处理过
+            continue
+        backward = backward or Obligation()
+        # + 0.0 把 -0.0 归一为 0.0
+        net_amount = round(forward.amount - backward.amount, 2) + 0.0
+        net_points = forward.points - backward.points
+        count = forward.count + backward.count
+        if net_amount == 0 and net_points == 0:
+            continue
+        if net_amount < 0 or (net_amount == 0 and net_points < 0):
+            a, b, net_amount, net_points = b, a, -net_amount + 0.0, -net_points
+        transfers.append(NetTransfer(a, b, max(net_points, 0), net_amount, count))
+    transfers.sort(key=lambda t: (t.from_store_id, t.to_store_id))
+    return transfers
+
+
+def claim_obligations(db: Session, period_end: datetime, completed_at: datetime) -> Dict[Tuple[int, int], Obligation]:
+    """
+    把 period_end 之前的 pending 结算记录标记为 completed，并返回按店铺对汇总的应付矩阵
+
+    标记和汇总在同一条语句中完成（UPDATE ... RETURNING 作为 CTE），
+    并发执行时已被其他事务领取的记录不会重复计入。
+    """
+    table = StorePointSettlements.__table__
+    claimed = update(table).where(
+        table.c.status == "pending",
+        table.c.settlement_date < period_end
+    ).values(
+        status="completed",
+        completed_at=completed_at,
+        updated_at=completed_at
+    ).returning(
+        table.c.source_store_id,
+        table.c.target_store_id,
+        table.c.points,
+        table.c.settlement_amount
+    ).cte("claimed")
+
+    rows = db.execute(
+        select(
+            claimed.c.source_store_id,
+            claimed.c.target_store_id,
+            func.sum(claimed.c.points).label("points"),
+            func.coalesce(func.sum(claimed.c.settlement_amount), 0).label("amount"),
+            func.count().label("count")
+        ).group_by(claimed.c.source_store_id, claimed.c.target_store_id)
+    ).all()
+
+    return {
+        (row.source_store_id, row.target_store_id): Obligation(int(row.points or 0), float(row.amount), row.count)
+        for row in rows
+    }
+
+
+def settle_period(
+    db: Session,
+    cycle: str,
+    period_start: datetime,
+    period_end: datetime,
+    now: Optional[datetime] = None,
+) -> dict:
+    """
+    结算一个周期（不提交事务）：领取并完成结算记录、写入净额划转、更新该周期协议的结算日期
+
+    Returns:
+        本次结算的汇总
+    """
+    now = now or datetime.now()
+    matrix = claim_obligations(db, period_end, now)
+    transfers = net_obligations(matrix)
+
+    if transfers:
+        db.execute(StoreSettlementTransfers.__table__.insert(), [
+            {
+                "cycle": cycle,
+                "period_start": period_start,
+                "period_end": period_end,
+                "from_store_id": t.from_store_id,
+                "to_store_id": t.to_store_id,
+                "net_points": t.net_points,
+                "net_amount": t.net_amount,
+                "settlement_count": t.settlement_count,
+                "status": "pending",
+                "updated_at": now,
+            }
+            for t in transfers
+        ])
+
+    # 第三方协议按各自的结算周期推进结算日期
+    agreements_closed = db.execute(
+        update(ThirdPartyPointAgreements).where(
+            ThirdPartyPointAgreements.settlement_cycle == cycle,
+            ThirdPartyPointAgreements.status == "active",
+            or_(
+                ThirdPartyPointAgreements.last_settlement_date.is_(None),
+                ThirdPartyPointAgreements.last_settlement_date < period_end
+            )
+        ).values(last_settlement_date=period_end, updated_at=now).execution_options(synchronize_session=False)
+    ).rowcount
+
+    settled = sum(o.count for o in matrix.values())
+    summary = {
+        "cycle": cycle,
+        "period_start": period_start,
+        "period_end": period_end,
+        "settlements_completed": settled,
+        "store_pairs": len(matrix),
+        "transfers": len(transfers),
+        "total_points": sum(o.points for o in matrix.values()),
+        "net_points": sum(t.net_points for t in transfers),
+        "net_amount": round(sum(t.net_amount for t in transfers), 2),
+        "agreements_closed": agreements_closed,
+    }
+    logger.info(
+        f"店铺结算 {cycle} {period_start:%Y-%m-%d}~{period_end:%Y-%m-%d}: "
+        f"{settled} 条记录 -> {len(transfers)} 条净额划转"
+    )
+    return summary
+
+
+def run_settlement_cycle(db: Session, cycle: Optional[str] = None, now: Optional[datetime] = None) -> dict:
+    """结算 now 之前最近一个已结束的周期（不提交事务）"""
+    cycle = cycle or STORE_SETTLEMENT_CYCLE
+    period_start, period_end = cycle_period(cycle, now)
+    return settle_period(db, cycle, period_start, period_end, now)
+
+
+__all__ = [
+    "SETTLEMENT_CYCLES",
+    "STORE_SETTLEMENT_CYCLE",
+    "Obligation",
+    "NetTransfer",
+    "cycle_period",
+    "net_obligations",
+    "claim_obligations",
+    "settle_period",
+    "run_settlement_cycle",
+]
@@ -0,0 +1,233 @@
+"""
+桌台占用状态服务
+楼面图（桌号列表 + 是否有进行中的订单）按店铺缓存在进程内，刷新楼面图只读缓存：
+- load_store_occupancy 用一条 LEFT JOIN + GROUP BY 查询取回店铺全部桌台及其进行中的订单
+- 订单创建 / 状态变化 / 支付完成后调用 record_order_event 增量更新缓存，
+  返回的 table_state 消息经 ws_hub 推送到店铺房间
+- 其他 worker 发布的 table_state 消息由 apply_table_message 应用到本进程的缓存（按订单 ID 幂等）
+- 同步路由（顾客端下单、店员端改状态）调用 publish_order_event，经 ws_hub.publish_sync 通知所有 worker
+- 缓存最多保留 OCCUPANCY_CACHE_TTL 秒，兜底覆盖其他服务进程（顾客端、店员端）产生的订单变化；
+  桌台增删改后调用 invalidate_store_tables 立即失效
+"""
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional
+
+from sqlalchemy import and_, func
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.orm import Session
+
+from storage.database.db import get_session
+from storage.database.shared.model import Orders, Tables
+from services.ws_hub import publish_sync, room_name
+
+# 占用缓存的存活时间（秒）
+OCCUPANCY_CACHE_TTL = float(os.getenv("OCCUPANCY_CACHE_TTL", "15"))
+
+# 进行中的订单状态（桌台视为占用）
+ACTIVE_ORDER_STATUSES = ("pending", "confirmed", "preparing", "ready", "serving")
+
+# 推送到店铺房间的桌台状态消息类型
+TABLE_STATE_MESSAGE = "table_state"
+
+
+class TableState:
+    """一张桌台及其进行中的订单"""
+
+    __slots__ = ("table_id", "table_number", "table_name", "seats", "is_active", "orders")
+
+    def __init__(self, table_id: int, table_number: str, table_name: Optional[str], seats: int, is_active: bool,
+                 orders: Optional[Dict[int, str]] = None):
+        self.table_id = table_id
+        self.table_number = table_number
+        self.table_name = table_name
+        self.seats = seats
+        self.is_active = is_active
+        # 进行中的订单: {订单ID: 订单状态}
+        self.orders: Dict[int, str] = orders or {}
+
+    @property
+    def is_occupied(self) -> bool:
+        return bool(self.orders)
+
+    @property
+    def current_order_id(self) -> Optional[int]:
+        """最近的进行中订单"""
+        return max(self.orders) if self.orders else None
+
+    @property
+    def current_order_status(self) -> Optional[str]:
+        order_id = self.current_order_id
+        return self.orders[order_id] if order_id is not None else None
+
+    def apply(self, order_id: int, status: str):
+        """应用一个订单事件：进行中的订单记录状态，已完成 / 已取消的移除"""
+        if status in ACTIVE_ORDER_STATUSES:
+            self.orders[order_id] = status
+        else:
+            self.orders.pop(order_id, None)
+
+    def as_dict(self) -> dict:
+        return {
+            "id": self.table_id,
+            "table_number": self.table_number,
+            "table_name": self.table_name,
+            "seats": self.seats,
+            "is_active": self.is_active,
+            "is_occupied": self.is_occupied,
+            "active_orders": len(self.orders),
+            "current_order_id": self.current_order_id,
+            "current_order_status": self.current_order_status
+        }
+
+
+class StoreOccupancy:
+    """一个店铺的桌台占用状态"""
+
+    def __init__(self, store_id: int, tables: Iterable[TableState]):
+        self.store_id = store_id
+        self.tables: Dict[int, TableState] = {t.table_id: t for t in tables}
+        self.loaded_at = time.monotonic()
+
+    def is_fresh(self) -> bool:
+        return time.monotonic() - self.loaded_at < OCCUPANCY_CACHE_TTL
+
+    def list(self) -> List[dict]:
+        """按桌号排序的桌台状态"""
+        with _lock:
+            return [t.as_dict() for t in sorted(self.tables.values(), key=lambda t: t.table_number)]
+
+
+_stores: Dict[int, StoreOccupancy] = {}
+# 每个店铺的失效次数，加载期间发生失效的结果不写入缓存
+_generations: Dict[int, int] = {}
+_lock = threading.Lock()
+
+
+def load_store_occupancy(db: Session, store_id: int) -> List[TableState]:
+    """一条查询加载店铺全部桌台及各桌进行中的订单（桌台 LEFT JOIN 进行中订单，按桌台分组）"""
+    order_ids = func.array_agg(aggregate_order_by(Orders.id, Orders.id)).filter(Orders.id.isnot(None))
+    order_statuses = func.array_agg(aggregate_order_by(Orders.order_status, Orders.id)).filter(Orders.id.isnot(None))
+    rows = db.query(
+        Tables.id,
+        Tables.table_number,
+        Tables.table_name,
+        Tables.seats,
+        Tables.is_active,
+        order_ids.label("order_ids"),
+        order_statuses.label("order_statuses")
+    ).outerjoin(
+        Orders,
+        and_(Orders.table_id == Tables.id, Orders.order_status.in_(ACTIVE_ORDER_STATUSES))
+    ).filter(
+        Tables.store_id == store_id
+    ).group_by(Tables.id).all()
+
+    return [
+        TableState(
+            row.id, row.table_number, row.table_name, row.seats, row.is_active,
+            dict(zip(row.order_ids or [], row.order_statuses or []))
+        )
+        for row in rows
+    ]
+
+
+def get_store_occupancy(
+    store_id: int,
+    db: Optional[Session] = None,
+    session_factory: Callable[[], Session] = get_session,
+) -> StoreOccupancy:
+    """获取店铺的桌台占用状态，缓存命中时不访问数据库（未传 db 时按需创建会话）"""
+    occupancy = _stores.get(store_id)
+    if occupancy is not None and occupancy.is_fresh():
+        return occupancy
+
+    generation = _generations.get(store_id, 0)
+    own_session = db is None
+    if own_session:
+        db = session_factory()
+    try:
+        tables = load_store_occupancy(db, store_id)
+    finally:
+        if own_session:
+            db.close()
+
+    occupancy = StoreOccupancy(store_id, tables)
+    with _lock:
+        if _generations.get(store_id, 0) == generation:
+            _stores[store_id] = occupancy
+    return occupancy
+
+
+def invalidate_store_tables(store_id: int):
+    """桌台增删改后使店铺缓存失效，下次访问时重新加载"""
+    with _lock:
+        _generations[store_id] = _generations.get(store_id, 0) + 1
+        _stores.pop(store_id, None)
+
+
+def record_order_event(store_id: int, table_id: Optional[int], order_id: int, status: str) -> Optional[dict]:
+    """
+    订单创建 / 状态变化 / 支付后更新本进程的占用缓存
+
+    返回要推送到店铺房间的 table_state 消息；订单没有桌号时返回 None。
+    店铺未缓存时不加载，消息中 table 为 None，只携带订单事件。
+    """
+    if not store_id or not table_id:
+        return None
+    table = None
+    with _lock:
+        occupancy = _stores.get(store_id)
+        state = occupancy.tables.get(table_id) if occupancy is not None else None
+        if state is not None:
+            state.apply(order_id, status)
+            table = state.as_dict()
+    return {
+        "type": TABLE_STATE_MESSAGE,
+        "store_id": store_id,
+        "order": {"id": order_id, "table_id": table_id, "status": status},
+        "table": table,
+        "timestamp": datetime.now().isoformat()
+    }
+
+
+def publish_order_event(store_id: int, table_id: Optional[int], order_id: int, status: str) -> bool:
+    """
+    同步路由中的订单事件：更新本进程缓存，并把 table_state 消息发布到店铺房间
+
+    其他 worker 收到后经 apply_table_message 更新各自的缓存并推送给楼面图；
+    没有跨进程消息代理时只更新本进程，其他进程依赖 OCCUPANCY_CACHE_TTL 兜底。
+    """
+    message = record_order_event(store_id, table_id, order_id, status)
+    if message is None:
+        return False
+    return publish_sync([room_name("store", store_id)], message)
+
+
+def apply_table_message(message: dict):
+    """应用 broker 转发的 table_state 消息（包括本 worker 发布的，重复应用无副作用）"""
+    order = message.get("order") or {}
+    if order.get("id") is None:
+        return
+    with _lock:
+        occupancy = _stores.get(message.get("store_id"))
+        state = occupancy.tables.get(order.get("table_id")) if occupancy is not None else None
+        if state is not None:
+            state.apply(order["id"], order.get("status"))
+
+
+__all__ = [
+    "OCCUPANCY_CACHE_TTL",
+    "ACTIVE_ORDER_STATUSES",
+    "TABLE_STATE_MESSAGE",
+    "TableState",
+    "StoreOccupancy",
+    "load_store_occupancy",
+    "get_store_occupancy",
+    "invalidate_store_tables",
+    "record_order_event",
+    "publish_order_event",
+    "apply_table_message",
+]
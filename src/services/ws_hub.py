@@ -0,0 +1,604 @@
+"""
+WebSocket 推送中心
+统一管理店铺/订单/桌号等房间的 WebSocket 连接，并通过可插拔的消息代理（broker）
+在多个 uvicorn worker 之间转发 new_order / order_status_update / payment_status_update 等事件。
+
+- InProcessBroker: 进程内直接投递（单 worker，默认）
+- PostgresBroker: 基于 Postgres LISTEN/NOTIFY，每个 worker 监听同一个频道，
+  发布的事件由所有 worker 收到后投递给各自持有的本地连接，无需粘性会话
+
+各 worker 收到消息时还会按消息类型调用 add_listener 注册的回调，
+用于同步进程内缓存（如 table_state 更新桌台占用状态）。
+同步代码（同步路由、顾客端 / 店员端等其他服务进程）用 publish_sync 经同一频道 NOTIFY 发布，
+不需要持有 ConnectionManager。
+
+本地投递时消息只序列化一次，然后放入每个连接独立的有界发送队列，
+由连接各自的 writer 任务发送；慢连接只会积压自己的队列，不会拖慢其他连接
+和触发广播的 HTTP 请求（如 create_order）。
+
+通过环境变量配置：
+  WS_BROKER=memory|postgres（默认 memory）
+  WS_BROKER_DSN（默认使用 PGDATABASE_URL）
+  WS_BROKER_CHANNEL（默认 restaurant_ws）
+  WS_SEND_QUEUE_SIZE 每个连接的发送队列长度（默认 100）
+  WS_BACKPRESSURE 队列满时的策略: drop_oldest | coalesce | disconnect（默认 coalesce）
+  WS_SEND_TIMEOUT 单条消息发送超时秒数，超时视为慢连接并断开（默认 5）
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+from fastapi import WebSocket
+
+logger = logging.getLogger(__name__)
+
+# Postgres NOTIFY 的 payload 上限是 8000 字节
+MAX_NOTIFY_PAYLOAD = 7900
+
+# 背压策略
+BACKPRESSURE_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+# 可以合并的消息类型：同一订单只需要推送最新状态
+COALESCE_TYPES = {
+    "order_status_update": "order",
+    "payment_status_update": "payment",
+    "table_state": "table",
+}
+
+Deliver = Callable[[dict], Awaitable[None]]
+
+
+def room_name(kind: str, key) -> str:
+    """房间名：store:1 / order:1001 / table:5"""
+    return f"{kind}:{key}"
+
+
+# ============ 消息代理 ============
+
+class InProcessBroker:
+    """进程内消息代理：发布即投递，只覆盖当前 worker 的连接"""
+
+    def __init__(self):
+        self._deliver: Optional[Deliver] = None
+
+    async def start(self, deliver: Deliver):
+        self._deliver = deliver
+
+    async def stop(self):
+        self._deliver = None
+
+    async def publish(self, envelope: dict):
+        if self._deliver:
+            await self._deliver(envelope)
+
+
+class PostgresBroker:
+    """
+    Postgres LISTEN/NOTIFY 消息代理
+
+    监听连接注册到事件循环的 add_reader 上，不占用线程；
+    NOTIFY 使用单独的自动提交连接，在线程池中执行，避免阻塞事件循环。
+    本 worker 发布的事件同样经由 LISTEN 收回后再投递，保证各 worker 行为一致。
+    """
+
+    def __init__(self, dsn: str, channel: str = "restaurant_ws"):
+        self.dsn = dsn
+        self.channel = channel
+        self._deliver: Optional[Deliver] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._listen_conn = None
+        self._notify_conn = None
+        self._notify_lock = threading.Lock()
+        self._reconnect_task: Optional[asyncio.Task] = None
+
+    def _connect(self):
+        import psycopg2
+
+        conn = psycopg2.connect(self.dsn)
+        conn.autocommit = True
+        return conn
+
+    async def start(self, deliver: Deliver):
+        self._deliver = deliver
+        self._loop = asyncio.get_running_loop()
+        await self._loop.run_in_executor(None, self._open_listener)
+        logger.info(f"WebSocket broker 已启动: postgres channel={self.channel}")
+
+    def _open_listener(self):
+        conn = self._connect()
+        with conn.cursor() as cursor:
+            cursor.execute(f'LISTEN "{self.channel}"')
+        self._listen_conn = conn
+        self._loop.call_soon_threadsafe(self._loop.add_reader, conn.fileno(), self._on_readable)
+
+    def _close_listener(self):
+        conn, self._listen_conn = self._listen_conn, None
+        if conn is None:
+            return
+        try:
+            self._loop.remove_reader(conn.fileno())
+        except Exception:
+            pass
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _on_readable(self):
+        conn = self._listen_conn
+        if conn is None:
+            return
+        try:
+            conn.poll()
+        except Exception as e:
+            logger.error(f"WebSocket broker 监听连接断开: {str(e)}")
+            self._close_listener()
+            self._schedule_reconnect()
+            return
+
+        while conn.notifies:
+            notify = conn.notifies.pop(0)
+            try:
+                envelope = json.loads(notify.payload)
+            except ValueError:
+                logger.error(f"WebSocket broker 收到无法解析的消息: {notify.payload[:200]}")
+                continue
+            if self._deliver:
+                asyncio.ensure_future(self._deliver(envelope))
+
+    def _schedule_reconnect(self):
+        if self._reconnect_task is None or self._reconnect_task.done():
+            self._reconnect_task = asyncio.ensure_future(self._reconnect())
+
+    async def _reconnect(self):
+        delay = 1
+        while self._deliver is not None:
+            await asyncio.sleep(delay)
+            try:
+                await self._loop.run_in_executor(None, self._open_listener)
+                logger.info("WebSocket broker 监听连接已恢复")
+                return
+            except Exception as e:
+                logger.error(f"WebSocket broker 重连失败: {str(e)}")
+                delay = min(delay * 2, 30)
+
+    async def stop(self):
+        self._deliver = None
+        if self._reconnect_task:
+            self._reconnect_task.cancel()
+        self._close_listener()
+        with self._notify_lock:
+            if self._notify_conn is not None:
+                self._notify_conn.close()
+                self._notify_conn = None
+
+    def _notify(self, payload: str):
+        with self._notify_lock:
+            for attempt in range(2):
+                try:
+                    if self._notify_conn is None or self._notify_conn.closed:
+                        self._notify_conn = self._connect()
+                    with self._notify_conn.cursor() as cursor:
+                        cursor.execute("SELECT pg_notify(%s, %s)", (self.channel, payload))
+                    return
+                except Exception:
+                    # 连接失效时重建一次
+                    self._notify_conn = None
+                    if attempt == 1:
+                        raise
+
+    async def publish(self, envelope: dict):
+        payload = json.dumps(envelope, ensure_ascii=False, default=str)
+        if len(payload.encode("utf-8")) > MAX_NOTIFY_PAYLOAD:
+            logger.warning(f"WebSocket 消息超过 NOTIFY 上限，仅投递本 worker: rooms={envelope.get('rooms')}")
+            await self._deliver(envelope)
+            return
+
+        try:
+            await self._loop.run_in_executor(None, self._notify, payload)
+        except Exception as e:
+            # 代理不可用时至少保证本 worker 的连接能收到
+            logger.error(f"WebSocket broker 发布失败，降级为本地投递: {str(e)}")
+            await self._deliver(envelope)
+
+
+def _normalize_dsn(url: str) -> str:
+    """SQLAlchemy URL（postgresql+psycopg2://）转换为 libpq DSN"""
+    for prefix in ("postgresql+psycopg2://", "postgresql+asyncpg://", "postgres://"):
+        if url.startswith(prefix):
+            return "postgresql://" + url[len(prefix):]
+    return url
+
+
+def _broker_settings() -> Optional[tuple]:
+    """WS_BROKER=postgres 时返回 (dsn, channel)，进程内代理返回 None"""
+    backend = os.getenv("WS_BROKER", "memory").lower()
+    if backend != "postgres":
+        return None
+    dsn = os.getenv("WS_BROKER_DSN") or os.getenv("PGDATABASE_URL") or ""
+    if not dsn:
+        raise ValueError("WS_BROKER=postgres 需要设置 WS_BROKER_DSN 或 PGDATABASE_URL")
+    return _normalize_dsn(dsn), os.getenv("WS_BROKER_CHANNEL", "restaurant_ws")
+
+
+def create_broker():
+    """根据环境变量创建消息代理"""
+    settings = _broker_settings()
+    if settings is not None:
+        return PostgresBroker(*settings)
+    return InProcessBroker()
+
+
+# 同步发布使用的 NOTIFY 连接（每个进程一个，不启动监听）
+_sync_broker: Optional[PostgresBroker] = None
+_sync_broker_lock = threading.Lock()
+
+
+def publish_sync(rooms: Iterable[str], message: dict) -> bool:
+    """
+    从同步代码发布消息（阻塞执行一次 NOTIFY），所有 worker 收到后投递给各自的连接并调用监听回调
+
+    WS_BROKER 不是 postgres 时没有跨进程通道，返回 False；发布失败只记录日志，同样返回 False。
+    """
+    global _sync_broker
+    if _sync_broker is None:
+        with _sync_broker_lock:
+            if _sync_broker is None:
+                settings = _broker_settings()
+                if settings is None:
+                    return False
+                _sync_broker = PostgresBroker(*settings)
+
+    payload = json.dumps({"rooms": list(rooms), "message": message}, ensure_ascii=False, default=str)
+    if len(payload.encode("utf-8")) > MAX_NOTIFY_PAYLOAD:
+        logger.warning(f"WebSocket 消息超过 NOTIFY 上限，未发布: type={message.get('type')}")
+        return False
+    try:
+        _sync_broker._notify(payload)
+        return True
+    except Exception as e:
+        logger.error(f"WebSocket 消息同步发布失败: {str(e)}")
+        return False
+
+
+# ============ 连接发送队列 ============
+
+def _coalesce_key(message: dict) -> Optional[tuple]:
+    """可合并消息的键：(消息类型, 订单ID)，其他消息返回 None"""
+    field = COALESCE_TYPES.get(message.get("type"))
+    if not field:
+        return None
+    data = message.get(field) or {}
+    if data.get("id") is None:
+        return None
+    return message["type"], data["id"]
+
+
+class _Subscriber:
+    """
+    单个连接的有界发送队列和 writer 任务
+
+    队列元素是 (合并键, 已序列化的文本)，发送时直接 send_text，不再重复编码。
+    """
+
+    def __init__(self, manager: "ConnectionManager", room: str, connection_id: str, websocket: WebSocket):
+        self.manager = manager
+        self.room = room
+        self.connection_id = connection_id
+        self.websocket = websocket
+        self.queue: deque = deque()
+        self.dropped = 0
+        self.closed = False
+        self._ready = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    def offer(self, text: str, key: Optional[tuple] = None):
+        """放入一条消息（不阻塞），按背压策略处理队列已满的情况"""
+        if self.closed:
+            return
+
+        policy = self.manager.backpressure
+        if policy == "coalesce" and key is not None:
+            for index, (queued_key, _) in enumerate(self.queue):
+                if queued_key == key:
+                    # 原位置替换为最新状态，保持相对顺序
+                    self.queue[index] = (key, text)
+                    return
+
+        if len(self.queue) >= self.manager.queue_size:
+            if policy == "disconnect":
+                logger.warning(f"WebSocket发送队列已满，断开慢连接: room={self.room}, connection_id={self.connection_id}")
+                self.close(code=1013)
+                return
+            self._drop_one(policy)
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 100 == 0:
+                logger.warning(f"WebSocket发送队列已满，丢弃旧消息: room={self.room}, "
+                               f"connection_id={self.connection_id}, dropped={self.dropped}")
+
+        self.queue.append((key, text))
+        self._ready.set()
+
+    def _drop_one(self, policy: str):
+        """队列已满时丢弃一条：coalesce 策略优先丢弃最旧的状态类消息（之后还会有新状态），保留新订单通知"""
+        if policy == "coalesce":
+            for index, (queued_key, _) in enumerate(self.queue):
+                if queued_key is not None:
+                    del self.queue[index]
+                    return
+        self.queue.popleft()
+
+    async def _run(self):
+        try:
+            while True:
+                await self._ready.wait()
+                while self.queue:
+                    _, text = self.queue.popleft()
+                    await asyncio.wait_for(self.websocket.send_text(text), timeout=self.manager.send_timeout)
+                self._ready.clear()
+        except asyncio.CancelledError:
+            pass
+        except asyncio.TimeoutError:
+            logger.error(f"WebSocket发送超时，断开连接: room={self.room}, connection_id={self.connection_id}")
+            self.close(code=1013, cancel=False)
+        except Exception as e:
+            logger.error(f"发送消息失败: room={self.room}, connection_id={self.connection_id}, error={str(e)}")
+            self.close(cancel=False)
+
+    def close(self, code: int = 1000, cancel: bool = True):
+        """停止 writer 并移出房间；code 非 1000 时主动关闭底层连接"""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.clear()
+        if cancel:
+            self._task.cancel()
+        self.manager._remove(self)
+        if code != 1000:
+            asyncio.ensure_future(self._close_socket(code))
+
+    async def _close_socket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+
+# ============ 连接管理 ============
+
+class ConnectionManager:
+    """
+    WebSocket 连接管理器
+
+    本地只保存当前 worker 的连接（room -> {connection_id: 发送队列}），
+    所有广播都经过 broker 发布，由各 worker 投递给本地连接。
+    """
+
+    def __init__(
+        self,
+        broker=None,
+        queue_size: Optional[int] = None,
+        backpressure: Optional[str] = None,
+        send_timeout: Optional[float] = None,
+    ):
+        self.broker = broker or create_broker()
+        self.queue_size = queue_size or int(os.getenv("WS_SEND_QUEUE_SIZE", "100"))
+        self.backpressure = backpressure or os.getenv("WS_BACKPRESSURE", "coalesce")
+        self.send_timeout = send_timeout or float(os.getenv("WS_SEND_TIMEOUT", "5"))
+        if self.backpressure not in BACKPRESSURE_POLICIES:
+            raise ValueError(f"不支持的背压策略: {self.backpressure}")
+
+        self.rooms: Dict[str, Dict[str, _Subscriber]] = {}
+        # 消息类型 -> 回调列表（每个 worker 收到该类型消息时调用，与是否有本地连接无关）
+        self._listeners: Dict[str, List[Callable[[dict], None]]] = {}
+        self._started = False
+        self._start_lock: Optional[asyncio.Lock] = None
+
+    # ---------- 生命周期 ----------
+
+    async def start(self):
+        """启动消息代理（首次连接或广播时自动调用）"""
+        if self._started:
+            return
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+        async with self._start_lock:
+            if not self._started:
+                await self.broker.start(self._deliver)
+                self._started = True
+
+    async def stop(self):
+        if self._started:
+            await self.broker.stop()
+            self._started = False
+
+    # ---------- 房间 ----------
+
+    async def join(self, room: str, websocket: WebSocket, connection_id: str, hello: Optional[dict] = None):
+        """接受连接并加入房间"""
+        await self.start()
+        await websocket.accept()
+        if hello is not None:
+            await websocket.send_json(hello)
+
+        # 同一 connection_id 重连时替换旧连接
+        self.leave(room, connection_id)
+        self.rooms.setdefault(room, {})[connection_id] = _Subscriber(self, room, connection_id, websocket)
+        logger.info(f"WebSocket连接: room={room}, connection_id={connection_id}")
+
+    def leave(self, room: str, connection_id: str):
+        """离开房间"""
+        subscriber = self.rooms.get(room, {}).get(connection_id)
+        if subscriber:
+            subscriber.close()
+
+    def _remove(self, subscriber: _Subscriber):
+        connections = self.rooms.get(subscriber.room)
+        if connections and connections.get(subscriber.connection_id) is subscriber:
+            del connections[subscriber.connection_id]
+            logger.info(f"断开连接: room={subscriber.room}, connection_id={subscriber.connection_id}")
+            if not connections:
+                del self.rooms[subscriber.room]
+
+    def add_listener(self, message_type: str, callback: Callable[[dict], None]):
+        """注册消息回调：本 worker 收到 message_type 类型的消息时调用 callback(message)"""
+        self._listeners.setdefault(message_type, []).append(callback)
+
+    async def publish(self, rooms: Iterable[str], message: dict):
+        """向一个或多个房间发布消息（跨 worker）"""
+        await self.start()
+        await self.broker.publish({"rooms": list(rooms), "message": message})
+
+    async def _deliver(self, envelope: dict):
+        """
+        broker 回调：投递给本 worker 持有的连接
+
+        消息只编码一次，然后放入各连接的发送队列立即返回，实际发送由各自的 writer 完成。
+        """
+        message = envelope.get("message") or {}
+        for callback in self._listeners.get(message.get("type"), ()):
+            try:
+                callback(message)
+            except Exception as e:
+                logger.error(f"消息回调失败: type={message.get('type')}, error={e}")
+
+        subscribers = [
+            subscriber
+            for room in envelope.get("rooms") or []
+            for subscriber in list(self.rooms.get(room, {}).values())
+        ]
+        if not subscribers:
+            return
+
+        text = json.dumps(message, ensure_ascii=False, default=str)
+        key = _coalesce_key(message)
+        for subscriber in subscribers:
+            subscriber.offer(text, key)
+
+    def send_to(self, room: str, connection_id: str, message: dict) -> bool:
+        """
+        只发给本 worker 上的一个连接（如心跳回复），不经过 broker
+
+        消息放入该连接的发送队列，由其 writer 任务发送，保证每个连接只有一个发送方。
+        连接不在本 worker 时返回 False。
+        """
+        subscriber = self.rooms.get(room, {}).get(connection_id)
+        if subscriber is None:
+            return False
+        subscriber.offer(json.dumps(message, ensure_ascii=False, default=str))
+        return True
+
+    def pong(self, kind: str, key: int, connection_id: str) -> bool:
+        """回复客户端心跳"""
+        return self.send_to(room_name(kind, key), connection_id, {
+            "type": "pong",
+            "timestamp": datetime.now().isoformat()
+        })
+
+    def stats(self) -> dict:
+        """连接与队列统计"""
+        subscribers = [s for connections in self.rooms.values() for s in connections.values()]
+        return {
+            "rooms": len(self.rooms),
+            "connections": len(subscribers),
+            "queued_messages": sum(len(s.queue) for s in subscribers),
+            "dropped_messages": sum(s.dropped for s in subscribers),
+            "backpressure": self.backpressure,
+        }
+
+    # ---------- 店铺 / 订单 / 桌号 ----------
+
+    async def _connect(self, kind: str, key: int, websocket: WebSocket, connection_id: str):
+        await self.join(room_name(kind, key), websocket, connection_id, hello={
+            "type": "connected",
+            "message": "连接成功",
+            f"{kind}_id": key,
+            "connection_id": connection_id,
+            "timestamp": datetime.now().isoformat()
+        })
+
+    async def connect_to_store(self, websocket: WebSocket, store_id: int, connection_id: str):
+        """连接到店铺（用于店员端）"""
+        await self._connect("store", store_id, websocket, connection_id)
+
+    async def connect_to_order(self, websocket: WebSocket, order_id: int, connection_id: str):
+        """连接到订单（用于顾客端）"""
+        await self._connect("order", order_id, websocket, connection_id)
+
+    async def connect_to_table(self, websocket: WebSocket, table_id: int, connection_id: str):
+        """连接到桌号（用于顾客端）"""
+        await self._connect("table", table_id, websocket, connection_id)
+
+    def disconnect(self, store_id: int = None, order_id: int = None, table_id: int = None, connection_id: str = None):
+        """断开连接"""
+        if not connection_id:
+            return
+        if store_id:
+            self.leave(room_name("store", store_id), connection_id)
+        if order_id:
+            self.leave(room_name("order", order_id), connection_id)
+        if table_id:
+            self.leave(room_name("table", table_id), connection_id)
+
+    async def broadcast_to_store(self, store_id: int, message: dict):
+        """向店铺的所有连接广播消息"""
+        await self.publish([room_name("store", store_id)], message)
+
+    async def broadcast_to_order(self, order_id: int, message: dict):
+        """向订单的所有连接广播消息（顾客端）"""
+        await self.publish([room_name("order", order_id)], message)
+
+    async def broadcast_to_table(self, table_id: int, message: dict):
+        """向桌号的所有连接广播消息（顾客端）"""
+        await self.publish([room_name("table", table_id)], message)
+
+    def _order_rooms(self, order_id: int, data: dict) -> List[str]:
+        rooms = [room_name("order", order_id)]
+        if "store_id" in data:
+            rooms.insert(0, room_name("store", data["store_id"]))
+        return rooms
+
+    async def broadcast_order_status(self, order_id: int, order_data: dict):
+        """
+        广播订单状态更新
+        同时推送到店铺（店员端）和订单（顾客端），一次发布
+        """
+        await self.publish(self._order_rooms(order_id, order_data), {
+            "type": "order_status_update",
+            "order": order_data,
+            "timestamp": datetime.now().isoformat()
+        })
+
+    async def broadcast_new_order(self, order_data: dict):
+        """广播新订单到店铺"""
+        if "store_id" not in order_data:
+            return
+        await self.publish([room_name("store", order_data["store_id"])], {
+            "type": "new_order",
+            "order": order_data,
+            "timestamp": datetime.now().isoformat()
+        })
+
+    async def broadcast_payment_status(self, order_id: int, payment_data: dict):
+        """广播支付状态更新"""
+        await self.publish(self._order_rooms(order_id, payment_data), {
+            "type": "payment_status_update",
+            "payment": payment_data,
+            "timestamp": datetime.now().isoformat()
+        })
+
+
+__all__ = [
+    "BACKPRESSURE_POLICIES",
+    "room_name",
+    "InProcessBroker",
+    "PostgresBroker",
+    "create_broker",
+    "publish_sync",
+    "ConnectionManager",
+]
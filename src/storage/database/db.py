@@ -1,9 +1,15 @@
+import asyncio
 import os
 import time
 from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import OperationalError
 import logging
+
+from .pool_metrics import (
+    TimedAsyncQueuePool, TimedQueuePool, instrument_engine, get_pool_metrics
+)
+
 logger = logging.getLogger(__name__)
 
 MAX_RETRY_TIME = 20  # 连接最大重试时间（秒）
@@ -31,23 +37,87 @@ def get_db_url() -> str:
 _engine = None
 _SessionLocal = None
 
+# 未设置 DB_MAX_CONNECTIONS 时每个 worker 的默认连接预算（同步 + 异步两个引擎合计）
+DEFAULT_CONNECTIONS_PER_WORKER = 200
+
+# 各引擎显式指定池大小的环境变量: (pool_size, max_overflow)
+_POOL_ENV = {
+    "sync": ("DB_POOL_SIZE", "DB_MAX_OVERFLOW"),
+    "async": ("DB_ASYNC_POOL_SIZE", "DB_ASYNC_MAX_OVERFLOW"),
+}
+
+def _split_share(share: int, size, overflow):
+    """把一个引擎分到的连接数拆成 pool_size / max_overflow（已指定的一项保持不变）"""
+    if size is None:
+        size = max(1, share // 2) if overflow is None else max(1, share - int(overflow))
+    if overflow is None:
+        overflow = max(0, share - int(size))
+    return int(size), int(overflow)
+
+def get_pool_settings() -> dict:
+    """
+    每个 worker 的连接池参数（环境变量配置），同步引擎与异步引擎各一个连接池
+
+    每个 worker 的连接预算为 DB_MAX_CONNECTIONS / WEB_CONCURRENCY（worker 数），
+    未设置 DB_MAX_CONNECTIONS 时为 DEFAULT_CONNECTIONS_PER_WORKER。
+    DB_POOL_SIZE / DB_MAX_OVERFLOW（同步）、DB_ASYNC_POOL_SIZE / DB_ASYNC_MAX_OVERFLOW（异步）
+    可直接指定；未指定的引擎平分预算中剩余的部分，
+    保证 worker 数 x 两个引擎的 (pool_size + max_overflow) 之和不超过数据库允许的连接数。
+
+    Returns:
+        {"sync": {...}, "async": {...}, "connections_per_worker": 预算, "max_connections_per_worker": 两个池的上限之和}
+    """
+    max_connections = os.getenv("DB_MAX_CONNECTIONS")
+    if max_connections:
+        workers = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+        budget = max(2, int(max_connections) // workers)
+    else:
+        budget = DEFAULT_CONNECTIONS_PER_WORKER
+
+    configured = {
+        kind: (os.getenv(size_env), os.getenv(overflow_env))
+        for kind, (size_env, overflow_env) in _POOL_ENV.items()
+    }
+    # 完全指定的引擎先占用预算，其余引擎平分剩余部分
+    fixed = {
+        kind: (int(size), int(overflow))
+        for kind, (size, overflow) in configured.items()
+        if size is not None and overflow is not None
+    }
+    flexible = [kind for kind in _POOL_ENV if kind not in fixed]
+    remaining = budget - sum(size + overflow for size, overflow in fixed.values())
+    share = max(1, remaining // len(flexible)) if flexible else 0
+
+    common = {
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        "pool_timeout": int(os.getenv("DB_POOL_TIMEOUT", "30")),
+    }
+    settings = {}
+    for kind in _POOL_ENV:
+        size, overflow = fixed.get(kind) or _split_share(share, *configured[kind])
+        settings[kind] = {"pool_size": size, "max_overflow": overflow, **common}
+
+    total = sum(s["pool_size"] + s["max_overflow"] for s in settings.values())
+    if total > budget:
+        logger.warning(f"Database pool settings exceed per-worker budget: {total} > {budget}")
+    settings["connections_per_worker"] = budget
+    settings["max_connections_per_worker"] = total
+    return settings
+
 def _create_engine_with_retry():
     url = get_db_url()
     if url is None or url == "":
         logger.error("PGDATABASE_URL is not set")
         raise ValueError("PGDATABASE_URL is not set")
-    size = 100
-    overflow = 100
-    recycle = 1800
-    timeout = 30
+    settings = get_pool_settings()["sync"]
     engine = create_engine(
         url,
-        pool_size=size,
-        max_overflow=overflow,
+        poolclass=TimedQueuePool,
         pool_pre_ping=True,
-        pool_recycle=recycle,
-        pool_timeout=timeout,
+        **settings,
     )
+    instrument_engine(engine, "sync")
+    logger.info(f"Database pool settings: {settings}")
     # 验证连接，带重试
     start_time = time.time()
     last_error = None
@@ -79,9 +149,106 @@ def get_sessionmaker():
 def get_session():
     return get_sessionmaker()()
 
+def get_db():
+    """FastAPI 依赖：每个请求一个会话，请求结束自动关闭（db: Session = Depends(get_db)）"""
+    db = get_session()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+# ============ 异步数据库访问（asyncpg + AsyncSession）============
+# 供 async def 路由使用，数据库 IO 不阻塞事件循环（以及同一 worker 上的 WebSocket）
+
+_async_engine = None
+_AsyncSessionLocal = None
+_async_engine_lock = None
+
+def get_async_db_url() -> str:
+    """Build asyncpg database URL from environment."""
+    url = os.getenv("PGDATABASE_URL") or ""
+    if url is None or url == "":
+        logger.error("PGDATABASE_URL is not set in environment variables")
+        raise ValueError("PGDATABASE_URL is not set. Please set PGDATABASE_URL environment variable.")
+    for prefix in ("postgresql+psycopg2://", "postgresql://", "postgres://"):
+        if url.startswith(prefix):
+            url = "postgresql+asyncpg://" + url[len(prefix):]
+            break
+    # asyncpg 使用 ssl 参数而不是 libpq 的 sslmode
+    return url.replace("sslmode=", "ssl=")
+
+async def _create_async_engine_with_retry():
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    url = get_async_db_url()
+    engine = create_async_engine(
+        url,
+        poolclass=TimedAsyncQueuePool,
+        pool_pre_ping=True,
+        **get_pool_settings()["async"],
+    )
+    instrument_engine(engine, "async")
+    # 验证连接，带重试（与同步引擎相同的重试语义）
+    start_time = time.time()
+    last_error = None
+    while time.time() - start_time < MAX_RETRY_TIME:
+        try:
+            async with engine.connect() as conn:
+                await conn.execute(text("SELECT 1"))
+            return engine
+        except (OperationalError, OSError) as e:
+            last_error = e
+            elapsed = time.time() - start_time
+            logger.warning(f"Async database connection failed, retrying... (elapsed: {elapsed:.1f}s)")
+            await asyncio.sleep(min(1, MAX_RETRY_TIME - elapsed))
+    await engine.dispose()
+    logger.error(f"Async database connection failed after {MAX_RETRY_TIME}s: {last_error}")
+    raise last_error
+
+async def get_async_engine():
+    global _async_engine, _async_engine_lock
+    if _async_engine is None:
+        if _async_engine_lock is None:
+            _async_engine_lock = asyncio.Lock()
+        async with _async_engine_lock:
+            if _async_engine is None:
+                _async_engine = await _create_async_engine_with_retry()
+    return _async_engine
+
+async def get_async_sessionmaker():
+    global _AsyncSessionLocal
+    if _AsyncSessionLocal is None:
+        from sqlalchemy.ext.asyncio import async_sessionmaker
+
+        # expire_on_commit=False：提交后访问属性不会触发隐式的同步 IO
+        _AsyncSessionLocal = async_sessionmaker(
+            bind=await get_async_engine(), autoflush=False, expire_on_commit=False
+        )
+    return _AsyncSessionLocal
+
+async def get_async_session():
+    return (await get_async_sessionmaker())()
+
+async def get_async_db():
+    """FastAPI 依赖：每个请求一个 AsyncSession（db: AsyncSession = Depends(get_async_db)）"""
+    db = await get_async_session()
+    try:
+        yield db
+    finally:
+        await db.close()
+
 __all__ = [
     "get_db_url",
     "get_engine",
     "get_sessionmaker",
     "get_session",
+    "get_db",
+    "get_pool_settings",
+    "get_pool_metrics",
+    "get_async_db_url",
+    "get_async_engine",
+    "get_async_sessionmaker",
+    "get_async_session",
+    "get_async_db",
 ]
@@ -0,0 +1,223 @@
+"""
+连接池与 SQL 耗时监控
+通过 SQLAlchemy 事件和计时连接池记录：
+- 连接池当前占用（checked-out / overflow / 空闲）
+- 取连接等待时间直方图（池满时请求在这里排队）
+- 慢查询日志（超过 DB_SLOW_QUERY_MS 的语句记录 warning，并保留最近若干条）
+
+数据只保存在当前进程内，由 /api/diagnostic/health 输出，用于按实际负载确定每个 worker 的连接池大小。
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+logger = logging.getLogger(__name__)
+
+# 慢查询阈值（毫秒）
+SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "500"))
+# 保留的最近慢查询条数
+SLOW_QUERY_HISTORY = int(os.getenv("DB_SLOW_QUERY_HISTORY", "20"))
+# 取连接等待时间直方图的桶上界（毫秒），最后一个桶收集更大的值
+WAIT_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+# 慢查询日志中 SQL 的最大长度
+_MAX_STATEMENT_LENGTH = 500
+
+
+class Histogram:
+    """固定桶的累计直方图（线程安全）"""
+
+    def __init__(self, buckets=WAIT_BUCKETS_MS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            if value > self._max:
+                self._max = value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counts = list(self._counts)
+            total, peak = self._sum, self._max
+        count = sum(counts)
+        labels = [f"le_{bound}" for bound in self.buckets] + ["inf"]
+        return {
+            "count": count,
+            "avg_ms": round(total / count, 3) if count else 0.0,
+            "max_ms": round(peak, 3),
+            "buckets": dict(zip(labels, counts)),
+        }
+
+
+class PoolMetrics:
+    """单个引擎的连接池与查询统计"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.checkout_wait = Histogram()
+        self.checkout_timeouts = 0
+        self.connections_created = 0
+        self.invalidated = 0
+        self.queries = 0
+        self.slow_queries = 0
+        self.recent_slow_queries = deque(maxlen=SLOW_QUERY_HISTORY)
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def _incr(self, field: str):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def record_slow_query(self, statement: str, elapsed_ms: float):
+        statement = " ".join(statement.split())[:_MAX_STATEMENT_LENGTH]
+        with self._lock:
+            self.slow_queries += 1
+            self.recent_slow_queries.append({
+                "elapsed_ms": round(elapsed_ms, 1),
+                "statement": statement,
+                "at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            })
+        logger.warning(f"[{self.name}] 慢查询 {elapsed_ms:.1f}ms: {statement}")
+
+    def snapshot(self) -> dict:
+        pool = self._pool
+        with self._lock:
+            result = {
+                "checkout_timeouts": self.checkout_timeouts,
+                "connections_created": self.connections_created,
+                "invalidated": self.invalidated,
+                "queries": self.queries,
+                "slow_queries": self.slow_queries,
+                "slow_query_threshold_ms": SLOW_QUERY_MS,
+                "recent_slow_queries": list(self.recent_slow_queries),
+            }
+        if pool is not None:
+            result["pool"] = {
+                "size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "checked_in": pool.checkedin(),
+                # QueuePool.overflow() 以 -pool_size 为起点，这里只报告实际溢出的连接数
+                "overflow": max(0, pool.overflow()),
+                # _max_overflow 为 -1 时表示不限制
+                "max_overflow": pool._max_overflow,
+                "timeout": pool.timeout(),
+            }
+        result["checkout_wait_ms"] = self.checkout_wait.snapshot()
+        return result
+
+
+class _TimedPoolMixin:
+    """记录每次从池中取连接的等待时间（包括池满时的排队时间）"""
+
+    metrics: Optional[PoolMetrics] = None
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            if self.metrics is not None:
+                self.metrics._incr("checkout_timeouts")
+            raise
+        finally:
+            if self.metrics is not None:
+                self.metrics.checkout_wait.observe((time.perf_counter() - start) * 1000)
+
+    def recreate(self):
+        # pool_pre_ping 等场景重建连接池时保留统计对象
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        if self.metrics is not None:
+            self.metrics._pool = pool
+        return pool
+
+
+class TimedQueuePool(_TimedPoolMixin, QueuePool):
+    """同步引擎使用的计时连接池"""
+
+
+class TimedAsyncQueuePool(_TimedPoolMixin, AsyncAdaptedQueuePool):
+    """异步引擎使用的计时连接池"""
+
+
+_registry: Dict[str, PoolMetrics] = {}
+
+
+def instrument_engine(engine, name: str) -> PoolMetrics:
+    """
+    为引擎挂载监控（create_engine 需传入 poolclass=TimedQueuePool / TimedAsyncQueuePool）
+
+    异步引擎传入 AsyncEngine 即可，事件注册在其 sync_engine 上。
+    """
+    sync_engine = getattr(engine, "sync_engine", engine)
+    metrics = PoolMetrics(name)
+    pool = sync_engine.pool
+    if isinstance(pool, _TimedPoolMixin):
+        pool.metrics = metrics
+    metrics._pool = pool
+
+    @event.listens_for(sync_engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        metrics._incr("connections_created")
+
+    @event.listens_for(sync_engine, "invalidate")
+    def _on_invalidate(dbapi_connection, connection_record, exception):
+        metrics._incr("invalidated")
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("query_start_time")
+        if not starts:
+            return
+        elapsed_ms = (time.perf_counter() - starts.pop()) * 1000
+        metrics._incr("queries")
+        if elapsed_ms >= SLOW_QUERY_MS:
+            metrics.record_slow_query(statement, elapsed_ms)
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _on_error(context):
+        # 语句执行失败时不会触发 after_cursor_execute，丢弃对应的开始时间
+        conn = context.connection
+        if conn is not None and conn.info.get("query_start_time"):
+            conn.info["query_start_time"].pop()
+
+    _registry[name] = metrics
+    return metrics
+
+
+def get_pool_metrics() -> Dict[str, dict]:
+    """所有已创建引擎的连接池与查询统计: {引擎名: 统计}"""
+    return {name: metrics.snapshot() for name, metrics in _registry.items()}
+
+
+__all__ = [
+    "SLOW_QUERY_MS",
+    "WAIT_BUCKETS_MS",
+    "Histogram",
+    "PoolMetrics",
+    "TimedQueuePool",
+    "TimedAsyncQueuePool",
+    "instrument_engine",
+    "get_pool_metrics",
+]
@@ -180,6 +180,7 @@ class DailyRevenue(Base):
     __table_args__ = (
         ForeignKeyConstraint(['store_id'], ['stores.id'], ondelete='CASCADE', name='daily_revenue_store_id_fkey'),
         PrimaryKeyConstraint('id', name='daily_revenue_pkey'),
+        UniqueConstraint('store_id', 'date', name='daily_revenue_store_date_key'),
         Index('ix_daily_revenue_store_date', 'store_id', 'date')
     )
 
@@ -191,6 +192,9 @@ class DailyRevenue(Base):
     total_discount: Mapped[float] = mapped_column(Double(53), nullable=False, comment='总折扣金额')
     total_refund: Mapped[float] = mapped_column(Double(53), nullable=False, comment='总退款金额')
     net_revenue: Mapped[float] = mapped_column(Double(53), nullable=False, comment='净营收')
+    paid_orders: Mapped[int] = mapped_column(Integer, nullable=False, server_default=text('0'), comment='已支付订单数')
+    paid_amount: Mapped[float] = mapped_column(Double(53), nullable=False, server_default=text('0'), comment='已支付金额')
+    cancelled_orders: Mapped[int] = mapped_column(Integer, nullable=False, server_default=text('0'), comment='已取消订单数')
     created_at: Mapped[datetime.datetime] = mapped_column(DateTime(True), nullable=False, server_default=text('now()'))
     payment_methods: Mapped[Optional[dict]] = mapped_column(JSON, comment='支付方式统计')
     peak_hours: Mapped[Optional[dict]] = mapped_column(JSON, comment='高峰时段')
@@ -567,7 +571,8 @@ class StorePointSettlements(Base):
         ForeignKeyConstraint(['member_id'], ['members.id'], ondelete='CASCADE', name='store_point_settlements_member_fkey'),
         PrimaryKeyConstraint('id', name='store_point_settlements_pkey'),
         Index('ix_store_point_settlements_source_target', 'source_store_id', 'target_store_id'),
-        Index('ix_store_point_settlements_date', 'settlement_date')
+        Index('ix_store_point_settlements_date', 'settlement_date'),
+        Index('ix_store_point_settlements_status_date', 'status', 'settlement_date')
     )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
@@ -591,6 +596,34 @@ class StorePointSettlements(Base):
     member: Mapped['Members'] = relationship('Members')
 
 
+class StoreSettlementTransfers(Base):
+    """店铺结算净额划转表 - 每个结算周期按店铺对轧差后的应付积分/金额"""
+    __tablename__ = 'store_settlement_transfers'
+    __table_args__ = (
+        ForeignKeyConstraint(['from_store_id'], ['stores.id'], ondelete='CASCADE', name='store_settlement_transfers_from_store_fkey'),
+        ForeignKeyConstraint(['to_store_id'], ['stores.id'], ondelete='CASCADE', name='store_settlement_transfers_to_store_fkey'),
+        PrimaryKeyConstraint('id', name='store_settlement_transfers_pkey'),
+        Index('ix_store_settlement_transfers_period', 'cycle', 'period_end'),
+        Index('ix_store_settlement_transfers_stores', 'from_store_id', 'to_store_id')
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    cycle: Mapped[str] = mapped_column(String(50), nullable=False, comment='结算周期: daily, weekly, monthly')
+    period_start: Mapped[datetime.datetime] = mapped_column(DateTime(True), nullable=False, comment='周期开始时间')
+    period_end: Mapped[datetime.datetime] = mapped_column(DateTime(True), nullable=False, comment='周期结束时间（不含）')
+    from_store_id: Mapped[int] = mapped_column(Integer, nullable=False, comment='付款店铺ID（轧差后净欠款方）')
+    to_store_id: Mapped[int] = mapped_column(Integer, nullable=False, comment='收款店铺ID')
+    net_points: Mapped[int] = mapped_column(Integer, nullable=False, comment='轧差后积分')
+    net_amount: Mapped[float] = mapped_column(Double(53), nullable=False, comment='轧差后金额')
+    settlement_count: Mapped[int] = mapped_column(Integer, nullable=False, comment='覆盖的结算记录数（双向合计）')
+    status: Mapped[str] = mapped_column(String(50), nullable=False, default='pending', comment='划转状态: pending, paid')
+    created_at: Mapped[datetime.datetime] = mapped_column(DateTime(True), nullable=False, server_default=text('now()'))
+    updated_at: Mapped[Optional[datetime.datetime]] = mapped_column(DateTime(True))
+
+    from_store: Mapped['Stores'] = relationship('Stores', foreign_keys=[from_store_id])
+    to_store: Mapped['Stores'] = relationship('Stores', foreign_keys=[to_store_id])
+
+
 class ThirdPartyPointAgreements(Base):
     """第三方积分协议表 - 记录与第三方公司的积分合作协议"""
     __tablename__ = 'third_party_point_agreements'
@@ -666,6 +699,24 @@ class PointExchangeLogs(Base):
     order: Mapped[Optional['Orders']] = relationship('Orders')
 
 
+class PointExchangeDailyUsage(Base):
+    """积分兑换每日用量表 - 按协议、日期累计已兑换积分，用于每日限额校验"""
+    __tablename__ = 'point_exchange_daily_usage'
+    __table_args__ = (
+        ForeignKeyConstraint(['agreement_id'], ['third_party_point_agreements.id'], ondelete='CASCADE', name='point_exchange_daily_usage_agreement_fkey'),
+        PrimaryKeyConstraint('id', name='point_exchange_daily_usage_pkey'),
+        UniqueConstraint('agreement_id', 'usage_date', name='point_exchange_daily_usage_agreement_date_key')
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    agreement_id: Mapped[int] = mapped_column(Integer, nullable=False, comment='第三方协议ID')
+    usage_date: Mapped[datetime.datetime] = mapped_column(DateTime(True), nullable=False, comment='日期（当天零点）')
+    points_used: Mapped[int] = mapped_column(Integer, nullable=False, server_default=text('0'), comment='当日已兑换积分')
+    exchange_count: Mapped[int] = mapped_column(Integer, nullable=False, server_default=text('0'), comment='当日兑换次数')
+    created_at: Mapped[datetime.datetime] = mapped_column(DateTime(True), nullable=False, server_default=text('now()'))
+    updated_at: Mapped[Optional[datetime.datetime]] = mapped_column(DateTime(True))
+
+
 class DiscountConfig(Base):
     """优惠配置表 - 店铺或公司设置的优惠规则"""
     __tablename__ = 'discount_config'
@@ -720,3 +771,16 @@ class MemberQRCodes(Base):
 
     member: Mapped['Members'] = relationship('Members')
 
+
+
+class IdWorkerLeases(Base):
+    """订单号生成器 worker ID 租约表 - 未配置 ID_WORKER_ID 的进程从这里租用唯一的 worker ID"""
+    __tablename__ = 'id_worker_leases'
+    __table_args__ = (
+        PrimaryKeyConstraint('worker_id', name='id_worker_leases_pkey'),
+    )
+
+    worker_id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False, comment='worker ID（0~1023）')
+    owner: Mapped[str] = mapped_column(String(255), nullable=False, comment='持有者（主机名:进程号:随机串）')
+    leased_at: Mapped[datetime.datetime] = mapped_column(DateTime(True), nullable=False, server_default=text('now()'), comment='租用时间')
+    expires_at: Mapped[datetime.datetime] = mapped_column(DateTime(True), nullable=False, comment='到期时间')
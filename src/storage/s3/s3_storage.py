@@ -1,7 +1,13 @@
+import base64
+import json
 import os
 import re
+import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
-from typing import Optional, Any, Dict, List, TypedDict, Iterable
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Optional, Any, Dict, List, TypedDict, Iterable, Iterator
 from uuid import uuid4
 
 import boto3
@@ -13,6 +19,125 @@ logger = logging.getLogger(__name__)
 # 允许的文件名字符集（面向用户输入的约束）
 FILE_NAME_ALLOWED_RE = re.compile(r"^[A-Za-z0-9._\-/]+$")
 
+# x-storage-token 的默认有效期（秒），令牌本身带 exp 时以 exp 为准
+STORAGE_TOKEN_TTL = int(os.getenv("STORAGE_TOKEN_TTL", "300"))
+# 距过期不足该秒数时提前刷新令牌
+STORAGE_TOKEN_REFRESH_MARGIN = int(os.getenv("STORAGE_TOKEN_REFRESH_MARGIN", "60"))
+# 签名 URL 缓存的最大条目数
+PRESIGNED_URL_CACHE_SIZE = int(os.getenv("PRESIGNED_URL_CACHE_SIZE", "4096"))
+# 签名 URL 剩余有效期不低于请求有效期的该比例时复用
+PRESIGNED_URL_REUSE_RATIO = float(os.getenv("PRESIGNED_URL_REUSE_RATIO", "0.8"))
+
+
+def _fetch_access_token() -> str:
+    from coze_workload_identity import Client as CozeClient
+    coze_client = CozeClient()
+    try:
+        return coze_client.get_access_token()
+    finally:
+        try:
+            coze_client.close()
+        except Exception:
+            # 资源释放失败不影响后续流程
+            pass
+
+
+def _token_expires_at(token: str, fetched_at: float) -> float:
+    """从 JWT 的 exp 解析令牌过期时间（解析失败时按 STORAGE_TOKEN_TTL 计算）"""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get("exp")
+        if exp:
+            return float(exp)
+    except Exception:
+        pass
+    return fetched_at + STORAGE_TOKEN_TTL
+
+
+class _StorageTokenCache:
+    """
+    进程内共享的 x-storage-token 缓存
+
+    距过期不足 STORAGE_TOKEN_REFRESH_MARGIN 秒时由一个线程刷新，
+    刷新期间其他线程继续使用尚未过期的旧令牌，不排队等待。
+    """
+
+    def __init__(self):
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._refresh_lock = threading.Lock()
+
+    def get(self) -> str:
+        now = time.time()
+        token = self._token
+        if token is not None and now < self._expires_at - STORAGE_TOKEN_REFRESH_MARGIN:
+            return token
+
+        still_valid = token is not None and now < self._expires_at
+        # 旧令牌仍有效时只让一个线程刷新，其余线程直接使用旧令牌
+        if not self._refresh_lock.acquire(blocking=not still_valid):
+            return token
+        try:
+            if self._token is not None and time.time() < self._expires_at - STORAGE_TOKEN_REFRESH_MARGIN:
+                return self._token
+            fetched_at = time.time()
+            token = _fetch_access_token()
+            self._token = token
+            self._expires_at = _token_expires_at(token, fetched_at)
+            return token
+        except Exception:
+            if still_valid:
+                logger.warning("Refreshing x-storage-token failed, using the cached token")
+                return self._token
+            raise
+        finally:
+            self._refresh_lock.release()
+
+    def invalidate(self):
+        self._token = None
+        self._expires_at = 0.0
+
+
+_token_cache = _StorageTokenCache()
+
+
+class _PresignedUrlCache:
+    """签名 URL 缓存: (bucket, key, 请求有效期) -> (url, 过期时间)，LRU 淘汰"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, cache_key: tuple, expire_time: int) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None:
+                return None
+            url, expires_at = entry
+            # 剩余有效期不足时不复用，调用方拿到的 URL 至少还有请求有效期的 PRESIGNED_URL_REUSE_RATIO
+            if expires_at - time.time() < expire_time * PRESIGNED_URL_REUSE_RATIO:
+                self._entries.pop(cache_key, None)
+                return None
+            self._entries.move_to_end(cache_key)
+            return url
+
+    def put(self, cache_key: tuple, url: str, expires_at: float):
+        with self._lock:
+            self._entries[cache_key] = (url, expires_at)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, bucket: str, key: str):
+        with self._lock:
+            for cache_key in [k for k in self._entries if k[0] == bucket and k[1] == key]:
+                self._entries.pop(cache_key, None)
+
+
+_presigned_url_cache = _PresignedUrlCache(PRESIGNED_URL_CACHE_SIZE)
+
 
 class ListFilesResult(TypedDict):
     # list_files 的返回结构类型
@@ -60,19 +185,10 @@ class S3SyncStorage:
                 region_name=self.region,
             )
 
-            # 注册 before-call 钩子，发送前注入 x-storage-token 头
+            # 注册 before-call 钩子，发送前注入 x-storage-token 头（令牌缓存复用，临近过期时提前刷新）
             def _inject_header(**kwargs):
                 try:
-                    from coze_workload_identity import Client as CozeClient
-                    coze_client = CozeClient()
-                    try:
-                        token = coze_client.get_access_token()
-                    except Exception as e:
-                        logger.error("Error loading COZE_WORKLOAD_IDENTITY_TOKEN: %s", e)
-                        token = None
-                        raise e
-                    finally:
-                        coze_client.close()
+                    token = _token_cache.get()
                     params = kwargs.get("params", {})
                     headers = params.setdefault("headers", {})
                     headers["x-storage-token"] = token
@@ -83,6 +199,10 @@ class S3SyncStorage:
             self._client = client
         return self._client
 
+    def warm_up(self) -> None:
+        """提前创建 S3 客户端：多线程并发上传前调用一次，避免各线程同时初始化客户端"""
+        self._get_client()
+
     def _generate_object_key(self, *, original_name: str) -> str:
         suffix = Path(original_name).suffix.lower()
         stem = Path(original_name).stem
@@ -157,6 +277,7 @@ class S3SyncStorage:
             client = self._get_client()
             target_bucket = self._resolve_bucket(bucket)
             client.delete_object(Bucket=target_bucket, Key=file_key)
+            _presigned_url_cache.discard(target_bucket, file_key)
             return True
         except Exception as e:
             logger.error(self._error_msg("Error deleting file from S3", e))
@@ -231,20 +352,23 @@ class S3SyncStorage:
             raise e
 
     def generate_presigned_url(self, *, key: str, bucket: Optional[str] = None, expire_time: int = 1800) -> str:
-        """通过 S3 Proxy 生成签名 URL。"""
-        import json
+        """通过 S3 Proxy 生成签名 URL（同一对象、同一有效期的 URL 在剩余有效期足够时直接复用）。"""
+        target_bucket = self._resolve_bucket(bucket)
+        cache_key = (target_bucket, key, expire_time)
+        cached_url = _presigned_url_cache.get(cache_key, expire_time)
+        if cached_url is not None:
+            return cached_url
+
+        signed_at = time.time()
+        url = self._sign_url(key=key, bucket=target_bucket, expire_time=expire_time)
+        _presigned_url_cache.put(cache_key, url, signed_at + expire_time)
+        return url
+
+    def _sign_url(self, *, key: str, bucket: str, expire_time: int) -> str:
+        """调用 S3 Proxy 的 /sign-url 签名（不经过缓存）。"""
         import urllib.request as urllib_request
         try:
-            from coze_workload_identity import Client as CozeClient
-            coze_client = CozeClient()
-            try:
-                token = coze_client.get_access_token()
-            finally:
-                try:
-                    coze_client.close()
-                except Exception:
-                    # 资源释放失败不影响后续流程
-                    pass
+            token = _token_cache.get()
         except Exception as e:
             logger.error(f"Error loading x-storage-token: {e}")
             raise RuntimeError(f"获取 x-storage-token 失败: {e}")
@@ -259,8 +383,7 @@ class S3SyncStorage:
                 "x-storage-token": token,
             }
 
-            target_bucket = self._resolve_bucket(bucket)
-            payload = {"bucket_name": target_bucket, "path": key, "expire_time": expire_time}
+            payload = {"bucket_name": bucket, "path": key, "expire_time": expire_time}
             data = json.dumps(payload).encode("utf-8")
             request = urllib_request.Request(sign_url_endpoint, data=data, headers=headers, method="POST")
         except Exception as e:
@@ -364,61 +487,176 @@ class S3SyncStorage:
 
     def trunk_upload_file(self, *, chunk_iter: Iterable[bytes], file_name: str,
                            content_type: str = "application/octet-stream", bucket: Optional[str] = None,
-                           part_size: int = 5 * 1024 * 1024) -> str:
+                           part_size: int = 5 * 1024 * 1024, max_concurrency: int = 4,
+                           upload_state: Optional[Dict[str, Any]] = None) -> str:
         """流式上传（字节迭代器，显式分片 Multipart Upload）
         - chunk_iter: 可迭代对象，逐块产生 bytes；每块大小可变（内部累积到 part_size 再上传），最后一块可小于 5MB
         - file_name: 原始文件名，用于生成唯一 key
         - content_type: MIME 类型
         - bucket: 目标桶；为空时取环境或实例默认值
         - part_size: 每个 part 的最小大小（除最后一个）；默认 5MB
+        - max_concurrency: 并发上传的分片数（默认 4）；内存中最多同时持有 2 x max_concurrency 个分片
+        - upload_state: 断点续传状态（可选）。传入空 dict 时记录 key/upload_id/part_size/parts，
+          失败后不中止分片上传；用同一个 dict 和相同数据重试时跳过服务端已完成的分片
         返回：最终写入的对象 key
+
+        分片数据按 memoryview 切片直接写入每个分片自己的缓冲区，每个字节只复制一次。
         """
         client = self._get_client()
         target_bucket = self._resolve_bucket(bucket)
-        key = self._generate_object_key(original_name=file_name)
-
-        # 初始化分片上传
-        try:
-            init_resp = client.create_multipart_upload(Bucket=target_bucket, Key=key, ContentType=content_type)
-            upload_id = init_resp["UploadId"]
-        except Exception as e:
-            logger.error(self._error_msg("create_multipart_upload failed", e))
-            raise e
+        resumable = upload_state is not None
+
+        if resumable and upload_state.get("upload_id"):
+            key = upload_state["key"]
+            upload_id = upload_state["upload_id"]
+            part_size = upload_state.get("part_size", part_size)
+            completed = self._list_uploaded_parts(client, target_bucket, key, upload_id)
+        else:
+            key = self._generate_object_key(original_name=file_name)
+            # 初始化分片上传
+            try:
+                init_resp = client.create_multipart_upload(Bucket=target_bucket, Key=key, ContentType=content_type)
+                upload_id = init_resp["UploadId"]
+            except Exception as e:
+                logger.error(self._error_msg("create_multipart_upload failed", e))
+                raise e
+            completed = {}
+            if resumable:
+                upload_state.update({"key": key, "upload_id": upload_id, "part_size": part_size, "parts": {}})
+
+        etags: Dict[int, str] = dict(completed)
+        if resumable:
+            upload_state["parts"] = dict(etags)
+
+        def _upload_part(part_number: int, data: bytearray) -> None:
+            resp = client.upload_part(Bucket=target_bucket, Key=key, UploadId=upload_id,
+                                      PartNumber=part_number, Body=data)
+            etags[part_number] = resp["ETag"]
+            if resumable:
+                upload_state["parts"][part_number] = resp["ETag"]
+
+        max_concurrency = max(1, max_concurrency)
+        pool = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="s3-part")
+        in_flight = set()
+
+        def _submit(part_number: int, data: bytearray) -> None:
+            if part_number in completed:
+                # 断点续传：服务端已有该分片，丢弃数据
+                return
+            # 限制在途分片数量，避免上传跟不上读取时内存无限增长
+            while len(in_flight) >= 2 * max_concurrency:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    in_flight.discard(future)
+                    future.result()
+            in_flight.add(pool.submit(_upload_part, part_number, data))
 
-        parts = []
         part_number = 1
-        buffer = bytearray()
+        part = bytearray(part_size)
+        filled = 0
         try:
             for chunk in chunk_iter:
                 if not chunk:
                     continue
-                buffer.extend(chunk)
-                while len(buffer) >= part_size:
-                    data = bytes(buffer[:part_size])
-                    buffer = buffer[part_size:]
-                    resp = client.upload_part(Bucket=target_bucket, Key=key, UploadId=upload_id, PartNumber=part_number,
-                                              Body=data)
-                    parts.append({"PartNumber": part_number, "ETag": resp["ETag"]})
-                    part_number += 1
+                view = memoryview(chunk)
+                offset = 0
+                while offset < len(view):
+                    n = min(part_size - filled, len(view) - offset)
+                    part[filled:filled + n] = view[offset:offset + n]
+                    filled += n
+                    offset += n
+                    if filled == part_size:
+                        _submit(part_number, part)
+                        part_number += 1
+                        part = bytearray(part_size)
+                        filled = 0
 
             # 上传最后不足 part_size 的余量
-            if len(buffer) > 0:
-                resp = client.upload_part(Bucket=target_bucket, Key=key, UploadId=upload_id, PartNumber=part_number,
-                                          Body=bytes(buffer))
-                parts.append({"PartNumber": part_number, "ETag": resp["ETag"]})
+            if filled > 0 or part_number == 1:
+                del part[filled:]
+                _submit(part_number, part)
+            else:
+                part_number -= 1
+
+            for future in in_flight:
+                future.result()
 
             # 完成分片
+            parts = [{"PartNumber": n, "ETag": etags[n]} for n in range(1, part_number + 1)]
             client.complete_multipart_upload(
                 Bucket=target_bucket,
                 Key=key,
                 UploadId=upload_id,
                 MultipartUpload={"Parts": parts},
             )
+            if resumable:
+                upload_state["completed"] = True
             return key
         except Exception as e:
             logger.error(self._error_msg("multipart upload failed", e))
-            try:
-                client.abort_multipart_upload(Bucket=target_bucket, Key=key, UploadId=upload_id)
-            except Exception as ae:
-                logger.error(self._error_msg("abort_multipart_upload failed", ae))
+            for future in in_flight:
+                future.cancel()
+            if resumable:
+                # 保留已上传的分片，调用方用同一个 upload_state 重试
+                logger.info("multipart upload %s kept for resume (%d parts done)", upload_id, len(etags))
+            else:
+                try:
+                    client.abort_multipart_upload(Bucket=target_bucket, Key=key, UploadId=upload_id)
+                except Exception as ae:
+                    logger.error(self._error_msg("abort_multipart_upload failed", ae))
             raise e
+        finally:
+            pool.shutdown(wait=True)
+
+    def _list_uploaded_parts(self, client, bucket: str, key: str, upload_id: str) -> Dict[int, str]:
+        """查询分片上传中服务端已完成的分片: {PartNumber: ETag}"""
+        parts: Dict[int, str] = {}
+        kwargs: Dict[str, Any] = {"Bucket": bucket, "Key": key, "UploadId": upload_id}
+        while True:
+            resp = client.list_parts(**kwargs)
+            for item in resp.get("Parts", []) or []:
+                parts[item["PartNumber"]] = item["ETag"]
+            if not resp.get("IsTruncated"):
+                return parts
+            kwargs["PartNumberMarker"] = resp.get("NextPartNumberMarker")
+
+    def abort_upload(self, *, upload_state: Dict[str, Any], bucket: Optional[str] = None) -> None:
+        """放弃一个可续传的分片上传，释放服务端已上传的分片"""
+        if not upload_state.get("upload_id") or upload_state.get("completed"):
+            return
+        client = self._get_client()
+        target_bucket = self._resolve_bucket(bucket)
+        try:
+            client.abort_multipart_upload(Bucket=target_bucket, Key=upload_state["key"],
+                                          UploadId=upload_state["upload_id"])
+        except Exception as e:
+            logger.error(self._error_msg("abort_multipart_upload failed", e))
+            raise e
+
+    def stream_download(self, *, file_key: str, bucket: Optional[str] = None,
+                        chunk_size: int = 1024 * 1024) -> Iterator[bytes]:
+        """流式读取对象（read_file 的流式版本），逐块产出 bytes，不把整个对象读入内存
+        - file_key: 对象 key
+        - bucket: 目标桶；为空时取环境或实例默认值
+        - chunk_size: 每块大小（默认 1MB）
+        """
+        try:
+            client = self._get_client()
+            target_bucket = self._resolve_bucket(bucket)
+            resp = client.get_object(Bucket=target_bucket, Key=file_key)
+            body = resp.get("Body")
+            if body is None:
+                raise RuntimeError("S3 get_object returned no Body")
+        except Exception as e:
+            logger.error(self._error_msg("Error reading file from S3", e))
+            raise e
+
+        try:
+            for chunk in body.iter_chunks(chunk_size=chunk_size):
+                if chunk:
+                    yield chunk
+        finally:
+            try:
+                body.close()
+            except Exception as ce:
+                logger.debug("Failed to close S3 response body: %s", ce)
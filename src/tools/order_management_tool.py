@@ -6,6 +6,7 @@ from sqlalchemy.orm import Session
 from langchain.tools import tool
 from storage.database.db import get_session
 from storage.database.shared.model import Orders, OrderItems, OrderStatusLogs, Payments
+from services.revenue_rollup import apply_event, record_order_status_change
 from datetime import datetime, timedelta
 from pydantic import BaseModel, Field
 
@@ -170,6 +171,7 @@ def update_order_status(order_id: int, new_status: str, operator_id: Optional[in
             # 支付状态应该由收银员在支付操作时设置
             
             db.commit()
+            apply_event(db, record_order_status_change, order, old_status)
             db.refresh(order)
             
             return json.dumps({
@@ -2,18 +2,155 @@
 二维码生成工具
 为每个桌号生成唯一二维码并上传至S3
 支持彩色二维码和中间添加公司logo
+
+整店批量生成（iter_qrcodes_for_store）按流水线执行：
+- 二维码渲染是 CPU 密集的 PIL/qrcode 计算，在进程池中并行
+- 上传和签名是网络 IO，在线程池中以有限并发执行
+- logo 每批只解码一次，每个渲染进程按二维码尺寸缓存裁好的圆形 logo
+- 结果按完成顺序逐个产出，数据库按批回写
 """
 import io
 import os
-from typing import Optional
-from PIL import Image, ImageDraw
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterator, Optional, Tuple
+from PIL import Image, ImageChops, ImageDraw
 import qrcode
 from qrcode.constants import ERROR_CORRECT_H
+from sqlalchemy import update
 
 from storage.s3.s3_storage import S3SyncStorage
 from storage.database.db import get_session
 from storage.database.shared.model import Tables
 
+# 整店批量生成时的渲染进程数和上传并发数
+QRCODE_RENDER_WORKERS = int(os.getenv("QRCODE_RENDER_WORKERS", str(min(os.cpu_count() or 1, 8))))
+QRCODE_UPLOAD_CONCURRENCY = int(os.getenv("QRCODE_UPLOAD_CONCURRENCY", "8"))
+# 批量生成时每多少张回写一次数据库
+_DB_UPDATE_BATCH = 50
+
+
+def load_logo(logo_data: bytes) -> Optional[Image.Image]:
+    """解码 logo 并转换为 RGBA（失败时返回 None，二维码不加 logo）"""
+    try:
+        logo_img = Image.open(io.BytesIO(logo_data))
+        logo_img.load()
+        return logo_img.convert('RGBA')
+    except Exception as e:
+        print(f"加载logo失败: {str(e)}")
+        return None
+
+
+def fit_logo(logo_img: Image.Image, logo_size: int) -> Image.Image:
+    """
+    把 logo 缩放到 logo_size 并裁成圆形
+
+    圆形以外的像素透明，圆形以内保留 logo 原有的透明度（用通道相乘代替逐像素复制）。
+    """
+    thumb = logo_img.copy()
+    thumb.thumbnail((logo_size, logo_size), Image.Resampling.LANCZOS)
+    canvas = Image.new('RGBA', (logo_size, logo_size), (0, 0, 0, 0))
+    canvas.paste(thumb, (0, 0))
+
+    mask = Image.new('L', (logo_size, logo_size), 0)
+    ImageDraw.Draw(mask).ellipse([(0, 0), (logo_size - 1, logo_size - 1)], fill=255)
+    canvas.putalpha(ImageChops.multiply(canvas.getchannel('A'), mask))
+    return canvas
+
+
+def paste_logo(qrcode_img: Image.Image, fitted_logo: Image.Image) -> Image.Image:
+    """把已裁好的 logo 居中粘贴到二维码上"""
+    qr_width, qr_height = qrcode_img.size
+    logo_size = fitted_logo.size[0]
+    logo_position = (
+        (qr_width - logo_size) // 2,
+        (qr_height - logo_size) // 2
+    )
+    qrcode_img.paste(fitted_logo, logo_position, fitted_logo)
+    return qrcode_img
+
+
+def logo_size_for(qrcode_img: Image.Image, logo_ratio: float) -> int:
+    return int(min(qrcode_img.size) * logo_ratio)
+
+
+def make_qrcode_image(content: str, foreground_color: str, background_color: str) -> Image.Image:
+    """生成二维码图片（高错误纠正级别，以支持中间的 logo）"""
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=ERROR_CORRECT_H,  # 使用高错误纠正级别（30%）
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(content)
+    qr.make(fit=True)
+    return qr.make_image(fill_color=foreground_color, back_color=background_color)
+
+
+def image_to_png(img: Image.Image) -> bytes:
+    img_byte_arr = io.BytesIO()
+    img.save(img_byte_arr, format='PNG')
+    return img_byte_arr.getvalue()
+
+
+class _TableQRCodeRenderer:
+    """一批桌码的渲染器：logo 只解码一次，按二维码尺寸缓存裁好的 logo"""
+
+    def __init__(self, logo_png: Optional[bytes], logo_ratio: float):
+        self.logo = load_logo(logo_png) if logo_png else None
+        self.logo_ratio = logo_ratio
+        self.fitted_logos: Dict[int, Image.Image] = {}
+
+    def render(self, table_id: int, content: str, foreground_color: str, background_color: str) -> Tuple[int, bytes]:
+        """渲染一张桌码: (table_id, PNG 字节)"""
+        img = make_qrcode_image(content, foreground_color, background_color)
+        if self.logo is not None:
+            logo_size = logo_size_for(img, self.logo_ratio)
+            fitted = self.fitted_logos.get(logo_size)
+            if fitted is None:
+                fitted = fit_logo(self.logo, logo_size)
+                self.fitted_logos[logo_size] = fitted
+            img = paste_logo(img, fitted)
+        return table_id, image_to_png(img)
+
+
+# ============ 渲染进程 ============
+# 渲染进程启动时创建本进程的渲染器，该全局变量只存在于渲染进程内
+
+_worker_renderer: Optional[_TableQRCodeRenderer] = None
+
+
+def _init_render_worker(logo_png: Optional[bytes], logo_ratio: float):
+    global _worker_renderer
+    _worker_renderer = _TableQRCodeRenderer(logo_png, logo_ratio)
+
+
+def _render_table_qrcode(table_id: int, content: str, foreground_color: str, background_color: str) -> Tuple[int, bytes]:
+    """渲染一张桌码（在渲染进程中执行）: (table_id, PNG 字节)"""
+    return _worker_renderer.render(table_id, content, foreground_color, background_color)
+
+
+class _InlineExecutor:
+    """
+    渲染进程数为 1 时在当前线程渲染，不启动进程池
+
+    渲染器绑定在执行器上，不修改模块状态，同一服务进程内并发的批量生成互不影响。
+    """
+
+    def __init__(self, logo_png: Optional[bytes], logo_ratio: float):
+        self.renderer = _TableQRCodeRenderer(logo_png, logo_ratio)
+
+    def submit(self, fn, *args):
+        from concurrent.futures import Future
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
+
 
 class QRCodeGenerator:
     """二维码生成器"""
@@ -40,53 +177,40 @@ class QRCodeGenerator:
         Returns:
             Image.Image: 添加logo后的二维码图片
         """
-        try:
-            # 加载logo图片
-            logo_img = Image.open(io.BytesIO(logo_data))
-
-            # 计算logo尺寸
-            qr_width, qr_height = qrcode_img.size
-            logo_size = int(min(qr_width, qr_height) * logo_ratio)
-
-            # 调整logo大小（保持宽高比）
-            logo_img.thumbnail((logo_size, logo_size), Image.Resampling.LANCZOS)
-
-            # 计算logo位置（居中）
-            logo_position = (
-                (qr_width - logo_size) // 2,
-                (qr_height - logo_size) // 2
-            )
-
-            # 创建带圆角的logo
-            if logo_img.mode == 'RGBA':
-                # logo已经是RGBA格式，直接使用
-                pass
-            else:
-                logo_img = logo_img.convert('RGBA')
-
-            # 创建白色背景的圆形遮罩
-            mask = Image.new('RGBA', (logo_size, logo_size), (255, 255, 255, 0))
-            draw = ImageDraw.Draw(mask)
-            draw.ellipse([(0, 0), (logo_size - 1, logo_size - 1)], fill=(255, 255, 255, 255))
-
-            # 应用圆形遮罩
-            logo_with_mask = Image.new('RGBA', (logo_size, logo_size))
-            for y in range(logo_size):
-                for x in range(logo_size):
-                    pixel = logo_img.getpixel((x, y))
-                    mask_pixel = mask.getpixel((x, y))
-                    if mask_pixel[3] == 255:
-                        logo_with_mask.putpixel((x, y), pixel)
-
-            # 将logo粘贴到二维码上
-            qrcode_img.paste(logo_with_mask, logo_position, logo_with_mask)
-
+        logo_img = load_logo(logo_data)
+        if logo_img is None:
+            # 如果添加logo失败，返回原始二维码
             return qrcode_img
+        try:
+            return paste_logo(qrcode_img, fit_logo(logo_img, logo_size_for(qrcode_img, logo_ratio)))
         except Exception as e:
             # 如果添加logo失败，返回原始二维码
             print(f"添加logo失败: {str(e)}")
             return qrcode_img
     
+    def _upload_table_qrcode(
+        self,
+        png_bytes: bytes,
+        store_id: int,
+        table_id: int,
+        foreground_color: str,
+        background_color: str
+    ) -> str:
+        """上传桌码图片并生成签名URL（有效期1小时）"""
+        # 生成文件名（包含颜色信息以便区分）
+        color_suffix = f"{foreground_color.replace('#', '')}_{background_color.replace('#', '')}"
+        file_name = f"table_qrcode_store{store_id}_table{table_id}_{color_suffix}.png"
+
+        qrcode_key = self.storage.upload_file(
+            file_content=png_bytes,
+            file_name=file_name,
+            content_type="image/png"
+        )
+        return self.storage.generate_presigned_url(
+            key=qrcode_key,
+            expire_time=3600
+        )
+
     def generate_qrcode_for_table(
         self,
         table_id: int,
@@ -124,43 +248,16 @@ class QRCodeGenerator:
             # 生成二维码内容（包含店铺ID和桌号）
             qrcode_content = f"{base_url}?store_id={table.store_id}&table_id={table_id}"
 
-            # 生成二维码图片（使用高错误纠正级别以支持logo）
-            qr = qrcode.QRCode(
-                version=1,
-                error_correction=ERROR_CORRECT_H,  # 使用高错误纠正级别（30%）
-                box_size=10,
-                border=4,
-            )
-            qr.add_data(qrcode_content)
-            qr.make(fit=True)
-
-            # 将二维码转换为图片，使用自定义颜色
-            img = qr.make_image(fill_color=foreground_color, back_color=background_color)
+            # 生成二维码图片，使用自定义颜色
+            img = make_qrcode_image(qrcode_content, foreground_color, background_color)
 
             # 如果有logo，添加到二维码中间
             if logo_data:
                 img = self._add_logo_to_qrcode(img, logo_data, logo_ratio)
 
-            # 将图片转换为字节流
-            img_byte_arr = io.BytesIO()
-            img.save(img_byte_arr, format='PNG')
-            img_byte_arr = img_byte_arr.getvalue()
-
-            # 生成文件名（包含颜色信息以便区分）
-            color_suffix = f"{foreground_color.replace('#', '')}_{background_color.replace('#', '')}"
-            file_name = f"table_qrcode_store{table.store_id}_table{table.id}_{color_suffix}.png"
-
-            # 上传到S3
-            qrcode_key = self.storage.upload_file(
-                file_content=img_byte_arr,
-                file_name=file_name,
-                content_type="image/png"
-            )
-
-            # 生成签名URL（有效期1小时）
-            qrcode_url = self.storage.generate_presigned_url(
-                key=qrcode_key,
-                expire_time=3600
+            # 上传到S3并生成签名URL
+            qrcode_url = self._upload_table_qrcode(
+                image_to_png(img), table.store_id, table.id, foreground_color, background_color
             )
 
             # 更新数据库
@@ -183,17 +280,23 @@ class QRCodeGenerator:
         finally:
             db.close()
     
-    def generate_qrcodes_for_store(
+    def iter_qrcodes_for_store(
         self,
         store_id: int,
         base_url: str = "https://order.example.com",
         foreground_color: str = "black",
         background_color: str = "white",
         logo_data: Optional[bytes] = None,
-        logo_ratio: float = 0.2
-    ) -> list:
+        logo_ratio: float = 0.2,
+        render_workers: Optional[int] = None,
+        upload_concurrency: Optional[int] = None,
+        progress_callback: Optional[Callable[[int, int], None]] = None
+    ) -> Iterator[dict]:
         """
-        为指定店铺的所有桌号生成二维码
+        为指定店铺的所有桌号并行生成二维码，按完成顺序逐个产出结果
+
+        渲染在进程池中并行，上传和签名在线程池中以有限并发执行，
+        数据库每 _DB_UPDATE_BATCH 张回写一次；单个桌号失败不影响其他桌号。
 
         Args:
             store_id: 店铺ID
@@ -202,34 +305,175 @@ class QRCodeGenerator:
             background_color: 二维码背景色（支持十六进制颜色或颜色名称）
             logo_data: logo图片的字节数据（可选）
             logo_ratio: logo占二维码大小的比例（默认20%）
+            render_workers: 渲染进程数（默认 QRCODE_RENDER_WORKERS）
+            upload_concurrency: 上传并发数（默认 QRCODE_UPLOAD_CONCURRENCY）
+            progress_callback: 进度回调 (已完成数, 总数)
 
-        Returns:
-            list: 所有桌号的二维码信息列表
+        Yields:
+            dict: 成功时包含 qrcode_url / qrcode_content 等，success 为 True；
+                  失败时 success 为 False 并带 error
         """
         db = get_session()
         try:
             # 获取店铺所有活跃的桌号
-            tables = db.query(Tables).filter(
+            tables = db.query(Tables.id, Tables.table_number).filter(
                 Tables.store_id == store_id,
                 Tables.is_active == True
-            ).all()
-
-            results = []
-            for table in tables:
-                result = self.generate_qrcode_for_table(
-                    table.id,
-                    base_url,
-                    foreground_color,
-                    background_color,
-                    logo_data,
-                    logo_ratio
-                )
-                results.append(result)
-
-            return results
+            ).order_by(Tables.id).all()
+        finally:
+            db.close()
 
+        total = len(tables)
+        if total == 0:
+            return
+        table_numbers = {table.id: table.table_number for table in tables}
+        contents = {
+            table.id: f"{base_url}?store_id={store_id}&table_id={table.id}"
+            for table in tables
+        }
+
+        # logo 只解码一次，以 PNG 形式交给各渲染进程
+        logo_png = None
+        if logo_data:
+            logo_img = load_logo(logo_data)
+            if logo_img is not None:
+                logo_png = image_to_png(logo_img)
+
+        render_workers = min(render_workers or QRCODE_RENDER_WORKERS, total)
+        upload_concurrency = upload_concurrency or QRCODE_UPLOAD_CONCURRENCY
+        if render_workers > 1:
+            render_pool = ProcessPoolExecutor(
+                max_workers=render_workers,
+                initializer=_init_render_worker,
+                initargs=(logo_png, logo_ratio)
+            )
+            render = _render_table_qrcode
+        else:
+            render_pool = _InlineExecutor(logo_png, logo_ratio)
+            render = render_pool.renderer.render
+        upload_pool = ThreadPoolExecutor(max_workers=upload_concurrency, thread_name_prefix="qrcode-upload")
+        # 在线程池之外先创建 S3 客户端，避免各上传线程重复初始化
+        self.storage.warm_up()
+
+        pending_updates = []
+        done = 0
+        try:
+            renders = {
+                render_pool.submit(
+                    render, table_id, content, foreground_color, background_color
+                ): table_id
+                for table_id, content in contents.items()
+            }
+            uploads = {}
+            while renders or uploads:
+                finished, _ = wait(list(renders) + list(uploads), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    if future in renders:
+                        table_id = renders.pop(future)
+                        try:
+                            _, png_bytes = future.result()
+                        except Exception as e:
+                            done += 1
+                            yield self._failed_result(table_id, store_id, table_numbers, f"渲染失败: {str(e)}")
+                            if progress_callback:
+                                progress_callback(done, total)
+                            continue
+                        uploads[upload_pool.submit(
+                            self._upload_table_qrcode,
+                            png_bytes, store_id, table_id, foreground_color, background_color
+                        )] = table_id
+                        continue
+
+                    table_id = uploads.pop(future)
+                    done += 1
+                    try:
+                        qrcode_url = future.result()
+                    except Exception as e:
+                        yield self._failed_result(table_id, store_id, table_numbers, f"上传失败: {str(e)}")
+                    else:
+                        pending_updates.append({
+                            "id": table_id,
+                            "qrcode_url": qrcode_url,
+                            "qrcode_content": contents[table_id]
+                        })
+                        if len(pending_updates) >= _DB_UPDATE_BATCH:
+                            self._save_table_qrcodes(pending_updates)
+                            pending_updates = []
+                        yield {
+                            "success": True,
+                            "qrcode_url": qrcode_url,
+                            "qrcode_content": contents[table_id],
+                            "table_id": table_id,
+                            "store_id": store_id,
+                            "table_number": table_numbers[table_id]
+                        }
+                    if progress_callback:
+                        progress_callback(done, total)
+        finally:
+            # 提前停止迭代时同样回写已上传的桌码
+            render_pool.shutdown(wait=False, cancel_futures=True)
+            upload_pool.shutdown(wait=True, cancel_futures=True)
+            if pending_updates:
+                self._save_table_qrcodes(pending_updates)
+
+    @staticmethod
+    def _failed_result(table_id: int, store_id: int, table_numbers: Dict[int, str], error: str) -> dict:
+        return {
+            "success": False,
+            "error": error,
+            "table_id": table_id,
+            "store_id": store_id,
+            "table_number": table_numbers[table_id]
+        }
+
+    @staticmethod
+    def _save_table_qrcodes(rows: list):
+        """按主键批量回写桌码URL和内容（一条 executemany UPDATE）"""
+        db = get_session()
+        try:
+            db.execute(update(Tables), rows)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
         finally:
             db.close()
+
+    def generate_qrcodes_for_store(
+        self,
+        store_id: int,
+        base_url: str = "https://order.example.com",
+        foreground_color: str = "black",
+        background_color: str = "white",
+        logo_data: Optional[bytes] = None,
+        logo_ratio: float = 0.2,
+        progress_callback: Optional[Callable[[int, int], None]] = None
+    ) -> list:
+        """
+        为指定店铺的所有桌号生成二维码（iter_qrcodes_for_store 的列表形式）
+
+        Args:
+            store_id: 店铺ID
+            base_url: 点餐页面的基础URL
+            foreground_color: 二维码前景色（支持十六进制颜色或颜色名称）
+            background_color: 二维码背景色（支持十六进制颜色或颜色名称）
+            logo_data: logo图片的字节数据（可选）
+            logo_ratio: logo占二维码大小的比例（默认20%）
+            progress_callback: 进度回调 (已完成数, 总数)
+
+        Returns:
+            list: 所有桌号的二维码信息列表（按桌号ID排序，失败的桌号 success 为 False）
+        """
+        results = list(self.iter_qrcodes_for_store(
+            store_id,
+            base_url,
+            foreground_color,
+            background_color,
+            logo_data,
+            logo_ratio,
+            progress_callback=progress_callback
+        ))
+        return sorted(results, key=lambda r: r["table_id"])
     
     def get_qrcode_url_by_table(self, table_id: int) -> Optional[str]:
         """
@@ -5,10 +5,11 @@ from typing import List, Optional
 from sqlalchemy.orm import Session
 from langchain.tools import tool
 from storage.database.db import get_session
-from storage.database.shared.model import Orders, Payments, DailyRevenue
+from storage.database.shared.model import Payments
+from services.revenue_rollup import rebuild_daily_revenue, load_daily_revenue
 from datetime import datetime, timedelta, date
 import json
-from sqlalchemy import func, and_
+from sqlalchemy import and_
 
 
 @tool
@@ -30,81 +31,21 @@ def calculate_daily_revenue(store_id: int, target_date: Optional[str] = None, ru
         else:
             target_date = date.today()
         
-        # 计算日期范围
-        start_datetime = datetime.combine(target_date, datetime.min.time())
-        end_datetime = datetime.combine(target_date, datetime.max.time())
-        
         db = get_session()
         try:
-            # 查询当日订单
-            orders = db.query(Orders).filter(
-                Orders.store_id == store_id,
-                Orders.created_at >= start_datetime,
-                Orders.created_at <= end_datetime
-            ).all()
-            
-            # 计算基础数据
-            total_orders = len(orders)
-            total_amount = sum(o.total_amount for o in orders)
-            total_discount = sum(o.discount_amount for o in orders)
-            
-            # 查询当日退款
-            refunded_orders = db.query(Orders).filter(
-                Orders.store_id == store_id,
-                Orders.created_at >= start_datetime,
-                Orders.created_at <= end_datetime,
-                Orders.order_status == "cancelled"
-            ).all()
-            total_refund = sum(o.final_amount for o in refunded_orders)
-            
-            # 计算净营收
-            net_revenue = total_amount - total_discount - total_refund
-            
-            # 统计支付方式
-            payment_methods = {}
-            for order in orders:
-                if order.payment_method:
-                    payment_methods[order.payment_method] = payment_methods.get(order.payment_method, 0) + order.final_amount
-            
-            # 统计高峰时段（按小时）
-            peak_hours = {}
-            for order in orders:
-                hour = order.created_at.hour
-                peak_hours[hour] = peak_hours.get(hour, 0) + 1
-            
-            # 查找或创建每日营收记录
-            revenue_record = db.query(DailyRevenue).filter(
-                DailyRevenue.store_id == store_id,
-                func.date(DailyRevenue.date) == target_date
-            ).first()
-            
-            if revenue_record:
-                # 更新记录
-                revenue_record.total_orders = total_orders
-                revenue_record.total_amount = total_amount
-                revenue_record.total_discount = total_discount
-                revenue_record.total_refund = total_refund
-                revenue_record.net_revenue = net_revenue
-                revenue_record.payment_methods = payment_methods
-                revenue_record.peak_hours = peak_hours
-                revenue_record.updated_at = datetime.now()
-            else:
-                # 创建新记录
-                revenue_record = DailyRevenue(
-                    store_id=store_id,
-                    date=start_datetime,
-                    total_orders=total_orders,
-                    total_amount=total_amount,
-                    total_discount=total_discount,
-                    total_refund=total_refund,
-                    net_revenue=net_revenue,
-                    payment_methods=payment_methods,
-                    peak_hours=peak_hours
-                )
-                db.add(revenue_record)
-            
+            # 从订单表重算当日汇总行（与订单事件增量维护的口径一致）
+            rebuild_daily_revenue(db, target_date, target_date, store_id)
             db.commit()
-            db.refresh(revenue_record)
+            
+            rows = load_daily_revenue(db, target_date, target_date, store_id)
+            revenue_record = rows[0] if rows else None
+            total_orders = revenue_record.total_orders if revenue_record else 0
+            total_amount = revenue_record.total_amount if revenue_record else 0.0
+            total_discount = revenue_record.total_discount if revenue_record else 0.0
+            total_refund = revenue_record.total_refund if revenue_record else 0.0
+            net_revenue = revenue_record.net_revenue if revenue_record else 0.0
+            payment_methods = revenue_record.payment_methods if revenue_record else {}
+            peak_hours = revenue_record.peak_hours if revenue_record else {}
             
             return json.dumps({
                 "success": True,
@@ -154,11 +95,7 @@ def get_revenue_trend(store_id: int, days: int = 7, runtime=None) -> str:
         db = get_session()
         try:
             # 查询每日营收记录
-            revenues = db.query(DailyRevenue).filter(
-                DailyRevenue.store_id == store_id,
-                func.date(DailyRevenue.date) >= start_date,
-                func.date(DailyRevenue.date) <= end_date
-            ).order_by(DailyRevenue.date).all()
+            revenues = load_daily_revenue(db, start_date, end_date, store_id)
             
             # 构建返回数据
             trend_data = []
@@ -237,18 +174,10 @@ def compare_revenue(store_id: int, period1_start: str, period1_end: str, period2
         db = get_session()
         try:
             # 查询时期1的营收
-            revenues1 = db.query(DailyRevenue).filter(
-                DailyRevenue.store_id == store_id,
-                func.date(DailyRevenue.date) >= p1_start,
-                func.date(DailyRevenue.date) <= p1_end
-            ).all()
+            revenues1 = load_daily_revenue(db, p1_start, p1_end, store_id)
             
             # 查询时期2的营收
-            revenues2 = db.query(DailyRevenue).filter(
-                DailyRevenue.store_id == store_id,
-                func.date(DailyRevenue.date) >= p2_start,
-                func.date(DailyRevenue.date) <= p2_end
-            ).all()
+            revenues2 = load_daily_revenue(db, p2_start, p2_end, store_id)
             
             # 计算时期1的统计数据
             period1 = {
@@ -316,18 +245,15 @@ def get_peak_hours_analysis(store_id: int, days: int = 30, runtime=None) -> str:
         db = get_session()
         try:
             # 查询每日营收记录
-            revenues = db.query(DailyRevenue).filter(
-                DailyRevenue.store_id == store_id,
-                func.date(DailyRevenue.date) >= start_date,
-                func.date(DailyRevenue.date) <= end_date
-            ).all()
+            revenues = load_daily_revenue(db, start_date, end_date, store_id)
             
             # 统计各时段的订单数
             hour_stats = {}
             for revenue in revenues:
                 if revenue.peak_hours:
+                    # JSON 键是字符串，转成整数小时后再做区间比较
                     for hour, count in revenue.peak_hours.items():
-                        hour_stats[hour] = hour_stats.get(hour, 0) + count
+                        hour_stats[int(hour)] = hour_stats.get(int(hour), 0) + count
             
             # 排序找出高峰时段
             sorted_hours = sorted(hour_stats.items(), key=lambda x: x[1], reverse=True)
@@ -0,0 +1,320 @@
+"""
+非阻塞日志管道
+业务线程只把日志记录放入有界队列（QueueHandler），由后台 QueueListener 线程批量写文件：
+- 每批最多 LOG_BATCH_SIZE 条记录，写完整批后 flush 一次
+- fsync 按组执行：距上次 fsync 超过 LOG_FSYNC_INTERVAL 秒或累计写入超过 LOG_FSYNC_BYTES 字节时才调用
+- 队列满时丢弃新记录并按级别计数，不阻塞请求线程（ERROR 及以上最多等待 LOG_ERROR_PUT_TIMEOUT 秒）
+- ContextFilter 在入队前（业务线程）执行，log_id / run_id 等上下文字段与同步写入时一致
+
+node_log.write_log 的节点日志也走这条管道，带 raw_line 属性的记录按原样写入一行 JSON。
+"""
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+# 日志队列容量（条）
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# 后台线程每批最多处理的记录数
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "256"))
+# 两次 fsync 之间的最长间隔（秒）
+LOG_FSYNC_INTERVAL = float(os.getenv("LOG_FSYNC_INTERVAL", "1.0"))
+# 累计写入多少字节后立即 fsync
+LOG_FSYNC_BYTES = int(os.getenv("LOG_FSYNC_BYTES", str(1024 * 1024)))
+
+# 队列满时 ERROR 及以上级别的记录最多等待的时间（秒）
+LOG_ERROR_PUT_TIMEOUT = float(os.getenv("LOG_ERROR_PUT_TIMEOUT", "0.1"))
+
+# 预先格式化好的日志行（node_log 的 JSON 日志），文件处理器按原样写入
+RAW_LINE_ATTR = "raw_line"
+
+
+class DropCounter:
+    """队列满时丢弃的记录数（按级别）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.total = 0
+        self.by_level: Dict[str, int] = {}
+
+    def incr(self, levelname: str):
+        with self._lock:
+            self.total += 1
+            self.by_level[levelname] = self.by_level.get(levelname, 0) + 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"total": self.total, "by_level": dict(self.by_level)}
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """入队不阻塞的 QueueHandler，队列满时丢弃并计数"""
+
+    def __init__(self, log_queue: queue.Queue, drops: DropCounter):
+        super().__init__(log_queue)
+        self.drops = drops
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 在业务线程合并消息参数、格式化异常，保留原记录的其他字段交给后台线程的格式化器
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            if record.levelno >= logging.ERROR:
+                # 错误日志允许短暂等待，尽量不丢
+                self.queue.put(record, timeout=LOG_ERROR_PUT_TIMEOUT)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            self.drops.incr(record.levelname)
+
+
+class BatchingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    批量写入的滚动文件处理器（只在后台线程中使用）
+
+    emit 只写入文件缓冲区，commit 在一批记录写完后 flush，并按时间/字节预算执行组 fsync。
+    """
+
+    def __init__(self, filename: str, max_bytes: int = 0, backup_count: int = 0,
+                 fsync_interval: float = LOG_FSYNC_INTERVAL, fsync_bytes: int = LOG_FSYNC_BYTES):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        self.fsync_interval = fsync_interval
+        self.fsync_bytes = fsync_bytes
+        self._unsynced_bytes = 0
+        self._last_fsync = time.monotonic()
+        self.written = 0
+        self.fsyncs = 0
+
+    def format(self, record: logging.LogRecord) -> str:
+        raw = getattr(record, RAW_LINE_ATTR, None)
+        if raw is not None:
+            return raw
+        return super().format(record)
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            if self.shouldRollover(record):
+                self._sync()
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            line = self.format(record) + self.terminator
+            self.stream.write(line)
+            self._unsynced_bytes += len(line)
+            self.written += 1
+        except Exception:
+            self.handleError(record)
+
+    def commit(self, force: bool = False):
+        """一批记录写完后调用：flush，并在到达时间/字节预算时 fsync"""
+        if self.stream is None:
+            return
+        try:
+            self.stream.flush()
+            if self._unsynced_bytes and (
+                force
+                or self._unsynced_bytes >= self.fsync_bytes
+                or time.monotonic() - self._last_fsync >= self.fsync_interval
+            ):
+                self._sync()
+        except Exception as e:
+            print(f"Failed to flush log file: {e}", flush=True)
+
+    def _sync(self):
+        if self.stream is None:
+            return
+        self.stream.flush()
+        os.fsync(self.stream.fileno())
+        self._unsynced_bytes = 0
+        self._last_fsync = time.monotonic()
+        self.fsyncs += 1
+
+    def close(self):
+        self.commit(force=True)
+        super().close()
+
+
+class BatchingQueueListener(logging.handlers.QueueListener):
+    """每次取出一批记录交给处理器，批次结束后统一提交文件处理器"""
+
+    def __init__(self, log_queue: queue.Queue, *handlers: logging.Handler,
+                 batch_size: int = LOG_BATCH_SIZE, fsync_interval: float = LOG_FSYNC_INTERVAL):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.batch_size = batch_size
+        self.fsync_interval = fsync_interval
+        self.batches = 0
+
+    def enqueue_sentinel(self):
+        # 队列满时等待后台线程腾出空间，保证哨兵之前的记录都能写完
+        self.queue.put(self._sentinel)
+
+    def _commit(self, force: bool = False):
+        for handler in self.handlers:
+            if isinstance(handler, BatchingFileHandler):
+                handler.commit(force)
+
+    def _monitor(self):
+        q = self.queue
+        has_task_done = hasattr(q, "task_done")
+        while True:
+            try:
+                # 空闲时按 fsync 间隔醒来，保证最后一批数据在预算时间内落盘
+                first = q.get(timeout=self.fsync_interval)
+            except queue.Empty:
+                self._commit()
+                continue
+
+            batch = [first]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = False
+            for record in batch:
+                if record is self._sentinel:
+                    stop = True
+                else:
+                    self.handle(record)
+                if has_task_done:
+                    q.task_done()
+            self.batches += 1
+
+            if stop:
+                self._commit(force=True)
+                return
+            self._commit()
+
+
+class LogPipeline:
+    """QueueHandler + 后台批量写入线程"""
+
+    def __init__(self, handlers: List[logging.Handler], queue_size: int = LOG_QUEUE_SIZE,
+                 batch_size: int = LOG_BATCH_SIZE):
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.drops = DropCounter()
+        self.queue_handler = NonBlockingQueueHandler(self.queue, self.drops)
+        self.handlers = handlers
+        self.listener = BatchingQueueListener(self.queue, *handlers, batch_size=batch_size)
+        self._started = False
+
+    def start(self):
+        if not self._started:
+            self.listener.start()
+            self._started = True
+
+    def stop(self):
+        """写完队列中剩余的记录并关闭处理器"""
+        if self._started:
+            self._started = False
+            self.listener.stop()
+        for handler in self.handlers:
+            handler.close()
+
+    def submit_line(self, line: str, level: int = logging.INFO, message: str = "",
+                    logger_name: str = "node_log"):
+        """提交一行已格式化的日志：文件中写入 line，控制台输出 message"""
+        record = logging.LogRecord(logger_name, level, __file__, 0, message, None, None)
+        setattr(record, RAW_LINE_ATTR, line)
+        self.queue_handler.enqueue(record)
+
+    def stats(self) -> dict:
+        file_handlers = [h for h in self.handlers if isinstance(h, BatchingFileHandler)]
+        return {
+            "queue_depth": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "dropped": self.drops.snapshot(),
+            "batches": self.listener.batches,
+            "written": sum(h.written for h in file_handlers),
+            "fsyncs": sum(h.fsyncs for h in file_handlers),
+        }
+
+
+_pipeline: Optional[LogPipeline] = None
+_pipeline_lock = threading.Lock()
+
+
+def install_pipeline(pipeline: LogPipeline) -> LogPipeline:
+    """替换当前进程的日志管道（旧管道写完剩余记录后关闭）"""
+    global _pipeline
+    with _pipeline_lock:
+        previous, _pipeline = _pipeline, pipeline
+    pipeline.start()
+    if previous is not None:
+        previous.stop()
+    return pipeline
+
+
+def get_pipeline() -> Optional[LogPipeline]:
+    return _pipeline
+
+
+def get_or_create_file_pipeline(
+    log_file: str,
+    console_factory: Optional[Callable[[], logging.Handler]] = None,
+) -> LogPipeline:
+    """
+    获取当前日志管道，未配置时创建写 log_file 的管道（setup_logging 之前写节点日志时使用）
+
+    console_factory 只在新建管道时调用，用于同时输出到控制台。
+    """
+    global _pipeline
+    if _pipeline is not None:
+        return _pipeline
+    with _pipeline_lock:
+        if _pipeline is None:
+            handlers: List[logging.Handler] = [BatchingFileHandler(log_file)]
+            if console_factory is not None:
+                handlers.append(console_factory())
+            pipeline = LogPipeline(handlers)
+            pipeline.start()
+            _pipeline = pipeline
+        return _pipeline
+
+
+def shutdown_pipeline():
+    """进程退出时写完队列中的日志"""
+    global _pipeline
+    with _pipeline_lock:
+        pipeline, _pipeline = _pipeline, None
+    if pipeline is not None:
+        pipeline.stop()
+
+
+def get_log_pipeline_stats() -> dict:
+    """日志管道统计：队列深度、丢弃数、批次数、写入条数、fsync 次数"""
+    pipeline = _pipeline
+    if pipeline is None:
+        return {"enabled": False}
+    return {"enabled": True, **pipeline.stats()}
+
+
+__all__ = [
+    "LOG_QUEUE_SIZE",
+    "LOG_BATCH_SIZE",
+    "LOG_FSYNC_INTERVAL",
+    "LOG_FSYNC_BYTES",
+    "LOG_ERROR_PUT_TIMEOUT",
+    "RAW_LINE_ATTR",
+    "DropCounter",
+    "NonBlockingQueueHandler",
+    "BatchingFileHandler",
+    "BatchingQueueListener",
+    "LogPipeline",
+    "install_pipeline",
+    "get_pipeline",
+    "get_or_create_file_pipeline",
+    "shutdown_pipeline",
+    "get_log_pipeline_stats",
+]
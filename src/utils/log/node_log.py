@@ -19,6 +19,7 @@ import json
 from typing import Dict, Optional, Any
 from pydantic import BaseModel
 from utils.log.parser import LangGraphParser
+from utils.log.log_pipeline import get_or_create_file_pipeline
 import asyncio
 
 
@@ -60,9 +61,16 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
+def _console_handler() -> logging.Handler:
+    """未调用 setup_logging 时，节点日志管道的控制台输出"""
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    return handler
+
+
 def write_log(log_entry):
     """
-    直接使用文件操作写入JSON格式日志，确保立即刷新到磁盘
+    写入JSON格式日志：只在当前线程序列化并放入日志队列，由后台线程批量写文件和组 fsync
     :param log_entry: 符合要求格式的日志字典
     """
     try:
@@ -70,36 +78,15 @@ def write_log(log_entry):
             #  线上不打日志，待具备清理能后再打
             return None
         log_json = json.dumps(log_entry, ensure_ascii=False)
+        level = getattr(logging, str(log_entry.get('level', 'info')).upper(), logging.INFO)
 
-        # 修改为行缓冲模式（buffering=1）而不是无缓冲模式
-        with open(LOG_FILE, 'a', encoding='utf-8', buffering=1) as f:  # 行缓冲模式
-            f.write(log_json + '\n')
-            # 显式调用flush和fsync确保数据写入磁盘
-            f.flush()
-            os.fsync(f.fileno())
-
-        # 同时输出到控制台以便调试
-        level = log_entry.get('level', 'info').lower()
-        log_method = getattr(logger, level, logger.info)
-        log_method(log_entry.get('message', ''))
+        # 文件中写入完整 JSON，控制台只输出 message；队列满时丢弃并计数，不阻塞节点执行
+        pipeline = get_or_create_file_pipeline(LOG_FILE, _console_handler)
+        pipeline.submit_line(log_json, level, log_entry.get('message', ''), logger_name=__name__)
 
     except Exception as e:
         # 如果写入失败，打印到标准错误
         print(f"Failed to write log: {e}", flush=True)
-        # 尝试再次写入作为备选
-        try:
-            log_json = json.dumps(log_entry, ensure_ascii=False)
-            print(f"Attempting fallback write: {log_json}", flush=True)
-            # 修改备选方案为行缓冲模式
-            f = open(LOG_FILE, 'a', encoding='utf-8', buffering=1)
-            try:
-                f.write(log_json + '\n')
-                f.flush()
-                os.fsync(f.fileno())
-            finally:
-                f.close()
-        except Exception as fallback_e:
-            print(f"Fallback log write failed: {fallback_e}", flush=True)
 
 
 def create_log_entry(level="info", message="", timestamp=None, log_id=None, latency=0,
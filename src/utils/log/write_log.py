@@ -1,3 +1,4 @@
+import atexit
 import logging
 import logging.handlers
 import json
@@ -13,6 +14,13 @@ except ImportError:
     from utils.context_shim import Context
 
 from utils.log.config import LOG_DIR
+from utils.log.log_pipeline import (
+    RAW_LINE_ATTR,
+    BatchingFileHandler,
+    LogPipeline,
+    install_pipeline,
+    shutdown_pipeline,
+)
 
 request_context: ContextVar[Optional[Context]] = ContextVar('request_context', default=None)
 
@@ -70,6 +78,9 @@ class JsonFormatter(logging.Formatter):
 
         if record.exc_info:
             log_data['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            # 经日志队列传递的记录在入队时已格式化异常
+            log_data['exc_info'] = record.exc_text
         
         for key, value in record.__dict__.items():
             if key not in ['name', 'msg', 'args', 'created', 'filename', 'funcName', 
@@ -79,7 +90,7 @@ class JsonFormatter(logging.Formatter):
                           'log_id', 'run_id', 'space_id', 'project_id', 'method',
                           'x_tt_env', 'rpc_persist_rec_rec_biz_scene', 
                           'rpc_persist_coze_record_root_id', 'rpc_persist_rec_root_entity_type',
-                          'rpc_persist_rec_root_entity_id']:
+                          'rpc_persist_rec_root_entity_id', RAW_LINE_ATTR]:
                 log_data[key] = value
         
         return json.dumps(log_data, ensure_ascii=False)
@@ -105,6 +116,9 @@ class PlainTextFormatter(logging.Formatter):
         
         if record.exc_info:
             log_data['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            # 经日志队列传递的记录在入队时已格式化异常
+            log_data['exc_info'] = record.exc_text
         
         for key, value in record.__dict__.items():
             if key not in ['name', 'msg', 'args', 'created', 'filename', 'funcName', 
@@ -114,12 +128,15 @@ class PlainTextFormatter(logging.Formatter):
                           'log_id', 'run_id', 'space_id', 'project_id', 'method',
                           'x_tt_env', 'rpc_persist_rec_rec_biz_scene', 
                           'rpc_persist_coze_record_root_id', 'rpc_persist_rec_root_entity_type',
-                          'rpc_persist_rec_root_entity_id']:
+                          'rpc_persist_rec_root_entity_id', RAW_LINE_ATTR]:
                 log_data[key] = value
         
         return json.dumps(log_data, ensure_ascii=False)
 
 
+_atexit_registered = False
+
+
 def setup_logging(
     log_file: Optional[str] = None,
     max_bytes: int = 100 * 1024 * 1024,
@@ -148,11 +165,11 @@ def setup_logging(
     context_filter = ContextFilter()
     apscheduler_filter = APSchedulerFilter()
     
-    file_handler = logging.handlers.RotatingFileHandler(
+    # 文件和控制台处理器在后台线程中批量执行，业务线程只负责入队
+    file_handler = BatchingFileHandler(
         filename=log_file,
-        maxBytes=max_bytes,
-        backupCount=backup_count,
-        encoding='utf-8'
+        max_bytes=max_bytes,
+        backup_count=backup_count
     )
     file_handler.setLevel(getattr(logging, log_level.upper(), logging.INFO))
     
@@ -165,9 +182,7 @@ def setup_logging(
         )
     
     file_handler.setFormatter(file_formatter)
-    file_handler.addFilter(context_filter)
-    file_handler.addFilter(apscheduler_filter)
-    root_logger.addHandler(file_handler)
+    handlers = [file_handler]
     
     if console_output:
         console_handler = logging.StreamHandler()
@@ -178,9 +193,19 @@ def setup_logging(
             datefmt='%Y-%m-%d %H:%M:%S'
         )
         console_handler.setFormatter(console_formatter)
-        console_handler.addFilter(context_filter)
-        console_handler.addFilter(apscheduler_filter)
-        root_logger.addHandler(console_handler)
+        handlers.append(console_handler)
+    
+    pipeline = LogPipeline(handlers)
+    # 上下文字段来自 ContextVar，必须在业务线程入队前填充
+    pipeline.queue_handler.addFilter(context_filter)
+    pipeline.queue_handler.addFilter(apscheduler_filter)
+    root_logger.addHandler(pipeline.queue_handler)
+    install_pipeline(pipeline)
+    
+    global _atexit_registered
+    if not _atexit_registered:
+        atexit.register(shutdown_pipeline)
+        _atexit_registered = True
     
     logging.info(f"Logging configured: file={log_file}, max_bytes={max_bytes}, backup_count={backup_count}")
     